@@ -75,7 +75,7 @@ setup(
         package_data={"pep_tk": extra_files},
         include_package_data=True,
         entry_points={
-          'console_scripts': ['pep_gui=pep_tk:launch.main'],
+          'console_scripts': ['pep_gui=pep_tk:launch.main', 'pep_tk=pep_tk:cli.main'],
         },
         python_requires='>=3.8',
         test_suite="setup.test_suit",
@@ -0,0 +1,331 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+
+from pep_tk.core.daemon import DaemonException, HeadlessManager, JobDaemon, daemon_request
+from pep_tk.core.detection_index import RESULT_COLUMNS, expand_job_dirs, image_detection_counts, query_detections, \
+    summarize_detections, update_job_index
+from pep_tk.core.job import JobMeta, TaskKey, TaskStatus, load_job, pipeline_meta_json_fp
+from pep_tk.core.detection_stats import DetectionStats
+from pep_tk.core.job_lock import JobLock, JobLockedException, break_job_lock, read_job_lock, running_detections, \
+    running_progress, watch_job
+from pep_tk.core.leases import DEFAULT_LEASE_TIMEOUT, LeaseManager, SharedStateLock
+from pep_tk.core.pipeline_deps import build_dependency_graph
+from pep_tk.core.scheduler import Scheduler
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='pep_tk', description='PEP-TK command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    index = commands.add_parser('index', help='index the detections of completed tasks')
+    index.add_argument('jobs', nargs='+', help='job directories, or job base directories to index every job in')
+    index.add_argument('--rebuild', action='store_true', help='index every task again')
+
+    query = commands.add_parser('query', help='query the detections of one or more jobs')
+    query.add_argument('jobs', nargs='+', help='job directories, or job base directories to query every job in')
+    query.add_argument('--dataset', action='append', help='only this dataset, may be repeated')
+    query.add_argument('--class', dest='classes', action='append', help='only this class, may be repeated')
+    query.add_argument('--image', action='append', help='only detections on this image file name, may be repeated')
+    query.add_argument('--output', action='append', dest='outputs',
+                       help='only this detection output, e.g. output_thermal_detections, may be repeated')
+    query.add_argument('--min-confidence', type=float)
+    query.add_argument('--max-confidence', type=float)
+    query.add_argument('--group-by', nargs='+', metavar='COLUMN', choices=RESULT_COLUMNS,
+                       help='count the detections per group instead of listing them, e.g. --group-by dataset class')
+    query.add_argument('--image-counts', action='store_true',
+                       help='number of detections of every image, including images without detections')
+    query.add_argument('--csv', metavar='FILE', help='write the result to a csv file instead of printing it')
+
+    deps = commands.add_parser('deps', help='list the files a pipeline depends on and check that they exist')
+    deps.add_argument('pipeline', help='a pipe file, or a job directory to check the pipeline of')
+    deps.add_argument('--hash', action='store_true', help='hash the content of every dependency')
+    deps.add_argument('--json', action='store_true', help='print the dependency graph as json')
+
+    run = commands.add_parser('run', help='run a job without the gui')
+    run.add_argument('job', help='job directory')
+    run.add_argument('--viame-dir', help='VIAME install directory (containing setup_viame.sh)')
+    run.add_argument('--max-tasks', type=int, default=1, help='kwiver tasks running at the same time')
+    run.add_argument('--checkpoint-resume', action='store_true',
+                     help='resume partially processed tasks from their checkpoints')
+    run.add_argument('--distributed', action='store_true',
+                     help='run the job together with other nodes sharing the job directory, each task is claimed '
+                          'with a lease')
+    run.add_argument('--lease-timeout', type=float, default=DEFAULT_LEASE_TIMEOUT,
+                     help='seconds without a heartbeat after which the task of a node is reclaimed')
+
+    watch = commands.add_parser('watch', help='follow the progress of a job another process is running, read only')
+    watch.add_argument('job', help='job directory')
+
+    lock = commands.add_parser('lock', help='show which process is running a job')
+    lock.add_argument('job', help='job directory')
+    lock.add_argument('--break', dest='break_lock', action='store_true',
+                      help='remove the lock of a process that is no longer running the job')
+    lock.add_argument('--force', action='store_true', help='with --break, remove the lock even if it is not stale')
+
+    daemon = commands.add_parser('daemon', help='run the job queue daemon')
+    daemon.add_argument('--socket', help='unix socket to listen on, default $PEP_TK_DAEMON_SOCKET or '
+                                         '~/.pep_tk/daemon.sock')
+    daemon.add_argument('--queue', help='file to keep the queue in, default queue.json next to the socket')
+    daemon.add_argument('--viame-dir', help='VIAME install directory (containing setup_viame.sh)')
+    daemon.add_argument('--max-jobs', type=int, default=1, help='jobs running at the same time')
+    daemon.add_argument('--max-tasks', type=int, help='kwiver tasks running at the same time across every job')
+    daemon.add_argument('--max-tasks-per-job', type=int, default=1, help='kwiver tasks of one job running at once')
+    daemon.add_argument('--checkpoint-resume', action='store_true',
+                        help='resume partially processed tasks from their checkpoints')
+    for command, help_text in [('submit', 'add a job to the daemon\'s queue'),
+                               ('pause', 'stop a running or queued job until it is resumed'),
+                               ('resume', 'queue a paused, cancelled or failed job again'),
+                               ('cancel', 'stop a running or queued job'),
+                               ('status', 'status of the queued jobs, or of one job')]:
+        client = commands.add_parser(command, help=help_text)
+        client.add_argument('job', nargs='?' if command == 'status' else None, help='job directory')
+        client.add_argument('--socket', help='socket of the daemon')
+    shutdown = commands.add_parser('shutdown', help='stop the daemon, running jobs continue when it is restarted')
+    shutdown.add_argument('--socket', help='socket of the daemon')
+    return parser.parse_args(argv)
+
+
+def dependencies(args):
+    pipeline_fp = args.pipeline
+    if os.path.isdir(pipeline_fp):
+        if not os.path.isfile(pipeline_meta_json_fp(pipeline_fp)):
+            print(f'{args.pipeline} is not a job directory', file=sys.stderr)
+            return 1
+        pipeline_fp = JobMeta(pipeline_fp).pipeline_path
+    if not os.path.isfile(pipeline_fp):
+        print(f'Pipeline {pipeline_fp} does not exist', file=sys.stderr)
+        return 1
+    graph = build_dependency_graph(pipeline_fp, hash_contents=args.hash)
+    if args.json:
+        print(json.dumps(graph.to_dict(), indent=2))
+    else:
+        for dep in graph.dependencies:
+            status = (dep.digest or f'{dep.size} bytes') if dep.exists else 'MISSING'
+            print(f'{dep.kind:<12} {dep.key:<24} {dep.path}  {status}')
+    missing = graph.missing()
+    for dep in missing:
+        print(f'Missing {dep.kind} {dep.key} of {dep.referenced_by}: {dep.path}', file=sys.stderr)
+    return 1 if missing else 0
+
+
+def kwiver_setup_path(viame_dir):
+    if not viame_dir:
+        return None
+    return os.path.join(viame_dir, 'setup_viame.bat' if os.name == 'nt' else 'setup_viame.sh')
+
+
+def run_job(args):
+    manager = HeadlessManager()
+    kill_event = threading.Event()
+    leases = None
+    lock = None
+    if args.distributed:
+        # the nodes share the job, but not with a gui or daemon running it on its own
+        holder = read_job_lock(args.job)
+        if holder is not None and not holder.is_stale():
+            print(f'The job is already running: {holder.describe()}', file=sys.stderr)
+            return 1
+        # the failed tasks and checkpoints of the other nodes are kept, the tasks of a node that stopped are run again
+        # once their leases expire
+        with SharedStateLock(args.job):
+            job_state, job_meta = load_job(args.job, reset_incomplete=False)
+        leases = LeaseManager(args.job, lease_timeout=args.lease_timeout)
+        print(f'Running {args.job} as node {leases.node}')
+    else:
+        job_state = None  # the heartbeat starts before the job is loaded
+
+        def lock_lost():
+            # another process took over the job, stop without saving over its changes
+            if job_state is not None:
+                job_state.stop_saving()
+            kill_event.set()
+
+        lock = JobLock(args.job, owner='run', progress=lambda: running_progress(manager), on_lost=lock_lost,
+                       detections=lambda: running_detections(manager))
+        try:
+            lock.acquire()
+        except JobLockedException as e:
+            print(f'{e}\nUse `pep_tk watch {args.job}` to follow its progress.', file=sys.stderr)
+            return 1
+        job_state, job_meta = load_job(args.job)
+        if lock.lost:  # lost while loading
+            job_state.stop_saving()
+    scheduler = Scheduler(job_state, job_meta, manager, kwiver_setup_path=kwiver_setup_path(args.viame_dir),
+                          kill_event=kill_event, max_concurrent_tasks=args.max_tasks,
+                          checkpoint_resume=args.checkpoint_resume, leases=leases)
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: kill_event.set())
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(timeout=1)
+    except KeyboardInterrupt:
+        kill_event.set()
+        thread.join()
+    finally:
+        if lock is not None:
+            lock.release()
+    if kill_event.is_set():
+        return 1
+    if leases is not None:
+        job_state.reload()  # the tasks other nodes ran
+    tasks = job_state.tasks()
+    succeeded = job_state.tasks(status=TaskStatus.SUCCESS)
+    print(f'{len(succeeded)}/{len(tasks)} tasks succeeded')
+    return 0 if len(succeeded) == len(tasks) else 1
+
+
+class WatchManager(HeadlessManager):
+    """ Prints the task status changes, progress and detections of a watched job """
+    def _start_task(self, task_key: TaskKey):
+        print(f'{task_key}: running')
+
+    def _end_task(self, task_key: TaskKey, status: TaskStatus):
+        print(f'{task_key}: {status.name.lower()}')
+
+    def _update_task_progress(self, task_key: TaskKey, current_count: int, max_count: int):
+        print(f'{task_key}: {current_count}/{max_count} images')
+
+    def _update_task_detections(self, task_key: TaskKey, stats: DetectionStats):
+        print(f'{task_key}: {stats.summary()}')
+
+
+def watch(args):
+    holder = read_job_lock(args.job)
+    if holder is None or holder.is_stale():
+        print(f'{args.job} is not running', file=sys.stderr)
+        return 1
+    print(f'{args.job} is run by {holder.describe()}')
+    job_state, job_meta = load_job(args.job, read_only=True)
+    try:
+        watch_job(job_state, job_meta, WatchManager(), threading.Event())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def job_lock(args):
+    holder = read_job_lock(args.job)
+    if holder is None:
+        print(f'{args.job} is not locked')
+        return 0
+    stale = holder.is_stale()
+    print(f'{args.job} is locked by {holder.describe()}{" (stale)" if stale else ""}')
+    for task_key, count in sorted(holder.progress.items()):
+        detections = holder.detections.get(task_key)
+        summary = f', {DetectionStats.from_dict(detections).summary()}' if detections else ''
+        print(f'  {task_key}: {count} images{summary}')
+    if not args.break_lock:
+        return 0
+    if not stale and not args.force:
+        print('The lock is not stale, use --force to remove it anyway', file=sys.stderr)
+        return 1
+    if not break_job_lock(args.job, holder):
+        print('The lock changed while removing it, it was not removed', file=sys.stderr)
+        return 1
+    print('Lock removed')
+    return 0
+
+
+def run_daemon(args):
+    try:
+        JobDaemon(socket_path=args.socket, queue_fp=args.queue, max_jobs=args.max_jobs, max_tasks=args.max_tasks,
+                  kwiver_setup_path=kwiver_setup_path(args.viame_dir), max_concurrent_tasks=args.max_tasks_per_job,
+                  checkpoint_resume=args.checkpoint_resume).serve_forever()
+    except DaemonException as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+def format_queue_entry(entry) -> str:
+    s = f'{entry["status"]:<10} {entry["job"]}'
+    progress = entry.get('progress')
+    if progress:
+        tasks = ', '.join(f'{n} {status}' for status, n in sorted(progress['tasks'].items()))
+        s += f'  ({tasks}; {progress["images"]}/{progress["max_images"]} images'
+        detections = progress.get('detections')
+        if detections:
+            s += f'; {sum(d["detections"] for d in detections.values())} detections'
+        s += ')'
+        for task_key, d in sorted((detections or {}).items()):
+            s += f'\n    {task_key}: {DetectionStats.from_dict(d).summary()}'
+    if entry.get('message'):
+        s += f'  {entry["message"]}'
+    return s
+
+
+def daemon_client(args):
+    try:
+        response = daemon_request(args.command, job=getattr(args, 'job', None), socket_path=args.socket)
+    except DaemonException as e:
+        print(e, file=sys.stderr)
+        return 1
+    for entry in response.get('jobs', [response['job']] if 'job' in response else []):
+        print(format_queue_entry(entry))
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'deps':
+        return dependencies(args)
+    if args.command == 'run':
+        return run_job(args)
+    if args.command == 'lock':
+        return job_lock(args)
+    if args.command == 'watch':
+        return watch(args)
+    if args.command == 'daemon':
+        return run_daemon(args)
+    if args.command in ('submit', 'pause', 'resume', 'cancel', 'status', 'shutdown'):
+        return daemon_client(args)
+
+    job_dirs = expand_job_dirs(args.jobs)
+    if not job_dirs:
+        print(f'No jobs found in {", ".join(args.jobs)}', file=sys.stderr)
+        return 1
+
+    if args.command == 'index':
+        for job_dir in job_dirs:
+            indexed = update_job_index(job_dir, rebuild=args.rebuild)
+            print(f'{job_dir}: indexed {len(indexed)} task(s)')
+        return 0
+
+    if args.image_counts:
+        result = image_detection_counts(job_dirs, datasets=args.dataset, outputs=args.outputs)
+    else:
+        result = query_detections(job_dirs, datasets=args.dataset, classes=args.classes,
+                                  min_confidence=args.min_confidence, max_confidence=args.max_confidence,
+                                  images=args.image, outputs=args.outputs)
+        if args.group_by:
+            result = summarize_detections(result, by=args.group_by)
+    if args.csv:
+        result.to_csv(args.csv, index=False)
+    else:
+        print(result.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
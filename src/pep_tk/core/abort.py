@@ -0,0 +1,207 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Early-abort rules stop a task whose live outputs show the run is not worth finishing, e.g. a misconfigured pipeline
+that processes every image but never detects anything.  Rules are configured as a list of dictionaries, e.g. in the
+abort_rules gui setting:
+
+    {"rules": [{"type": "no_progress", "seconds": 600},
+               {"type": "output_pattern", "pattern": "Unable to load transform", "scope": "job"},
+               {"type": "no_detections", "images": 500},
+               {"type": "slow_throughput", "fraction": 0.2, "min_seconds": 300}]}
+
+A rule with the task scope (the default) cancels the task it fired on, a rule with the job scope cancels every task of
+the job.
+"""
+
+import abc
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from pep_tk.core.detection_stats import DetectionStats
+
+SCOPES = ('task', 'job')
+
+
+class AbortRuleException(Exception):
+    pass
+
+
+@dataclass
+class TaskObservation:
+    """ What is known about a running task when the abort rules are checked """
+    elapsed: float  # seconds since kwiver was started
+    images: int  # images processed by this run of the task
+    images_per_sec: Optional[float] = None  # throughput since the first image, None before the first image
+    seconds_since_first_image: float = 0.
+    expected_images_per_sec: Optional[float] = None  # historical throughput of the pipeline, see PerformanceHistory
+    detections: Optional[DetectionStats] = None  # statistics of this run's detections
+
+
+@dataclass
+class AbortDecision:
+    rule: str  # type of the rule that fired
+    reason: str
+    scope: str = 'task'
+
+    def to_dict(self) -> Dict:
+        return {'rule': self.rule, 'reason': self.reason, 'scope': self.scope}
+
+
+class AbortRule(metaclass=abc.ABCMeta):
+    type_name = ''
+
+    def __init__(self, scope: str = 'task'):
+        if scope not in SCOPES:
+            raise AbortRuleException(f'Abort rule scope must be one of {", ".join(SCOPES)}, not {scope}.')
+        self.scope = scope
+
+    def check(self, observation: TaskObservation) -> Optional[str]:
+        """ :return: the reason to abort the task, or None """
+        return None
+
+    def check_output(self, line: str) -> Optional[str]:
+        """ :return: the reason to abort the task because of a line of kwiver output, or None """
+        return None
+
+    def _params(self) -> Dict:
+        return {}
+
+    def to_dict(self) -> Dict:
+        return {'type': self.type_name, 'scope': self.scope, **self._params()}
+
+
+class NoProgressRule(AbortRule):
+    """ No image processed within the given seconds of starting kwiver """
+    type_name = 'no_progress'
+
+    def __init__(self, seconds: float, scope: str = 'task'):
+        super().__init__(scope)
+        self.seconds = float(seconds)
+
+    def check(self, observation: TaskObservation) -> Optional[str]:
+        if observation.images == 0 and observation.elapsed > self.seconds:
+            return f'no images processed {observation.elapsed:.0f} seconds after starting'
+        return None
+
+    def _params(self) -> Dict:
+        return {'seconds': self.seconds}
+
+
+class OutputPatternRule(AbortRule):
+    """ A line of kwiver's output matches a regular expression """
+    type_name = 'output_pattern'
+
+    def __init__(self, pattern: str, scope: str = 'task'):
+        super().__init__(scope)
+        try:
+            self.regex = re.compile(pattern)
+        except re.error as e:
+            raise AbortRuleException(f'Invalid abort rule pattern {pattern}: {e}')
+
+    def check_output(self, line: str) -> Optional[str]:
+        if self.regex.search(line):
+            return f'output matched "{self.regex.pattern}": {line.strip()}'
+        return None
+
+    def _params(self) -> Dict:
+        return {'pattern': self.regex.pattern}
+
+
+class NoDetectionsRule(AbortRule):
+    """ No detections after processing the given number of images """
+    type_name = 'no_detections'
+
+    def __init__(self, images: int, scope: str = 'task'):
+        super().__init__(scope)
+        self.images = int(images)
+
+    def check(self, observation: TaskObservation) -> Optional[str]:
+        stats = observation.detections
+        if stats is not None and stats.detections == 0 and stats.images >= self.images:
+            return f'no detections after {stats.images} images'
+        return None
+
+    def _params(self) -> Dict:
+        return {'images': self.images}
+
+
+class SlowThroughputRule(AbortRule):
+    """ Images/sec below a fraction of the pipeline's historical rate, once the task has run min_seconds """
+    type_name = 'slow_throughput'
+
+    def __init__(self, fraction: float = 0.25, min_seconds: float = 300, scope: str = 'task'):
+        super().__init__(scope)
+        self.fraction = float(fraction)
+        self.min_seconds = float(min_seconds)
+
+    def check(self, observation: TaskObservation) -> Optional[str]:
+        expected = observation.expected_images_per_sec
+        if not expected or observation.images_per_sec is None or \
+                observation.seconds_since_first_image < self.min_seconds:
+            return None
+        if observation.images_per_sec < self.fraction * expected:
+            return f'{observation.images_per_sec:.2f} images/sec is below {self.fraction:g} of the historical ' \
+                   f'{expected:.2f} images/sec'
+        return None
+
+    def _params(self) -> Dict:
+        return {'fraction': self.fraction, 'min_seconds': self.min_seconds}
+
+
+RULE_TYPES = {rule.type_name: rule for rule in [NoProgressRule, OutputPatternRule, NoDetectionsRule,
+                                                 SlowThroughputRule]}
+
+
+class AbortPolicy:
+    """ The early-abort rules checked while a task is running, the first rule to fire aborts the task """
+    def __init__(self, rules: Optional[List[AbortRule]] = None):
+        self.rules = list(rules or [])
+
+    def check(self, observation: TaskObservation) -> Optional[AbortDecision]:
+        for rule in self.rules:
+            reason = rule.check(observation)
+            if reason is not None:
+                return AbortDecision(rule.type_name, reason, rule.scope)
+        return None
+
+    def check_output(self, line: str) -> Optional[AbortDecision]:
+        for rule in self.rules:
+            reason = rule.check_output(line)
+            if reason is not None:
+                return AbortDecision(rule.type_name, reason, rule.scope)
+        return None
+
+    def to_dict(self) -> Dict:
+        return {'rules': [rule.to_dict() for rule in self.rules]}
+
+    @classmethod
+    def from_dict(cls, d: Optional[Dict]) -> 'AbortPolicy':
+        """ Create a policy from a configuration dictionary (e.g. the gui settings file), see the module docstring """
+        rules = []
+        for rule in (d or {}).get('rules', []):
+            rule = dict(rule)
+            rule_type = rule.pop('type', None)
+            if rule_type not in RULE_TYPES:
+                raise AbortRuleException(f'Unknown abort rule type {rule_type}, expected one of '
+                                         f'{", ".join(RULE_TYPES)}.')
+            try:
+                rules.append(RULE_TYPES[rule_type](**rule))
+            except TypeError as e:
+                raise AbortRuleException(f'Invalid {rule_type} abort rule: {e}')
+        return cls(rules)
@@ -0,0 +1,147 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from pep_tk.core.history import PerformanceHistory, parameter_hash
+from pep_tk.core.job import JobMeta, TaskKey
+from pep_tk.core.resources import PROC_DIR, format_bytes
+
+MB = 1024 * 1024
+
+
+def read_available_memory() -> Optional[int]:
+    """ :return: MemAvailable from /proc/meminfo in bytes, or None if it can't be read """
+    try:
+        with open(os.path.join(PROC_DIR, 'meminfo'), 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    # MemAvailable:   12345678 kB
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, PermissionError, ValueError, IndexError):
+        pass
+    return None
+
+
+@dataclass
+class AdmissionDecision:
+    task_key: TaskKey
+    admitted: bool
+    reason: str
+    required_memory: Optional[int] = None  # predicted peak rss of the task
+    available_memory: Optional[int] = None  # MemAvailable when the decision was made
+    reserved_memory: int = 0  # memory the running tasks are still expected to use
+
+    def to_log_line(self) -> str:
+        def fmt(n):
+            return format_bytes(n) if n is not None else 'unknown'
+        return f'{time.strftime("%Y-%m-%d %H:%M:%S")} {"ADMIT" if self.admitted else "DEFER"} {self.task_key} ' \
+               f'required={fmt(self.required_memory)} available={fmt(self.available_memory)} ' \
+               f'reserved={fmt(self.reserved_memory)} reason="{self.reason}"'
+
+
+class AdmissionController:
+    """
+    Decides if the scheduler may start another task while other tasks are running.  A task is admitted when the
+    available system memory, minus the memory the running tasks have not allocated yet and a reserve, can hold the
+    task's predicted peak memory.
+
+    The predicted peak memory of a task is (in order of preference) the peak observed on a previous attempt of the task,
+    the peak memory of the pipeline in the performance history, or `default_task_memory`.  When nothing is running the
+    task is always admitted so a job can't stall.
+    """
+    def __init__(self,
+                 history: Optional[PerformanceHistory] = None,
+                 memory_reserve: int = 512 * MB,
+                 default_task_memory: Optional[int] = None,
+                 log_fp: Optional[str] = None,
+                 available_memory_fn: Callable[[], Optional[int]] = read_available_memory):
+        """
+        :param history: performance history to predict peak memory from
+        :param memory_reserve: memory in bytes to always leave available for the system and the gui
+        :param default_task_memory: peak memory in bytes assumed for a task with no observations, if None tasks with
+        no observations are admitted as long as the reserve is available
+        :param log_fp: file to append admission decisions to
+        :param available_memory_fn: returns the available system memory in bytes
+        """
+        self.history = history
+        self.memory_reserve = memory_reserve
+        self.default_task_memory = default_task_memory
+        self.log_fp = log_fp
+        self.available_memory_fn = available_memory_fn
+        self._last_decision: Dict[TaskKey, bool] = {}
+        self._lock = threading.Lock()
+
+    def predict_task_memory(self, task_key: TaskKey, job_meta: JobMeta) -> Optional[int]:
+        observed = job_meta.get_task_resources(task_key)
+        if observed and observed.get('peak_rss'):
+            return int(observed['peak_rss'])
+        if self.history is not None and job_meta.pipeline_name:
+            predicted = self.history.predict_peak_memory(job_meta.pipeline_name,
+                                                         parameter_hash(job_meta.pipeline_parameters()))
+            if predicted:
+                return int(predicted)
+        return self.default_task_memory
+
+    def admit(self, task_key: TaskKey, job_meta: JobMeta, running: Dict[TaskKey, int]) -> AdmissionDecision:
+        """
+        Decide if a task can be started now.
+
+        :param task_key: the task to start
+        :param job_meta: the job meta of the task
+        :param running: for each running task the memory it is still expected to allocate (predicted peak minus
+        its current rss), this memory is still counted as available by the system
+        :return: AdmissionDecision
+        """
+        required = self.predict_task_memory(task_key, job_meta)
+        reserved = sum(max(v, 0) for v in running.values())
+        available = self.available_memory_fn()
+
+        if not running:
+            decision = AdmissionDecision(task_key, True, 'no running tasks', required, available, reserved)
+        elif available is None:
+            decision = AdmissionDecision(task_key, True, 'available memory unknown', required, available, reserved)
+        else:
+            headroom = available - reserved - self.memory_reserve
+            if required is None:
+                admitted = headroom > 0
+                reason = 'no memory prediction, reserve available' if admitted else 'reserve not available'
+            else:
+                admitted = headroom >= required
+                reason = 'enough headroom' if admitted else \
+                    f'insufficient headroom ({format_bytes(max(headroom, 0))})'
+            decision = AdmissionDecision(task_key, admitted, reason, required, available, reserved)
+
+        self._log(decision)
+        return decision
+
+    def _log(self, decision: AdmissionDecision):
+        # a deferred task is re-evaluated every scheduler poll, only log when the decision changes
+        with self._lock:
+            if self._last_decision.get(decision.task_key) is False and not decision.admitted:
+                return
+            self._last_decision[decision.task_key] = decision.admitted
+        if not self.log_fp:
+            return
+        try:
+            with open(self.log_fp, 'a') as f:
+                f.write(decision.to_log_line() + '\n')
+        except OSError as e:
+            print(f'Warning: unable to write admission log {self.log_fp}: {e}')
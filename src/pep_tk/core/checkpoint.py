@@ -0,0 +1,230 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from pep_tk.core.parser.parser import VIAMEDataset
+
+# dataset attributes holding the image lists a pipeline reads, in the order kwiver processes them
+INPUT_LIST_ATTRIBUTES = ('thermal_image_list', 'color_image_list')
+
+# columns of a VIAME detection csv
+DETECTION_ID_COLUMN = 0
+IMAGE_COLUMN = 1
+FRAME_ID_COLUMN = 2
+
+
+@dataclass
+class TaskCheckpoint:
+    """
+    The outputs of a task that stopped before processing its whole dataset (cancelled, errored or stalled).  The
+    output files are keyed by the environment variable of their output port so they can be matched with the outputs
+    of the run that resumes the task.
+    """
+    images: int  # number of images in every output image list
+    image_lists: Dict[str, str] = field(default_factory=dict)
+    detections: Dict[str, str] = field(default_factory=dict)
+    time: float = field(default_factory=time.time)
+    source: str = 'partial'  # 'partial' for a task that stopped, 'delta' for the outputs of a previous job
+
+    def to_dict(self) -> Dict:
+        return {'images': self.images, 'image_lists': dict(self.image_lists), 'detections': dict(self.detections),
+                'time': self.time, 'source': self.source}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'TaskCheckpoint':
+        return cls(images=int(d['images']), image_lists=dict(d.get('image_lists', {})),
+                   detections=dict(d.get('detections', {})), time=d.get('time', 0.),
+                   source=d.get('source', 'partial'))
+
+    def files_exist(self) -> bool:
+        return all(os.path.isfile(fp) for fp in list(self.image_lists.values()) + list(self.detections.values()))
+
+
+def read_list_lines(fp: str) -> List[str]:
+    """ :return: the non empty lines of an image list, in file order """
+    with open(fp, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def checkpoint_image_count(image_list_fps: List[str]) -> int:
+    """ :return: number of images every output image list has, kwiver appends to each list after each frame """
+    counts = [len(read_list_lines(fp)) if os.path.isfile(fp) else 0 for fp in image_list_fps]
+    return min(counts) if counts else 0
+
+
+def absolute_image_paths(list_fp: str) -> List[str]:
+    # relative paths in an image list are relative to the list, same as pep_tk.core.parser.ImageList
+    base_dir = os.path.dirname(os.path.abspath(list_fp))
+    return [line if os.path.isabs(line) else os.path.normpath(os.path.join(base_dir, line))
+            for line in read_list_lines(list_fp)]
+
+
+def remaining_images(checkpoint: TaskCheckpoint, dataset: VIAMEDataset) -> Optional[Dict[str, List[str]]]:
+    """
+    Find the images of the dataset that are not in the checkpoint.  Images are matched by file name, the same as the
+    image name column of the detection csvs.
+
+    The checkpoint is only used when every image it processed is still in the dataset (the dataset was appended to
+    or is unchanged) and the dataset's image lists all have the same number of processed images.
+
+    :param checkpoint: the checkpoint of the task
+    :param dataset: the dataset of the task
+    :return: dictionary of the dataset's image list path to its images that have not been processed, in list order,
+    or None if the task can't be resumed from the checkpoint
+    """
+    if checkpoint.images < 1 or not checkpoint.files_exist():
+        return None
+
+    done_lists = [set(os.path.basename(p) for p in read_list_lines(fp)[:checkpoint.images])
+                  for fp in checkpoint.image_lists.values()]
+    remaining = {}
+    for attr in INPUT_LIST_ATTRIBUTES:
+        list_fp = dataset.get(attr)
+        if not list_fp or not os.path.isfile(list_fp):
+            continue
+        images = absolute_image_paths(list_fp)
+        names = set(os.path.basename(p) for p in images)
+        # the images of one of the output image lists must all be in this input list
+        done = next((d for d in done_lists if d <= names), None)
+        if done is None:
+            return None
+        remaining[list_fp] = [p for p in images if os.path.basename(p) not in done]
+
+    if not remaining or len(set(len(images) for images in remaining.values())) != 1:
+        return None
+    return remaining
+
+
+def write_remaining_image_lists(checkpoint: TaskCheckpoint, dataset: VIAMEDataset,
+                                output_dir: str) -> Optional[Dict[str, str]]:
+    """
+    Write the images of the dataset that are not in the checkpoint to new image lists, see remaining_images.
+
+    :param checkpoint: the checkpoint of the task
+    :param dataset: the dataset of the task
+    :param output_dir: directory to write the remaining image lists to
+    :return: dictionary of the dataset's image list path to the remaining image list path, or None if the task can't
+    be resumed from the checkpoint
+    """
+    remaining = remaining_images(checkpoint, dataset)
+    if remaining is None:
+        return None
+
+    os.makedirs(output_dir, exist_ok=True)
+    remaining_fps = {}
+    for list_fp, images in remaining.items():
+        remaining_fp = os.path.join(output_dir, f'remaining-{os.path.basename(list_fp)}')
+        with open(remaining_fp, 'w') as f:
+            f.writelines(p + '\n' for p in images)
+        remaining_fps[list_fp] = remaining_fp
+    return remaining_fps
+
+
+def match_output_files(ports: Dict[str, str], files: List[str]) -> Dict[str, str]:
+    """
+    Match output files to the output ports whose file name pattern they were compiled from (see
+    pep_tk.core.kwiver.pipeline_compiler.compile_output_filenames), the newest file wins when several match a port.
+
+    :param ports: output port environment variable to its file name pattern, e.g. 'a_[TIMESTAMP]_ir_images.txt'
+    :param files: output file paths
+    :return: dictionary of output port environment variable to the matching file
+    """
+    matched = {}
+    for env_var, pattern in ports.items():
+        prefix, found, suffix = os.path.basename(pattern).partition('[TIMESTAMP]')
+        if not found:
+            continue
+        candidates = [fp for fp in files if os.path.basename(fp).startswith(prefix) and
+                      os.path.basename(fp).endswith(suffix) and
+                      len(os.path.basename(fp)) > len(prefix) + len(suffix)]
+        if candidates:
+            # the timestamp (%Y%m%d-%H%M%S) sorts chronologically
+            matched[env_var] = max(candidates, key=os.path.basename)
+    return matched
+
+
+def write_resume_pipeline(compiled_fp: str, remaining_lists: Dict[str, str], resume_fp: str):
+    """ Copy the compiled pipeline, reading the remaining image lists instead of the dataset's image lists """
+    with open(compiled_fp, 'r') as f:
+        content = f.read()
+    for list_fp, remaining_fp in remaining_lists.items():
+        content = content.replace(list_fp, remaining_fp)
+    with open(resume_fp, 'w') as f:
+        f.write(content)
+
+
+def stitch_image_list(partial_fp: str, new_fp: str, images: int):
+    """ Prepend the first `images` images of the partial image list to the new image list """
+    lines = read_list_lines(partial_fp)[:images]
+    new_lines = read_list_lines(new_fp) if os.path.isfile(new_fp) else []
+    with open(new_fp, 'w') as f:
+        f.writelines(line + '\n' for line in lines + new_lines)
+
+
+def stitch_detections(partial_fp: str, new_fp: str, images: int):
+    """
+    Prepend the detections of the first `images` frames of the partial detection csv to the new detection csv.  The
+    frame ids of the new detections are offset by `images` and their detection ids continue after the largest id of
+    the partial detections, so ids stay unique and in frame order.  Header lines are taken from the partial csv.
+    """
+    headers, rows = [], []
+    next_id = 0
+    with open(partial_fp, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                headers.append(line)
+                continue
+            cols = line.rstrip('\r\n').split(',')
+            if len(cols) <= FRAME_ID_COLUMN or not line.strip():
+                continue
+            if int(cols[FRAME_ID_COLUMN]) >= images:
+                continue  # written for a frame that never made it into the image list
+            rows.append(line if line.endswith('\n') else line + '\n')
+            next_id = max(next_id, int(cols[DETECTION_ID_COLUMN]) + 1)
+
+    if os.path.isfile(new_fp):
+        with open(new_fp, 'r') as f:
+            for line in f:
+                if line.startswith('#') or not line.strip():
+                    continue
+                cols = line.rstrip('\r\n').split(',')
+                cols[DETECTION_ID_COLUMN] = str(int(cols[DETECTION_ID_COLUMN]) + next_id)
+                cols[FRAME_ID_COLUMN] = str(int(cols[FRAME_ID_COLUMN]) + images)
+                rows.append(','.join(cols) + '\n')
+
+    with open(new_fp, 'w') as f:
+        f.writelines(headers + rows)
+
+
+def stitch_outputs(checkpoint: TaskCheckpoint, image_lists: Dict[str, str], detections: Dict[str, str]):
+    """
+    Stitch the outputs of the checkpoint and the outputs of the run that resumed from it, the new outputs are
+    rewritten in place.
+
+    :param checkpoint: the checkpoint the run resumed from
+    :param image_lists: output port environment variable to the image list written by the resumed run
+    :param detections: output port environment variable to the detection csv written by the resumed run
+    """
+    for env_var, new_fp in image_lists.items():
+        if env_var in checkpoint.image_lists:
+            stitch_image_list(checkpoint.image_lists[env_var], new_fp, checkpoint.images)
+    for env_var, new_fp in detections.items():
+        if env_var in checkpoint.detections:
+            stitch_detections(checkpoint.detections[env_var], new_fp, checkpoint.images)
@@ -33,11 +33,17 @@ class ConfigOption:
         self.validator = parse_type(self.type)
         self.__value: Optional[VALUE] = option_dict.get('_value')
         self._locked = option_dict.get('_locked', False)
+        # a threshold that only filters the pipeline's output detections, see pep_tk.core.post_filter
+        self.post_filter: Optional[Dict] = option_dict.get('post_filter')
 
         # ensure default is valid
         valid, _ = self.validator.validate(self.default)
         if not valid:
             raise InvalidConfigOptionDefaultException('', self.name, self.default)
+        if self.post_filter is not None:
+            valid, _ = self.validator.validate(self.post_filter.get('run_value'))
+            if not valid:
+                raise InvalidConfigOptionDefaultException('', self.name, self.post_filter.get('run_value'))
 
     def value(self) -> VALUE:
         if self.__value:
@@ -65,18 +71,31 @@ class ConfigOption:
         if not self._locked:
             self.__value = self.default
 
+    def run_value(self, post_filter: bool = True) -> VALUE:
+        """
+        The value the pipeline is run with.  A post filter option runs the pipeline at its permissive run_value, its
+        value is applied to the output detections afterwards, unless the value itself is more permissive.
+        :param post_filter: False to run the pipeline at the value, for jobs that do not post filter
+        """
+        if self.post_filter is None or not post_filter:
+            return self.value()
+        return min(self.post_filter['run_value'], self.value(), key=float)
+
     def get_env(self) -> Tuple[ENV_VARIABLE, VALUE]:
         """ returns a tuple with the first item being the environment variable name and the second begin the value """
         return self.env_variable, self.value()
 
     def to_dict(self) -> Dict:
-        return {'name': self.name,
-                '_value': self.value(),
-                '_locked': self._locked,
-                'default': self.default,
-                'type': self.type,
-                'env_variable': self.env_variable,
-                'description': self.description}
+        d = {'name': self.name,
+             '_value': self.value(),
+             '_locked': self._locked,
+             'default': self.default,
+             'type': self.type,
+             'env_variable': self.env_variable,
+             'description': self.description}
+        if self.post_filter is not None:
+            d['post_filter'] = dict(self.post_filter)
+        return d
 
 
 
@@ -183,6 +202,10 @@ class PipelineParametersOptionGroup(ConfigOptionGroup):
 
     def validate_option_type(self, opt) -> bool: return True
 
+    def get_run_env_ports(self, post_filter: bool = True) -> Dict[ENV_VARIABLE, VALUE]:
+        """ :return: the environment the pipeline is run with, post filter options at their permissive run value """
+        return {opt.env_variable: opt.run_value(post_filter) for opt in self.options}
+
 
 class DatasetPipelineEnvAdaptersGroup:
     def __init__(self, config_dict: Dict):
@@ -226,6 +249,8 @@ class PipelineConfig:
         self.parameters_group = PipelineParametersOptionGroup(config_dict)
         self.output_group = PipelineOutputOptionGroup(config_dict)
         self.dataset_ports = DatasetPipelineEnvAdaptersGroup(config_dict)
+        # seconds without progress or output before the scheduler considers a task of this pipeline stalled
+        self.stall_timeout = config_dict.get('stall_timeout')
 
     def get_output_env_ports(self, output_directory = ''):
         output_ports = self.output_group.get_env_ports()
@@ -236,6 +261,13 @@ class PipelineConfig:
     def get_parameter_env_ports(self):
         return self.parameters_group.get_env_ports()
 
+    def get_parameter_run_env_ports(self, post_filter: bool = True):
+        return self.parameters_group.get_run_env_ports(post_filter)
+
+    def get_parameter_values(self) -> Dict[str, VALUE]:
+        """ :return: dictionary of parameter name to the currently configured value """
+        return {opt.name: opt.value() for opt in self.parameters_group.options}
+
     def get_pipeline_dataset_environment(self, dataset: VIAMEDataset, missing_ok=False) -> Dict[ENV_VARIABLE, VALUE]:
         return self.dataset_ports.get_env_ports(dataset, missing_ok)
 
@@ -248,4 +280,6 @@ class PipelineConfig:
                 'dataset_pipeline_adapters': self.dataset_ports.to_dict(),
                 'path': self.path
             }
+        if self.stall_timeout is not None:
+            d['stall_timeout'] = self.stall_timeout
         return d
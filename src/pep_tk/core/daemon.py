@@ -0,0 +1,435 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local job queue daemon.  A long-running process holds a persistent queue of job directories and runs them, each with
+its own Scheduler, under a global limit on the number of jobs and kwiver tasks running at once.  Clients talk to it
+over a unix domain socket, one json request and one json response per connection:
+
+    {"command": "submit", "job": "/path/to/jobs/job"}  ->  {"ok": true, "job": {...}}
+
+Commands are submit, pause, resume, cancel (with a job), status (optionally with a job) and shutdown.  Pausing or
+cancelling a running job stops its kwiver processes the same way closing the gui does, a paused job that is resumed
+continues from its incomplete tasks (from its checkpoints with checkpoint_resume).  Jobs that were running when the
+daemon stopped are queued again when it restarts.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from enum import Enum
+from typing import Dict, List, Optional
+
+from pep_tk.core.job import JobState, TaskKey, TaskStatus, load_job
+from pep_tk.core.job_lock import JobLock, JobLockedException, running_detections, running_progress
+from pep_tk.core.scheduler import Scheduler, SchedulerEventManager
+from pep_tk.core.slots import SlotPool
+from pep_tk.core.utilities import jsonfile
+
+SOCKET_ENV_VAR = 'PEP_TK_DAEMON_SOCKET'
+COMMANDS = ('submit', 'pause', 'resume', 'cancel', 'status', 'shutdown')
+MAX_MESSAGE_BYTES = 1 << 20
+
+
+def default_socket_path() -> str:
+    """ :return: the socket of the daemon, $PEP_TK_DAEMON_SOCKET or ~/.pep_tk/daemon.sock """
+    return os.environ.get(SOCKET_ENV_VAR) or os.path.join(os.path.expanduser('~'), '.pep_tk', 'daemon.sock')
+
+
+class DaemonException(Exception):
+    pass
+
+
+class QueueStatus(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    PAUSED = 'paused'
+    CANCELLED = 'cancelled'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+
+class JobQueue:
+    """ The persistent queue of the daemon, job directory -> entry, saved on every change """
+    def __init__(self, queue_fp: str):
+        os.makedirs(os.path.dirname(os.path.abspath(queue_fp)), exist_ok=True)
+        dump_kwargs = dict(ensure_ascii=False, indent="\t", sort_keys=True)
+        self._store = jsonfile.jsonfile(queue_fp, default_data={}, autosave=True, dump_kwargs=dump_kwargs)
+        self._lock = threading.RLock()
+        if 'jobs' not in self._store.data:
+            self._store.data['jobs'] = {}
+        # the daemon stopped while these jobs were running, run them again
+        for job, entry in self.entries().items():
+            if entry['status'] == QueueStatus.RUNNING.value:
+                self.update(job, status=QueueStatus.QUEUED)
+
+    def entries(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {job: dict(entry) for job, entry in self._store.data['jobs'].items()}
+
+    def get(self, job: str) -> Optional[Dict]:
+        entry = self._store.data['jobs'].get(job)
+        return dict(entry) if entry is not None else None
+
+    def status(self, job: str) -> Optional[QueueStatus]:
+        entry = self.get(job)
+        return QueueStatus(entry['status']) if entry is not None else None
+
+    def submit(self, job: str) -> Dict:
+        with self._lock:
+            status = self.status(job)
+            if status in (QueueStatus.QUEUED, QueueStatus.RUNNING, QueueStatus.PAUSED):
+                raise DaemonException(f'{job} is already in the queue ({status.value})')
+            self._store.data['jobs'][job] = {'job': job, 'status': QueueStatus.QUEUED.value, 'submitted': time.time(),
+                                             'started': None, 'finished': None, 'message': ''}
+            return self.get(job)
+
+    def update(self, job: str, status: Optional[QueueStatus] = None, **fields) -> Dict:
+        with self._lock:
+            entry = self.get(job)
+            if status is not None:
+                entry['status'] = status.value
+            entry.update(fields)
+            self._store.data['jobs'][job] = entry
+            return entry
+
+    def next_queued(self) -> Optional[str]:
+        """ :return: the job submitted first of the queued jobs """
+        queued = [e for e in self.entries().values() if e['status'] == QueueStatus.QUEUED.value]
+        return min(queued, key=lambda e: e['submitted'])['job'] if queued else None
+
+
+class HeadlessManager(SchedulerEventManager):
+    """ Scheduler event manager without a gui, progress is kept in the base class and reported by status requests """
+    def _initialize_task(self, task_key: TaskKey, count: int, max_count: int, status: TaskStatus):
+        pass
+
+    def _start_task(self, task_key: TaskKey):
+        pass
+
+    def _end_task(self, task_key: TaskKey, status: TaskStatus):
+        pass
+
+    def _update_task_progress(self, task_key: TaskKey, current_count: int, max_count: int):
+        pass
+
+    def _update_task_stdout(self, task_key: TaskKey, line: str):
+        pass  # the scheduler writes the output of every task to the job's logs
+
+    def _update_task_stderr(self, task_key: TaskKey, line: str):
+        pass
+
+    def _check_cancelled(self, task_key: TaskKey) -> bool:
+        return False
+
+    def _update_task_output_files(self, task_key: TaskKey, output_files: List[str]):
+        pass
+
+
+class _RunningJob:
+    def __init__(self, job: str, job_state: JobState, manager: HeadlessManager):
+        self.job = job
+        self.job_state = job_state
+        self.manager = manager
+        self.kill_event = threading.Event()
+        self.stop_status: Optional[QueueStatus] = None  # why the job was stopped, paused or cancelled
+        self.stop_message = ''
+        self.thread: Optional[threading.Thread] = None
+
+    def progress(self) -> Dict:
+        tasks = {}
+        for task_key in self.job_state.tasks():
+            status = self.job_state.get_status(task_key).name.lower()
+            tasks[status] = tasks.get(status, 0) + 1
+        return {'tasks': tasks,
+                'images': sum(self.manager.task_count.values()),
+                'max_images': sum(self.manager.task_max_count.values()),
+                # task key -> DetectionStats.summary_dict of the tasks run since the daemon started the job
+                'detections': {task_key: stats.summary_dict()
+                               for task_key, stats in list(self.manager.task_detections.items())}}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline(MAX_MESSAGE_BYTES).decode('utf-8'))
+            response = self.server.job_daemon.handle_request(request)
+        except DaemonException as e:
+            response = {'ok': False, 'error': str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class JobDaemon:
+    def __init__(self, socket_path: Optional[str] = None, queue_fp: Optional[str] = None, max_jobs: int = 1,
+                 max_tasks: Optional[int] = None, slot_pools: Optional[List[SlotPool]] = None,
+                 kwiver_setup_path: Optional[str] = None, poll_freq: float = 1, **scheduler_kwargs):
+        """
+        :param socket_path: unix domain socket to listen on, see default_socket_path
+        :param queue_fp: file the queue is kept in, defaults to queue.json next to the socket
+        :param max_jobs: maximum number of jobs running at the same time
+        :param max_tasks: maximum number of kwiver tasks running at the same time across every job, a task slot pool
+        shared by the schedulers of every job. None only limits the tasks of each job (max_concurrent_tasks)
+        :param slot_pools: resource slot pools shared by the schedulers of every job (see pep_tk.core.slots)
+        :param kwiver_setup_path: setup_viame.sh path
+        :param poll_freq: seconds between checks for queued jobs
+        :param scheduler_kwargs: passed to the Scheduler of every job, e.g. max_concurrent_tasks or checkpoint_resume
+        """
+        if not hasattr(socket, 'AF_UNIX'):
+            raise DaemonException('The job daemon requires unix domain sockets.')
+        self.socket_path = socket_path or default_socket_path()
+        self.queue = JobQueue(queue_fp or os.path.join(os.path.dirname(os.path.abspath(self.socket_path)),
+                                                       'queue.json'))
+        self.max_jobs = max(1, max_jobs)
+        self.slot_pools = list(slot_pools or [])
+        if max_tasks is not None:
+            self.slot_pools.append(SlotPool('daemon_tasks', list(range(max(1, max_tasks)))))
+        self.kwiver_setup_path = kwiver_setup_path
+        self.poll_freq = poll_freq
+        self.scheduler_kwargs = scheduler_kwargs
+        self._running: Dict[str, _RunningJob] = {}
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+
+    def serve_forever(self):
+        """ Listen for requests and run the queued jobs until a shutdown request """
+        if os.path.exists(self.socket_path):
+            if _socket_accepting(self.socket_path):
+                raise DaemonException(f'A daemon is already listening on {self.socket_path}')
+            os.remove(self.socket_path)  # left behind by a daemon that did not exit cleanly
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.job_daemon = self
+        server_thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        server_thread.start()
+        print(f'Job daemon listening on {self.socket_path} (pid: {os.getpid()})')
+        try:
+            self._dispatch()
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            with self._lock:
+                for job in [j for j, r in self._running.items() if not r.thread.is_alive()]:
+                    del self._running[job]
+                while len(self._running) < self.max_jobs:
+                    job = self.queue.next_queued()
+                    if job is None:
+                        break
+                    self._start(job)
+            self._wake.wait(self.poll_freq)
+            self._wake.clear()
+
+        # running jobs are stopped, they stay queued to be continued when the daemon is started again
+        with self._lock:
+            running = list(self._running.values())
+            for r in running:
+                r.kill_event.set()
+        for r in running:
+            r.thread.join(timeout=120)
+
+    def _start(self, job: str):
+        manager = HeadlessManager()
+        running = None  # the heartbeat starts before the job is loaded
+
+        def lock_lost():
+            # another process took over the job, stop without saving over its changes
+            if running is None:
+                return  # checked once the job is loaded
+            running.job_state.stop_saving()
+            running.stop_status = QueueStatus.FAILED
+            running.stop_message = 'the job lock was taken by another process'
+            running.kill_event.set()
+
+        lock = JobLock(job, owner='daemon', progress=lambda: running_progress(manager), on_lost=lock_lost,
+                       detections=lambda: running_detections(manager))
+        try:
+            lock.acquire()
+        except JobLockedException as e:
+            self.queue.update(job, QueueStatus.FAILED, finished=time.time(), message=str(e))
+            return
+        try:
+            job_state, job_meta = load_job(job)
+        except Exception as e:
+            lock.release()
+            self.queue.update(job, QueueStatus.FAILED, finished=time.time(), message=f'unable to load the job: {e}')
+            return
+        running = _RunningJob(job, job_state, manager)
+        if lock.lost:
+            job_state.stop_saving()
+            lock.release()
+            self.queue.update(job, QueueStatus.FAILED, finished=time.time(),
+                              message='the job lock was taken by another process')
+            return
+        try:
+            scheduler = Scheduler(job_state, job_meta, manager, kwiver_setup_path=self.kwiver_setup_path,
+                                  kill_event=running.kill_event, slot_pools=self.slot_pools, **self.scheduler_kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            lock.release()
+            self.queue.update(job, QueueStatus.FAILED, finished=time.time(), message=f'unable to start the job: {e}')
+            return
+        running.thread = threading.Thread(target=self._run_job, args=(running, scheduler, lock), daemon=True)
+        self.queue.update(job, QueueStatus.RUNNING, started=time.time(), finished=None, message='')
+        self._running[job] = running
+        running.thread.start()
+
+    def _run_job(self, running: _RunningJob, scheduler: Scheduler, lock: JobLock):
+        try:
+            scheduler.run()
+        except Exception as e:
+            traceback.print_exc()
+            self.queue.update(running.job, QueueStatus.FAILED, finished=time.time(), message=str(e))
+            self._wake.set()
+            return
+        finally:
+            lock.release()
+        if running.stop_status is not None:
+            self.queue.update(running.job, running.stop_status, finished=time.time(), message=running.stop_message)
+        elif running.kill_event.is_set():
+            self.queue.update(running.job, QueueStatus.QUEUED, message='stopped by the daemon shutting down')
+        else:
+            tasks = running.job_state.tasks()
+            succeeded = running.job_state.tasks(status=TaskStatus.SUCCESS)
+            status = QueueStatus.COMPLETED if len(succeeded) == len(tasks) else QueueStatus.FAILED
+            self.queue.update(running.job, status, finished=time.time(),
+                              message=f'{len(succeeded)}/{len(tasks)} tasks succeeded')
+        self._wake.set()  # start the next queued job
+
+    def _stop_job(self, job: str, status: QueueStatus) -> Dict:
+        """ Pause or cancel a job, a running job is stopped and its status is set once its scheduler exits """
+        with self._lock:
+            running = self._running.get(job)
+            if running is not None:
+                running.stop_status = status
+                running.kill_event.set()
+                return self.queue.get(job)
+            current = self.queue.status(job)
+            if status == QueueStatus.PAUSED and current != QueueStatus.QUEUED:
+                raise DaemonException(f'{job} is not queued or running ({current.value})')
+            if status == QueueStatus.CANCELLED and current not in (QueueStatus.QUEUED, QueueStatus.PAUSED):
+                raise DaemonException(f'{job} is not queued, paused or running ({current.value})')
+            return self.queue.update(job, status, finished=time.time())
+
+    def _entry(self, job: str) -> Dict:
+        entry = self.queue.get(job)
+        running = self._running.get(job)
+        if running is not None:
+            entry['progress'] = running.progress()
+        return entry
+
+    def handle_request(self, request: Dict) -> Dict:
+        command = request.get('command')
+        if command not in COMMANDS:
+            raise DaemonException(f'Unknown command {command}, expected one of {", ".join(COMMANDS)}.')
+        if command == 'shutdown':
+            self.shutdown()
+            return {'ok': True}
+        job = request.get('job')
+        if job is not None:
+            job = os.path.normpath(os.path.abspath(job))
+        if command == 'status' and job is None:
+            with self._lock:
+                jobs = sorted(self.queue.entries(), key=lambda j: self.queue.get(j)['submitted'])
+                return {'ok': True, 'jobs': [self._entry(j) for j in jobs]}
+        if job is None:
+            raise DaemonException(f'The {command} command requires a job.')
+        if command == 'submit':
+            if not os.path.isfile(os.path.join(job, 'meta', 'job_state.json')):
+                raise DaemonException(f'{job} is not a job directory')
+            entry = self.queue.submit(job)
+            self._wake.set()
+            return {'ok': True, 'job': entry}
+        if self.queue.get(job) is None:
+            raise DaemonException(f'{job} is not in the queue')
+        with self._lock:
+            if command == 'pause':
+                entry = self._stop_job(job, QueueStatus.PAUSED)
+            elif command == 'cancel':
+                entry = self._stop_job(job, QueueStatus.CANCELLED)
+            elif command == 'resume':
+                if job in self._running or self.queue.status(job) in (QueueStatus.QUEUED, QueueStatus.RUNNING):
+                    raise DaemonException(f'{job} is already {self.queue.status(job).value}')
+                entry = self.queue.update(job, QueueStatus.QUEUED, finished=None, message='')
+                self._wake.set()
+            else:
+                entry = self._entry(job)
+        return {'ok': True, 'job': entry}
+
+
+def _socket_accepting(socket_path: str) -> bool:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def daemon_request(command: str, job: Optional[str] = None, socket_path: Optional[str] = None,
+                   timeout: float = 30) -> Dict:
+    """
+    Send a request to the daemon.
+
+    :param command: one of COMMANDS
+    :param job: the job directory the command applies to
+    :param socket_path: the daemon's socket, see default_socket_path
+    :param timeout: seconds to wait for the response
+    :return: the response, raises DaemonException if the daemon is not running or the request failed
+    """
+    socket_path = socket_path or default_socket_path()
+    request = {'command': command}
+    if job is not None:
+        request['job'] = os.path.abspath(job)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(socket_path)
+        s.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with s.makefile('rb') as f:
+            line = f.readline(MAX_MESSAGE_BYTES)
+    except OSError as e:
+        raise DaemonException(f'Unable to reach the job daemon at {socket_path}: {e}')
+    finally:
+        s.close()
+    try:
+        response = json.loads(line.decode('utf-8'))
+    except ValueError:
+        raise DaemonException(f'Invalid response from the job daemon: {line[:200]!r}')
+    if not response.get('ok'):
+        raise DaemonException(response.get('error', 'request failed'))
+    return response
@@ -0,0 +1,101 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+from typing import Dict
+
+from pep_tk.core.checkpoint import TaskCheckpoint, checkpoint_image_count, match_output_files, remaining_images
+from pep_tk.core.job import JobInitException, JobMeta, JobState, TaskStatus, baseline_outputs_dir, load_job, \
+    raw_outputs_dir
+from pep_tk.core.post_filter import apply_post_filters
+
+
+def _copy_outputs(ports: Dict[str, str], directory: str) -> Dict[str, str]:
+    os.makedirs(directory, exist_ok=True)
+    copied = {}
+    for env_var, fp in ports.items():
+        copied[env_var] = os.path.join(directory, os.path.basename(fp))
+        shutil.copy2(fp, copied[env_var])
+    return copied
+
+
+def _raw_output(job_dir: str, fp: str) -> str:
+    raw_fp = os.path.join(raw_outputs_dir(job_dir), os.path.basename(fp))
+    return raw_fp if os.path.isfile(raw_fp) else fp
+
+
+def create_delta_checkpoints(job_state: JobState, job_meta: JobMeta, previous_job_dir: str) -> Dict[str, int]:
+    """
+    Set up a new job to only process the images that were added to its datasets since a previous job ran the same
+    pipeline on them.
+
+    The outputs of every successful task of the previous job are copied to the new job and saved as a 'delta'
+    checkpoint of the task with the same dataset, the scheduler then resumes the task from the checkpoint (see
+    pep_tk.core.checkpoint) and stitches the new outputs to the previous ones.  A task whose dataset has no new images
+    is marked successful with the previous outputs, without running kwiver.
+
+    :param job_state: state of the new job
+    :param job_meta: meta of the new job
+    :param previous_job_dir: directory of the previous job
+    :return: dictionary of task key to the number of images the task does not need to process
+    """
+    prev_state, prev_meta = load_job(previous_job_dir, read_only=True)  # the previous job is not modified
+    if prev_meta.pipeline_name != job_meta.pipeline_name:
+        raise JobInitException(f'Delta job must run the same pipeline as {previous_job_dir} '
+                               f'({prev_meta.pipeline_name}), not {job_meta.pipeline_name}.')
+    if prev_meta.pipeline_parameters() != job_meta.pipeline_parameters():
+        raise JobInitException(f'Delta job must use the same pipeline parameters as {previous_job_dir}.')
+
+    skipped = {}
+    for task_key in job_state.tasks():
+        if task_key not in prev_state.tasks() or prev_state.get_status(task_key) != TaskStatus.SUCCESS:
+            continue
+        _, _, prev_outputs = prev_meta.get(task_key)
+        _, dataset, outputs = job_meta.get(task_key)
+        # stitch to the unfiltered detections if the previous job has post filters, see pep_tk.core.post_filter
+        prev_files = [_raw_output(previous_job_dir, fp) for fp in prev_state.get_task_outputs(task_key) or []]
+        prev_files = [fp for fp in prev_files if os.path.isfile(fp)]
+        list_ports = outputs.get_image_list_env_ports()
+        csv_ports = outputs.get_det_csv_env_ports()
+        image_lists = match_output_files(prev_outputs.get_image_list_env_ports(), prev_files)
+        detections = match_output_files(prev_outputs.get_det_csv_env_ports(), prev_files)
+        if set(image_lists) != set(list_ports) or set(detections) != set(csv_ports):
+            print(f'Warning: outputs of {task_key} in {previous_job_dir} are missing, processing the whole dataset')
+            continue
+
+        checkpoint = TaskCheckpoint(checkpoint_image_count(list(image_lists.values())), image_lists, detections,
+                                    source='delta')
+        remaining = remaining_images(checkpoint, dataset)
+        if remaining is None:
+            print(f'Warning: images processed by {task_key} in {previous_job_dir} are no longer in its dataset, '
+                  f'processing the whole dataset')
+            continue
+
+        if not any(remaining.values()):
+            # nothing new, the previous outputs are the result
+            copied = _copy_outputs({**image_lists, **detections}, job_meta.completed_outputs_dir)
+            apply_post_filters(job_meta, {opt.name: copied[opt.env_variable] for opt in outputs.get_det_csv_options()
+                                          if opt.env_variable in copied})
+            job_state.set_task_outputs(task_key, list(copied.values()))
+            job_state.set_task_status(task_key, TaskStatus.SUCCESS)
+        else:
+            baseline_dir = baseline_outputs_dir(job_meta.root_dir)
+            checkpoint.image_lists = _copy_outputs(image_lists, baseline_dir)
+            checkpoint.detections = _copy_outputs(detections, baseline_dir)
+            job_state.set_task_checkpoint(task_key, checkpoint.to_dict())
+        skipped[task_key] = checkpoint.images
+    return skipped
@@ -0,0 +1,337 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Columnar index of the detections of completed tasks, for querying many jobs without parsing their detection csvs.
+
+Every detection csv of a successful task is converted to a NumPy .npz file in the job's index directory.  The
+detections are sorted by frame and stored column by column (frame, detection id, bounding box, confidence, class,
+class score) with the names of the images the task processed and a per-image offset index: the detections of image
+i are rows image_offsets[i]:image_offsets[i + 1], so images without detections are kept and an image's detections
+are found without scanning the whole column.
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from pep_tk.core.checkpoint import DETECTION_ID_COLUMN, FRAME_ID_COLUMN, IMAGE_COLUMN, read_list_lines
+from pep_tk.core.job import JobMeta, JobState, TaskStatus, job_exists, load_job
+from pep_tk.core.post_filter import CLASS_COLUMN, CONFIDENCE_COLUMN
+
+INDEX_VERSION = 1
+BBOX_COLUMNS = (3, 4, 5, 6)  # top left x, top left y, bottom right x, bottom right y
+CLASS_SCORE_COLUMN = CLASS_COLUMN + 1
+
+RESULT_COLUMNS = ['job', 'dataset', 'output', 'image', 'frame', 'detection_id', 'tl_x', 'tl_y', 'br_x', 'br_y',
+                  'confidence', 'class', 'class_score']
+
+index_dir = lambda root_dir: os.path.join(root_dir, 'index')
+index_json_fp = lambda root_dir: os.path.join(index_dir(root_dir), 'index.json')
+
+# tasks finishing at the same time update the same index.json
+_index_lock = threading.Lock()
+
+
+def _write_json_atomic(fp: str, data: Dict):
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(fp), delete=False, suffix='.tmp') as f:
+        json.dump(data, f, indent='\t', sort_keys=True)
+        tmp_fp = f.name
+    os.replace(tmp_fp, fp)
+
+
+def read_detections_csv(fp: str) -> Dict[str, np.ndarray]:
+    """
+    Read a VIAME detection csv into columns, sorted by frame.
+
+    :param fp: the detection csv
+    :return: dictionary of column name to array, see DetectionIndex for the columns
+    """
+    with open(fp, 'r') as f:
+        lines = pd.Series(f.read().splitlines(), dtype=object)
+    lines = lines[(lines.str.strip() != '') & ~lines.str.startswith('#')]
+    if len(lines) == 0:
+        cols = pd.DataFrame(columns=range(CLASS_SCORE_COLUMN + 1), dtype=object)
+    else:
+        cols = lines.str.split(',', n=CLASS_SCORE_COLUMN + 1, expand=True)
+    # detections without a class have fewer columns
+    for c in range(CLASS_SCORE_COLUMN + 1):
+        if c not in cols.columns:
+            cols[c] = None
+
+    number = lambda c, dtype: pd.to_numeric(cols[c], errors='coerce').fillna(-1).to_numpy(dtype=dtype)
+    frame = number(FRAME_ID_COLUMN, np.int64)
+    order = np.argsort(frame, kind='stable')
+    classes, class_codes = np.unique(cols[CLASS_COLUMN].fillna('').to_numpy(dtype=str), return_inverse=True)
+    return {'frame': frame[order],
+            'detection_id': number(DETECTION_ID_COLUMN, np.int64)[order],
+            'bbox': np.stack([number(c, np.float32) for c in BBOX_COLUMNS], axis=1)[order].reshape(-1, 4),
+            'confidence': number(CONFIDENCE_COLUMN, np.float32)[order],
+            'class_code': class_codes.astype(np.int32)[order],
+            'class_score': number(CLASS_SCORE_COLUMN, np.float32)[order],
+            'classes': classes,
+            'image': cols[IMAGE_COLUMN].fillna('').to_numpy(dtype=str)[order]}
+
+
+def build_task_index(detections_fp: str, image_list_fp: Optional[str], index_fp: str) -> Dict:
+    """
+    Convert a detection csv to the columnar .npz format.
+
+    :param detections_fp: the detection csv
+    :param image_list_fp: the output image list written with the detections, gives the names of images without
+    detections
+    :param index_fp: the .npz file to write
+    :return: summary of the written index
+    """
+    cols = read_detections_csv(detections_fp)
+    frame = cols.pop('frame')
+    det_images = cols.pop('image')
+    n_images = int(frame.max()) + 1 if len(frame) else 0
+    images = [os.path.basename(p) for p in read_list_lines(image_list_fp)] \
+        if image_list_fp and os.path.isfile(image_list_fp) else []
+    if len(images) < n_images:
+        # the image list is missing frames, name them from the detections
+        names = dict(zip(frame.tolist(), det_images.tolist()))
+        images += [names.get(i, '') for i in range(len(images), n_images)]
+    image_offsets = np.searchsorted(frame, np.arange(len(images) + 1), side='left').astype(np.int64)
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_fp)), exist_ok=True)
+    tmp_fp = index_fp + '.tmp.npz'
+    np.savez(tmp_fp, frame=frame.astype(np.int32), images=np.array(images, dtype=str), image_offsets=image_offsets,
+             **cols)
+    os.replace(tmp_fp, index_fp)
+    return {'detections': int(len(frame)), 'images': len(images)}
+
+
+def _paired_image_list(det_output_name: str, image_lists: Dict[str, str]) -> Optional[str]:
+    # output_thermal_detections is written with output_thermal_image_list
+    name = re.sub(r'_detections$', '_image_list', det_output_name)
+    if name in image_lists:
+        return image_lists[name]
+    return next(iter(image_lists.values())) if len(image_lists) == 1 else None
+
+
+def _output_files(job_state: JobState, job_meta: JobMeta, task_key: str):
+    """ :return: (output name to detection csv, output name to image list) of a successful task """
+    _, _, outputs = job_meta.get(task_key)
+    files = job_state.get_task_outputs(task_key) or []
+
+    def match(options):
+        matched = {}
+        for opt in options:
+            prefix, _, suffix = os.path.basename(opt.value()).partition('[TIMESTAMP]')
+            candidates = [fp for fp in files if os.path.basename(fp).startswith(prefix) and
+                          os.path.basename(fp).endswith(suffix)]
+            if candidates:
+                matched[opt.name] = max(candidates, key=os.path.basename)
+        return matched
+    return match(outputs.get_det_csv_options()), match(outputs.get_image_list_options())
+
+
+def index_tasks(job_state: JobState, job_meta: JobMeta, task_keys: Optional[Iterable[str]] = None,
+                rebuild: bool = False) -> List[str]:
+    """
+    Index the detections of the successful tasks of a job, tasks whose detection csvs did not change since they were
+    indexed are skipped.
+
+    :param job_state: the job state
+    :param job_meta: the job meta
+    :param task_keys: only index these tasks, defaults to every successful task
+    :param rebuild: index every task again
+    :return: the task keys that were (re)indexed
+    """
+    job_dir = job_meta.root_dir
+    with _index_lock:
+        manifest = load_index_manifest(job_dir)
+        if rebuild or manifest.get('version') != INDEX_VERSION:
+            manifest = {'version': INDEX_VERSION, 'tasks': {}}
+        successful = job_state.tasks(status=TaskStatus.SUCCESS)
+        # drop the entries of tasks that are no longer successful, e.g. re-run
+        manifest['tasks'] = {k: v for k, v in manifest['tasks'].items() if k in successful}
+
+        indexed = []
+        for task_key in successful if task_keys is None else [k for k in task_keys if k in successful]:
+            detections, image_lists = _output_files(job_state, job_meta, task_key)
+            safe_task_key = re.sub(r'[^\w.-]', '_', task_key)
+            entries = {}
+            for name, det_fp in detections.items():
+                if not os.path.isfile(det_fp):
+                    continue
+                st = os.stat(det_fp)
+                source = {'source': os.path.basename(det_fp), 'source_size': st.st_size,
+                          'source_mtime': st.st_mtime}
+                previous = manifest['tasks'].get(task_key, {}).get(name)
+                index_fn = f'{safe_task_key}-{name}.npz'
+                if previous and all(previous.get(k) == v for k, v in source.items()) and \
+                        os.path.isfile(os.path.join(index_dir(job_dir), index_fn)):
+                    entries[name] = previous
+                    continue
+                summary = build_task_index(det_fp, _paired_image_list(name, image_lists),
+                                           os.path.join(index_dir(job_dir), index_fn))
+                entries[name] = {'file': index_fn, **source, **summary}
+            if entries != manifest['tasks'].get(task_key):
+                indexed.append(task_key)
+            manifest['tasks'][task_key] = entries
+
+        os.makedirs(index_dir(job_dir), exist_ok=True)
+        _write_json_atomic(index_json_fp(job_dir), manifest)
+    return indexed
+
+
+def update_job_index(job_dir: str, rebuild: bool = False) -> List[str]:
+    """ Index the successful tasks of the job in job_dir, see index_tasks """
+    # read only, the job may be running in another process and loading it to run would reset its running tasks
+    job_state, job_meta = load_job(job_dir, read_only=True)
+    return index_tasks(job_state, job_meta, rebuild=rebuild)
+
+
+def load_index_manifest(job_dir: str) -> Dict:
+    try:
+        with open(index_json_fp(job_dir), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'version': INDEX_VERSION, 'tasks': {}}
+
+
+def expand_job_dirs(paths: Iterable[str]) -> List[str]:
+    """ :return: the job directories, a path that is not a job but contains jobs (a job base directory) is expanded """
+    jobs = []
+    for path in paths:
+        if job_exists(path):
+            jobs.append(path)
+        elif os.path.isdir(path):
+            jobs.extend(os.path.join(path, d) for d in sorted(os.listdir(path))
+                        if job_exists(os.path.join(path, d)))
+    return jobs
+
+
+def _select(value: str, allowed: Optional[Sequence[str]]) -> bool:
+    return allowed is None or value in allowed
+
+
+def _iter_tables(job_dirs: Iterable[str], datasets: Optional[Sequence[str]], outputs: Optional[Sequence[str]]) \
+        -> Iterator[tuple]:
+    for job_dir in job_dirs:
+        job_name = os.path.basename(os.path.normpath(os.path.abspath(job_dir)))
+        for task_key, entries in load_index_manifest(job_dir).get('tasks', {}).items():
+            if not _select(task_key, datasets):
+                continue
+            for name, entry in entries.items():
+                if not _select(name, outputs):
+                    continue
+                with np.load(os.path.join(index_dir(job_dir), entry['file'])) as table:
+                    yield job_name, task_key, name, {k: table[k] for k in table.files}
+
+
+def query_detections(job_dirs: Iterable[str],
+                     datasets: Optional[Sequence[str]] = None,
+                     classes: Optional[Sequence[str]] = None,
+                     min_confidence: Optional[float] = None,
+                     max_confidence: Optional[float] = None,
+                     images: Optional[Sequence[str]] = None,
+                     outputs: Optional[Sequence[str]] = None,
+                     update: bool = True) -> pd.DataFrame:
+    """
+    Query the indexed detections of one or more jobs.
+
+    :param job_dirs: job directories or job base directories
+    :param datasets: only detections of these datasets (task keys)
+    :param classes: only detections whose top class is one of these
+    :param min_confidence: only detections with at least this confidence
+    :param max_confidence: only detections with at most this confidence
+    :param images: only detections on these images (file names)
+    :param outputs: only detections of these detection outputs, e.g. output_thermal_detections
+    :param update: index tasks that are not indexed yet or changed first
+    :return: DataFrame with the RESULT_COLUMNS
+    """
+    job_dirs = expand_job_dirs(job_dirs)
+    if update:
+        for job_dir in job_dirs:
+            update_job_index(job_dir)
+
+    frames = []
+    for job_name, task_key, name, t in _iter_tables(job_dirs, datasets, outputs):
+        if images is not None:
+            # only read the rows of the requested images, using the per-image offsets
+            positions = np.flatnonzero(np.isin(t['images'], list(images)))
+            rows = np.concatenate([np.arange(t['image_offsets'][i], t['image_offsets'][i + 1])
+                                   for i in positions]) if len(positions) else np.array([], dtype=np.int64)
+        else:
+            rows = np.arange(len(t['frame']))
+        mask = np.ones(len(rows), dtype=bool)
+        if min_confidence is not None:
+            mask &= t['confidence'][rows] >= min_confidence
+        if max_confidence is not None:
+            mask &= t['confidence'][rows] <= max_confidence
+        if classes is not None:
+            mask &= np.isin(t['class_code'][rows], np.flatnonzero(np.isin(t['classes'], list(classes))))
+        rows = rows[mask]
+        if len(rows) == 0:
+            continue
+
+        frame = t['frame'][rows]
+        bbox = t['bbox'][rows]
+        frames.append(pd.DataFrame({
+            'job': job_name, 'dataset': task_key, 'output': name,
+            'image': t['images'][frame] if len(t['images']) else '',
+            'frame': frame, 'detection_id': t['detection_id'][rows],
+            'tl_x': bbox[:, 0], 'tl_y': bbox[:, 1], 'br_x': bbox[:, 2], 'br_y': bbox[:, 3],
+            'confidence': t['confidence'][rows], 'class': t['classes'][t['class_code'][rows]],
+            'class_score': t['class_score'][rows]}))
+    if not frames:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)[RESULT_COLUMNS]
+
+
+def summarize_detections(detections: pd.DataFrame, by: Sequence[str] = ('dataset', 'class')) -> pd.DataFrame:
+    """
+    Aggregate queried detections.
+
+    :param detections: result of query_detections
+    :param by: columns to group by
+    :return: DataFrame with the detection count, number of images with detections and confidence statistics of
+    every group
+    """
+    by = list(by)
+    if len(detections) == 0:
+        return pd.DataFrame(columns=by + ['detections', 'images', 'mean_confidence', 'max_confidence'])
+    grouped = detections.groupby(by, sort=True)
+    return grouped.agg(detections=('confidence', 'size'),
+                       images=('image', 'nunique'),
+                       mean_confidence=('confidence', 'mean'),
+                       max_confidence=('confidence', 'max')).reset_index()
+
+
+def image_detection_counts(job_dirs: Iterable[str], datasets: Optional[Sequence[str]] = None,
+                           outputs: Optional[Sequence[str]] = None, update: bool = True) -> pd.DataFrame:
+    """ :return: DataFrame of job, dataset, output, image and its number of detections, images without detections
+    included """
+    job_dirs = expand_job_dirs(job_dirs)
+    if update:
+        for job_dir in job_dirs:
+            update_job_index(job_dir)
+    frames = [pd.DataFrame({'job': job_name, 'dataset': task_key, 'output': name, 'image': t['images'],
+                            'detections': np.diff(t['image_offsets'])})
+              for job_name, task_key, name, t in _iter_tables(job_dirs, datasets, outputs)]
+    if not frames:
+        return pd.DataFrame(columns=['job', 'dataset', 'output', 'image', 'detections'])
+    return pd.concat(frames, ignore_index=True)
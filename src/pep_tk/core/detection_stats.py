@@ -0,0 +1,128 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from pep_tk.core.checkpoint import FRAME_ID_COLUMN
+from pep_tk.core.post_filter import CLASS_COLUMN, CONFIDENCE_COLUMN
+
+CONFIDENCE_BINS = 10  # the confidence histogram has bins of 0.1
+
+
+@dataclass
+class DetectionStats:
+    """ Running statistics of the detections a task has written so far """
+    detections: int = 0
+    images: int = 0  # images processed, including images without detections
+    classes: Counter = field(default_factory=Counter)  # top class -> number of detections
+    confidence_histogram: List[int] = field(default_factory=lambda: [0] * CONFIDENCE_BINS)
+    frame_detections: Counter = field(default_factory=Counter)  # frame -> number of detections
+
+    @property
+    def detections_per_image(self) -> float:
+        return self.detections / self.images if self.images else 0.
+
+    @property
+    def max_detections_per_image(self) -> int:
+        return max(self.frame_detections.values()) if self.frame_detections else 0
+
+    def add_row(self, row: List[str]):
+        try:
+            confidence = float(row[CONFIDENCE_COLUMN])
+            frame = int(row[FRAME_ID_COLUMN])
+        except (IndexError, ValueError):
+            return  # not a detection row
+        self.detections += 1
+        self.frame_detections[frame] += 1
+        self.classes[row[CLASS_COLUMN] if len(row) > CLASS_COLUMN else ''] += 1
+        self.confidence_histogram[min(max(int(confidence * CONFIDENCE_BINS), 0), CONFIDENCE_BINS - 1)] += 1
+
+    def copy(self) -> 'DetectionStats':
+        return DetectionStats(self.detections, self.images, Counter(self.classes), list(self.confidence_histogram),
+                              Counter(self.frame_detections))
+
+    def to_dict(self) -> Dict:
+        return {'detections': self.detections,
+                'images': self.images,
+                'detections_per_image': self.detections_per_image,
+                'max_detections_per_image': self.max_detections_per_image,
+                'classes': dict(self.classes),
+                'confidence_histogram': list(self.confidence_histogram)}
+
+    def summary_dict(self) -> Dict:
+        """ :return: the fields of the summary, e.g. for the status of a job run without the gui """
+        return {'detections': self.detections,
+                'images': self.images,
+                'detections_per_image': self.detections_per_image,
+                'classes': dict(self.classes)}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'DetectionStats':
+        """ :param d: a to_dict or summary_dict, the counts per frame are not kept """
+        return cls(detections=int(d.get('detections', 0)), images=int(d.get('images', 0)),
+                   classes=Counter(d.get('classes', {})),
+                   confidence_histogram=list(d.get('confidence_histogram', [0] * CONFIDENCE_BINS)))
+
+    def summary(self, top_classes: int = 3) -> str:
+        """ :return: one line summary, e.g. '120 detections (2.4/image) Hotspot: 118, Seal: 2' """
+        s = f'{self.detections} detections ({self.detections_per_image:.1f}/image)'
+        if self.classes:
+            s += ' ' + ', '.join(f'{c}: {n}' for c, n in self.classes.most_common(top_classes))
+        return s
+
+
+class DetectionTailReader:
+    """
+    Incrementally reads a detection csv that kwiver is still writing.  Every poll only reads the bytes appended since
+    the previous poll, a partially written last line is kept until the rest of it is written.
+    """
+    def __init__(self, fp: str):
+        self.fp = fp
+        self.stats = DetectionStats()
+        self._offset = 0
+        self._partial = b''
+        self._lock = threading.Lock()  # polled by the monitor thread and the task thread once kwiver exits
+
+    def poll(self, images: int = None, final: bool = False) -> DetectionStats:
+        """
+        :param images: number of images processed so far, for detections_per_image
+        :param final: the file is complete, a last line without a newline is read too
+        :return: a copy of the statistics of the detections written so far
+        """
+        with self._lock:
+            if images is not None:
+                self.stats.images = images
+            try:
+                if os.path.getsize(self.fp) < self._offset:
+                    # the file was replaced, e.g. a re-started task
+                    self.stats, self._offset, self._partial = DetectionStats(images=self.stats.images), 0, b''
+                with open(self.fp, 'rb') as f:
+                    f.seek(self._offset)
+                    data = f.read()
+            except OSError:
+                return self.stats.copy()  # not created yet or already moved
+            self._offset += len(data)
+            lines = (self._partial + data).split(b'\n')
+            self._partial = lines.pop() if not final else b''
+            for line in lines:
+                line = line.decode('utf-8', errors='replace').strip()
+                if line and not line.startswith('#'):
+                    self.stats.add_row(line.split(',', CLASS_COLUMN + 1))
+            return self.stats.copy()
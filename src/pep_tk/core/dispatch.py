@@ -0,0 +1,145 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import abc
+import os
+from typing import Dict, List, Optional
+
+from pep_tk.core.history import PerformanceHistory, parameter_hash
+from pep_tk.core.job import JobMeta, TaskKey
+
+
+class DispatchPolicy(metaclass=abc.ABCMeta):
+    """
+    A DispatchPolicy decides the order the scheduler runs a job's tasks in.  The order is computed once when the
+    policy is applied and persisted in the job state so that resuming a job runs tasks in the same order.
+    """
+    name = ''
+
+    @abc.abstractmethod
+    def order(self, task_keys: List[TaskKey], job_meta: JobMeta) -> List[TaskKey]:
+        pass
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name}
+
+
+class AlphabeticalPolicy(DispatchPolicy):
+    """ Run tasks sorted by task key (the original behavior) """
+    name = 'alphabetical'
+
+    def order(self, task_keys: List[TaskKey], job_meta: JobMeta) -> List[TaskKey]:
+        return sorted(task_keys)
+
+
+class LongestFirstPolicy(DispatchPolicy):
+    """ Longest-processing-time-first, run the datasets with the most images first """
+    name = 'longest_first'
+
+    def order(self, task_keys: List[TaskKey], job_meta: JobMeta) -> List[TaskKey]:
+        counts = {k: job_meta.image_count(k) for k in task_keys}
+        return sorted(task_keys, key=lambda k: (-counts[k], k))
+
+
+class ShortestFirstPolicy(DispatchPolicy):
+    """ Run the datasets with the fewest images first for fast feedback """
+    name = 'shortest_first'
+
+    def order(self, task_keys: List[TaskKey], job_meta: JobMeta) -> List[TaskKey]:
+        counts = {k: job_meta.image_count(k) for k in task_keys}
+        return sorted(task_keys, key=lambda k: (counts[k], k))
+
+
+class PriorityPolicy(DispatchPolicy):
+    """ Run tasks by explicit priority, highest first.  Tasks without a priority have priority 0. """
+    name = 'priority'
+
+    def __init__(self, priorities: Optional[Dict[TaskKey, int]] = None):
+        self.priorities = dict(priorities or {})
+
+    def order(self, task_keys: List[TaskKey], job_meta: JobMeta) -> List[TaskKey]:
+        return sorted(task_keys, key=lambda k: (-self.priorities.get(k, 0), k))
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'priorities': self.priorities}
+
+
+def storage_location(image_list_fp: Optional[str], depth: int = 2) -> str:
+    """
+    The storage location of an image list is the first `depth` components of the directory of the first image in
+    the list, for example '/mnt/nas1' for '/mnt/nas1/kotz/fl04/CENT/image.tif'.
+    """
+    if not image_list_fp or not os.path.isfile(image_list_fp):
+        return ''
+    with open(image_list_fp, 'r') as f:
+        first_image = next((line.strip() for line in f if line.strip()), '')
+    if not os.path.isabs(first_image):
+        first_image = os.path.join(os.path.dirname(image_list_fp), first_image)
+    drive, path = os.path.splitdrive(os.path.normpath(first_image))
+    parts = [p for p in os.path.dirname(path).split(os.sep) if p]
+    return drive + os.sep + os.sep.join(parts[:depth])
+
+
+class StorageLocationPolicy(DispatchPolicy):
+    """ Group tasks whose images live on the same storage so each storage location is read in one stretch """
+    name = 'storage_location'
+
+    def __init__(self, depth: int = 2):
+        self.depth = depth
+
+    def order(self, task_keys: List[TaskKey], job_meta: JobMeta) -> List[TaskKey]:
+        locations = {}
+        for k in task_keys:
+            _, dataset, _ = job_meta.get(k)
+            image_list = dataset.color_image_list or dataset.thermal_image_list
+            locations[k] = storage_location(image_list, self.depth)
+        return sorted(task_keys, key=lambda k: (locations[k], k))
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'depth': self.depth}
+
+
+class ExpectedDurationPolicy(DispatchPolicy):
+    """
+    Longest expected duration first using the performance history of the job base directory, falls back to the
+    image count when the pipeline has no history.
+    """
+    name = 'expected_duration'
+
+    def order(self, task_keys: List[TaskKey], job_meta: JobMeta) -> List[TaskKey]:
+        history = PerformanceHistory(job_meta.base_dir)
+        param_hash = parameter_hash(job_meta.pipeline_parameters())
+        expected = {}
+        for k in task_keys:
+            count = job_meta.image_count(k)
+            duration = history.predict_duration(job_meta.pipeline_name, count, param_hash)
+            expected[k] = (duration if duration is not None else -1., count)
+        return sorted(task_keys, key=lambda k: (-expected[k][0], -expected[k][1], k))
+
+
+DISPATCH_POLICIES = {p.name: p for p in [AlphabeticalPolicy, LongestFirstPolicy, ShortestFirstPolicy,
+                                         PriorityPolicy, StorageLocationPolicy, ExpectedDurationPolicy]}
+
+
+def get_dispatch_policy(name: str, **kwargs) -> DispatchPolicy:
+    if name not in DISPATCH_POLICIES:
+        raise ValueError(f'Unknown dispatch policy "{name}", must be one of {", ".join(DISPATCH_POLICIES.keys())}')
+    return DISPATCH_POLICIES[name](**kwargs)
+
+
+def dispatch_policy_from_dict(d: Dict) -> DispatchPolicy:
+    kwargs = {k: v for k, v in d.items() if k != 'name'}
+    return get_dispatch_policy(d['name'], **kwargs)
@@ -0,0 +1,165 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import statistics
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+from pep_tk.core.utilities import jsonfile
+
+# the performance history is shared by every job in a job base directory
+history_dir = lambda base_dir: os.path.join(base_dir, '.pep_tk')
+history_json_fp = lambda base_dir: os.path.join(history_dir(base_dir), 'performance_history.json')
+
+
+def parameter_hash(parameters: Dict) -> str:
+    """
+    Hash a pipeline's parameter values so runs with identical settings can be grouped together.
+
+    :param parameters: dictionary of parameter name to value
+    :return: short hex digest that is stable across processes
+    """
+    s = json.dumps({str(k): str(v) for k, v in parameters.items()}, sort_keys=True)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[:12]
+
+
+@dataclass
+class TaskPerformanceRecord:
+    """ Performance of a single successfully completed task """
+    pipeline: str  # pipeline name from the pipeline manifest
+    parameter_hash: str  # see parameter_hash()
+    image_count: int  # number of images processed
+    duration: float  # seconds from launching kwiver to the task ending
+    startup_time: float  # seconds from launching kwiver to the first image being processed
+    images_per_sec: float  # throughput once the pipeline has started processing images
+    peak_memory: Optional[int] = None  # peak rss of the task's process tree in bytes, if it was sampled
+    task_key: str = ''
+    job_name: str = ''
+    timestamp: float = field(default_factory=time.time)
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'TaskPerformanceRecord':
+        keys = cls.__dataclass_fields__.keys()
+        return cls(**{k: v for k, v in d.items() if k in keys})
+
+
+class PerformanceHistory:
+    def __init__(self, base_dir: str, max_records: int = 5000):
+        """
+        Store of per-task performance records kept across jobs, used to predict how long new tasks will take.
+
+        :param base_dir: the job base directory, the history is kept in base_dir/.pep_tk/
+        :param max_records: oldest records are dropped once the history grows past this size
+        """
+        self.base_dir = base_dir
+        self.max_records = max_records
+        self.history_fp = history_json_fp(base_dir)
+
+        dump_kwargs = dict(ensure_ascii=False, indent="\t", sort_keys=True)
+        self._store = jsonfile.jsonfile(self.history_fp, default_data={'records': []}, autosave=True,
+                                        dump_kwargs=dump_kwargs)
+
+    def add_record(self, record: TaskPerformanceRecord):
+        # other jobs may have written to the history since it was loaded
+        self._store.reload()
+        records = list(self._store.data.get('records', [])) + [asdict(record)]
+        self._store.data['records'] = records[-self.max_records:]
+
+    def records(self, pipeline: Optional[str] = None, param_hash: Optional[str] = None) -> List[TaskPerformanceRecord]:
+        self._store.reload()
+        res = []
+        for d in self._store.data.get('records', []):
+            rec = TaskPerformanceRecord.from_dict(d)
+            if pipeline is not None and rec.pipeline != pipeline:
+                continue
+            if param_hash is not None and rec.parameter_hash != param_hash:
+                continue
+            res.append(rec)
+        return res
+
+    def _matching_records(self, pipeline: str, param_hash: Optional[str]) -> List[TaskPerformanceRecord]:
+        # prefer runs with the same parameters, fall back to any run of the pipeline
+        if param_hash is not None:
+            recs = self.records(pipeline, param_hash)
+            if len(recs) > 0:
+                return recs
+        return self.records(pipeline)
+
+    def predict_duration(self, pipeline: str, image_count: int, param_hash: Optional[str] = None) -> Optional[float]:
+        """
+        Predict how long a task will take in seconds.
+
+        :param pipeline: pipeline name
+        :param image_count: number of images in the task's dataset
+        :param param_hash: parameter hash of the task's pipeline parameters
+        :return: predicted duration in seconds or None if the pipeline has never been run
+        """
+        recs = [r for r in self._matching_records(pipeline, param_hash) if r.images_per_sec > 0]
+        if len(recs) == 0:
+            return None
+        startup = statistics.median([r.startup_time for r in recs])
+        images_per_sec = statistics.median([r.images_per_sec for r in recs])
+        return startup + image_count / images_per_sec
+
+    def predict_images_per_sec(self, pipeline: str, param_hash: Optional[str] = None) -> Optional[float]:
+        """ :return: median throughput of the pipeline's recorded runs or None if the pipeline has never been run """
+        rates = [r.images_per_sec for r in self._matching_records(pipeline, param_hash) if r.images_per_sec > 0]
+        if len(rates) == 0:
+            return None
+        return statistics.median(rates)
+
+    def predict_total_duration(self, pipeline: str, image_counts: List[int],
+                               param_hash: Optional[str] = None) -> Optional[float]:
+        """ :return: predicted duration in seconds of running every dataset sequentially, or None if unknown """
+        durations = [self.predict_duration(pipeline, count, param_hash) for count in image_counts]
+        if len(durations) == 0 or None in durations:
+            return None
+        return sum(durations)
+
+    def predict_peak_memory(self, pipeline: str, param_hash: Optional[str] = None) -> Optional[int]:
+        """ :return: the largest peak memory(bytes) recorded for the pipeline or None if never recorded """
+        peaks = [r.peak_memory for r in self._matching_records(pipeline, param_hash) if r.peak_memory]
+        if len(peaks) == 0:
+            return None
+        return max(peaks)
+
+
+def build_performance_record(pipeline: str, param_hash: str, image_count: int, start_time: float, end_time: float,
+                             first_progress_time: Optional[float] = None, first_progress_count: int = 0,
+                             peak_memory: Optional[int] = None, task_key: str = '',
+                             job_name: str = '') -> TaskPerformanceRecord:
+    """
+    Build a TaskPerformanceRecord from the timings the scheduler's event manager keeps for each task.
+
+    Progress is polled so the first progress is seen after some images were already processed, the throughput is
+    measured from the first progress update to the end and the startup time is extrapolated back from it.
+    """
+    duration = max(end_time - start_time, 0.)
+    if first_progress_time is not None and image_count > first_progress_count and end_time > first_progress_time:
+        images_per_sec = (image_count - first_progress_count) / (end_time - first_progress_time)
+        startup_time = first_progress_time - start_time - first_progress_count / images_per_sec
+        startup_time = min(max(startup_time, 0.), duration)
+    else:
+        # not enough progress updates to separate the startup time from processing
+        startup_time = 0.
+        images_per_sec = image_count / duration if duration > 0 else 0.
+    return TaskPerformanceRecord(pipeline=pipeline, parameter_hash=param_hash, image_count=image_count,
+                                 duration=duration, startup_time=startup_time, images_per_sec=images_per_sec,
+                                 peak_memory=peak_memory, task_key=task_key, job_name=job_name)
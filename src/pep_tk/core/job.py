@@ -17,7 +17,7 @@
 import os
 import shutil
 from enum import Enum
-from typing import List, Tuple, Optional
+from typing import TYPE_CHECKING, Collection, Dict, List, Tuple, Optional
 
 from pep_tk.core.utilities import jsonfile
 from pep_tk.core.parser import VIAMEDataset
@@ -25,6 +25,9 @@ from pep_tk.core.configuration import PipelineConfig
 from pep_tk.core.configuration.configurations import PipelineOutputOptionGroup
 from pep_tk.core.kwiver.pipeline_compiler import compile_pipeline
 
+if TYPE_CHECKING:
+    from pep_tk.core.dispatch import DispatchPolicy  # imports this module
+
 
 class JobInitException(Exception):
     pass
@@ -37,6 +40,8 @@ logs_dir = lambda root_dir: os.path.join(root_dir, 'logs')
 completed_outputs_dir = lambda root_dir: os.path.join(root_dir, 'outputs_success')
 error_outputs_dir = lambda root_dir: os.path.join(root_dir, 'outputs_error')
 pending_outputs_dir = lambda root_dir: os.path.join(root_dir, 'outputs_pending')
+baseline_outputs_dir = lambda root_dir: os.path.join(root_dir, 'outputs_baseline')  # outputs copied for delta jobs
+raw_outputs_dir = lambda root_dir: os.path.join(root_dir, 'outputs_raw')  # detections before post filtering
 
 job_state_json_fp = lambda root_dir: os.path.join(meta_dir(root_dir), 'job_state.json')
 pipeline_meta_json_fp = lambda root_dir: os.path.join(meta_dir(root_dir), 'pipelines_meta.json')
@@ -62,8 +67,13 @@ class JobMeta:
         self._ds_store = jsonfile.jsonfile(self.dataset_meta_fp, default_data={}, autosave=True,
                                            dump_kwargs=dump_kwargs)
 
-    def create_meta(self, pipeline: PipelineConfig, datasets: List[VIAMEDataset]):
-        self._pipe_store.data = pipeline.to_dict()
+    def create_meta(self, pipeline: PipelineConfig, datasets: List[VIAMEDataset], post_filter: bool = False):
+        pipe = pipeline.to_dict()
+        if not post_filter:
+            # the job runs the pipeline at the configured values and keeps its outputs as they are
+            for opt in pipe['parameters_config'].values():
+                opt.pop('post_filter', None)
+        self._pipe_store.data = pipe
         for idx, dataset in enumerate(datasets):
             compiled_fp = os.path.join(self.compiled_pipelines_dir,
                                        f'{dataset.filename_friendly_name}-{pipeline.name}.pipe')
@@ -76,7 +86,8 @@ class JobMeta:
                 output_config[config_name]['_locked'] = True
 
             # compile everything EXCEPT the new outputs
-            env = {**pipeline.get_parameter_env_ports(),
+            # post filter parameters are compiled at their permissive run value and applied to the outputs later
+            env = {**pipeline.get_parameter_run_env_ports(post_filter),
                    **pipeline.get_pipeline_dataset_environment(dataset)}
             compiled_pipe = compile_pipeline(pipeline, env)
             with open(compiled_fp, 'w') as f:
@@ -86,9 +97,63 @@ class JobMeta:
             self._ds_store.data[dataset.name] = {'compiled_fp': compiled_relpath, 'dataset': dataset.asdict(),
                                                  'output_config': output_config}
 
+    def reload(self):
+        """ Re-read the meta from the job directory, e.g. after another process running the job changed it """
+        self._pipe_store.reload()
+        self._ds_store.reload()
+
     def keys(self):
         return list(self._ds_store.data.keys())
 
+    @property
+    def job_name(self) -> str:
+        return os.path.basename(os.path.normpath(os.path.abspath(self.root_dir)))
+
+    @property
+    def base_dir(self) -> str:
+        """ the job base directory this job was created in """
+        return os.path.dirname(os.path.normpath(os.path.abspath(self.root_dir)))
+
+    @property
+    def pipeline_name(self) -> Optional[str]:
+        return self._pipe_store.data.get('name')
+
+    @property
+    def pipeline_path(self) -> Optional[str]:
+        """ the pipeline the job's pipelines were compiled from """
+        return self._pipe_store.data.get('path')
+
+    @property
+    def stall_timeout(self) -> Optional[float]:
+        """ seconds without progress or output before a task is considered stalled, if set in the pipeline manifest """
+        timeout = self._pipe_store.data.get('stall_timeout')
+        return float(timeout) if timeout is not None else None
+
+    def pipeline_parameters(self) -> Dict:
+        """ :return: dictionary of parameter name to the value the job's pipelines were configured with """
+        params = self._pipe_store.data.get('parameters_config', {})
+        return {name: opt.get('_value', opt.get('default')) for name, opt in params.items()}
+
+    def parameters_config(self) -> Dict:
+        """ :return: the pipeline's parameters configuration, see pep_tk.core.configuration.ConfigOption.to_dict """
+        params = self._pipe_store.data.get('parameters_config', {})
+        return {name: dict(opt) for name, opt in params.items()}
+
+    def set_task_resources(self, dataset_key, resources: Dict):
+        """ Save the peak and average resource usage of the dataset's task (see pep_tk.core.resources) """
+        self._ds_store.data[dataset_key]['resources'] = resources
+
+    def get_task_resources(self, dataset_key) -> Optional[Dict]:
+        ds_meta = self._ds_store.data.get(dataset_key)
+        if ds_meta is None or ds_meta.get('resources') is None:
+            return None
+        return dict(ds_meta['resources'])
+
+    def image_count(self, dataset_key) -> int:
+        """ :return: number of images the task for this dataset will process """
+        _, dataset, _ = self.get(dataset_key)
+        return max(dataset.thermal_image_count, dataset.color_image_count)
+
     def get(self, dataset_key) -> Optional[Tuple[str, VIAMEDataset, PipelineOutputOptionGroup]]:
         ds_meta = self._ds_store.data.get(dataset_key)
         if ds_meta is None:
@@ -113,18 +178,25 @@ class TaskStatus(Enum):
 
 
 class JobState:
-    def __init__(self, root_dir, pipeline_keys=None, load_existing=False):
+    def __init__(self, root_dir, pipeline_keys=None, load_existing=False, read_only=False, reset_incomplete=True):
+        """
+        :param read_only: never write the state, e.g. to watch a job another process is running
+        :param reset_incomplete: reset the tasks that did not succeed to be run again, off when other nodes are running
+        the job (see pep_tk.core.leases)
+        """
         self.state_fp = job_state_json_fp(root_dir)
 
         dump_kwargs = dict(ensure_ascii=False, indent="\t", sort_keys=True)
-        self._store = jsonfile.jsonfile(self.state_fp, default_data={}, autosave=True, dump_kwargs=dump_kwargs)
+        self._store = jsonfile.jsonfile(self.state_fp, default_data={}, autosave=not read_only,
+                                        dump_kwargs=dump_kwargs)
 
         if load_existing:
             if not os.path.isfile(self.state_fp):
                 msg = f'Unable to load job. {self.state_fp} does not exist.'
                 raise JobInitException(msg)
 
-            self._store = jsonfile.jsonfile(self.state_fp, default_data={}, autosave=True, dump_kwargs=dump_kwargs)
+            self._store = jsonfile.jsonfile(self.state_fp, default_data={}, autosave=not read_only,
+                                            dump_kwargs=dump_kwargs)
             if not self._store.data.get('initialized', False):
                 msg = f'Possibly corrupt job file, please share the following file with Yuval. {self.state_fp}'
                 raise JobInitException(msg)
@@ -138,26 +210,38 @@ class JobState:
 
             # initialize the new job
             self._store.data['tasks'] = sorted(pipeline_keys)
+            self._store.data['dispatch_order'] = sorted(pipeline_keys)
+            self._store.data['dispatch_policy'] = {'name': 'alphabetical'}
             self._store.data['task_status'] = {task_key: TaskStatus.INITIALIZED.value for task_key in pipeline_keys}
             self._store.data['total_tasks'] = len(pipeline_keys)
             self._store.data['task_outputs'] = {task_key: [] for task_key in pipeline_keys}
             self._store.data['initialized'] = True
 
         # reset any previous errored tasks to initialized
-        for task_key in self._store.data['task_status']:
-            if self.get_status(task_key) != TaskStatus.SUCCESS:
-                self._store.data['task_status'][task_key] = TaskStatus.INITIALIZED.value
+        if not read_only and reset_incomplete:
+            for task_key in self._store.data['task_status']:
+                if self.get_status(task_key) != TaskStatus.SUCCESS:
+                    self._store.data['task_status'][task_key] = TaskStatus.INITIALIZED.value
 
     def get_status(self, task_key: TaskKey):
         return TaskStatus(self._store.data['task_status'][task_key])
 
     @classmethod
-    def load(cls, meta_directory):
-        return cls(meta_directory, load_existing=True)
+    def load(cls, meta_directory, read_only=False, reset_incomplete=True):
+        return cls(meta_directory, load_existing=True, read_only=read_only, reset_incomplete=reset_incomplete)
 
-    def current_task(self) -> Optional[TaskKey]:
-        for task_key in self.tasks():
-            if self.is_task_complete(task_key):
+    def reload(self):
+        """ Re-read the state from the job directory, e.g. after another process running the job changed it """
+        self._store.reload()
+
+    def stop_saving(self):
+        """ Only change the state in memory from now on, e.g. once another process took over running the job """
+        self._store.autosave = False
+
+    def current_task(self, exclude: Optional[Collection[TaskKey]] = None) -> Optional[TaskKey]:
+        """ :return: the next incomplete task in dispatch order, skipping the tasks in exclude (e.g. running tasks) """
+        for task_key in self.dispatch_order():
+            if self.is_task_complete(task_key) or (exclude and task_key in exclude):
                 continue
             return task_key
 
@@ -171,6 +255,37 @@ class JobState:
     def set_task_status(self, task_key: TaskKey, status: TaskStatus):
         self._store.data['task_status'][task_key] = status.value
 
+    def add_task_event(self, task_key: TaskKey, event: Dict):
+        """ Record an event of a task, e.g. the watchdog killing a stalled task """
+        # jobs created before task events existed don't have the key
+        if 'task_events' not in self._store.data:
+            self._store.data['task_events'] = {}
+        self._store.data['task_events'][task_key] = self.get_task_events(task_key) + [event]
+
+    def get_task_events(self, task_key: TaskKey) -> List[Dict]:
+        return [dict(e) for e in self._store.data.get('task_events', {}).get(task_key, [])]
+
+    def add_job_event(self, event: Dict):
+        """ Record an event of the whole job, e.g. an abort rule cancelling every task """
+        self._store.data['job_events'] = self.get_job_events() + [event]
+
+    def get_job_events(self) -> List[Dict]:
+        return [dict(e) for e in self._store.data.get('job_events', [])]
+
+    def get_task_attempts(self, task_key: TaskKey) -> List[Dict]:
+        """ :return: the recorded runs of the task (exit code, status, failure class, ...), oldest first """
+        return [e for e in self.get_task_events(task_key) if e.get('event') == 'attempt']
+
+    def set_task_checkpoint(self, task_key: TaskKey, checkpoint: Optional[Dict]):
+        """ Save the partial outputs of a task to resume from (see pep_tk.core.checkpoint), None clears it """
+        if 'task_checkpoints' not in self._store.data:
+            self._store.data['task_checkpoints'] = {}
+        self._store.data['task_checkpoints'][task_key] = checkpoint
+
+    def get_task_checkpoint(self, task_key: TaskKey) -> Optional[Dict]:
+        checkpoint = self._store.data.get('task_checkpoints', {}).get(task_key)
+        return dict(checkpoint) if checkpoint is not None else None
+
     def set_task_outputs(self, task_key: TaskKey, outputs: List[str]):
         self._store.data['task_outputs'][task_key] = outputs
 
@@ -195,6 +310,25 @@ class JobState:
 
         return ret
 
+    def dispatch_order(self) -> List[TaskKey]:
+        """ :return: all tasks in the order the scheduler runs them """
+        # jobs created before dispatch policies existed run in task order
+        return list(self._store.data.get('dispatch_order', self._store.data['tasks']))
+
+    def dispatch_policy(self) -> Dict:
+        return dict(self._store.data.get('dispatch_policy', {'name': 'alphabetical'}))
+
+    def set_dispatch_order(self, order: List[TaskKey], policy: Optional[Dict] = None):
+        if sorted(order) != sorted(self.tasks()):
+            raise JobInitException('Dispatch order must contain every task in the job exactly once.')
+        self._store.data['dispatch_order'] = list(order)
+        if policy is not None:
+            self._store.data['dispatch_policy'] = policy
+
+    def apply_dispatch_policy(self, policy: 'DispatchPolicy', job_meta: JobMeta):
+        """ Re-order the tasks with the given policy (see pep_tk.core.dispatch) and persist the order """
+        self.set_dispatch_order(policy.order(self.tasks(), job_meta), policy.to_dict())
+
     def completed_tasks(self) -> List[TaskKey]:
         completed = []
         for task_key in self.tasks():
@@ -203,19 +337,38 @@ class JobState:
         return completed
 
 
-def load_job(directory: str) -> Tuple[JobState, JobMeta]:
-    job_state = JobState.load(directory)
+def load_job(directory: str, dispatch_policy: 'DispatchPolicy' = None,
+             read_only: bool = False, reset_incomplete: bool = True) -> Tuple[JobState, JobMeta]:
+    job_state = JobState.load(directory, read_only=read_only, reset_incomplete=reset_incomplete)
     job_meta = JobMeta(directory)
+    if dispatch_policy is not None:
+        job_state.apply_dispatch_policy(dispatch_policy, job_meta)
     return job_state, job_meta
 
 def job_exists(job_path: str):
     try:
-        job_state, job_meta = load_job(job_path)
+        job_state, job_meta = load_job(job_path, read_only=True)
     except:
         return False
     return True
 
-def create_job(directory, pipeline: PipelineConfig, datasets: List[VIAMEDataset], force=False) -> str:
+def create_job(directory, pipeline: PipelineConfig, datasets: List[VIAMEDataset], force=False,
+               dispatch_policy: 'DispatchPolicy' = None, delta_from: Optional[str] = None,
+               post_filter: bool = False) -> str:
+    """
+    Create a job that runs the pipeline on every dataset.
+
+    :param directory: directory of the new job, must not exist unless force is set
+    :param pipeline: the pipeline to run
+    :param datasets: the datasets to run the pipeline on
+    :param force: delete the directory if it exists
+    :param dispatch_policy: order to run the tasks in, alphabetical if not set
+    :param delta_from: directory of a previous job of the same pipeline, only the images added to each dataset since
+    that job are processed and the outputs include the previous detections (see pep_tk.core.delta)
+    :param post_filter: run the post filter parameters of the pipeline at their permissive run value and apply the
+    configured thresholds to the outputs, so the job can be re-thresholded later (see pep_tk.core.post_filter)
+    :return: the job directory
+    """
     if os.path.isdir(directory) or os.path.isfile(directory):
         if force:
             shutil.rmtree(directory, ignore_errors=True)
@@ -237,8 +390,13 @@ def create_job(directory, pipeline: PipelineConfig, datasets: List[VIAMEDataset]
         # initialize state and meta
         # TODO make interface for initializing job state and meta the same
         job_meta = JobMeta(directory)
-        job_meta.create_meta(pipeline=pipeline, datasets=datasets)
+        job_meta.create_meta(pipeline=pipeline, datasets=datasets, post_filter=post_filter)
         job_state = JobState(directory, job_meta.keys())
+        if dispatch_policy is not None:
+            job_state.apply_dispatch_policy(dispatch_policy, job_meta)
+        if delta_from:
+            from pep_tk.core.delta import create_delta_checkpoints
+            create_delta_checkpoints(job_state, job_meta, delta_from)
     except Exception as e:
         # clean up if failed for some reason
         # important to make sure this is never reached without the initial directory exists check
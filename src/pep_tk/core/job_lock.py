@@ -0,0 +1,320 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Exclusive lock of a job directory, so two schedulers (e.g. the same job resumed in two GUIs) never run the same job
+and race on its state and outputs.  The lock is a file in the job's meta directory naming the process holding it (pid,
+host and what it is), renewed with a heartbeat while the job runs.  The heartbeat also carries the progress of the
+running tasks, so other processes can watch the job read only (see watch_job).
+
+A lock is stale when its heartbeat is older than the stale timeout, or when the process holding it is gone (only
+detectable on the same host).  A stale lock, e.g. of a GUI that crashed, is removed when the job is run again.  Jobs
+run on several nodes (see pep_tk.core.leases) don't take the lock, a job can't be locked while nodes are running it.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from pep_tk.core.detection_stats import DetectionStats
+from pep_tk.core.job import JobMeta, JobState, TaskStatus, meta_dir
+from pep_tk.core.leases import SharedStateLock, active_leases, read_json, write_exclusive
+
+DEFAULT_HEARTBEAT_INTERVAL = 10.
+DEFAULT_STALE_TIMEOUT = 60.
+
+job_lock_fp = lambda root_dir: os.path.join(meta_dir(root_dir), 'job.lock')
+
+
+def pid_alive(pid: int) -> bool:
+    """ :return: True if a process with the pid is running on this host, always True where it can't be checked """
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # running as another user
+    return True
+
+
+@dataclass
+class LockHolder:
+    pid: int
+    host: str
+    owner: str  # what is running the job, e.g. gui, daemon or run
+    acquired: float
+    heartbeat: float
+    progress: Dict[str, int] = field(default_factory=dict)  # task key -> images processed, of the running tasks
+    # task key -> DetectionStats.summary_dict of the running tasks
+    detections: Dict[str, Dict] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'LockHolder':
+        return cls(pid=int(d.get('pid', 0)), host=d.get('host', ''), owner=d.get('owner', ''),
+                   acquired=float(d.get('acquired', 0)), heartbeat=float(d.get('heartbeat', 0)),
+                   progress=dict(d.get('progress', {})), detections=dict(d.get('detections', {})))
+
+    def to_dict(self) -> Dict:
+        return {'pid': self.pid, 'host': self.host, 'owner': self.owner, 'acquired': self.acquired,
+                'heartbeat': self.heartbeat, 'progress': self.progress, 'detections': self.detections}
+
+    def heartbeat_age(self) -> float:
+        return time.time() - self.heartbeat
+
+    def is_stale(self, stale_timeout: float = DEFAULT_STALE_TIMEOUT) -> bool:
+        if self.heartbeat_age() > stale_timeout:
+            return True
+        return self.host == socket.gethostname() and not pid_alive(self.pid)
+
+    def describe(self) -> str:
+        since = datetime.fromtimestamp(self.acquired).strftime('%Y-%m-%d %H:%M:%S')
+        return f'{self.owner} (pid {self.pid} on {self.host}) since {since}, ' \
+               f'last heartbeat {self.heartbeat_age():.0f} seconds ago'
+
+
+class JobLockedException(Exception):
+    def __init__(self, message: str, holder: Optional[LockHolder] = None):
+        super().__init__(message)
+        self.holder = holder  # None if the job is being run on several nodes
+
+
+def read_job_lock(root_dir: str) -> Optional[LockHolder]:
+    """ :return: the holder of the job's lock, None if the job is not locked """
+    data = read_json(job_lock_fp(root_dir))
+    return LockHolder.from_dict(data) if data is not None else None
+
+
+def break_job_lock(root_dir: str, holder: Optional[LockHolder] = None) -> bool:
+    """
+    Remove the job's lock, e.g. a stale lock.
+
+    :param holder: only remove the lock if it is still held by this holder, not a process that took it since
+    :return: True if the lock was removed
+    """
+    fp = job_lock_fp(root_dir)
+    broken_fp = f'{fp}.{socket.gethostname()}-{os.getpid()}.broken'
+    with SharedStateLock(root_dir):  # not while JobLock.renew checks and writes it
+        try:
+            os.rename(fp, broken_fp)  # only one of the processes breaking the lock gets it
+        except FileNotFoundError:
+            return False
+        data = read_json(broken_fp)
+        if holder is not None and data is not None and LockHolder.from_dict(data).acquired != holder.acquired:
+            # taken by another process since it was read, put it back unless yet another process took the lock
+            try:
+                os.link(broken_fp, fp)
+            except FileExistsError:
+                pass
+            os.remove(broken_fp)
+            return False
+        os.remove(broken_fp)
+        return True
+
+
+class JobLock:
+    def __init__(self, root_dir: str, owner: str = 'pep_tk', progress: Optional[Callable[[], Dict[str, int]]] = None,
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL, stale_timeout: float = DEFAULT_STALE_TIMEOUT,
+                 on_lost: Optional[Callable[[], None]] = None,
+                 detections: Optional[Callable[[], Dict[str, Dict]]] = None):
+        """
+        Exclusive lock of a job directory held while running the job.
+
+        :param root_dir: the job directory
+        :param owner: what is running the job, shown to processes that find the job locked
+        :param progress: returns the images processed by each running task, published with every heartbeat
+        :param heartbeat_interval: seconds between heartbeats
+        :param stale_timeout: seconds without a heartbeat after which another process may take the lock
+        :param on_lost: called from the heartbeat thread if another process removed or took the lock while it was
+        held, e.g. a heartbeat was delayed past the stale timeout.  Should stop running the job, another process may
+        be running it now.
+        :param detections: returns the detection statistics of each running task, published with every heartbeat
+        """
+        self.root_dir = root_dir
+        self.lock_fp = job_lock_fp(root_dir)
+        self.owner = owner
+        self.progress = progress
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_timeout = stale_timeout
+        self.on_lost = on_lost
+        self.detections = detections
+        self.holder: Optional[LockHolder] = None
+        self._lost = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def held(self) -> bool:
+        return self.holder is not None
+
+    @property
+    def lost(self) -> bool:
+        """ True if another process removed or took the lock while this process held it """
+        return self._lost
+
+    def acquire(self) -> 'JobLock':
+        """ Take the lock and start the heartbeat, :raises JobLockedException: if the job is already running """
+        running_on = {lease.get('node') for lease in active_leases(self.root_dir).values()}
+        if running_on:
+            raise JobLockedException(f'The job is running on {len(running_on)} node(s): '
+                                     f'{", ".join(sorted(running_on))}')
+        now = time.time()
+        holder = LockHolder(os.getpid(), socket.gethostname(), self.owner, now, now)
+        while not write_exclusive(self.lock_fp, holder.to_dict()):
+            current = read_job_lock(self.root_dir)
+            if current is None:
+                try:
+                    if time.time() - os.stat(self.lock_fp).st_mtime > self.stale_timeout:
+                        break_job_lock(self.root_dir)  # unreadable, e.g. the disk filled up while writing it
+                    else:
+                        time.sleep(.1)
+                except OSError:
+                    pass  # released in the meantime
+                continue
+            if not current.is_stale(self.stale_timeout):
+                raise JobLockedException(f'The job is already running: {current.describe()}', current)
+            print(f'Warning: removing the stale lock of {current.describe()}')
+            break_job_lock(self.root_dir, current)
+        self.holder = holder
+        self._lost = False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def release(self):
+        """ Stop the heartbeat and remove the lock, if it is still held by this process """
+        if self.holder is None:
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        with SharedStateLock(self.root_dir):
+            if self._holds(read_job_lock(self.root_dir)):
+                try:
+                    os.remove(self.lock_fp)
+                except OSError:
+                    pass
+        self.holder = None
+
+    def _holds(self, current: Optional[LockHolder]) -> bool:
+        return current is not None and current.acquired == self.holder.acquired and current.pid == self.holder.pid
+
+    def renew(self):
+        """ Write a new heartbeat and the progress of the running tasks, stops the heartbeat if the lock was lost """
+        if self._lost:
+            return
+        if self.progress is not None:
+            self.holder.progress = dict(self.progress())
+        if self.detections is not None:
+            self.holder.detections = dict(self.detections())
+        tmp_fp = f'{self.lock_fp}.{os.getpid()}.tmp'
+        # another process breaks the lock under the same lock, it can't take the job between the check and the write
+        with SharedStateLock(self.root_dir):
+            if self._holds(read_job_lock(self.root_dir)):
+                self.holder.heartbeat = time.time()
+                try:
+                    with open(tmp_fp, 'w') as f:
+                        json.dump(self.holder.to_dict(), f)
+                    os.replace(tmp_fp, self.lock_fp)
+                except OSError as e:
+                    print(f'Warning: unable to renew the lock of {self.root_dir}: {e}')
+                return
+        print(f'Warning: the lock of {self.root_dir} was removed by another process, stopping the job')
+        self._lost = True
+        self._stop.set()
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            self.renew()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def running_progress(manager) -> Dict[str, int]:
+    """ :return: task key -> images processed of the running tasks of a SchedulerEventManager, for JobLock progress """
+    return {task_key: count for task_key, count in list(manager.task_count.items())
+            if manager.task_status.get(task_key) == TaskStatus.RUNNING}
+
+
+def running_detections(manager) -> Dict[str, Dict]:
+    """ :return: task key -> DetectionStats.summary_dict of the running tasks of a SchedulerEventManager """
+    return {task_key: stats.summary_dict() for task_key, stats in list(manager.task_detections.items())
+            if manager.task_status.get(task_key) == TaskStatus.RUNNING}
+
+
+def watch_job(job_state: JobState, job_meta: JobMeta, manager, stop_event: threading.Event, poll_freq: float = 2.):
+    """
+    Follow a job another process is running without changing it, the status of its tasks and the progress published
+    with the lock's heartbeat are passed to the manager as if a scheduler was running them.  Returns once the job is no
+    longer locked, the lock is stale or stop_event is set.
+
+    :param job_state: the job state, loaded read only
+    :param job_meta: the job meta
+    :param manager: the SchedulerEventManager to update, e.g. the GUI
+    :param stop_event: set to stop watching
+    :param poll_freq: seconds between reading the job state and lock
+    """
+    status = {}
+    published = {}  # task key -> the detection statistics last passed to the manager
+    for task_key in job_state.tasks():
+        _, dataset, _ = job_meta.get(task_key)
+        max_image_count = max(dataset.thermal_image_count, dataset.color_image_count)
+        if job_state.get_status(task_key) == TaskStatus.SUCCESS:
+            status[task_key] = TaskStatus.SUCCESS
+            manager.initialize_task(task_key, max_image_count, max_image_count, TaskStatus.SUCCESS,
+                                    job_state.get_task_outputs(task_key))
+        else:
+            status[task_key] = TaskStatus.INITIALIZED
+            manager.initialize_task(task_key, 0, max_image_count, TaskStatus.INITIALIZED)
+
+    while True:
+        job_state.reload()
+        holder = read_job_lock(job_meta.root_dir)
+        progress = holder.progress if holder is not None else {}
+        detections = holder.detections if holder is not None else {}
+        for task_key in job_state.tasks():
+            task_status = job_state.get_status(task_key)
+            if task_status != status[task_key]:
+                status[task_key] = task_status
+                if task_status == TaskStatus.RUNNING:
+                    manager.start_task(task_key)
+                else:
+                    manager.end_task(task_key, task_status)
+                    outputs = job_state.get_task_outputs(task_key)
+                    if task_status == TaskStatus.SUCCESS and outputs:
+                        manager.update_task_output_files(task_key, outputs)
+            count = progress.get(task_key)
+            if task_status == TaskStatus.RUNNING and count is not None and count != manager.task_count.get(task_key):
+                manager.update_task_progress(task_key, count)
+            stats = detections.get(task_key)
+            if task_status == TaskStatus.RUNNING and stats is not None and stats != published.get(task_key):
+                published[task_key] = stats
+                manager.update_task_detections(task_key, DetectionStats.from_dict(stats))
+        if holder is None or holder.is_stale() or stop_event.wait(poll_freq):
+            return
@@ -16,18 +16,21 @@
 
 import os
 import subprocess
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 
-def get_kwiver_runner_command(kwiver_setup_path=None, debug=False) -> List:
+def get_kwiver_runner_command(kwiver_setup_path=None, debug=False, cpu_affinity: Optional[str] = None) -> List:
     """
     Get Command for Kwiver Runner
 
     :param kwiver_setup_path: path to kwiver_setup.sh or on windows kwiver_setup.bat
     :param debug: run kwiver with gdb --debug
+    :param cpu_affinity: cpu list in taskset format (e.g. '0-3,8') to pin kwiver to, linux only
     :return: List command
     """
     if os.name == 'nt':
+        if cpu_affinity:
+            print(f'Warning: cpu affinity "{cpu_affinity}" is not supported on windows, ignoring.')
         if kwiver_setup_path:
             return [f'"{kwiver_setup_path}"', '&&', 'kwiver.exe', 'runner']
         else:
@@ -38,6 +41,9 @@ def get_kwiver_runner_command(kwiver_setup_path=None, debug=False) -> List:
         else:
             args = ['kwiver', 'runner']
 
+        if cpu_affinity:
+            args = ['taskset', '-c', cpu_affinity] + args
+
         if kwiver_setup_path:
             args = ['source', kwiver_setup_path, '&&', 'printenv', '&&'] + args
         return args
@@ -55,10 +61,10 @@ def execute_command(cmd: str, env: Dict, cwd, stdout=None, stderr=None) -> subpr
     :return: subprocess.Popen object
     """
     if os.name == 'nt':
-        env = {**env, **os.environ}
+        env = {**os.environ, **env}
         return subprocess.Popen(cmd, cwd=cwd, stdout=stdout, stderr=subprocess.STDOUT, env=env)
     else:
-        env = {**env, **os.environ}
+        env = {**os.environ, **env}
         return subprocess.Popen(cmd, cwd=cwd, stdout=stdout, stderr=stderr, env=env, shell=True, executable='/bin/bash')
 
 
@@ -72,7 +78,8 @@ class KwiverRunner:
                  cwd: str,
                  env: Dict = None,
                  pipe_args: Dict = None,
-                 kwiver_setup_path: str = None):
+                 kwiver_setup_path: str = None,
+                 cpu_affinity: Optional[str] = None):
         """
 
         :param pipeline_fp: Filepath of the .pipe file being run.
@@ -80,12 +87,14 @@ class KwiverRunner:
         :param env: environment variables to set when running the pipeline.
         :param pipe_args: arguments to pass to kwiver runner in the '-s process:param=value' format.
         :param kwiver_setup_path: Path to the 'setup_viame.sh' or on windows 'setup_viame.bat'.
+        :param cpu_affinity: cpu list in taskset format to pin the kwiver process to (linux only).
         """
         self.pipeline_fp = pipeline_fp
         self.cwd = cwd
         self.kwiver_setup_path = kwiver_setup_path
         self.env = env or {}
         self.pipe_args = pipe_args or {}
+        self.cpu_affinity = cpu_affinity
 
     def get_environment_str(self) -> str:
         """
@@ -123,7 +132,8 @@ class KwiverRunner:
         :param stderr: Optional stream for process to write stderr to
         :return: The subprocess.Popen object
         """
-        cmd = get_kwiver_runner_command(kwiver_setup_path=self.kwiver_setup_path) + [self.pipeline_fp]
+        cmd = get_kwiver_runner_command(kwiver_setup_path=self.kwiver_setup_path,
+                                        cpu_affinity=self.cpu_affinity) + [self.pipeline_fp]
         cmd = ' '.join(cmd)
 
         # Add kwiver runner pipeline arguments
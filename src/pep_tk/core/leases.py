@@ -0,0 +1,297 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Multi-node execution of one job over a shared filesystem.  Schedulers on several hosts (or several processes on one
+host) run the same job directory, each task is claimed through a lease file in the job's leases folder before it is
+started so only one node runs it.  A node renews the heartbeat of its leases while its tasks run, the lease of a node
+that stopped renewing it (crashed, lost its mount) expires after lease_timeout seconds and the task is reclaimed by
+another node.  The heartbeats are compared against the local clock, the clocks of the nodes must be synchronized to
+well within lease_timeout.
+
+Lease files are created with an atomic hard link and expired leases are reclaimed with an atomic rename, both are
+atomic on local filesystems and NFS.  Changes to job_state.json are made under a lock file by re-reading the state
+first (see SharedStateLock) so the nodes don't overwrite each other's changes.
+"""
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from pep_tk.core.job import TaskKey
+
+DEFAULT_LEASE_TIMEOUT = 60.
+LEASE_SUFFIX = '.lease'
+
+leases_dir = lambda root_dir: os.path.join(root_dir, 'leases')
+state_lock_fp = lambda root_dir: os.path.join(root_dir, 'meta', 'job_state.lock')
+
+
+def default_node_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def write_exclusive(fp: str, data: Dict) -> bool:
+    """ Create a file with its whole content at once.  :return: False if the file already exists """
+    tmp_fp = f'{fp}.{default_node_id()}.{threading.get_ident()}.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(data, f)
+    try:
+        os.link(tmp_fp, fp)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_fp)
+
+
+def read_json(fp: str) -> Optional[Dict]:
+    try:
+        with open(fp, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_leases(root_dir: str) -> Dict[TaskKey, Dict]:
+    """ :return: task key -> lease of every lease in the job, including expired leases """
+    leases = {}
+    directory = leases_dir(root_dir)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return leases
+    for name in names:
+        if name.endswith(LEASE_SUFFIX):
+            lease = read_json(os.path.join(directory, name))
+            if lease is not None and 'task' in lease:
+                leases[lease['task']] = lease
+    return leases
+
+
+def active_leases(root_dir: str) -> Dict[TaskKey, Dict]:
+    """ :return: task key -> lease of the unexpired leases of the job, i.e. the tasks nodes are running """
+    now = time.time()
+    return {task_key: lease for task_key, lease in read_leases(root_dir).items()
+            if now - lease.get('heartbeat', 0) <= lease.get('timeout', DEFAULT_LEASE_TIMEOUT)}
+
+
+class LeaseManager:
+    def __init__(self, root_dir: str, node: Optional[str] = None, lease_timeout: float = DEFAULT_LEASE_TIMEOUT,
+                 heartbeat_interval: Optional[float] = None):
+        """
+        Claims the tasks of a job for this node through lease files.
+
+        :param root_dir: the job directory
+        :param node: unique name of this node, defaults to <hostname>-<pid>
+        :param lease_timeout: seconds without a heartbeat after which a lease is expired and its task can be reclaimed
+        :param heartbeat_interval: seconds between heartbeats, a quarter of the lease timeout by default
+        """
+        self.root_dir = root_dir
+        self.lease_dir = leases_dir(root_dir)
+        self.node = node or default_node_id()
+        self.host = socket.gethostname()
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval or lease_timeout / 4
+        self._held: Dict[TaskKey, Dict] = {}
+        self._lost: Set[TaskKey] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        os.makedirs(self.lease_dir, exist_ok=True)
+
+    def _lease_fp(self, task_key: TaskKey) -> str:
+        return os.path.join(self.lease_dir, re.sub(r'[^\w.-]', '_', task_key) + LEASE_SUFFIX)
+
+    def _new_lease(self, task_key: TaskKey) -> Dict:
+        now = time.time()
+        return {'task': task_key, 'node': self.node, 'host': self.host, 'pid': os.getpid(), 'acquired': now,
+                'heartbeat': now, 'timeout': self.lease_timeout}
+
+    def read(self, task_key: TaskKey) -> Optional[Dict]:
+        return read_json(self._lease_fp(task_key))
+
+    def expired(self, lease: Dict) -> bool:
+        return time.time() - lease.get('heartbeat', 0) > self.lease_timeout
+
+    def start(self):
+        """ Start renewing the heartbeat of the held leases """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the heartbeats and release every held lease """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        for task_key in list(self._held):
+            self.release(task_key)
+
+    def acquire(self, task_key: TaskKey) -> bool:
+        """ :return: True if this node now holds the task's lease """
+        fp = self._lease_fp(task_key)
+        with self._lock:
+            if task_key in self._held:
+                return True
+            lease = self._new_lease(task_key)
+            if not write_exclusive(fp, lease):
+                if not self._reclaim(task_key, fp) or not write_exclusive(fp, lease):
+                    return False
+            self._held[task_key] = lease
+            self._lost.discard(task_key)
+            return True
+
+    def _reclaim(self, task_key: TaskKey, fp: str) -> bool:
+        """ Remove an expired lease.  :return: True if it was removed by this node """
+        lease = read_json(fp)
+        if lease is None:
+            try:
+                # being written, or unreadable, only reclaimed once it is as old as an expired heartbeat
+                if time.time() - os.stat(fp).st_mtime <= self.lease_timeout:
+                    return False
+            except OSError:
+                return True  # released in the meantime
+            lease = {}
+        elif not self.expired(lease):
+            return False
+        # only one of the nodes reclaiming the lease renames it, the others find it gone
+        stale_fp = f'{fp}.{self.node}.stale'
+        try:
+            os.rename(fp, stale_fp)
+        except FileNotFoundError:
+            return False
+        moved = read_json(stale_fp) or {}
+        os.remove(stale_fp)
+        if lease and moved != lease:
+            # another node reclaimed the expired lease and took the task between the read and the rename
+            write_exclusive(fp, moved)
+            return False
+        print(f'Reclaiming {task_key} from {lease.get("node", "an unknown node")}, no heartbeat for '
+              f'{time.time() - lease.get("heartbeat", 0):.0f} seconds')
+        return True
+
+    def release(self, task_key: TaskKey):
+        """ Delete the task's lease, if it is still held by this node """
+        with self._lock:
+            held = self._held.pop(task_key, None)
+            if held is None:
+                return
+            fp = self._lease_fp(task_key)
+            lease = read_json(fp)
+            if lease is not None and lease.get('node') == self.node:
+                try:
+                    os.remove(fp)
+                except OSError:
+                    pass
+
+    def lost(self, task_key: TaskKey) -> bool:
+        """ :return: True if the task's lease expired and was reclaimed by another node while this node held it """
+        return task_key in self._lost
+
+    def renew(self):
+        """ Write a new heartbeat to every held lease """
+        with self._lock:
+            for task_key, held in list(self._held.items()):
+                fp = self._lease_fp(task_key)
+                lease = read_json(fp)
+                if lease is None or lease.get('node') != self.node:
+                    print(f'Warning: the lease of {task_key} was reclaimed by '
+                          f'{(lease or {}).get("node", "another node")}')
+                    self._lost.add(task_key)
+                    del self._held[task_key]
+                    continue
+                held['heartbeat'] = time.time()
+                tmp_fp = f'{fp}.{self.node}.tmp'
+                try:
+                    with open(tmp_fp, 'w') as f:
+                        json.dump(held, f)
+                    os.replace(tmp_fp, fp)
+                except OSError as e:
+                    print(f'Warning: unable to renew the lease of {task_key}: {e}')
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            self.renew()
+
+    def leases(self) -> Dict[TaskKey, Dict]:
+        """ :return: task key -> lease of every lease in the job, including expired leases """
+        return read_leases(self.root_dir)
+
+    def held_by_others(self) -> Dict[TaskKey, Dict]:
+        """ :return: task key -> lease of the unexpired leases of other nodes """
+        return {task_key: lease for task_key, lease in self.leases().items()
+                if lease.get('node') != self.node and not self.expired(lease)}
+
+
+class SharedStateLock:
+    """
+    Lock around changes to the job state and meta shared by the nodes running a job.  Within a process it is a
+    re-entrant lock, across processes a lock file.  The state and meta are re-read from the job directory when the
+    lock is acquired, so changes are made to the latest state and saved before another node can change it.
+    """
+    def __init__(self, root_dir: str, reload: Iterable = (), stale_timeout: float = 30.):
+        """
+        :param root_dir: the job directory
+        :param reload: objects re-read when the lock is acquired, e.g. the JobState and JobMeta of the job
+        :param stale_timeout: seconds after which the lock file of a node that crashed while holding it is removed
+        """
+        self.reload = list(reload)
+        self.lock_fp = state_lock_fp(root_dir)
+        self.stale_timeout = stale_timeout
+        self._rlock = threading.RLock()
+        self._depth = 0
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0:
+            try:
+                self._acquire_file_lock()
+                for store in self.reload:
+                    store.reload()
+            except BaseException:
+                self._rlock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                os.remove(self.lock_fp)
+            except OSError:
+                pass
+        self._rlock.release()
+
+    def _acquire_file_lock(self):
+        delay = .005
+        while not write_exclusive(self.lock_fp, {'node': default_node_id(), 'time': time.time()}):
+            try:
+                if time.time() - os.stat(self.lock_fp).st_mtime > self.stale_timeout:
+                    stale_fp = f'{self.lock_fp}.{default_node_id()}.stale'
+                    os.rename(self.lock_fp, stale_fp)
+                    os.remove(stale_fp)
+                    print(f'Warning: removed the stale job state lock {self.lock_fp}')
+                    continue
+            except OSError:
+                continue  # released in the meantime
+            time.sleep(delay)
+            delay = min(delay * 2, .1)
@@ -0,0 +1,233 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pep_tk.core.detection_stats import CONFIDENCE_BINS
+from pep_tk.core.job import TaskStatus
+from pep_tk.core.resources import proc_available, read_process_usage
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name -> (type, help)
+METRICS = {
+    'pep_tk_tasks': ('gauge', 'Number of tasks in the job by status'),
+    'pep_tk_queue_depth': ('gauge', 'Number of tasks waiting to be started'),
+    'pep_tk_images_processed_total': ('counter', 'Images processed by kwiver in this session'),
+    'pep_tk_task_images': ('gauge', 'Images processed by the task'),
+    'pep_tk_task_images_expected': ('gauge', 'Images in the dataset of the task'),
+    'pep_tk_task_images_per_second': ('gauge', 'Throughput of the task since its first image'),
+    'pep_tk_task_seconds_since_progress': ('gauge', 'Seconds since a running task last processed an image'),
+    'pep_tk_task_rss_bytes': ('gauge', 'Resident memory of the kwiver process tree of a running task'),
+    'pep_tk_task_detections': ('gauge', 'Detections written by the task so far'),
+    'pep_tk_task_detections_per_image': ('gauge', 'Average detections per image processed by the task'),
+    'pep_tk_task_max_detections_per_image': ('gauge', 'Most detections the task wrote for a single image'),
+    'pep_tk_task_class_detections': ('gauge', 'Detections written by the task by top class'),
+    'pep_tk_task_detections_confidence_le': ('gauge', 'Detections written by the task with at most the le confidence'),
+    'pep_tk_process_rss_bytes': ('gauge', 'Resident memory of the pep_tk process'),
+    'pep_tk_last_update_timestamp_seconds': ('gauge', 'Time the metrics were collected'),
+}
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_sample(name: str, labels: Dict[str, str], value: float) -> str:
+    label_str = ','.join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+    value_str = repr(float(value)) if not float(value).is_integer() else str(int(value))
+    return f'{name}{{{label_str}}} {value_str}' if label_str else f'{name} {value_str}'
+
+
+class JobMetrics:
+    """
+    Collects metrics of a running job from the SchedulerEventManager the scheduler reports to, and renders them in
+    the Prometheus text exposition format.
+    """
+    def __init__(self, manager, job_name: str, clock: Callable[[], float] = time.time):
+        """
+        :param manager: the SchedulerEventManager of the scheduler
+        :param job_name: added as the job label of every metric
+        :param clock: returns the current time
+        """
+        self.manager = manager
+        self.job_name = job_name
+        self.clock = clock
+
+    def collect(self) -> List[Sample]:
+        m = self.manager
+        now = self.clock()
+        job = {'job': self.job_name}
+        samples: List[Sample] = []
+
+        statuses = dict(m.task_status)
+        for status in TaskStatus:
+            samples.append(('pep_tk_tasks', {**job, 'status': status.name.lower()},
+                            sum(1 for s in statuses.values() if s == status)))
+        samples.append(('pep_tk_queue_depth', job,
+                        sum(1 for s in statuses.values() if s == TaskStatus.INITIALIZED)))
+
+        # a running total, the progress of a task starts over when it is re-started
+        samples.append(('pep_tk_images_processed_total', job, m.images_processed))
+
+        for task_key, status in statuses.items():
+            task = {**job, 'task': task_key}
+            samples.append(('pep_tk_task_images', task, m.task_count.get(task_key, 0)))
+            samples.append(('pep_tk_task_images_expected', task, m.task_max_count.get(task_key, 0)))
+            if task_key not in m.task_start_time:
+                continue
+
+            running = status == TaskStatus.RUNNING
+            first_time = m.task_first_progress_time.get(task_key)
+            if first_time is not None:
+                end = now if running else m.task_last_progress_time.get(task_key, now)
+                images = m.task_count.get(task_key, 0) - m.task_first_progress_count.get(task_key, 0)
+                rate = images / (end - first_time) if end > first_time else 0.
+                samples.append(('pep_tk_task_images_per_second', task, rate))
+            if running:
+                last = m.task_last_progress_time.get(task_key, m.task_start_time[task_key])
+                samples.append(('pep_tk_task_seconds_since_progress', task, max(now - last, 0.)))
+                sample = m.task_resources.get(task_key)
+                if sample is not None:
+                    samples.append(('pep_tk_task_rss_bytes', task, sample.rss))
+            stats = m.task_detections.get(task_key)
+            if stats is not None:
+                samples.append(('pep_tk_task_detections', task, stats.detections))
+                samples.append(('pep_tk_task_detections_per_image', task, stats.detections_per_image))
+                samples.append(('pep_tk_task_max_detections_per_image', task, stats.max_detections_per_image))
+                for class_name, count in sorted(stats.classes.items()):
+                    samples.append(('pep_tk_task_class_detections', {**task, 'class': class_name}, count))
+                cumulative = 0
+                for i, count in enumerate(stats.confidence_histogram):
+                    cumulative += count
+                    le = f'{(i + 1) / CONFIDENCE_BINS:g}'
+                    samples.append(('pep_tk_task_detections_confidence_le', {**task, 'le': le}, cumulative))
+
+        if proc_available():
+            usage = read_process_usage(os.getpid())
+            if usage is not None:
+                samples.append(('pep_tk_process_rss_bytes', job, usage[1]))
+        samples.append(('pep_tk_last_update_timestamp_seconds', job, now))
+        return samples
+
+    def render(self) -> str:
+        by_name: Dict[str, List[Sample]] = {}
+        for sample in self.collect():
+            by_name.setdefault(sample[0], []).append(sample)
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            if name not in by_name:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(format_sample(*s) for s in by_name[name])
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.job_metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # don't print a line for every scrape
+
+
+class MetricsExporter:
+    """
+    Exposes JobMetrics through a local HTTP endpoint (GET /metrics) and/or a textfile that is rewritten periodically,
+    e.g. into the directory of the node_exporter textfile collector.
+    """
+    def __init__(self, metrics: JobMetrics, textfile_fp: Optional[str] = None, port: Optional[int] = None,
+                 host: str = '127.0.0.1', interval: float = 15):
+        """
+        :param metrics: the job metrics to expose
+        :param textfile_fp: file to write the metrics to, replaced atomically every interval
+        :param port: port to serve the metrics on, 0 picks a free port
+        :param host: address to serve the metrics on, local only by default
+        :param interval: seconds between textfile writes
+        """
+        self.metrics = metrics
+        self.textfile_fp = textfile_fp
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        if self.port is not None:
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+            except OSError as e:
+                print(f'Warning: unable to serve metrics on {self.host}:{self.port}: {e}')
+            else:
+                self._server.daemon_threads = True
+                self._server.job_metrics = self.metrics
+                self.port = self._server.server_address[1]
+                self._threads.append(threading.Thread(target=self._server.serve_forever, daemon=True))
+                print(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+        if self.textfile_fp:
+            self._threads.append(threading.Thread(target=self._textfile_loop, daemon=True))
+        for t in self._threads:
+            t.start()
+
+    def _textfile_loop(self):
+        while True:
+            self.write_textfile()
+            if self._stop_event.wait(self.interval):
+                break
+
+    def write_textfile(self):
+        if not self.textfile_fp:
+            return
+        try:
+            directory = os.path.dirname(os.path.abspath(self.textfile_fp))
+            os.makedirs(directory, exist_ok=True)
+            # the textfile collector must never read a partially written file
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp') as f:
+                f.write(self.metrics.render())
+                tmp_fp = f.name
+            os.replace(tmp_fp, self.textfile_fp)
+        except OSError as e:
+            print(f'Warning: unable to write metrics {self.textfile_fp}: {e}')
+
+    def stop(self):
+        """ Stop serving and write the final metrics to the textfile """
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for t in self._threads:
+            t.join(timeout=5)
+        self._threads = []
+        self.write_textfile()
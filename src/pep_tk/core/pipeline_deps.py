@@ -0,0 +1,238 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Dependency graph of a pipeline: the pipes it includes and the model, config and other files they reference, with the
+size, modification time and (optionally) content hash of each.  Pipes are parsed once per path and modification time
+and content hashes are memoized by path, size and modification time, so building the graph of an unchanged pipeline
+again only stats its files.
+
+Dependencies of the include and relativepath kinds are required, a missing one makes kwiver fail as soon as the
+pipeline is loaded.  preflight_pipeline reports them before a job's tasks are run.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+INCLUDE = 'include'
+RELATIVEPATH = 'relativepath'
+FILE = 'file'  # an absolute path value, only recorded if it exists (it may be e.g. an output file)
+REQUIRED_KINDS = (INCLUDE, RELATIVEPATH)
+
+_INCLUDE_RE = re.compile(r'^include\s+(\S.*)$')
+_RELATIVEPATH_RE = re.compile(r'^relativepath\s+(\S+)\s*=\s*(.*)$')
+_CONFIG_RE = re.compile(r'^(\S+)\s*=\s*(.*)$')  # key = value
+_PROCESS_CONFIG_RE = re.compile(r'^:(\S+)\s+(.*)$')  # :key value, in a process block
+
+# models are large, only hash a file again when its size or modification time changed
+_file_digests: Dict[Tuple[str, int, int], str] = {}
+_file_digests_lock = threading.Lock()
+
+# pipe path -> (modification time, parsed references)
+_parsed_pipes: Dict[str, Tuple[int, List[Tuple[str, str, str]]]] = {}
+_parsed_pipes_lock = threading.Lock()
+
+
+@dataclass
+class Dependency:
+    path: str  # absolute path
+    kind: str  # include, relativepath or file
+    key: str  # the config key referencing the file, or the include directive
+    referenced_by: str  # the pipe referencing the file
+    size: Optional[int] = None  # None if the file does not exist
+    mtime_ns: Optional[int] = None
+    digest: Optional[str] = None  # sha256 of the content, if hashed
+
+    @property
+    def exists(self) -> bool:
+        return self.size is not None
+
+    @property
+    def required(self) -> bool:
+        return self.kind in REQUIRED_KINDS
+
+    def to_dict(self) -> Dict:
+        return {'path': self.path, 'kind': self.kind, 'key': self.key, 'referenced_by': self.referenced_by,
+                'size': self.size, 'mtime_ns': self.mtime_ns, 'digest': self.digest}
+
+
+@dataclass
+class DependencyGraph:
+    pipeline: str  # absolute path of the root pipe
+    dependencies: List[Dependency] = field(default_factory=list)
+
+    def files(self, kinds: Optional[Iterable[str]] = None) -> List[str]:
+        """ :return: sorted paths of the existing dependencies, optionally only of the given kinds """
+        return sorted({d.path for d in self.dependencies if d.exists and (kinds is None or d.kind in kinds)})
+
+    def missing(self) -> List[Dependency]:
+        """ :return: the required dependencies that do not exist, once per file """
+        missing = {}
+        for d in self.dependencies:
+            if d.required and not d.exists:
+                missing.setdefault(d.path, d)
+        return list(missing.values())
+
+    def edges(self) -> Dict[str, List[str]]:
+        """ :return: pipe -> the files it references directly """
+        edges = {}
+        for d in self.dependencies:
+            edges.setdefault(d.referenced_by, []).append(d.path)
+        return edges
+
+    @property
+    def total_bytes(self) -> int:
+        return sum({d.path: d.size or 0 for d in self.dependencies}.values())
+
+    def fingerprint(self) -> str:
+        """ :return: hash of the content of the pipeline and every existing dependency, requires hashed contents """
+        h = hashlib.sha256()
+        h.update(file_digest(self.pipeline).encode('utf-8'))
+        for digest in sorted({d.digest or '' for d in self.dependencies if d.exists}):
+            h.update(digest.encode('utf-8'))
+        return h.hexdigest()
+
+    def to_dict(self) -> Dict:
+        return {'pipeline': self.pipeline, 'dependencies': [d.to_dict() for d in self.dependencies]}
+
+
+def file_digest(fp: str) -> str:
+    """ :return: sha256 hex digest of a file's content, memoized by path, size and modification time """
+    st = os.stat(fp)
+    memo_key = (os.path.abspath(fp), st.st_size, st.st_mtime_ns)
+    with _file_digests_lock:
+        digest = _file_digests.get(memo_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(fp, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with _file_digests_lock:
+            _file_digests[memo_key] = digest
+    return digest
+
+
+def parse_pipe_references(content: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    The files a pipe may reference, in the order they appear.
+
+    :param content: the content of a pipe
+    :return: iterator of (kind, key, value), value is the path as written in the pipe
+    """
+    for line in content.splitlines():
+        line = line.split('#', 1)[0].strip()  # kwiver comments start with #
+        if not line:
+            continue
+        m = _INCLUDE_RE.match(line)
+        if m:
+            yield INCLUDE, 'include', m.group(1).strip()
+            continue
+        m = _RELATIVEPATH_RE.match(line)
+        if m:
+            yield RELATIVEPATH, m.group(1), m.group(2).strip()
+            continue
+        m = _CONFIG_RE.match(line) or _PROCESS_CONFIG_RE.match(line)
+        if m and os.path.isabs(m.group(2).strip()):
+            yield FILE, m.group(1).lstrip(':'), m.group(2).strip()
+
+
+def _parse_pipe(pipe_fp: str) -> List[Tuple[str, str, str]]:
+    """ :return: the references of a pipe, parsed again only when the pipe was modified """
+    mtime = os.stat(pipe_fp).st_mtime_ns
+    with _parsed_pipes_lock:
+        cached = _parsed_pipes.get(pipe_fp)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(pipe_fp, 'r') as f:
+        references = list(parse_pipe_references(f.read()))
+    with _parsed_pipes_lock:
+        _parsed_pipes[pipe_fp] = (mtime, references)
+    return references
+
+
+def _resolve_include(value: str, pipe_dir: str, include_paths: Iterable[str]) -> str:
+    if os.path.isabs(value):
+        return os.path.normpath(value)
+    for directory in [pipe_dir, *include_paths]:
+        candidate = os.path.normpath(os.path.join(directory, value))
+        if os.path.isfile(candidate):
+            return candidate
+    return os.path.normpath(os.path.join(pipe_dir, value))
+
+
+def build_dependency_graph(pipeline_fp: str, hash_contents: bool = True,
+                           include_paths: Iterable[str] = ()) -> DependencyGraph:
+    """
+    Parse a pipeline and the pipes it includes into a dependency graph.
+
+    :param pipeline_fp: the pipeline, relativepath entries are resolved relative to the pipe they appear in the same
+    way compile_pipeline does
+    :param hash_contents: hash the content of every existing dependency
+    :param include_paths: directories to search for included pipes that are not relative to the including pipe
+    :return: the dependency graph
+    """
+    root = os.path.normpath(os.path.abspath(pipeline_fp))
+    include_paths = list(include_paths)
+    graph = DependencyGraph(root)
+    visited = set()
+    pending = [root]
+    while pending:
+        pipe_fp = pending.pop(0)
+        if pipe_fp in visited:
+            continue  # included twice, or an include cycle
+        visited.add(pipe_fp)
+        pipe_dir = os.path.dirname(pipe_fp)
+        for kind, key, value in _parse_pipe(pipe_fp):
+            if kind == INCLUDE:
+                path = _resolve_include(value, pipe_dir, include_paths)
+            elif kind == RELATIVEPATH:
+                path = os.path.normpath(os.path.join(pipe_dir, value))
+            else:
+                path = os.path.normpath(value)
+            dep = Dependency(path, kind, key, pipe_fp)
+            try:
+                st = os.stat(path)
+            except OSError:
+                if kind == FILE:
+                    continue  # not necessarily an input
+            else:
+                if not os.path.isfile(path):
+                    continue  # e.g. an output directory
+                dep.size, dep.mtime_ns = st.st_size, st.st_mtime_ns
+                if hash_contents:
+                    dep.digest = file_digest(path)
+                if kind == INCLUDE:
+                    pending.append(path)
+            graph.dependencies.append(dep)
+    return graph
+
+
+def preflight_pipeline(pipeline_fp: str, include_paths: Iterable[str] = ()) -> List[str]:
+    """
+    Check that a pipeline and every file it requires exist, without hashing them.
+
+    :return: a message for every missing file, an empty list if the pipeline can be loaded
+    """
+    if not os.path.isfile(pipeline_fp):
+        return [f'pipeline {pipeline_fp} does not exist']
+    graph = build_dependency_graph(pipeline_fp, hash_contents=False, include_paths=include_paths)
+    return [f'{d.kind} {d.key} of {os.path.basename(d.referenced_by)}: {d.path} does not exist'
+            for d in graph.missing()]
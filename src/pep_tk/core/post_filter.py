@@ -0,0 +1,190 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Post filter parameters are pipeline parameters that only drop detections below a confidence threshold, e.g. a
+detector's output threshold.  They are marked in the pipeline manifest with a post_filter block:
+
+    detection_threshold_hotspot:
+      default: 0.1
+      type: float[0,1]
+      env_variable: PIPE_ARG_DET_THRESH_HS
+      post_filter:
+        run_value: 0.01                       # permissive value the pipeline is run with
+        outputs: [output_thermal_detections]  # optional, the detection outputs it filters, defaults to all
+        classes: [hotspot]                    # optional, only filter detections of these classes
+
+Post filtering is opt-in per job, create_job(..., post_filter=True).  The pipeline then runs once at run_value, the
+unfiltered detections are kept in the job's outputs_raw directory and the configured value is applied to the
+detections in outputs_success.  rethreshold_job filters the raw detections at any stricter value without running
+kwiver again.  Only the detections of the listed classes are filtered, a job that post filters keeps the detections
+of any other class the pipeline outputs at run_value.  Other jobs run the pipeline at the configured values.
+"""
+
+import os
+import re
+import shutil
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from pep_tk.core.job import JobMeta, TaskStatus, load_job, raw_outputs_dir
+
+# columns of a VIAME detection csv
+CONFIDENCE_COLUMN = 7
+CLASS_COLUMN = 9  # the first (highest scoring) class of the detection
+
+
+class PostFilterException(Exception):
+    pass
+
+
+@dataclass
+class PostFilter:
+    parameter: str
+    threshold: float  # detections with a lower confidence are dropped
+    run_value: float
+    outputs: Optional[List[str]] = None  # output config names, None for every detection output
+    classes: Optional[List[str]] = None  # None for every class
+
+    def applies_to(self, output_name: str) -> bool:
+        return self.outputs is None or output_name in self.outputs
+
+
+def post_filters(parameters_config: Dict, values: Optional[Dict] = None) -> List[PostFilter]:
+    """
+    :param parameters_config: a pipeline's parameters_config (see JobMeta.parameters_config)
+    :param values: parameter name to threshold, overriding the configured values
+    :return: the post filters of the pipeline
+    """
+    values = values or {}
+    filters = []
+    for name, opt in parameters_config.items():
+        if not opt.get('post_filter'):
+            continue
+        pf = dict(opt['post_filter'])
+        configured = float(opt.get('_value', opt.get('default')))
+        # the pipeline ran at the configured value if it is more permissive, see ConfigOption.run_value
+        run_value = min(float(pf['run_value']), configured)
+        threshold = float(values.get(name, configured))
+        filters.append(PostFilter(parameter=name, threshold=threshold, run_value=run_value,
+                                  outputs=list(pf['outputs']) if pf.get('outputs') else None,
+                                  classes=list(pf['classes']) if pf.get('classes') else None))
+    unknown = set(values) - set(f.parameter for f in filters)
+    if unknown:
+        raise PostFilterException(f'Not post filter parameters: {", ".join(sorted(unknown))}')
+    return filters
+
+
+def filter_detections(raw_fp: str, out_fp: str, filters: List[PostFilter]) -> int:
+    """
+    Write the detections of a VIAME detection csv that pass every filter, header lines are kept.  The detection
+    lines are split and compared as whole columns instead of one row at a time.
+
+    :param raw_fp: detection csv to filter
+    :param out_fp: filtered detection csv, may be raw_fp
+    :param filters: the filters to apply
+    :return: number of detections written
+    """
+    with open(raw_fp, 'r') as f:
+        lines = pd.Series(f.read().splitlines(), dtype=object)
+    lines = lines[lines.str.strip() != '']
+    is_header = lines.str.startswith('#')
+    detections = lines[~is_header]
+
+    keep = pd.Series(True, index=detections.index)
+    if len(detections) > 0 and filters:
+        cols = detections.str.split(',', n=CLASS_COLUMN + 1, expand=True)
+        confidence = pd.to_numeric(cols[CONFIDENCE_COLUMN], errors='coerce')
+        classes = cols[CLASS_COLUMN] if CLASS_COLUMN in cols.columns else pd.Series(None, index=detections.index)
+        for pf in filters:
+            applies = classes.isin(pf.classes) if pf.classes is not None else True
+            keep &= ~(applies & (confidence < pf.threshold))
+
+    kept = detections[keep]
+    with open(out_fp, 'w') as f:
+        f.writelines(line + '\n' for line in lines[is_header])
+        f.writelines(line + '\n' for line in kept)
+    return len(kept)
+
+
+def apply_post_filters(job_meta: JobMeta, outputs: Dict[str, str]) -> Dict[str, str]:
+    """
+    Keep a raw copy of a task's detection outputs in outputs_raw and filter them in place with the job's post filters.
+
+    :param job_meta: meta of the job
+    :param outputs: output config name to output file of the task's detection csvs
+    :return: output config name to the raw copy of the detections, empty if the job has no post filters
+    """
+    filters = post_filters(job_meta.parameters_config())
+    if not filters:
+        return {}
+    raw_dir = raw_outputs_dir(job_meta.root_dir)
+    os.makedirs(raw_dir, exist_ok=True)
+    raw = {}
+    for name, fp in outputs.items():
+        output_filters = [pf for pf in filters if pf.applies_to(name)]
+        if not output_filters or not os.path.isfile(fp):
+            continue
+        raw[name] = os.path.join(raw_dir, os.path.basename(fp))
+        shutil.copy2(fp, raw[name])
+        filter_detections(raw[name], fp, output_filters)
+    return raw
+
+
+def rethreshold_job(job_dir: str, values: Dict[str, float], output_dir: Optional[str] = None) -> Dict[str, List[str]]:
+    """
+    Filter the raw detections of every successful task of a job at new post filter thresholds.
+
+    :param job_dir: the job directory
+    :param values: post filter parameter name to its new threshold, parameters not given keep the job's value
+    :param output_dir: directory to write the detection csvs to, defaults to a directory in the job named by the
+    thresholds, e.g. outputs_rethreshold/detection_threshold_hotspot-0.5
+    :return: task key to the written detection csvs
+    """
+    job_state, job_meta = load_job(job_dir, read_only=True)  # only reads the outputs, the job may be running
+    filters = post_filters(job_meta.parameters_config(), values)
+    for pf in filters:
+        if pf.threshold < pf.run_value:
+            raise PostFilterException(f'{pf.parameter} can not be lower than {pf.run_value:g}, the value the '
+                                      f'pipeline was run with.')
+    if output_dir is None:
+        name = '_'.join(f'{pf.parameter}-{pf.threshold:g}' for pf in filters)
+        output_dir = os.path.join(job_dir, 'outputs_rethreshold', re.sub(r'[^\w.\-]', '_', name))
+    os.makedirs(output_dir, exist_ok=True)
+
+    raw_dir = raw_outputs_dir(job_meta.root_dir)
+    written = {}
+    for task_key in job_state.tasks(status=TaskStatus.SUCCESS):
+        _, _, outputs = job_meta.get(task_key)
+        task_outputs = job_state.get_task_outputs(task_key) or []
+        for opt in outputs.get_det_csv_options():
+            output_filters = [pf for pf in filters if pf.applies_to(opt.name)]
+            prefix, _, suffix = opt.value().partition('[TIMESTAMP]')
+            for fp in task_outputs:
+                fn = os.path.basename(fp)
+                if not (fn.startswith(prefix) and fn.endswith(suffix)):
+                    continue
+                # outputs without post filters were never filtered, they have no raw copy
+                raw_fp = os.path.join(raw_dir, fn) if output_filters else fp
+                if not os.path.isfile(raw_fp):
+                    print(f'Warning: {task_key} has no raw detections {raw_fp}, skipping it')
+                    continue
+                out_fp = os.path.join(output_dir, fn)
+                filter_detections(raw_fp, out_fp, output_filters)
+                written.setdefault(task_key, []).append(out_fp)
+    return written
@@ -0,0 +1,168 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Page cache prefetching, a lighter alternative to staging (see pep_tk.core.staging) that needs no scratch space.  The
+model files of a task's pipeline and a window of the images kwiver will read next are read into the page cache ahead
+of kwiver, with posix_fadvise(WILLNEED) where available and plain background reads otherwise.  The window follows
+kwiver's position as reported by the progress monitor so it stays a bounded number of images ahead.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+from pep_tk.core.checkpoint import absolute_image_paths
+from pep_tk.core.result_cache import referenced_files
+
+DEFAULT_WINDOW = 64
+READ_CHUNK_SIZE = 1 << 20
+
+
+def prefetch_file(fp: str, use_fadvise: bool = True) -> bool:
+    """
+    Ask the kernel to read a file into the page cache.
+
+    :param fp: the file to prefetch
+    :param use_fadvise: use posix_fadvise(WILLNEED) when available, it returns immediately and the kernel reads the
+    file in the background.  Otherwise, or on filesystems that ignore the advice, the file is read and discarded
+    :return: True if the file was prefetched
+    """
+    try:
+        fd = os.open(fp, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except OSError:
+        return False  # missing files are reported by kwiver
+    try:
+        if use_fadvise and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while os.read(fd, READ_CHUNK_SIZE):
+                pass
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def pipeline_inputs(pipeline_fp: str, image_lists: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """
+    The files a compiled pipeline reads.
+
+    :param pipeline_fp: the compiled pipeline (or its resume or staged copy)
+    :param image_lists: the input image lists the pipeline may read
+    :return: (the model and other files its relativepath entries resolve to, the image lists it reads)
+    """
+    with open(pipeline_fp, 'r') as f:
+        content = f.read()
+    lists = [fp for fp in image_lists if fp and fp in content and os.path.isfile(fp)]
+    models = [fp for fp in referenced_files(content) if fp not in lists]
+    return models, lists
+
+
+class _PrefetchTask:
+    def __init__(self, image_lists: List[str], images: List[List[str]]):
+        self.image_lists = image_lists
+        self.images = images  # the images of every image list, in the order kwiver reads them
+        self.ahead = 0  # images of every list prefetched so far
+        self.stopped = threading.Event()
+
+
+class Prefetcher:
+    def __init__(self, window: int = DEFAULT_WINDOW, max_workers: int = 2, use_fadvise: bool = True):
+        """
+        Prefetches the model files and upcoming images of running tasks into the page cache.
+
+        :param window: number of images of every image list kept prefetched ahead of kwiver's position
+        :param max_workers: number of files prefetched at the same time
+        :param use_fadvise: see prefetch_file
+        """
+        self.window = max(1, window)
+        self.use_fadvise = use_fadvise
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='prefetch')
+        self._tasks: Dict[str, _PrefetchTask] = {}
+        self._lock = threading.Lock()
+
+    def prefetching(self, task_key: str) -> bool:
+        return task_key in self._tasks
+
+    def start(self, task_key: str, image_lists: Iterable[str], model_files: Iterable[str] = ()):
+        """
+        Prefetch the model files and the first window of images of a task that is about to start.  Starting a task
+        that is already prefetching with the same image lists keeps its position, e.g. the next task was prefetched
+        while the previous task ran.
+        """
+        image_lists = [fp for fp in image_lists if fp]
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is not None and task.image_lists == image_lists:
+                return
+            if task is not None:
+                task.stopped.set()
+            images = []
+            for list_fp in image_lists:
+                try:
+                    images.append(absolute_image_paths(list_fp))
+                except OSError:
+                    images.append([])
+            task = _PrefetchTask(image_lists, images)
+            self._tasks[task_key] = task
+        for fp in model_files:
+            self._submit(task, fp)
+        self.update(task_key, 0)
+
+    def update(self, task_key: str, position: int):
+        """
+        Move the prefetch window of a task.
+
+        :param task_key: the task
+        :param position: number of images kwiver processed so far in this run of the task
+        """
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is None:
+                return
+            start = max(task.ahead, position)  # images kwiver already read are not prefetched
+            end = position + self.window
+            if end <= start:
+                return
+            task.ahead = end
+        for images in task.images:
+            for image in images[start:end]:
+                self._submit(task, image)
+
+    def _submit(self, task: _PrefetchTask, fp: str):
+        try:
+            self._pool.submit(self._prefetch, task, fp)
+        except RuntimeError:
+            pass  # closed
+
+    def _prefetch(self, task: _PrefetchTask, fp: str):
+        if not task.stopped.is_set():
+            prefetch_file(fp, self.use_fadvise)
+
+    def stop(self, task_key: str):
+        """ Stop prefetching a task, prefetches that were not started yet are skipped """
+        with self._lock:
+            task = self._tasks.pop(task_key, None)
+        if task is not None:
+            task.stopped.set()
+
+    def close(self):
+        for task_key in list(self._tasks):
+            self.stop(task_key)
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,165 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+# Set to 1 (or run pep_gui --profile) to profile the scheduler, its task threads and the gui event loop of every job
+PROFILE_ENV_VAR = 'PEP_TK_PROFILE'
+# Seconds between tracemalloc snapshots while profiling
+TRACEMALLOC_INTERVAL_ENV_VAR = 'PEP_TK_TRACEMALLOC_INTERVAL'
+
+profile_dir = lambda logs_dir: os.path.join(logs_dir, 'profile')
+
+
+def profiling_enabled() -> bool:
+    return os.environ.get(PROFILE_ENV_VAR, '').strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+
+def enable_profiling():
+    os.environ[PROFILE_ENV_VAR] = '1'
+
+
+class Profiler:
+    """
+    Runs functions under cProfile, which only profiles the thread it runs in, so every thread that should be
+    profiled calls its target through Profiler.run.  Profiles are grouped by name (e.g. 'scheduler', 'tasks',
+    'gui') and each group is written as a .prof file that can be opened with snakeviz or pstats, and a text summary.
+
+    While running tracemalloc snapshots are taken periodically and the top allocations are appended to
+    tracemalloc.txt, the last snapshot is dumped to tracemalloc.snapshot for comparison with tracemalloc.Snapshot.load.
+    """
+    def __init__(self, output_dir: str, snapshot_interval: Optional[float] = None, top_n: int = 30):
+        """
+        :param output_dir: directory to write the profiles to
+        :param snapshot_interval: seconds between tracemalloc snapshots, defaults to PEP_TK_TRACEMALLOC_INTERVAL or 60
+        :param top_n: number of functions/allocations listed in the text summaries
+        """
+        if snapshot_interval is None:
+            snapshot_interval = float(os.environ.get(TRACEMALLOC_INTERVAL_ENV_VAR, 60))
+        self.output_dir = output_dir
+        self.snapshot_interval = snapshot_interval
+        self.top_n = top_n
+        self._profiles: Dict[str, List[cProfile.Profile]] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._snapshot_thread = None
+        self._last_snapshot = None
+        self._started_tracemalloc = False
+        self._saved = False
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._snapshot_thread = threading.Thread(target=self._snapshot_loop, daemon=True)
+        self._snapshot_thread.start()
+        print(f'Profiling enabled, writing profiles to {self.output_dir}')
+
+    def run(self, group: str, fn: Callable, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) in the current thread under cProfile.  The profile is added to the group when fn
+        returns, a profile can't be collected from another thread so calls still running at stop are not written.
+
+        From Python 3.12 cProfile is built on sys.monitoring, which allows only one active profiler per process and
+        sees the calls of every thread.  A thread started while another profile is active then runs fn unprofiled
+        (its calls are recorded by the active profile) instead of failing.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Another profiling tool is already active
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.setdefault(group, []).append(profile)
+
+    def _snapshot_loop(self):
+        while not self._stop_event.wait(self.snapshot_interval):
+            self.take_snapshot()
+
+    def take_snapshot(self):
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        stats = snapshot.statistics('lineno')[:self.top_n]
+        with self._lock:
+            self._last_snapshot = snapshot
+            with open(os.path.join(self.output_dir, 'tracemalloc.txt'), 'a') as f:
+                f.write(f'=== {datetime.now().isoformat(timespec="seconds")} traced current={current} '
+                        f'peak={peak} ===\n')
+                for stat in stats:
+                    f.write(f'{stat}\n')
+                f.write('\n')
+
+    def stop(self):
+        """ Stop taking snapshots and write the profiles, only the first call writes """
+        with self._lock:
+            if self._saved:
+                return
+            self._saved = True
+        self._stop_event.set()
+        try:
+            self.take_snapshot()
+            if self._last_snapshot is not None:
+                self._last_snapshot.dump(os.path.join(self.output_dir, 'tracemalloc.snapshot'))
+            self._save_profiles()
+        finally:
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+
+    def _save_profiles(self):
+        with self._lock:
+            groups = {k: list(v) for k, v in self._profiles.items()}
+        for group, profiles in groups.items():
+            stats = None
+            for profile in profiles:
+                profile.create_stats()
+                if not profile.stats:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            if stats is None:
+                continue
+            stats.dump_stats(os.path.join(self.output_dir, f'{group}.prof'))
+            summary = io.StringIO()
+            stats.stream = summary
+            stats.sort_stats('cumulative').print_stats(self.top_n)
+            with open(os.path.join(self.output_dir, f'{group}.txt'), 'w') as f:
+                f.write(summary.getvalue())
+
+
+def job_profiler(logs_dir: str) -> Optional[Profiler]:
+    """ :return: a started Profiler writing to logs/profile/<timestamp> if profiling is enabled, otherwise None """
+    if not profiling_enabled():
+        return None
+    profiler = Profiler(os.path.join(profile_dir(logs_dir), time.strftime('%Y%m%d-%H%M%S')))
+    profiler.start()
+    return profiler
@@ -0,0 +1,194 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# Resource sampling reads the linux /proc filesystem, on other platforms sampling is disabled.
+PROC_DIR = '/proc'
+
+
+def proc_available() -> bool:
+    return os.path.isdir(os.path.join(PROC_DIR, 'self'))
+
+
+def _clock_ticks() -> int:
+    try:
+        return os.sysconf('SC_CLK_TCK')
+    except (ValueError, OSError, AttributeError):
+        return 100
+
+
+def _page_size() -> int:
+    try:
+        return os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4096
+
+
+def _read_stat(pid: int) -> Optional[List[str]]:
+    """ :return: fields of /proc/pid/stat after the process name, or None if the process is gone """
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'stat'), 'r') as f:
+            data = f.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    # the process name is in parenthesis and may contain spaces
+    return data[data.rfind(')') + 2:].split()
+
+
+def list_process_tree(pid: int) -> List[int]:
+    """ :return: pid and the pids of all of its descendants """
+    children = {}
+    for entry in os.listdir(PROC_DIR):
+        if not entry.isdigit():
+            continue
+        fields = _read_stat(int(entry))
+        if fields is None:
+            continue
+        ppid = int(fields[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree = []
+    to_visit = [pid]
+    while to_visit:
+        p = to_visit.pop()
+        tree.append(p)
+        to_visit.extend(children.get(p, []))
+    return tree
+
+
+def read_process_usage(pid: int) -> Optional[Tuple[float, int, int, int]]:
+    """
+    Read the resource usage of a single process.
+
+    :return: (cpu seconds including reaped children, rss bytes, read bytes, write bytes) or None if the process is gone
+    """
+    fields = _read_stat(pid)
+    if fields is None:
+        return None
+    # utime, stime, cutime, cstime are fields 14-17 of /proc/pid/stat, rss (in pages) is field 24
+    cpu_time = sum(int(x) for x in fields[11:15]) / _clock_ticks()
+    rss = int(fields[21]) * _page_size()
+
+    read_bytes, write_bytes = 0, 0
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'io'), 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'read_bytes':
+                    read_bytes = int(value)
+                elif name == 'write_bytes':
+                    write_bytes = int(value)
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass  # io accounting may not be available
+    return cpu_time, rss, read_bytes, write_bytes
+
+
+@dataclass
+class ResourceSample:
+    """ Resource usage of a task's whole process tree at one point in time """
+    timestamp: float
+    cpu_time: float  # cpu seconds used by the process tree
+    rss: int  # resident memory in bytes
+    read_bytes: int
+    write_bytes: int
+    num_processes: int
+    cpu_percent: float = 0.  # cpu usage since the previous sample, 100% is one core
+
+    csv_header = 'timestamp,cpu_time,rss,read_bytes,write_bytes,num_processes,cpu_percent'
+
+    def to_csv_row(self) -> str:
+        return f'{self.timestamp:.3f},{self.cpu_time:.2f},{self.rss},{self.read_bytes},{self.write_bytes},' \
+               f'{self.num_processes},{self.cpu_percent:.1f}'
+
+
+def sample_process_tree(pid: int, previous: Optional[ResourceSample] = None) -> Optional[ResourceSample]:
+    """
+    Sample the resource usage of a process and all of its descendants.
+
+    :param pid: root process of the tree
+    :param previous: the previous sample of the same tree, used to calculate cpu_percent
+    :return: ResourceSample or None if /proc is unavailable or the process has exited
+    """
+    if not proc_available():
+        return None
+    totals = [0., 0, 0, 0]
+    n = 0
+    for p in list_process_tree(pid):
+        usage = read_process_usage(p)
+        if usage is None:
+            continue
+        n += 1
+        for i, v in enumerate(usage):
+            totals[i] += v
+    if n == 0:
+        return None
+
+    sample = ResourceSample(timestamp=time.time(), cpu_time=totals[0], rss=int(totals[1]),
+                            read_bytes=int(totals[2]), write_bytes=int(totals[3]), num_processes=n)
+    if previous is not None and sample.timestamp > previous.timestamp:
+        cpu_delta = max(sample.cpu_time - previous.cpu_time, 0.)
+        sample.cpu_percent = 100. * cpu_delta / (sample.timestamp - previous.timestamp)
+    return sample
+
+
+class ResourceUsageSummary:
+    """ Running peak and average of the samples taken for a task """
+    def __init__(self):
+        self.sample_count = 0
+        self.peak_rss = 0
+        self.peak_cpu_percent = 0.
+        self._rss_total = 0
+        self._cpu_percent_total = 0.
+        self.last_sample: Optional[ResourceSample] = None
+
+    def add(self, sample: ResourceSample):
+        self.sample_count += 1
+        self.peak_rss = max(self.peak_rss, sample.rss)
+        self.peak_cpu_percent = max(self.peak_cpu_percent, sample.cpu_percent)
+        self._rss_total += sample.rss
+        self._cpu_percent_total += sample.cpu_percent
+        self.last_sample = sample
+
+    @property
+    def avg_rss(self) -> int:
+        return int(self._rss_total / self.sample_count) if self.sample_count else 0
+
+    @property
+    def avg_cpu_percent(self) -> float:
+        return self._cpu_percent_total / self.sample_count if self.sample_count else 0.
+
+    def to_dict(self) -> Dict:
+        last = self.last_sample
+        return {'sample_count': self.sample_count,
+                'peak_rss': self.peak_rss,
+                'avg_rss': self.avg_rss,
+                'peak_cpu_percent': round(self.peak_cpu_percent, 1),
+                'avg_cpu_percent': round(self.avg_cpu_percent, 1),
+                'cpu_time': round(last.cpu_time, 2) if last else 0.,
+                'read_bytes': last.read_bytes if last else 0,
+                'write_bytes': last.write_bytes if last else 0}
+
+
+def format_bytes(n: int) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} {unit}'
+        n /= 1024.
+    return f'{n:.1f} TB'
@@ -0,0 +1,210 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pep_tk.core.history import history_dir
+from pep_tk.core.parser import VIAMEDataset
+from pep_tk.core.pipeline_deps import file_digest, parse_pipe_references
+
+# bump when the key or the layout of an entry changes so old entries are never hit
+CACHE_FORMAT_VERSION = 1
+ENTRY_FILENAME = 'entry.json'
+DEFAULT_MAX_BYTES = 1 << 30  # 1 GiB
+
+# the default result cache directory, shared by every job in the job base directory
+result_cache_dir = lambda base_dir: os.path.join(history_dir(base_dir), 'result_cache')
+
+def referenced_files(pipe_content: str) -> List[str]:
+    """ :return: sorted absolute paths of the existing files a compiled pipe references, e.g. models """
+    files = set()
+    # `key = value`, `:key = value` and `:key value` lines, after compilation relativepath values are absolute paths
+    for _, _, value in parse_pipe_references(pipe_content):
+        if os.path.isabs(value) and os.path.isfile(value):
+            files.add(os.path.normpath(value))
+    return sorted(files)
+
+
+def task_cache_key(compiled_pipe_fp: str, dataset: VIAMEDataset) -> str:
+    """
+    Content address of a task's outputs.  Hashes the compiled pipe (the pipeline with its parameters and dataset
+    compiled in, output ports are left as environment variables), the content of every file it references (models,
+    image lists, transformation files) and the content of the dataset's image lists.
+
+    :param compiled_pipe_fp: the compiled pipe of the task
+    :param dataset: the dataset of the task
+    :return: hex digest
+    """
+    with open(compiled_pipe_fp, 'r') as f:
+        content = f.read()
+    h = hashlib.sha256()
+    h.update(f'pep_tk result cache v{CACHE_FORMAT_VERSION}\n'.encode('utf-8'))
+    h.update(content.encode('utf-8'))
+
+    files = set(referenced_files(content))
+    for list_fp in (dataset.thermal_image_list, dataset.color_image_list, dataset.transformation_file):
+        if list_fp and os.path.isfile(list_fp):
+            files.add(os.path.normpath(os.path.abspath(list_fp)))
+    # file contents only, so a model or image list that moved still hits
+    for digest in sorted(file_digest(fp) for fp in files):
+        h.update(digest.encode('utf-8'))
+    return h.hexdigest()
+
+
+def _write_json_atomic(fp: str, data: Dict):
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(fp), delete=False, suffix='.tmp') as f:
+        json.dump(data, f, indent='\t', sort_keys=True)
+        tmp_fp = f.name
+    os.replace(tmp_fp, fp)
+
+
+class ResultCache:
+    """
+    Local content addressed cache of task outputs (see task_cache_key).  Every entry is a directory named by its key
+    holding the output files and an entry.json mapping each output port environment variable to its file.  Entries
+    are evicted least recently used first once the cache is larger than max_bytes.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES, link: bool = False):
+        """
+        :param cache_dir: directory to keep the cache in, shared by every job using it
+        :param max_bytes: size of the cache above which the least recently used entries are evicted
+        :param link: hard link cached outputs into the job instead of copying them (falls back to copying across
+        file systems), only safe when outputs are never edited in place
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.link = link
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _read_entry(self, key: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self._entry_dir(key), ENTRY_FILENAME), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        """ :return: output port environment variable to the cached output file, or None if not cached """
+        entry = self._read_entry(key)
+        if entry is None:
+            return None
+        outputs = {env_var: os.path.join(self._entry_dir(key), fn) for env_var, fn in entry['outputs'].items()}
+        if not all(os.path.isfile(fp) for fp in outputs.values()):
+            return None
+        entry['last_used'] = time.time()
+        try:
+            _write_json_atomic(os.path.join(self._entry_dir(key), ENTRY_FILENAME), entry)
+        except OSError:
+            pass  # read only cache, still usable
+        return outputs
+
+    def fetch(self, key: str, destinations: Dict[str, str]) -> Optional[List[str]]:
+        """
+        Link or copy the cached outputs of key to their destinations.
+
+        :param key: the task cache key
+        :param destinations: output port environment variable to the path to write its output to
+        :return: the written files, or None if key is not cached or doesn't have every output
+        """
+        cached = self.get(key)
+        if cached is None or not set(destinations) <= set(cached):
+            return None
+        written = []
+        for env_var, dest in destinations.items():
+            os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+            if self.link:
+                try:
+                    os.link(cached[env_var], dest)
+                    written.append(dest)
+                    continue
+                except OSError:
+                    pass  # e.g. another file system
+            shutil.copy2(cached[env_var], dest)
+            written.append(dest)
+        return written
+
+    def put(self, key: str, outputs: Dict[str, str], meta: Optional[Dict] = None):
+        """
+        Add the outputs of a task to the cache, an existing entry for key is kept.
+
+        :param key: the task cache key
+        :param outputs: output port environment variable to the output file
+        :param meta: extra information saved with the entry, e.g. the job and task it came from
+        """
+        if self._read_entry(key) is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # build the entry next to its final location and rename it in place, readers never see a partial entry
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            size = 0
+            files = {}
+            for env_var, fp in outputs.items():
+                files[env_var] = os.path.basename(fp)
+                shutil.copy2(fp, os.path.join(tmp_dir, files[env_var]))
+                size += os.path.getsize(fp)
+            now = time.time()
+            _write_json_atomic(os.path.join(tmp_dir, ENTRY_FILENAME),
+                               {'outputs': files, 'bytes': size, 'created': now, 'last_used': now,
+                                'meta': dict(meta or {})})
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if self._read_entry(key) is None:  # not added by someone else at the same time
+                print(f'Warning: unable to add {key} to the result cache {self.cache_dir}: {e}')
+            return
+        self.evict()
+
+    def entries(self) -> Dict[str, Dict]:
+        """ :return: key to entry of every complete entry in the cache """
+        if not os.path.isdir(self.cache_dir):
+            return {}
+        entries = {}
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.'):
+                continue
+            entry = self._read_entry(key)
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    def size(self) -> int:
+        """ :return: bytes of output files in the cache """
+        return sum(e.get('bytes', 0) for e in self.entries().values())
+
+    def evict(self) -> List[str]:
+        """ Remove the least recently used entries until the cache fits in max_bytes. :return: the evicted keys """
+        with self._lock:
+            entries = self.entries()
+            total = sum(e.get('bytes', 0) for e in entries.values())
+            evicted = []
+            for key, entry in sorted(entries.items(), key=lambda kv: kv[1].get('last_used', 0)):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                total -= entry.get('bytes', 0)
+                evicted.append(key)
+            return evicted
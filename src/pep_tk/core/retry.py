@@ -0,0 +1,115 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+from enum import Enum
+from typing import Dict, Iterable, Optional
+
+
+class FailureClass(Enum):
+    OOM_KILLED = 'oom_killed'
+    CUDA_ERROR = 'cuda_error'
+    IO_ERROR = 'io_error'
+    MISSING_FILE = 'missing_file'
+    STALLED = 'stalled'
+    UNKNOWN = 'unknown'
+
+
+# checked in order, the first class with a matching pattern wins.  CUDA comes first because a cuda out of memory
+# error would otherwise be classified as the process running out of system memory
+FAILURE_PATTERNS = [
+    (FailureClass.CUDA_ERROR, [r'CUDA error', r'cudaError', r'CUDNN_STATUS_', r'CUBLAS_STATUS_',
+                               r'CUDA out of memory', r'no CUDA-capable device']),
+    (FailureClass.OOM_KILLED, [r'std::bad_alloc', r'MemoryError', r'[Oo]ut of memory', r'Cannot allocate memory',
+                               r'^Killed$']),
+    (FailureClass.MISSING_FILE, [r'No such file or directory', r'FileNotFoundError', r'[Cc]ould not open',
+                                 r'does not exist']),
+    (FailureClass.IO_ERROR, [r'Input/output error', r'Stale file handle', r'Connection reset', r'Connection refused',
+                             r'Resource temporarily unavailable', r'Transport endpoint is not connected']),
+]
+
+_FAILURE_REGEXES = [(failure, re.compile('|'.join(f'(?:{p})' for p in patterns)))
+                    for failure, patterns in FAILURE_PATTERNS]
+
+# exit codes of a process killed with SIGKILL, e.g. by the kernel oom killer.  Negative when python started the killed
+# process itself, 128 + 9 when it was a child of the shell kwiver is run through
+SIGKILL_EXIT_CODES = (-9, 137)
+
+
+def classify_failure(exit_code: int, log_lines: Iterable[str]) -> FailureClass:
+    """
+    Classify why a kwiver process failed from its exit code and the end of its output.
+
+    :param exit_code: exit code of the process
+    :param log_lines: the last lines the process wrote
+    :return: FailureClass
+    """
+    lines = [line.rstrip('\r\n') for line in log_lines]
+    for failure, regex in _FAILURE_REGEXES:
+        if any(regex.search(line) for line in lines):
+            return failure
+    if exit_code in SIGKILL_EXIT_CODES:
+        return FailureClass.OOM_KILLED
+    return FailureClass.UNKNOWN
+
+
+class RetryPolicy:
+    """
+    Decides if a failed task is retried.  A task is retried when its failure class is retryable and it has not been
+    attempted max_attempts times, after waiting backoff_base * backoff_factor ^ (attempt - 1) seconds capped at
+    backoff_max.
+    """
+    DEFAULT_RETRYABLE = (FailureClass.OOM_KILLED, FailureClass.CUDA_ERROR, FailureClass.IO_ERROR)
+
+    def __init__(self,
+                 max_attempts: int = 3,
+                 backoff_base: float = 30,
+                 backoff_factor: float = 2,
+                 backoff_max: float = 600,
+                 retryable: Optional[Iterable[FailureClass]] = None):
+        """
+        :param max_attempts: maximum number of times a task is run, including the first attempt
+        :param backoff_base: seconds to wait before the first retry
+        :param backoff_factor: the wait is multiplied by this for every further retry
+        :param backoff_max: maximum seconds to wait before a retry
+        :param retryable: failure classes that are retried, defaults to out of memory, cuda and io errors
+        """
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_base = backoff_base
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retryable = frozenset(retryable if retryable is not None else self.DEFAULT_RETRYABLE)
+
+    def should_retry(self, failure: FailureClass, attempt: int) -> bool:
+        """ :param attempt: the number of the attempt that failed, starting at 1 """
+        return failure in self.retryable and attempt < self.max_attempts
+
+    def backoff(self, attempt: int) -> float:
+        """ :return: seconds to wait before retrying after the given failed attempt """
+        return min(self.backoff_base * self.backoff_factor ** max(attempt - 1, 0), self.backoff_max)
+
+    def to_dict(self) -> Dict:
+        return {'max_attempts': self.max_attempts, 'backoff_base': self.backoff_base,
+                'backoff_factor': self.backoff_factor, 'backoff_max': self.backoff_max,
+                'retryable': sorted(f.value for f in self.retryable)}
+
+    @classmethod
+    def from_dict(cls, d: Optional[Dict]) -> 'RetryPolicy':
+        """ Create a policy from a configuration dictionary (e.g. the gui settings file), missing keys use defaults """
+        d = dict(d or {})
+        if 'retryable' in d:
+            d['retryable'] = [FailureClass(v) for v in d['retryable']]
+        return cls(**d)
@@ -17,34 +17,67 @@
 import abc
 import atexit
 import os
+import signal
 import shutil
 import subprocess
 import threading
 import time
+import traceback
+from collections import deque
 from datetime import datetime
 from time import sleep
-from typing import List, Optional, IO
+from typing import Dict, List, Optional, IO
 
 try:
     from Queue import Queue, Empty
 except ImportError:
     from queue import Queue, Empty  # python 3.x
 
+from pep_tk.core.abort import AbortDecision, AbortPolicy, TaskObservation
+from pep_tk.core.admission import AdmissionController
+from pep_tk.core.checkpoint import INPUT_LIST_ATTRIBUTES, TaskCheckpoint, checkpoint_image_count, match_output_files, \
+    stitch_outputs, write_remaining_image_lists, write_resume_pipeline
+from pep_tk.core.detection_index import index_tasks
+from pep_tk.core.detection_stats import DetectionStats, DetectionTailReader
+from pep_tk.core.history import PerformanceHistory, build_performance_record, parameter_hash
 from pep_tk.core.job import JobState, JobMeta, TaskStatus, TaskKey
 from pep_tk.core.kwiver.pipeline_compiler import compile_output_filenames
 from pep_tk.core.kwiver.runner import KwiverRunner
+from pep_tk.core.leases import LeaseManager, SharedStateLock
+from pep_tk.core.metrics import MetricsExporter
+from pep_tk.core.pipeline_deps import preflight_pipeline
+from pep_tk.core.post_filter import apply_post_filters
+from pep_tk.core.prefetch import Prefetcher, pipeline_inputs
+from pep_tk.core.profiling import Profiler
+from pep_tk.core.result_cache import ResultCache, task_cache_key
+from pep_tk.core.retry import FailureClass, RetryPolicy, classify_failure
+from pep_tk.core.resources import ResourceSample, ResourceUsageSummary, list_process_tree, proc_available, \
+    sample_process_tree
+from pep_tk.core.slots import SlotPool, acquire_slots, release_slots
+from pep_tk.core.staging import ImageStager, restore_detection_images, restore_image_list, write_staged_pipeline
+from pep_tk.core.tracing import TraceRecorder, SCHEDULER_TRACK, task_track
 
 
 class SchedulerEventManager(metaclass=abc.ABCMeta):
     def __init__(self):
         self.task_start_time = {}
         self.task_end_time = {}
+        self.task_first_progress_time = {}
+        self.task_first_progress_count = {}
+        self.task_last_progress_time = {}
         self.task_status = {}
         self.task_messages = {}
         self.task_count = {}
         self.task_max_count = {}
         self.initialized_tasks = []
         self.task_output_files = {}
+        self.task_resources = {}
+        self.task_detections = {}
+        # images processed by the tasks started in this session, only increases (re-started tasks and the images of
+        # a checkpoint are not counted again)
+        self.images_processed = 0
+        self._images_counted = {}  # task key -> progress count up to which the task's images were counted
+        self._images_lock = threading.Lock()
 
     def initialize_task(self, task_key: TaskKey, count: int, max_count: int, status: TaskStatus,
                         task_outputs: Optional[List[str]] = None):
@@ -57,9 +90,19 @@ class SchedulerEventManager(metaclass=abc.ABCMeta):
         if task_outputs:
             self.update_task_output_files(task_key, task_outputs)
 
-    def start_task(self, task_key: TaskKey):
+    def start_task(self, task_key: TaskKey, skipped_images: int = 0):
+        """
+        :param skipped_images: images included in the task's progress that this run does not process, e.g. the
+        images of the checkpoint it resumes from
+        """
         self.task_status[task_key] = TaskStatus.RUNNING
         self.task_start_time[task_key] = time.time()
+        self.task_count[task_key] = 0  # a re-started task writes a new image list
+        self.task_first_progress_time.pop(task_key, None)
+        self.task_last_progress_time.pop(task_key, None)
+        self.task_detections.pop(task_key, None)
+        with self._images_lock:
+            self._images_counted[task_key] = skipped_images
         return self._start_task(task_key)
 
     def end_task(self, task_key: TaskKey, status: TaskStatus):
@@ -71,7 +114,17 @@ class SchedulerEventManager(metaclass=abc.ABCMeta):
         return self._check_cancelled(task_key)
 
     def update_task_progress(self, task_key: TaskKey, current_count: int):
+        if current_count > self.task_count.get(task_key, 0):
+            self.task_last_progress_time[task_key] = time.time()
         self.task_count[task_key] = current_count
+        if current_count > 0 and task_key not in self.task_first_progress_time:
+            self.task_first_progress_time[task_key] = time.time()
+            self.task_first_progress_count[task_key] = current_count
+        with self._images_lock:
+            counted = self._images_counted.get(task_key)
+            if counted is not None and current_count > counted:
+                self.images_processed += current_count - counted
+                self._images_counted[task_key] = current_count
         return self._update_task_progress(task_key, current_count, self.task_max_count[task_key])
 
     def update_task_stdout(self, task_key: TaskKey, line: str):
@@ -84,6 +137,14 @@ class SchedulerEventManager(metaclass=abc.ABCMeta):
         self.task_output_files[task_key] = output_files
         return self._update_task_output_files(task_key, output_files)
 
+    def update_task_resources(self, task_key: TaskKey, sample: ResourceSample):
+        self.task_resources[task_key] = sample
+        return self._update_task_resources(task_key, sample)
+
+    def update_task_detections(self, task_key: TaskKey, stats: DetectionStats):
+        self.task_detections[task_key] = stats
+        return self._update_task_detections(task_key, stats)
+
     def elapsed_time(self, task_key: TaskKey) -> float:
         if task_key not in self.task_start_time:
             return 0.
@@ -123,6 +184,14 @@ class SchedulerEventManager(metaclass=abc.ABCMeta):
     def _update_task_output_files(self, task_key: TaskKey, output_files: List[str]):
         pass
 
+    def _update_task_resources(self, task_key: TaskKey, sample: ResourceSample):
+        # optional, the latest sample is kept in task_resources to be sent with the next progress update
+        pass
+
+    def _update_task_detections(self, task_key: TaskKey, stats: DetectionStats):
+        # optional, the latest statistics are kept in task_detections to be sent with the next progress update
+        pass
+
 
 # Scheduler helpers
 def poll_image_list(fp: str):
@@ -134,17 +203,45 @@ def poll_image_list(fp: str):
 
 
 def monitor_outputs(stop_event: threading.Event, task_key: TaskKey, manager: SchedulerEventManager,
-                    output_file: str, poll_freq: int):
+                    output_file: str, poll_freq: int, offset: int = 0,
+                    detection_reader: Optional[DetectionTailReader] = None, prefetcher: Optional[Prefetcher] = None):
     while not stop_event.wait(poll_freq):
         try:
             count = poll_image_list(output_file)
-            manager.update_task_progress(task_key, count)
+            if prefetcher is not None:
+                # keep the prefetch window ahead of the images kwiver has processed in this run
+                prefetcher.update(task_key, count)
+            if detection_reader is not None:
+                # only the rows appended since the last poll are read
+                manager.update_task_detections(task_key, detection_reader.poll(images=count))
+            manager.update_task_progress(task_key, count + offset)
         except Exception as e:
             # should not have an issue but this is just to ensure program doesn't crash for user
             # pretty sure the concurrency stuff here is solid, but hard to be certain
             print(e)
 
 
+def monitor_resources(stop_event: threading.Event, task_key: TaskKey, manager: SchedulerEventManager,
+                      pid: int, poll_freq: float, summary: ResourceUsageSummary, timeseries_fp: str):
+    previous = None
+    with open(timeseries_fp, 'w') as f:
+        f.write(ResourceSample.csv_header + '\n')
+        while True:
+            try:
+                sample = sample_process_tree(pid, previous)
+                if sample is not None:
+                    previous = sample
+                    summary.add(sample)
+                    f.write(sample.to_csv_row() + '\n')
+                    f.flush()
+                    manager.update_task_resources(task_key, sample)
+            except Exception as e:
+                # should not have an issue but this is just to ensure program doesn't crash for user
+                print(e)
+            if stop_event.wait(poll_freq):
+                break
+
+
 def enqueue_output(out, queue, evt: threading.Event, logfile: IO):
     # don't want it to stop on an emty byte(b'') because we need to detect
     # if an empty byte has come through and we can't do it asynchronously
@@ -185,8 +282,15 @@ def exit_cleanup(fds, files_to_move, dir_to_move):
 
 
 def kill_process(process):
+    """ Kill the process and its descendants, kwiver is started through a shell so it is a child of the process """
     if os.name == 'nt':
         subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+    elif proc_available():
+        for pid in reversed(list_process_tree(process.pid)):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
     else:
         process.kill()
 
@@ -198,9 +302,28 @@ class Scheduler:
                  manager: SchedulerEventManager,
                  kwiver_setup_path: str,
                  progress_poll_freq: int = 1,
-                 kill_event: threading.Event() = None):
+                 kill_event: threading.Event() = None,
+                 history: Optional[PerformanceHistory] = None,
+                 resource_poll_freq: float = 2,
+                 max_concurrent_tasks: int = 1,
+                 admission: Optional[AdmissionController] = None,
+                 slot_pools: Optional[List[SlotPool]] = None,
+                 trace: bool = True,
+                 profiler: Optional[Profiler] = None,
+                 metrics: Optional[MetricsExporter] = None,
+                 stall_timeout: Optional[float] = None,
+                 stall_retries: int = 1,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 checkpoint_resume: bool = False,
+                 result_cache: Optional[ResultCache] = None,
+                 detection_index: bool = False,
+                 abort_policy: Optional[AbortPolicy] = None,
+                 stager: Optional[ImageStager] = None,
+                 prefetcher: Optional[Prefetcher] = None,
+                 preflight: bool = False,
+                 leases: Optional[LeaseManager] = None):
         """
-        Initialize a Scheduler for proccessing task queue synchronously.
+        Initialize a Scheduler for proccessing the task queue, by default one task at a time.
 
         :param job_state: the job state
         :param job_meta: the job metadata
@@ -209,6 +332,40 @@ class Scheduler:
         :param progress_poll_freq: frequency to poll progress (reads output file and counts progress)
         :param kill_event: threading.Event to send the scheduler if the GUI thread is exited or the program is killed
         which will trigger the scheduler to cleanup and exit cleanly
+        :param history: performance history to record completed tasks in, defaults to the history kept in the
+        job base directory
+        :param resource_poll_freq: frequency to sample the cpu, memory and io of the kwiver process tree (linux only)
+        :param max_concurrent_tasks: maximum number of kwiver processes to run at the same time
+        :param admission: admission controller deciding if another task can be started while tasks are running,
+        defaults to a memory based AdmissionController logging to logs/admission.log
+        :param slot_pools: resource slot pools (devices, cpu sets, ...), each running task is assigned a free slot
+        from every pool and a task is only started when every pool has a free slot
+        :param trace: write a Chrome trace-event timeline of every task's phases to logs/trace-<timestamp>.json
+        :param profiler: if set every task thread is run under the profiler (profile group 'tasks'), the thread
+        calling run should be run under the profiler by the caller
+        :param metrics: metrics exporter, started when the scheduler runs and stopped once every task is done
+        :param stall_timeout: seconds without new images or output after which a task is considered stalled and its
+        kwiver process is killed, the stall_timeout of the pipeline manifest takes precedence. None disables the watchdog
+        :param stall_retries: number of times a stalled task is restarted before it is marked as errored
+        :param retry_policy: if set tasks whose kwiver process fails with a retryable failure class (see
+        pep_tk.core.retry) are re-queued with a backoff, by default failed tasks are not retried
+        :param checkpoint_resume: a task that previously stopped part way through its dataset only processes the
+        images it has not processed yet, its new outputs are stitched to the partial outputs (see pep_tk.core.checkpoint)
+        :param result_cache: if set a task whose compiled pipe, models and image lists match a previously successful
+        task takes its outputs from the cache instead of running kwiver, and successful outputs are added to the cache
+        :param detection_index: add the detections of every successful task to the job's columnar detection index
+        (see pep_tk.core.detection_index) as soon as the task finishes
+        :param abort_policy: early-abort rules checked while a task runs (see pep_tk.core.abort), a rule that fires
+        cancels the task or, for job scoped rules, every task of the job
+        :param stager: if set the images of the next task are copied to local scratch storage while a task runs and
+        the next task reads the local copies (see pep_tk.core.staging)
+        :param prefetcher: if set the model files and upcoming images of a task are read into the page cache ahead of
+        kwiver, starting just before the task is started (see pep_tk.core.prefetch)
+        :param preflight: check that the job's pipeline and every file it requires (included pipes, relativepath
+        models) exist before running any task, if not the incomplete tasks are marked as errored
+        :param leases: run the job together with schedulers on other nodes sharing the job directory, a task is only
+        started once this node holds its lease and the job state is re-read before every change (see
+        pep_tk.core.leases).  Killing the scheduler hands its tasks back to the other nodes instead of failing them
         """
         self.job_state = job_state
         self.job_meta = job_meta
@@ -216,6 +373,42 @@ class Scheduler:
         self.kwiver_setup_path = kwiver_setup_path
         self.progress_poll_freq = progress_poll_freq
         self.kill_event: threading.Event() = kill_event
+        self.history = history if history is not None else PerformanceHistory(job_meta.base_dir)
+        self.resource_poll_freq = resource_poll_freq
+        self.max_concurrent_tasks = max(1, max_concurrent_tasks)
+        if admission is None:
+            admission = AdmissionController(history=self.history,
+                                            log_fp=os.path.join(job_meta.logs_dir, 'admission.log'))
+        self.admission = admission
+        self.slot_pools = list(slot_pools or [])
+        trace_fp = os.path.join(job_meta.logs_dir, f'trace-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+        self.tracer = TraceRecorder(trace_fp if trace else None)
+        self.profiler = profiler
+        self.metrics = metrics
+        self.stall_timeout = job_meta.stall_timeout if job_meta.stall_timeout is not None else stall_timeout
+        self.stall_retries = max(0, stall_retries)
+        self.retry_policy = retry_policy
+        self.checkpoint_resume = checkpoint_resume
+        self.result_cache = result_cache
+        self.detection_index = detection_index
+        self.abort_policy = abort_policy
+        self.stager = stager
+        self.prefetcher = prefetcher
+        self.preflight = preflight
+        self.leases = leases
+
+        # job state and meta are saved on every change, only let one task thread modify them at a time
+        if leases is not None:
+            self._state_lock = SharedStateLock(job_meta.root_dir, reload=(job_state, job_meta))
+        else:
+            self._state_lock = threading.RLock()
+        self._task_done = threading.Event()
+        self._predicted_memory = {}
+        self._task_slots = {}
+        self._attempts = {}  # number of the current attempt of each task, including the attempts of earlier runs
+        self._not_before = {}  # task key -> time a task waiting to be retried may start again
+        self._expected_rates = {}  # task key -> historical images/sec of the pipeline, for the abort rules
+        self._job_abort: Optional[AbortDecision] = None  # set when a job scoped abort rule fires
 
     def run(self):
         print('Scheduler Started (pid: %d)' % os.getpid())
@@ -245,112 +438,396 @@ class Scheduler:
                 max_image_count = max(dataset.thermal_image_count, dataset.color_image_count)
                 self.manager.initialize_task(task_key, 0, max_image_count, TaskStatus.INITIALIZED)
 
-        while not self.job_state.is_job_complete():
-            current_task_key = self.job_state.current_task()
-            pipeline_fp, dataset, outputs = self.job_meta.get(current_task_key)
-
-            # Create the environment variables needed for running
-            #  - output ports (image list and viame detection csv file names)
-            #  - the kwiver environment required for running kwiver runner
-            stdout_enqueue_thread = datetime.now()
-            csv_ports_raw = outputs.get_det_csv_env_ports()
-            image_list_raw = outputs.get_image_list_env_ports()
-
-            pipeline_output_csv_env = compile_output_filenames(csv_ports_raw, path=self.job_meta.pending_outputs_dir,
-                                                               t=stdout_enqueue_thread)
-            pipeline_output_image_list_env = compile_output_filenames(image_list_raw,
-                                                                      path=self.job_meta.pending_outputs_dir,
-                                                                      t=stdout_enqueue_thread)
-
-            env = {**pipeline_output_csv_env, **pipeline_output_image_list_env}
-
-            # Setup error log
-            stdout_log_fp = os.path.join(self.job_meta.logs_dir,
-                                         f'kwiver-output-{current_task_key.replace(":", "_")}.log')
-
-            output_log = open(stdout_log_fp, 'w+b')
+        if self.checkpoint_resume:
+            # the pending outputs of the tasks other nodes are running are not left over, the tasks of a node that
+            # stopped are still marked running
+            running_elsewhere = self.leases.held_by_others() if self.leases is not None else {}
+            for task_key in self.job_state.tasks(status=TaskStatus.INITIALIZED) + \
+                    self.job_state.tasks(status=TaskStatus.RUNNING):
+                if task_key not in running_elsewhere:
+                    self._recover_pending_outputs(task_key)
+
+        if self.preflight and not self._preflight():
+            return
+
+        run_start = time.time()
+        running = {}  # task key -> thread running the task
+        launched = set()
+        if self.metrics is not None:
+            self.metrics.start()
+        if self.leases is not None:
+            self.leases.start()
+        try:
+            self._run_tasks(running, launched)
+        finally:
+            if self.leases is not None:
+                self.leases.stop()
+            self.tracer.span('scheduler run', SCHEDULER_TRACK, run_start, time.time())
+            self.tracer.save()
+            if self.metrics is not None:
+                self.metrics.stop()
+            if self.stager is not None:
+                self.stager.close()
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+
+    def _run_tasks(self, running, launched):
+        while True:
+            if self.kill_event and self.kill_event.is_set():
+                # each task thread kills its own process, wait for them before marking the incomplete tasks
+                for thread in running.values():
+                    thread.join(timeout=60)
+                self._kill_all_tasks()
+                return
+
+            for task_key in [k for k, t in running.items() if not t.is_alive()]:
+                del running[task_key]
+                with self._state_lock:
+                    if self.job_state.get_status(task_key) == TaskStatus.INITIALIZED:
+                        launched.discard(task_key)  # re-queued by the watchdog or the retry policy
+
+            if self._job_abort is not None:
+                # the running tasks stop themselves, the tasks that were not started are cancelled
+                if not running:
+                    self._cancel_remaining_tasks()
+                    return
+                self._task_done.wait(.5)
+                self._task_done.clear()
+                continue
 
-            atexit.register(exit_cleanup, fds=[output_log],
-                            files_to_move=list(pipeline_output_csv_env.values()) + list(
-                                pipeline_output_image_list_env.values()),
-                            dir_to_move=self.job_meta.error_outputs_dir)
+            now = time.time()
+            backing_off = {k for k, t in self._not_before.items() if t > now}
+            # tasks run by other nodes, the job is only done once they are complete too
+            elsewhere = set(self.leases.held_by_others()) if self.leases is not None else set()
+            with self._state_lock:
+                next_task_key = self.job_state.current_task(exclude=launched | backing_off | elsewhere)
+                elsewhere = {k for k in elsewhere if not self.job_state.is_task_complete(k)}
+            if next_task_key is None and not running and not backing_off and not elsewhere:
+                break
+
+            if next_task_key is not None and len(running) < self.max_concurrent_tasks \
+                    and self._reserve_resources(next_task_key, running) and self._acquire_lease(next_task_key):
+                launched.add(next_task_key)
+                if self.profiler is not None:
+                    thread = threading.Thread(target=self.profiler.run, daemon=True,
+                                              args=('tasks', self._run_task_thread, next_task_key))
+                else:
+                    thread = threading.Thread(target=self._run_task_thread, args=(next_task_key,), daemon=True)
+                running[next_task_key] = thread
+                thread.start()
+                self._stage_next(launched | elsewhere)
+                self._prefetch_next(launched | elsewhere)
+                continue
 
-            # Update Task Started
-            self.manager.start_task(current_task_key)
+            # wait for a task to finish, or re-check the admission as memory frees up
+            self._task_done.wait(.5)
+            self._task_done.clear()
+
+    def _reserve_resources(self, task_key: TaskKey, running) -> bool:
+        """ Acquire a slot from every slot pool and check admission, :return: True if the task can be started """
+        assignment = acquire_slots(self.slot_pools, self._slot_owner(task_key))
+        if assignment is None:
+            return False
+        if not self._admit(task_key, running):
+            release_slots(self.slot_pools, self._slot_owner(task_key))
+            return False
+        self._task_slots[task_key] = assignment
+        return True
+
+    def _acquire_lease(self, task_key: TaskKey) -> bool:
+        """ Claim the task for this node, :return: False if another node claimed or completed it in the meantime """
+        if self.leases is None:
+            return True
+        if self.leases.acquire(task_key):
+            with self._state_lock:
+                complete = self.job_state.is_task_complete(task_key)
+            if not complete:
+                return True
+            self.leases.release(task_key)
+        release_slots(self.slot_pools, self._slot_owner(task_key))
+        self._task_slots.pop(task_key, None)
+        return False
+
+    def _slot_owner(self, task_key: TaskKey) -> str:
+        """ the owner of a task's slots, slot pools may be shared by several jobs (see pep_tk.core.daemon) """
+        return f'{os.path.abspath(self.job_meta.root_dir)}:{task_key}'
+
+    def _admit(self, task_key: TaskKey, running) -> bool:
+        if self.admission is None:
+            return True
+        outstanding = {}
+        for k in running:
+            sample = self.manager.task_resources.get(k)
+            current_rss = sample.rss if sample is not None else 0
+            outstanding[k] = (self._predicted_memory.get(k) or 0) - current_rss
+        decision = self.admission.admit(task_key, self.job_meta, outstanding)
+        if decision.admitted:
+            self._predicted_memory[task_key] = decision.required_memory
+        return decision.admitted
+
+    def _run_task_thread(self, task_key: TaskKey):
+        start = time.time()
+        try:
+            self._run_task(task_key)
+        except Exception as e:
+            # don't leave the task running in the job state if something unexpected happened
+            print(f'Error running {task_key}: {e}')
+            traceback.print_exc()
+            with self._state_lock:
+                self.job_state.set_task_status(task_key, TaskStatus.ERROR)
+            self.manager.end_task(task_key, TaskStatus.ERROR)
+        finally:
+            release_slots(self.slot_pools, self._slot_owner(task_key))
+            self._task_slots.pop(task_key, None)
+            if self.stager is not None:
+                self.stager.release(task_key)
+            if self.prefetcher is not None:
+                self.prefetcher.stop(task_key)
+            if self.leases is not None:
+                self.leases.release(task_key)
+            self.tracer.span('task', task_track(task_key), start, time.time(),
+                             status=self.job_state.get_status(task_key).name)
+            self._save_trace()
+            self._task_done.set()
+
+    def _save_trace(self):
+        try:
+            self.tracer.save()
+        except OSError as e:
+            print(f'Warning: unable to write trace {self.tracer.trace_fp}: {e}')
+
+    def _run_task(self, current_task_key: TaskKey):
+        track = task_track(current_task_key)
+        task_start = time.time()
+        with self._state_lock:
+            # the attempts recorded by earlier runs of the job, or other nodes, count towards the retry policy
+            self._attempts[current_task_key] = len(self.job_state.get_task_attempts(current_task_key)) + 1
+        self._not_before.pop(current_task_key, None)
+        pipeline_fp, dataset, outputs = self.job_meta.get(current_task_key)
+
+        cache_key = self._result_cache_key(current_task_key, pipeline_fp, dataset)
+        if cache_key is not None and self._complete_from_cache(current_task_key, cache_key, outputs):
+            return
+
+        # Create the environment variables needed for running
+        #  - output ports (image list and viame detection csv file names)
+        #  - the kwiver environment required for running kwiver runner
+        stdout_enqueue_thread = datetime.now()
+        csv_ports_raw = outputs.get_det_csv_env_ports()
+        image_list_raw = outputs.get_image_list_env_ports()
+
+        pipeline_output_csv_env = compile_output_filenames(csv_ports_raw, path=self.job_meta.pending_outputs_dir,
+                                                           t=stdout_enqueue_thread)
+        pipeline_output_image_list_env = compile_output_filenames(image_list_raw,
+                                                                  path=self.job_meta.pending_outputs_dir,
+                                                                  t=stdout_enqueue_thread)
+
+        env = {**pipeline_output_csv_env, **pipeline_output_image_list_env}
+
+        # Export the resource slots assigned to this task
+        slots = self._task_slots.get(current_task_key)
+        cpu_affinity = None
+        if slots is not None and slots.slots:
+            env.update(slots.environment())
+            cpu_affinity = slots.cpu_affinity()
+
+        checkpoint, pipeline_fp = self._resume_from_checkpoint(current_task_key, pipeline_fp, dataset)
+        pipeline_fp, staged_images = self._use_staged_images(current_task_key, pipeline_fp, dataset)
+        resumed_images = checkpoint.images if checkpoint is not None else 0
+        self._prefetch_task(current_task_key, pipeline_fp, dataset)
+        self.tracer.span('env build', track, task_start, time.time())
+
+        # Setup error log
+        stdout_log_fp = os.path.join(self.job_meta.logs_dir,
+                                     f'kwiver-output-{current_task_key.replace(":", "_")}.log')
+
+        output_log = open(stdout_log_fp, 'w+b')
+
+        atexit.register(exit_cleanup, fds=[output_log],
+                        files_to_move=list(pipeline_output_csv_env.values()) + list(
+                            pipeline_output_image_list_env.values()),
+                        dir_to_move=self.job_meta.error_outputs_dir)
+
+        # Update Task Started
+        self.manager.start_task(current_task_key, skipped_images=resumed_images)
+        if slots is not None and slots.slots:
+            self.manager.update_task_stdout(current_task_key, f'Assigned resource slots: {slots}\n')
+        if checkpoint is not None:
+            self.manager.update_task_stdout(current_task_key, f'Resuming from checkpoint, skipping the '
+                                                              f'{checkpoint.images} images already processed\n')
+        with self._state_lock, self.tracer.timed('state save', track):
             self.job_state.set_task_status(current_task_key, TaskStatus.RUNNING)
 
-            # create the progress polling thread and start it
-            image_list_monitor = list(pipeline_output_image_list_env.values())[0]  # Image list to monitor
-            prog_stop_evt = threading.Event()
-            thread_args = (prog_stop_evt, current_task_key, self.manager, image_list_monitor, self.progress_poll_freq)
-            progress_thread = threading.Thread(target=monitor_outputs,
-                                               args=thread_args,
-                                               daemon=True)
-            progress_thread.start()
-
-            # Create the kwiver runner and run it
-            kwr = KwiverRunner(pipeline_fp,
-                               cwd=self.job_meta.root_dir,
-                               env=env,
-                               kwiver_setup_path=self.kwiver_setup_path)
-
-            process = kwr.run(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            print('Kwiver Runner Started (pid: %d)' % process.pid)
-
-            if process.stdout is None:
-                raise RuntimeError("Stdout must not be none")
-
-            # Stdout Thread
-            kwiver_output_queue = Queue()
-            stdout_enqueue_thread = threading.Thread(target=enqueue_output, args=(
-            process.stdout, kwiver_output_queue, prog_stop_evt, output_log))
-            stdout_enqueue_thread.daemon = True  # thread dies with the program
-            stdout_enqueue_thread.start()
-
-            cancelled = False
-            while not cancelled:  # read line without blocking
-                if self.kill_event:
-                    if self.kill_event.is_set():
-                        # Kill all incomplete tasks
-                        self._kill_all_tasks(process, prog_stop_evt)
-                        exit_cleanup(fds=[output_log],
-                                     files_to_move=list(pipeline_output_csv_env.values()) + list(
-                                         pipeline_output_image_list_env.values()),
-                                     dir_to_move=self.job_meta.error_outputs_dir)
-                        return
-                try:
-                    line = kwiver_output_queue.get(timeout=.5)
-                    if line == b'':
-                        break  # job is complete if empty byte received
-                    else:
-                        self.manager.update_task_stdout(current_task_key, line.decode("utf-8"))
-                except Empty:
-                    pass
-
-                # check if user cancelled task, if cancelled kill kwiver process and stop output reading loop
-                cancelled = self.manager.check_cancelled(current_task_key)
-
-            # Wait for exit up to 30 seconds after kill
-            code = process.wait(30)
-
-            # stop polling for progress and stop polling for stdout
-            prog_stop_evt.set()
-
-            outputs_to_move = list(pipeline_output_csv_env.values()) + list(pipeline_output_image_list_env.values())
-
-            # if user cancells task
-            if cancelled:
+        # create the progress polling thread and start it
+        image_list_monitor = list(pipeline_output_image_list_env.values())[0]  # Image list to monitor
+        # running statistics of this run's detections (the first detection output)
+        detection_reader = DetectionTailReader(list(pipeline_output_csv_env.values())[0]) \
+            if pipeline_output_csv_env else None
+        prog_stop_evt = threading.Event()
+        thread_args = (prog_stop_evt, current_task_key, self.manager, image_list_monitor, self.progress_poll_freq,
+                       resumed_images, detection_reader, self.prefetcher)
+        progress_thread = threading.Thread(target=monitor_outputs,
+                                           args=thread_args,
+                                           daemon=True)
+        progress_thread.start()
+
+        # Create the kwiver runner and run it
+        kwr = KwiverRunner(pipeline_fp,
+                           cwd=self.job_meta.root_dir,
+                           env=env,
+                           kwiver_setup_path=self.kwiver_setup_path,
+                           cpu_affinity=cpu_affinity)
+
+        spawn_start = time.time()
+        process = kwr.run(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        spawned = time.time()
+        self.tracer.span('process spawn', track, spawn_start, spawned, pid=process.pid)
+        print('Kwiver Runner Started (pid: %d)' % process.pid)
+
+        if process.stdout is None:
+            raise RuntimeError("Stdout must not be none")
+
+        # Resource sampling thread, samples the whole kwiver process tree
+        resource_summary = ResourceUsageSummary()
+        resource_thread = None
+        if proc_available():
+            timeseries_fp = os.path.join(self.job_meta.logs_dir,
+                                         f'resources-{current_task_key.replace(":", "_")}.csv')
+            thread_args = (prog_stop_evt, current_task_key, self.manager, process.pid, self.resource_poll_freq,
+                           resource_summary, timeseries_fp)
+            resource_thread = threading.Thread(target=monitor_resources, args=thread_args, daemon=True)
+            resource_thread.start()
+
+        # Stdout Thread
+        kwiver_output_queue = Queue()
+        stdout_enqueue_thread = threading.Thread(target=enqueue_output, args=(
+        process.stdout, kwiver_output_queue, prog_stop_evt, output_log))
+        stdout_enqueue_thread.daemon = True  # thread dies with the program
+        stdout_enqueue_thread.start()
+
+        cancelled = False
+        stalled = False
+        abort = None
+        first_line_time = None
+        last_output_time = spawned
+        output_tail = deque(maxlen=200)  # the end of the output is used to classify failures
+        while not cancelled and not stalled and abort is None:  # read line without blocking
+            if self.kill_event:
+                if self.kill_event.is_set():
+                    # Kill this task, the scheduler marks all incomplete tasks once every task thread has exited
+                    prog_stop_evt.set()
+                    kill_process(process)
+                    process.wait(timeout=30)
+                    for fp in pipeline_output_image_list_env.values():
+                        restore_image_list(fp, staged_images)
+                    for fp in pipeline_output_csv_env.values():
+                        restore_detection_images(fp, staged_images)
+                    if checkpoint is not None:
+                        stitch_outputs(checkpoint, pipeline_output_image_list_env, pipeline_output_csv_env)
+                    exit_cleanup(fds=[output_log],
+                                 files_to_move=list(pipeline_output_csv_env.values()) + list(
+                                     pipeline_output_image_list_env.values()),
+                                 dir_to_move=self.job_meta.error_outputs_dir)
+                    self._save_checkpoint(current_task_key, pipeline_output_image_list_env, pipeline_output_csv_env)
+                    if self.leases is not None:
+                        # hand the task back to the other nodes before its lease is released
+                        with self._state_lock:
+                            self.job_state.set_task_status(current_task_key, TaskStatus.INITIALIZED)
+                    return
+            if self.leases is not None and self.leases.lost(current_task_key):
+                # the lease expired and another node reclaimed the task, that node owns its state now
+                prog_stop_evt.set()
                 kill_process(process)
-                print(f'Cancelled {current_task_key}')
-
-                count = poll_image_list(image_list_monitor)
-                self.manager.update_task_progress(current_task_key, count)
+                process.wait(timeout=30)
+                exit_cleanup(fds=[output_log],
+                             files_to_move=list(pipeline_output_csv_env.values()) + list(
+                                 pipeline_output_image_list_env.values()),
+                             dir_to_move=self.job_meta.error_outputs_dir)
+                msg = f'Task {current_task_key} was reclaimed by another node, the kwiver process was killed.'
+                print(msg)
+                self.manager.update_task_stdout(current_task_key, msg + '\n')
+                self.manager.end_task(current_task_key, TaskStatus.ERROR)
+                return
+            try:
+                line = kwiver_output_queue.get(timeout=.5)
+                if line == b'':
+                    break  # job is complete if empty byte received
+                else:
+                    last_output_time = time.time()
+                    if first_line_time is None:
+                        first_line_time = last_output_time
+                    decoded = line.decode("utf-8", errors="replace")
+                    output_tail.append(decoded)
+                    self.manager.update_task_stdout(current_task_key, decoded)
+                    if self.abort_policy is not None:
+                        abort = self.abort_policy.check_output(decoded)
+            except Empty:
+                pass
+
+            # check if user cancelled task, if cancelled kill kwiver process and stop output reading loop
+            cancelled = self.manager.check_cancelled(current_task_key)
+            idle_time = self._idle_time(current_task_key, last_output_time)
+            stalled = self.stall_timeout is not None and idle_time > self.stall_timeout
+            if abort is None:
+                abort = self._check_abort(current_task_key, spawned, resumed_images)
+
+        # if the user cancelled the task, it stalled or was aborted kill kwiver, don't wait for it to finish on its own
+        if cancelled or stalled or abort is not None:
+            kill_process(process)
+
+        # Wait for exit up to 30 seconds after kill
+        code = process.wait(30)
+        self._trace_process_phases(current_task_key, spawned, first_line_time, time.time(), code)
+
+        # stop polling for progress and stop polling for stdout
+        prog_stop_evt.set()
+        self._save_resource_usage(current_task_key, resource_thread, resource_summary)
+        # read the last detections before the outputs are stitched to a checkpoint or moved
+        if detection_reader is not None:
+            stats = detection_reader.poll(images=poll_image_list(image_list_monitor), final=True)
+            self.manager.update_task_detections(current_task_key, stats)
+            self.manager.update_task_stdout(current_task_key, f'Detections: {stats.summary()}\n')
+
+        # the output image lists and detection csvs name the images kwiver read, the staged copies are deleted once
+        # the task is done.  Rewritten after the last detections were read, the reader tails the csv by offset
+        for fp in pipeline_output_image_list_env.values():
+            restore_image_list(fp, staged_images)
+        for fp in pipeline_output_csv_env.values():
+            restore_detection_images(fp, staged_images)
+
+        # prepend the outputs of the checkpoint so the outputs are complete whether or not this run succeeded
+        if checkpoint is not None:
+            with self.tracer.timed('checkpoint stitch', track):
+                stitch_outputs(checkpoint, pipeline_output_image_list_env, pipeline_output_csv_env)
+
+        outputs_to_move = list(pipeline_output_csv_env.values()) + list(pipeline_output_image_list_env.values())
+
+        if stalled:
+            count = poll_image_list(image_list_monitor)
+            self.manager.update_task_progress(current_task_key, count)
+            with self.tracer.timed('output move', track):
+                move_output_files(outputs_to_move, self.job_meta.error_outputs_dir)
+            self._save_checkpoint(current_task_key, pipeline_output_image_list_env, pipeline_output_csv_env)
+            self._handle_stalled(current_task_key, idle_time, count, code)
+            return
+
+        # if user cancells task, or an abort rule cancelled it
+        if cancelled or abort is not None:
+            print(f'Cancelled {current_task_key}')
+
+            count = poll_image_list(image_list_monitor)
+            self.manager.update_task_progress(current_task_key, count)
+            if abort is not None and not cancelled:
+                self._record_abort(current_task_key, abort, count)
+            with self._state_lock, self.tracer.timed('state save', track):
+                self._record_attempt(current_task_key, TaskStatus.CANCELLED, code, count)
                 self.job_state.set_task_status(current_task_key, TaskStatus.CANCELLED)
-                self.manager.end_task(current_task_key, TaskStatus.CANCELLED)
+            self.manager.end_task(current_task_key, TaskStatus.CANCELLED)
 
-                # Move outputs to error folder, attempt until process releases lock on files
-                moved = False
-                attempts = 0
+            # Move outputs to error folder, attempt until process releases lock on files
+            moved = False
+            attempts = 0
+            with self.tracer.timed('output move', track):
                 while not moved:
                     if attempts > 30:
                         # try for 30 seconds
@@ -361,44 +838,444 @@ class Scheduler:
                     except PermissionError:
                         sleep(1)
                         attempts += 1
+            if moved:
+                self._save_checkpoint(current_task_key, pipeline_output_image_list_env, pipeline_output_csv_env)
 
-                continue
+            return
 
-            if code > 0:  # ERROR
-                # Update Task Ended with error
-                count = poll_image_list(image_list_monitor)
-                self.manager.update_task_progress(current_task_key, count)
-                self.job_state.set_task_status(current_task_key, TaskStatus.ERROR)
-                self.manager.end_task(current_task_key, TaskStatus.ERROR)
+        if code != 0:  # ERROR, negative if kwiver was killed by a signal
+            # Update Task Ended with error
+            count = poll_image_list(image_list_monitor)
+            self.manager.update_task_progress(current_task_key, count)
 
-                # Move output files to error dir
-                outputs_to_move = list(pipeline_output_csv_env.values()) + list(pipeline_output_image_list_env.values())
+            # Move output files to error dir
+            outputs_to_move = list(pipeline_output_csv_env.values()) + list(pipeline_output_image_list_env.values())
+            with self.tracer.timed('output move', track):
                 move_output_files(outputs_to_move, self.job_meta.error_outputs_dir)
-            else:  # SUCCESS
-                # Update Task final count in GUI, has to be done before moving file
-                count = poll_image_list(image_list_monitor)
-                self.manager.update_task_progress(current_task_key, count)
+            self._save_checkpoint(current_task_key, pipeline_output_image_list_env, pipeline_output_csv_env)
 
-                # Move outputs to completed folder
-                outputs_new_loc = move_output_files(outputs_to_move, self.job_meta.completed_outputs_dir)
+            failure = classify_failure(code, output_tail)
+            self._handle_failed(current_task_key, code, count, failure)
+        else:  # SUCCESS
+            # Update Task final count in GUI, has to be done before moving file
+            count = poll_image_list(image_list_monitor)
+            self.manager.update_task_progress(current_task_key, count)
 
-                # Update Task State with success and output files
+            # Move outputs to completed folder
+            with self.tracer.timed('output move', track):
+                outputs_new_loc = move_output_files(outputs_to_move, self.job_meta.completed_outputs_dir)
+            # the cache keeps the unfiltered detections, jobs with other post filter values can use them too
+            if cache_key is not None:
+                with self.tracer.timed('cache store', track):
+                    self._cache_outputs(current_task_key, cache_key, {**pipeline_output_csv_env,
+                                                                      **pipeline_output_image_list_env})
+            self._post_filter_outputs(current_task_key, outputs, pipeline_output_csv_env)
+
+            # Update Task State with success and output files
+            with self._state_lock, self.tracer.timed('state save', track):
+                self._record_attempt(current_task_key, TaskStatus.SUCCESS, code, count)
+                self.job_state.set_task_checkpoint(current_task_key, None)
                 self.job_state.set_task_outputs(current_task_key, outputs_new_loc)
                 self.job_state.set_task_status(current_task_key, TaskStatus.SUCCESS)
 
-                # Update GUI with success
-                self.manager.end_task(current_task_key, TaskStatus.SUCCESS)
-                self.manager.update_task_output_files(current_task_key, outputs_new_loc)
+            # Update GUI with success
+            self.manager.end_task(current_task_key, TaskStatus.SUCCESS)
+            self.manager.update_task_output_files(current_task_key, outputs_new_loc)
+            self._index_outputs(current_task_key)
+            # only the images of this run count towards its throughput
+            self._record_performance(current_task_key, count - resumed_images, resource_summary.peak_rss or None,
+                                     skipped_images=resumed_images)
+
+    def _result_cache_key(self, task_key: TaskKey, pipeline_fp: str, dataset) -> Optional[str]:
+        """ :return: the result cache key of the task, or None if the result cache is disabled or unusable """
+        if self.result_cache is None:
+            return None
+        try:
+            with self.tracer.timed('cache key', task_track(task_key)):
+                return task_cache_key(os.path.join(self.job_meta.root_dir, pipeline_fp), dataset)
+        except OSError as e:
+            print(f'Warning: unable to compute the result cache key of {task_key}: {e}')
+            return None
+
+    def _complete_from_cache(self, task_key: TaskKey, cache_key: str, outputs) -> bool:
+        """ Complete the task with the cached outputs of an identical task. :return: True if the outputs were cached """
+        t = datetime.now()
+        image_lists = compile_output_filenames(outputs.get_image_list_env_ports(),
+                                               path=self.job_meta.completed_outputs_dir, t=t)
+        detections = compile_output_filenames(outputs.get_det_csv_env_ports(),
+                                              path=self.job_meta.completed_outputs_dir, t=t)
+        destinations = {**detections, **image_lists}
+        try:
+            with self.tracer.timed('cache fetch', task_track(task_key)):
+                outputs_new_loc = self.result_cache.fetch(cache_key, destinations)
+        except OSError as e:
+            print(f'Warning: unable to copy the cached outputs of {task_key}: {e}')
+            return False
+        if outputs_new_loc is None:
+            return False
+
+        print(f'Outputs of {task_key} found in the result cache ({cache_key[:12]})')
+        count = checkpoint_image_count(list(image_lists.values()))
+        self.manager.start_task(task_key, skipped_images=count)  # kwiver is not run, no images are processed
+        self.manager.update_task_stdout(task_key, f'Outputs found in the result cache {self.result_cache.cache_dir} '
+                                                  f'({cache_key[:12]}), kwiver was not run\n')
+        self._post_filter_outputs(task_key, outputs, detections)
+        self.manager.update_task_progress(task_key, count)
+        with self._state_lock:
+            self.job_state.add_task_event(task_key, {'event': 'cache_hit', 'key': cache_key, 'time': time.time()})
+            self._record_attempt(task_key, TaskStatus.SUCCESS, None, count)
+            self.job_state.set_task_checkpoint(task_key, None)
+            self.job_state.set_task_outputs(task_key, outputs_new_loc)
+            self.job_state.set_task_status(task_key, TaskStatus.SUCCESS)
+        self.manager.end_task(task_key, TaskStatus.SUCCESS)
+        self.manager.update_task_output_files(task_key, outputs_new_loc)
+        self._index_outputs(task_key)
+        return True
+
+    def _post_filter_outputs(self, task_key: TaskKey, outputs, detections: Dict[str, str]):
+        """ Apply the post filter parameters to the detections of a successful task (see pep_tk.core.post_filter) """
+        names = {opt.env_variable: opt.name for opt in outputs.get_det_csv_options()}
+        completed = {names[env_var]: os.path.join(self.job_meta.completed_outputs_dir, os.path.basename(fp))
+                     for env_var, fp in detections.items() if env_var in names}
+        with self.tracer.timed('post filter', task_track(task_key)):
+            apply_post_filters(self.job_meta, completed)
+
+    def _index_outputs(self, task_key: TaskKey):
+        """ Add the detections of a successful task to the job's detection index """
+        if not self.detection_index:
+            return
+        try:
+            with self.tracer.timed('detection index', task_track(task_key)):
+                index_tasks(self.job_state, self.job_meta, [task_key])
+        except (OSError, ValueError) as e:
+            print(f'Warning: unable to index the detections of {task_key}: {e}')
+
+    def _cache_outputs(self, task_key: TaskKey, cache_key: str, pending_outputs: Dict[str, str]):
+        """ Add the outputs of a successful task, moved from pending_outputs to the completed outputs, to the cache """
+        completed = {env_var: os.path.join(self.job_meta.completed_outputs_dir, os.path.basename(fp))
+                     for env_var, fp in pending_outputs.items()}
+        if not all(os.path.isfile(fp) for fp in completed.values()):
+            return
+        self.result_cache.put(cache_key, completed, meta={'job': os.path.abspath(self.job_meta.root_dir),
+                                                          'task': task_key})
+
+    def _resume_from_checkpoint(self, task_key: TaskKey, pipeline_fp: str, dataset):
+        """
+        Create a pipeline that only processes the images the checkpoint of the task does not have.
 
+        :return: (the checkpoint, the pipeline to run) or (None, pipeline_fp) if the task has no usable checkpoint
+        """
+        with self._state_lock:
+            saved = self.job_state.get_task_checkpoint(task_key)
+        if not saved:
+            return None, pipeline_fp
+        checkpoint = TaskCheckpoint.from_dict(saved)
+        if checkpoint.source != 'delta' and not self.checkpoint_resume:
+            return None, pipeline_fp  # delta jobs always resume, they were created to only process new images
+        resume_dir = os.path.join(self.job_meta.compiled_pipelines_dir, 'resume')
+        remaining = write_remaining_image_lists(checkpoint, dataset, resume_dir)
+        if remaining is None:
+            print(f'Warning: unable to resume {task_key} from its checkpoint, processing the whole dataset')
+            return None, pipeline_fp
+        resume_fp = os.path.join(resume_dir, os.path.basename(pipeline_fp))
+        write_resume_pipeline(os.path.join(self.job_meta.root_dir, pipeline_fp), remaining, resume_fp)
+        print(f'Resuming {task_key} after {checkpoint.images} images')
+        return checkpoint, os.path.relpath(resume_fp, self.job_meta.root_dir)
+
+    def _stage_next(self, launched):
+        """ Start staging the images of the next task that will be started """
+        if self.stager is None:
+            return
+        with self._state_lock:
+            next_task_key = self.job_state.current_task(exclude=launched)
+        if next_task_key is None or self.stager.staging(next_task_key):
+            return
+        _, dataset, _ = self.job_meta.get(next_task_key)
+        self.stager.stage(next_task_key, [dataset.get(attr) for attr in INPUT_LIST_ATTRIBUTES])
+
+    def _use_staged_images(self, task_key: TaskKey, pipeline_fp: str, dataset):
+        """
+        Make the task's pipeline read the images that were staged while the previous task ran.
 
-    def _kill_all_tasks(self, process: subprocess.Popen, prog_stop_evt: threading.Event):
-        for task_to_end in self.job_state.tasks():
-            if self.job_state.is_task_complete(task_to_end):
-                continue  # do not modify state of complete tasks
+        :return: (the pipeline to run, dictionary of original image path to its staged copy)
+        """
+        if self.stager is None:
+            return pipeline_fp, {}
+        staged = self.stager.staged_images(task_key)
+        if not staged:
+            return pipeline_fp, {}
+        lists = [dataset.get(attr) for attr in INPUT_LIST_ATTRIBUTES if dataset.get(attr)]
+        # a resumed task reads the remaining image lists, see _resume_from_checkpoint
+        resume_dir = os.path.join(self.job_meta.compiled_pipelines_dir, 'resume')
+        lists += [os.path.join(resume_dir, f'remaining-{os.path.basename(fp)}') for fp in lists]
+        staged_dir = os.path.join(self.job_meta.compiled_pipelines_dir, 'staged')
+        with self.tracer.timed('staging', task_track(task_key)):
+            staged_fp = write_staged_pipeline(os.path.join(self.job_meta.root_dir, pipeline_fp), lists, staged,
+                                              staged_dir)
+        if staged_fp is None:
+            return pipeline_fp, {}
+        self.manager.update_task_stdout(task_key, f'Reading {len(staged)} images staged in '
+                                                  f'{self.stager.scratch_dir}\n')
+        return os.path.relpath(staged_fp, self.job_meta.root_dir), staged
+
+    def _prefetch_next(self, launched):
+        """ Prefetch the model files and first images of the next task that will be started """
+        if self.prefetcher is None:
+            return
+        with self._state_lock:
+            next_task_key = self.job_state.current_task(exclude=launched)
+        if next_task_key is None or self.prefetcher.prefetching(next_task_key):
+            return
+        pipeline_fp, dataset, _ = self.job_meta.get(next_task_key)
+        self._prefetch_task(next_task_key, pipeline_fp, dataset)
+
+    def _prefetch_task(self, task_key: TaskKey, pipeline_fp: str, dataset):
+        """ Prefetch the files the task's pipeline reads, pipeline_fp may be its resume or staged pipeline """
+        if self.prefetcher is None:
+            return
+        lists = [dataset.get(attr) for attr in INPUT_LIST_ATTRIBUTES if dataset.get(attr)]
+        # the image lists written by _resume_from_checkpoint and _use_staged_images
+        resume_dir = os.path.join(self.job_meta.compiled_pipelines_dir, 'resume')
+        staged_dir = os.path.join(self.job_meta.compiled_pipelines_dir, 'staged')
+        remaining = [os.path.join(resume_dir, f'remaining-{os.path.basename(fp)}') for fp in lists]
+        lists += remaining + [os.path.join(staged_dir, f'staged-{os.path.basename(fp)}') for fp in lists + remaining]
+        try:
+            model_files, image_lists = pipeline_inputs(os.path.join(self.job_meta.root_dir, pipeline_fp), lists)
+        except OSError as e:
+            print(f'Warning: unable to prefetch the inputs of {task_key}: {e}')
+            return
+        self.prefetcher.start(task_key, image_lists, model_files)
 
-            # set all tasks statuses to cancelled
-            self.job_state.set_task_status(task_to_end, TaskStatus.ERROR)
-            self.manager.end_task(task_to_end, TaskStatus.ERROR)
-        prog_stop_evt.set()
-        process.kill()
-        process.wait(timeout=30)
\ No newline at end of file
+    def _recover_pending_outputs(self, task_key: TaskKey):
+        """
+        Outputs left in the pending outputs directory were written by a run that never finished, e.g. the machine lost
+        power.  Move the newest outputs of the task to the error outputs directory and checkpoint them.
+        """
+        _, _, outputs = self.job_meta.get(task_key)
+        list_ports = outputs.get_image_list_env_ports()
+        csv_ports = outputs.get_det_csv_env_ports()
+        pending = [os.path.join(self.job_meta.pending_outputs_dir, f)
+                   for f in os.listdir(self.job_meta.pending_outputs_dir)]
+        image_lists = match_output_files(list_ports, pending)
+        detections = match_output_files(csv_ports, pending)
+        if not list_ports or len(image_lists) != len(list_ports) or len(detections) != len(csv_ports):
+            return
+        move_output_files(list(image_lists.values()) + list(detections.values()), self.job_meta.error_outputs_dir)
+        self._save_checkpoint(task_key, image_lists, detections)
+
+    def _save_checkpoint(self, task_key: TaskKey, image_lists: Dict[str, str], detections: Dict[str, str]):
+        """ Record the partial outputs of a task that were moved to the error outputs directory """
+        moved = lambda ports: {k: os.path.join(self.job_meta.error_outputs_dir, os.path.basename(fp))
+                               for k, fp in ports.items()}
+        with self._state_lock:
+            previous = self.job_state.get_task_checkpoint(task_key)
+        # the outputs of a delta task include the outputs of the previous job, keep resuming it as a delta
+        source = previous.get('source', 'partial') if previous else 'partial'
+        checkpoint = TaskCheckpoint(0, moved(image_lists), moved(detections), source=source)
+        if not checkpoint.files_exist():
+            return  # kwiver failed before writing its outputs, keep the previous checkpoint
+        checkpoint.images = checkpoint_image_count(list(checkpoint.image_lists.values()))
+        if checkpoint.images > 0:
+            with self._state_lock:
+                self.job_state.set_task_checkpoint(task_key, checkpoint.to_dict())
+
+    def _idle_time(self, task_key: TaskKey, last_output_time: float) -> float:
+        """ :return: seconds since the task last processed an image or wrote output """
+        last_progress = self.manager.task_last_progress_time.get(task_key, 0)
+        return time.time() - max(last_output_time, last_progress)
+
+    def _check_abort(self, task_key: TaskKey, spawned: float, resumed_images: int) -> Optional[AbortDecision]:
+        """ Check the abort rules against the live outputs of a running task """
+        if self._job_abort is not None:
+            return AbortDecision(self._job_abort.rule, f'job aborted: {self._job_abort.reason}', 'task')
+        if self.abort_policy is None or not self.abort_policy.rules:
+            return None
+        if task_key not in self._expected_rates:
+            self._expected_rates[task_key] = self.history.predict_images_per_sec(
+                self.job_meta.pipeline_name, parameter_hash(self.job_meta.pipeline_parameters()))
+        now = time.time()
+        images = max(self.manager.task_count.get(task_key, 0) - resumed_images, 0)
+        first_time = self.manager.task_first_progress_time.get(task_key)
+        images_per_sec, since_first = None, 0.
+        if first_time is not None:
+            since_first = now - first_time
+            if since_first > 0:
+                first_count = self.manager.task_first_progress_count.get(task_key, 0)
+                images_per_sec = (self.manager.task_count.get(task_key, 0) - first_count) / since_first
+        observation = TaskObservation(elapsed=now - spawned, images=images, images_per_sec=images_per_sec,
+                                      seconds_since_first_image=since_first,
+                                      expected_images_per_sec=self._expected_rates[task_key],
+                                      detections=self.manager.task_detections.get(task_key))
+        return self.abort_policy.check(observation)
+
+    def _record_abort(self, task_key: TaskKey, abort: AbortDecision, count: int):
+        """ Record why an abort rule cancelled the task, a job scoped rule cancels the rest of the job too """
+        msg = f'Task {task_key} aborted by the {abort.rule} rule: {abort.reason}.'
+        if abort.scope == 'job':
+            msg += ' Cancelling the job.'
+        print(msg)
+        self.manager.update_task_stdout(task_key, msg + '\n')
+        self.tracer.instant('aborted', task_track(task_key), rule=abort.rule, scope=abort.scope)
+        with self._state_lock:
+            self.job_state.add_task_event(task_key, {'event': 'aborted', 'time': time.time(), 'images': count,
+                                                     **abort.to_dict()})
+            if abort.scope == 'job' and self._job_abort is None:
+                self._job_abort = abort
+                self.job_state.add_job_event({'event': 'aborted', 'time': time.time(), 'task': task_key,
+                                              **abort.to_dict()})
+        self._task_done.set()
+
+    def _preflight(self) -> bool:
+        """ :return: True if the job's pipeline can be loaded, see pep_tk.core.pipeline_deps """
+        pipeline_fp = self.job_meta.pipeline_path
+        if not pipeline_fp or not os.path.isfile(pipeline_fp):
+            # e.g. a job created on another machine, only its compiled pipelines are known
+            print(f'Warning: pipeline {pipeline_fp} not found, skipping the pre-flight check')
+            return True
+        problems = preflight_pipeline(pipeline_fp)
+        if not problems:
+            return True
+        message = 'Pre-flight check failed, the pipeline can not be loaded:\n' + \
+                  ''.join(f'  {problem}\n' for problem in problems)
+        print(message, end='')
+        with self._state_lock:
+            self.job_state.add_job_event({'event': 'preflight_failed', 'time': time.time(), 'problems': problems})
+            for task_key in self.job_state.tasks(status=TaskStatus.INITIALIZED):
+                self.manager.update_task_stdout(task_key, message)
+                self.job_state.set_task_status(task_key, TaskStatus.ERROR)
+                self.manager.end_task(task_key, TaskStatus.ERROR)
+        return False
+
+    def _cancel_remaining_tasks(self):
+        """ Cancel the tasks that were not started when a job scoped abort rule fired """
+        reason = f'job aborted: {self._job_abort.reason}'
+        with self._state_lock:
+            for task_key in self.job_state.tasks(status=TaskStatus.INITIALIZED):
+                self.job_state.add_task_event(task_key, {'event': 'aborted', 'time': time.time(), 'images': 0,
+                                                         'rule': self._job_abort.rule, 'reason': reason,
+                                                         'scope': 'task'})
+                self.job_state.set_task_status(task_key, TaskStatus.CANCELLED)
+                self.manager.end_task(task_key, TaskStatus.CANCELLED)
+
+    def _record_attempt(self, task_key: TaskKey, status: TaskStatus, exit_code: Optional[int], count: int,
+                        failure: Optional[FailureClass] = None, retry_in: Optional[float] = None):
+        """ Persist a finished run of the task in the job state, must hold the state lock """
+        attempt = {'event': 'attempt', 'attempt': self._attempts.get(task_key, 1),
+                   'start': self.manager.task_start_time.get(task_key), 'end': time.time(),
+                   'exit_code': exit_code, 'status': status.name, 'images': count,
+                   'failure': failure.value if failure is not None else None}
+        if retry_in is not None:
+            attempt['retry_in'] = round(retry_in, 1)
+        if self.leases is not None:
+            attempt['node'] = self.leases.node
+        self.job_state.add_task_event(task_key, attempt)
+
+    def _handle_failed(self, task_key: TaskKey, exit_code: int, count: int, failure: FailureClass):
+        """ Mark a task whose kwiver process failed as errored, or re-queue it if the retry policy allows """
+        attempt = self._attempts.get(task_key, 1)
+        retry = self.retry_policy is not None and self.retry_policy.should_retry(failure, attempt)
+        retry_in = self.retry_policy.backoff(attempt) if retry else None
+        if retry:
+            msg = f'Task {task_key} failed (exit code {exit_code}, {failure.value}) on attempt {attempt}, ' \
+                  f'retrying in {retry_in:g} seconds.'
+        else:
+            msg = f'Task {task_key} failed (exit code {exit_code}, {failure.value}) on attempt {attempt}.'
+        print(msg)
+        self.manager.update_task_stdout(task_key, msg + '\n')
+        self.tracer.instant('failed', task_track(task_key), exit_code=exit_code, failure=failure.value,
+                            retry_in=retry_in)
+
+        status = TaskStatus.INITIALIZED if retry else TaskStatus.ERROR
+        with self._state_lock, self.tracer.timed('state save', task_track(task_key)):
+            self._record_attempt(task_key, TaskStatus.ERROR, exit_code, count, failure, retry_in)
+            if retry:
+                self._not_before[task_key] = time.time() + retry_in
+            self.job_state.set_task_status(task_key, status)
+        self.manager.end_task(task_key, status)
+
+    def _handle_stalled(self, task_key: TaskKey, idle_time: float, count: int, exit_code: Optional[int] = None):
+        """ Record a task killed by the watchdog and re-queue it if it has retries left """
+        with self._state_lock:
+            stalls = [e for e in self.job_state.get_task_events(task_key) if e.get('event') == 'stalled']
+        retry = len(stalls) < self.stall_retries  # the stalls of earlier runs of the job count too
+        action = 'retry' if retry else 'error'
+        event = {'event': 'stalled', 'time': time.time(), 'idle_seconds': round(idle_time, 1),
+                 'stall_timeout': self.stall_timeout, 'images': count, 'action': action}
+        msg = f'Task {task_key} stalled, no new images or output for {idle_time:.0f} seconds ' \
+              f'(stall timeout {self.stall_timeout:g}s). The kwiver process was killed, ' \
+              f'{"retrying" if retry else "giving up"}.'
+        print(msg)
+        self.manager.update_task_stdout(task_key, msg + '\n')
+        self.tracer.instant('stalled', task_track(task_key), idle_seconds=idle_time, action=action)
+        try:
+            with open(os.path.join(self.job_meta.logs_dir, 'watchdog.log'), 'a') as f:
+                f.write(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")} {msg}\n')
+        except OSError as e:
+            print(f'Warning: unable to write watchdog log: {e}')
+
+        status = TaskStatus.INITIALIZED if retry else TaskStatus.ERROR
+        with self._state_lock, self.tracer.timed('state save', task_track(task_key)):
+            self.job_state.add_task_event(task_key, event)
+            self._record_attempt(task_key, TaskStatus.ERROR, exit_code, count, FailureClass.STALLED)
+            self.job_state.set_task_status(task_key, status)
+        self.manager.end_task(task_key, status)
+
+    def _trace_process_phases(self, task_key: TaskKey, spawned: float, first_line_time: Optional[float],
+                              exit_time: float, code: int):
+        """ Record the phases of the kwiver process, image times are as observed by the progress polling """
+        track = task_track(task_key)
+        first_image = self.manager.task_first_progress_time.get(task_key)
+        last_image = self.manager.task_last_progress_time.get(task_key)
+        self.tracer.span('first output line', track, spawned, first_line_time)
+        self.tracer.span('first image', track, spawned, first_image, poll_freq=self.progress_poll_freq)
+        self.tracer.span('last image', track, first_image, last_image,
+                         images=self.manager.task_count.get(task_key, 0))
+        self.tracer.span('process exit', track, last_image or spawned, exit_time, exit_code=code)
+
+    def _save_resource_usage(self, task_key: TaskKey, resource_thread: Optional[threading.Thread],
+                             summary: ResourceUsageSummary):
+        if resource_thread is None:
+            return
+        resource_thread.join(timeout=self.resource_poll_freq + 5)
+        if summary.sample_count > 0:
+            with self._state_lock:
+                self.job_meta.set_task_resources(task_key, summary.to_dict())
+
+    def _record_performance(self, task_key: TaskKey, image_count: int, peak_memory: Optional[int] = None,
+                            skipped_images: int = 0):
+        """
+        :param image_count: images processed by this run of the task
+        :param skipped_images: images of the checkpoint the run resumed from, included in the task's progress counts
+        """
+        if image_count < 1:
+            return
+        # the progress counts include the checkpoint's images, count the first progress from the start of this run
+        first_progress_count = max(self.manager.task_first_progress_count.get(task_key, 0) - skipped_images, 0)
+        try:
+            record = build_performance_record(pipeline=self.job_meta.pipeline_name,
+                                              param_hash=parameter_hash(self.job_meta.pipeline_parameters()),
+                                              image_count=image_count,
+                                              start_time=self.manager.task_start_time[task_key],
+                                              end_time=self.manager.task_end_time[task_key],
+                                              first_progress_time=self.manager.task_first_progress_time.get(task_key),
+                                              first_progress_count=first_progress_count,
+                                              peak_memory=peak_memory,
+                                              task_key=task_key,
+                                              job_name=self.job_meta.job_name)
+            with self._state_lock:
+                self.history.add_record(record)
+        except Exception as e:
+            # the history is only used for estimates, never fail a task because it couldn't be written
+            print(f'Warning: unable to record performance history for {task_key}: {e}')
+
+    def _kill_all_tasks(self):
+        if self.leases is not None:
+            return  # the task threads handed their tasks back, the other nodes continue the job
+        with self._state_lock:
+            for task_to_end in self.job_state.tasks():
+                if self.job_state.is_task_complete(task_to_end):
+                    continue  # do not modify state of complete tasks
+
+                # set all tasks statuses to cancelled
+                self.job_state.set_task_status(task_to_end, TaskStatus.ERROR)
+                self.manager.end_task(task_to_end, TaskStatus.ERROR)
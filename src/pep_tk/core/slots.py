@@ -0,0 +1,162 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from typing import Dict, List, Optional, Union
+
+from pep_tk.core.job import TaskKey
+
+
+def slot_env_name(pool_name: str) -> str:
+    """ The environment variable every slot is exported through, e.g. PEP_TK_SLOT_DEVICES for the 'devices' pool """
+    return 'PEP_TK_SLOT_' + ''.join(c if c.isalnum() else '_' for c in pool_name).upper()
+
+
+def cpuset_slots(cpu_count: int, cpus_per_slot: int) -> List[str]:
+    """
+    Split cpus 0..cpu_count-1 into contiguous cpu sets in taskset list format.
+
+    >>> cpuset_slots(8, 4)
+    ['0-3', '4-7']
+    """
+    if cpus_per_slot < 1:
+        raise ValueError('cpus_per_slot must be at least 1')
+    slots = []
+    for start in range(0, cpu_count - cpus_per_slot + 1, cpus_per_slot):
+        end = start + cpus_per_slot - 1
+        slots.append(str(start) if start == end else f'{start}-{end}')
+    return slots
+
+
+class SlotPool:
+    """
+    A named pool of slots (device indices, cpu sets, licenses, ...).  Every running task holds one slot of each pool
+    of the scheduler, so the number of slots in a pool also limits how many tasks run at once.
+
+    The slot assigned to a task is exported to the kwiver process through PEP_TK_SLOT_<NAME> and any extra
+    environment variables of the pool (e.g. CUDA_VISIBLE_DEVICES for a pool of gpus).  The slots of a cpu set pool
+    are also applied as the cpu affinity of the kwiver process.
+    """
+    def __init__(self, name: str, slots: List, env_vars: Optional[List[str]] = None, cpuset: bool = False):
+        """
+        :param name: name of the pool
+        :param slots: the slot values, e.g. [0, 1] for two gpus or ['0-3', '4-7'] for two cpu sets
+        :param env_vars: extra environment variables to export the assigned slot through
+        :param cpuset: slots are cpu lists in taskset format which are applied as the cpu affinity of the task
+        """
+        if len(slots) == 0:
+            raise ValueError(f'Slot pool "{name}" must have at least one slot')
+        if len(set(str(s) for s in slots)) != len(slots):
+            raise ValueError(f'Slot pool "{name}" has duplicate slots')
+        self.name = name
+        self.slots = [str(s) for s in slots]
+        self.env_vars = list(env_vars or [])
+        self.cpuset = cpuset
+        self._assigned: Dict[TaskKey, str] = {}
+        self._lock = threading.Lock()
+
+    def free_slots(self) -> List[str]:
+        with self._lock:
+            in_use = set(self._assigned.values())
+            return [s for s in self.slots if s not in in_use]
+
+    def acquire(self, task_key: TaskKey) -> Optional[str]:
+        """ :return: the slot assigned to the task, or None if every slot is in use """
+        with self._lock:
+            if task_key in self._assigned:
+                return self._assigned[task_key]
+            in_use = set(self._assigned.values())
+            for s in self.slots:
+                if s not in in_use:
+                    self._assigned[task_key] = s
+                    return s
+        return None
+
+    def release(self, task_key: TaskKey):
+        with self._lock:
+            self._assigned.pop(task_key, None)
+
+    def assigned(self, task_key: TaskKey) -> Optional[str]:
+        return self._assigned.get(task_key)
+
+    def environment(self, slot: str) -> Dict[str, str]:
+        env = {slot_env_name(self.name): slot}
+        for var in self.env_vars:
+            env[var] = slot
+        return env
+
+
+class SlotAssignment:
+    """ The slots a task holds, one from each pool """
+    def __init__(self, slots: Dict[str, str], pools: List[SlotPool]):
+        self.slots = slots
+        self._pools = {p.name: p for p in pools}
+
+    def environment(self) -> Dict[str, str]:
+        env = {}
+        for name, slot in self.slots.items():
+            env.update(self._pools[name].environment(slot))
+        return env
+
+    def cpu_affinity(self) -> Optional[str]:
+        """ :return: the cpu list (taskset format) the task is pinned to, or None """
+        cpusets = [slot for name, slot in self.slots.items() if self._pools[name].cpuset]
+        return ','.join(cpusets) if cpusets else None
+
+    def __str__(self):
+        return ', '.join(f'{name}={slot}' for name, slot in self.slots.items())
+
+
+def acquire_slots(pools: List[SlotPool], task_key: TaskKey) -> Optional[SlotAssignment]:
+    """ Acquire a slot from every pool for the task, all or nothing.  :return: SlotAssignment or None """
+    acquired = {}
+    for pool in pools:
+        slot = pool.acquire(task_key)
+        if slot is None:
+            release_slots(pools, task_key)
+            return None
+        acquired[pool.name] = slot
+    return SlotAssignment(acquired, pools)
+
+
+def release_slots(pools: List[SlotPool], task_key: TaskKey):
+    for pool in pools:
+        pool.release(task_key)
+
+
+def slot_pools_from_config(config: Dict[str, Union[List, Dict]]) -> List[SlotPool]:
+    """
+    Create slot pools from a configuration dictionary (e.g. from the gui settings file).  A pool is either a list of
+    slots or a dictionary with 'slots' and optional 'env' and 'cpuset' keys:
+
+        {"devices": {"slots": [0, 1], "env": ["CUDA_VISIBLE_DEVICES"]},
+         "cpus": {"slots": ["0-3", "4-7"], "cpuset": true},
+         "licenses": ["a", "b", "c"]}
+
+    :return: list of SlotPool
+    """
+    pools = []
+    for name, value in (config or {}).items():
+        if isinstance(value, dict):
+            if 'slots' not in value:
+                raise ValueError(f'Slot pool "{name}" is missing "slots"')
+            pools.append(SlotPool(name, value['slots'], env_vars=value.get('env'),
+                                  cpuset=bool(value.get('cpuset', False))))
+        elif isinstance(value, (list, tuple)):
+            pools.append(SlotPool(name, list(value)))
+        else:
+            raise ValueError(f'Slot pool "{name}" must be a list of slots or a dictionary')
+    return pools
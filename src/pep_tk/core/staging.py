@@ -0,0 +1,219 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local staging of a task's images.  When the imagery is on network storage kwiver spends most of its time waiting on
+reads, so while a task runs the images of the next task are copied to a local scratch directory in the background.
+When that task starts its pipeline reads the local copies of the images that were staged (images that were not
+staged in time, or did not fit the space budget, are still read from their original location), and the copies are
+deleted once the task is done.
+"""
+
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from pep_tk.core.checkpoint import IMAGE_COLUMN, absolute_image_paths, read_list_lines
+
+DEFAULT_MAX_BYTES = 20 << 30
+
+
+class _StagedTask:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+        self.staged: Dict[str, str] = {}  # original image path -> local copy, only completed copies
+        self.bytes = 0
+
+
+class ImageStager:
+    def __init__(self, scratch_dir: str, max_bytes: int = DEFAULT_MAX_BYTES, max_workers: int = 4):
+        """
+        Copies the images of upcoming tasks to a local scratch directory in the background.
+
+        :param scratch_dir: local directory to copy the images to, each task gets a sub directory
+        :param max_bytes: maximum size of the staged images of all tasks, images that don't fit are not staged
+        :param max_workers: number of images copied at the same time
+        """
+        self.scratch_dir = scratch_dir
+        self.max_bytes = max_bytes
+        self.max_workers = max(1, max_workers)
+        self._tasks: Dict[str, _StagedTask] = {}
+        self._lock = threading.Lock()
+        self._used_bytes = 0
+
+    def staging(self, task_key: str) -> bool:
+        return task_key in self._tasks
+
+    def stage(self, task_key: str, image_lists: Iterable[str]):
+        """ Start copying the images of the task's image lists in a background thread, if not already staging it """
+        with self._lock:
+            if task_key in self._tasks:
+                return
+            task = _StagedTask(os.path.join(self.scratch_dir, re.sub(r'[^\w.-]', '_', task_key)))
+            self._tasks[task_key] = task
+        thread = threading.Thread(target=self._stage, args=(task, [fp for fp in image_lists if fp]), daemon=True)
+        thread.start()
+
+    def _stage(self, task: _StagedTask, image_lists: List[str]):
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for i, list_fp in enumerate(image_lists):
+                    # a directory per image list, the thermal and color images may share file names
+                    list_dir = os.path.join(task.directory, str(i))
+                    os.makedirs(list_dir, exist_ok=True)
+                    images = absolute_image_paths(list_fp) if os.path.isfile(list_fp) else []
+                    for _ in pool.map(lambda image: self._copy(task, image, list_dir), images):
+                        pass
+        except OSError as e:
+            print(f'Warning: staging images to {task.directory} failed: {e}')
+        finally:
+            task.done.set()
+
+    def _copy(self, task: _StagedTask, image: str, list_dir: str):
+        if task.cancel.is_set() or image in task.staged:
+            return
+        try:
+            size = os.path.getsize(image)
+        except OSError:
+            return  # missing images are reported by kwiver
+        with self._lock:
+            if self._used_bytes + size > self.max_bytes:
+                return
+            self._used_bytes += size
+            task.bytes += size
+        local = os.path.join(list_dir, os.path.basename(image))
+        try:
+            shutil.copyfile(image, local + '.tmp')
+            os.replace(local + '.tmp', local)
+        except OSError as e:
+            with self._lock:
+                self._used_bytes -= size
+                task.bytes -= size
+            print(f'Warning: unable to stage {image}: {e}')
+            return
+        with self._lock:
+            if task.cancel.is_set():
+                return  # the task started or was released while copying, the copy is not used
+            task.staged[image] = local
+
+    def staged_images(self, task_key: str) -> Dict[str, str]:
+        """
+        Stop staging the task and return its staged images, kwiver reads the images it is given from the moment it
+        starts so images copied later would not be used.
+
+        :return: dictionary of original image path to its local copy
+        """
+        task = self._tasks.get(task_key)
+        if task is None:
+            return {}
+        with self._lock:
+            task.cancel.set()
+            return dict(task.staged)
+
+    def release(self, task_key: str):
+        """ Delete the staged images of a task """
+        with self._lock:
+            task = self._tasks.pop(task_key, None)
+            if task is None:
+                return
+            task.cancel.set()
+        task.done.wait(60)  # copies in flight finish before the directory is removed
+        shutil.rmtree(task.directory, ignore_errors=True)
+        with self._lock:
+            self._used_bytes -= task.bytes
+
+    def close(self):
+        """ Stop staging and delete the staged images of every task """
+        for task_key in list(self._tasks):
+            self.release(task_key)
+
+
+def write_staged_image_list(list_fp: str, staged: Dict[str, str], staged_list_fp: str) -> int:
+    """
+    Write a copy of an image list that reads the staged copy of every image that has one.
+
+    :return: number of images read from the staged copies
+    """
+    count = 0
+    with open(staged_list_fp, 'w') as f:
+        for image in absolute_image_paths(list_fp):
+            local = staged.get(image)
+            count += local is not None
+            f.write((local or image) + '\n')
+    return count
+
+
+def restore_image_list(output_list_fp: str, staged: Dict[str, str]):
+    """ Replace the staged copies kwiver wrote to an output image list with the original image paths """
+    if not staged or not os.path.isfile(output_list_fp):
+        return
+    originals = {local: image for image, local in staged.items()}
+    lines = read_list_lines(output_list_fp)
+    with open(output_list_fp, 'w') as f:
+        f.writelines(originals.get(line, line) + '\n' for line in lines)
+
+
+def restore_detection_images(detection_csv_fp: str, staged: Dict[str, str]):
+    """
+    Replace the staged copies kwiver wrote to the image column of a detection csv with the original image paths, the
+    pipelines write the full path of the image they read unless they set no_path_in_name.
+    """
+    if not staged or not os.path.isfile(detection_csv_fp):
+        return
+    originals = {local: image for image, local in staged.items()}
+    with open(detection_csv_fp, 'r') as f:
+        lines = f.readlines()
+    with open(detection_csv_fp, 'w') as f:
+        for line in lines:
+            cols = line.rstrip('\r\n').split(',')
+            if not line.startswith('#') and len(cols) > IMAGE_COLUMN and cols[IMAGE_COLUMN] in originals:
+                cols[IMAGE_COLUMN] = originals[cols[IMAGE_COLUMN]]
+                line = ','.join(cols) + '\n'
+            f.write(line)
+
+
+def write_staged_pipeline(pipeline_fp: str, image_lists: Iterable[str], staged: Dict[str, str],
+                          output_dir: str) -> Optional[str]:
+    """
+    Copy a compiled pipeline, reading staged copies of its input image lists.
+
+    :param pipeline_fp: the compiled pipeline
+    :param image_lists: the input image lists the pipeline may read
+    :param staged: original image path to its staged copy
+    :param output_dir: directory to write the staged image lists and pipeline to
+    :return: path of the staged pipeline, or None if none of the pipeline's images were staged
+    """
+    with open(pipeline_fp, 'r') as f:
+        content = f.read()
+    os.makedirs(output_dir, exist_ok=True)
+    staged_count = 0
+    for list_fp in image_lists:
+        if not list_fp or list_fp not in content or not os.path.isfile(list_fp):
+            continue
+        staged_list_fp = os.path.join(output_dir, f'staged-{os.path.basename(list_fp)}')
+        staged_count += write_staged_image_list(list_fp, staged, staged_list_fp)
+        content = content.replace(list_fp, staged_list_fp)
+    if staged_count == 0:
+        return None
+    staged_fp = os.path.join(output_dir, os.path.basename(pipeline_fp))
+    with open(staged_fp, 'w') as f:
+        f.write(content)
+    return staged_fp
@@ -0,0 +1,97 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from pep_tk.core.job import TaskKey
+
+SCHEDULER_TRACK = 'scheduler'
+
+
+class TraceRecorder:
+    """
+    Records the phases of each task in the Chrome trace event format, the trace can be opened in chrome://tracing or
+    https://ui.perfetto.dev.  Every task is shown as its own track.
+    """
+    def __init__(self, trace_fp: Optional[str]):
+        """
+        :param trace_fp: file to write the trace to, if None events are recorded but never written
+        """
+        self.trace_fp = trace_fp
+        self.pid = os.getpid()
+        self._events: List[Dict] = []
+        self._tracks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _tid(self, track: str) -> int:
+        # must hold the lock
+        if track not in self._tracks:
+            tid = len(self._tracks) + 1
+            self._tracks[track] = tid
+            self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                 'args': {'name': track}})
+            self._events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                 'args': {'sort_index': tid}})
+        return self._tracks[track]
+
+    def span(self, name: str, track: str, start: Optional[float], end: Optional[float], **args):
+        """ Record a complete event from start to end (time.time() seconds), ignored if either time is unknown """
+        if start is None or end is None:
+            return
+        with self._lock:
+            self._events.append({'name': name, 'cat': 'task', 'ph': 'X', 'pid': self.pid, 'tid': self._tid(track),
+                                 'ts': int(start * 1e6), 'dur': max(int((end - start) * 1e6), 0), 'args': args})
+
+    def instant(self, name: str, track: str, ts: Optional[float] = None, **args):
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            self._events.append({'name': name, 'cat': 'task', 'ph': 'i', 's': 't', 'pid': self.pid,
+                                 'tid': self._tid(track), 'ts': int(ts * 1e6), 'args': args})
+
+    @contextmanager
+    def timed(self, name: str, track: str, **args):
+        """ Record the time spent in the with block as a span """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.span(name, track, start, time.time(), **args)
+
+    def events(self) -> List[Dict]:
+        with self._lock:
+            return list(self._events)
+
+    def save(self):
+        """ Write the trace, the file is replaced atomically so a partial trace can be opened while the job runs """
+        if not self.trace_fp:
+            return
+        data = {'traceEvents': self.events(), 'displayTimeUnit': 'ms'}
+        directory = os.path.dirname(self.trace_fp)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp') as f:
+            json.dump(data, f)
+            tmp_fp = f.name
+        os.replace(tmp_fp, self.trace_fp)
+
+
+def task_track(task_key: TaskKey) -> str:
+    return f'task {task_key}'
@@ -13,7 +13,24 @@
 #
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
-def main():
+import argparse
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='pep_gui', description='PEP-TK detection pipeline batch runner')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the scheduler and gui threads and take periodic tracemalloc snapshots, '
+                             'results are written to the logs/profile directory of each job '
+                             '(same as setting PEP_TK_PROFILE=1)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        from pep_tk.core.profiling import enable_profiling
+        enable_profiling()
+
     from pep_tk.core.parser import load_dataset_manifest, DatasetManifestError, EmptyParser
     from pep_tk.psg.settings import UserProperties
     from pep_tk.psg.windows import launch_gui, popup_error
@@ -16,7 +16,9 @@
 from dataclasses import dataclass
 from typing import List, Optional
 
+from pep_tk.core.detection_stats import DetectionStats
 from pep_tk.core.job import TaskStatus
+from pep_tk.core.resources import ResourceSample
 
 
 @dataclass
@@ -29,6 +31,8 @@ class ProgressGUIEventData:
     output_files: List[str] = None  # output files from the task (image lists, detections)
     output_log: str = None
     completed_on_load: bool = False # if task was already completed when initialized/loaded
+    resource_usage: ResourceSample = None  # latest cpu/memory/io sample of the task's processes (linux only)
+    detection_stats: DetectionStats = None  # running statistics of the detections written so far
 
     @property
     def time_per_count(self) -> float:  # average time taken to process each item
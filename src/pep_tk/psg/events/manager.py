@@ -57,7 +57,8 @@ class GUIManager(SchedulerEventManager):
                                         progress_count=self.task_count[task_key],
                                         max_count=self.task_max_count[task_key],
                                         elapsed_time=self.elapsed_time(task_key),
-                                        output_log=self.pop_stdout(task_key, min_lines_to_pop=0))
+                                        output_log=self.pop_stdout(task_key, min_lines_to_pop=0),
+                                        detection_stats=self.task_detections.get(task_key))
         self._window.write_event_value(gui_task_event_key, evt_data)
         # delete outputs from memory when task is finished
         if task_key in self.stdout:
@@ -71,7 +72,9 @@ class GUIManager(SchedulerEventManager):
                                         progress_count=self.task_count[task_key],
                                         max_count=self.task_max_count[task_key],
                                         elapsed_time=self.elapsed_time(task_key),
-                                        output_log=self.pop_stdout(task_key, min_lines_to_pop=5))
+                                        output_log=self.pop_stdout(task_key, min_lines_to_pop=5),
+                                        resource_usage=self.task_resources.get(task_key),
+                                        detection_stats=self.task_detections.get(task_key))
 
         gui_task_event_key = self.task_event_key(task_key)
         self._window.write_event_value(gui_task_event_key, evt_data)
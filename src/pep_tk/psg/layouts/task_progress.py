@@ -19,7 +19,9 @@ from typing import List, Optional, Dict
 
 import PySimpleGUI as sg
 
+from pep_tk.core.detection_stats import DetectionStats
 from pep_tk.core.job import TaskStatus
+from pep_tk.core.resources import ResourceSample, format_bytes
 from pep_tk.psg.events import ProgressGUIEventData
 from pep_tk.psg.fonts import Fonts
 from pep_tk.psg.layouts import LayoutSection
@@ -61,6 +63,8 @@ class TaskTab(LayoutSection):
         self._counter_key = f'--tt-counter-{self.task_key}--'
         self._iteration_time_key = f'--tt-iteration-time-{self.task_key}--'
         self._status_key = f'--tt-status-{self.task_key}--'
+        self._resources_key = f'--tt-resources-{self.task_key}--'
+        self._detections_key = f'--tt-detections-{self.task_key}--'
         self._output_files_key = f'--tt-output-files-{self.task_key}--'
         self._kwiver_output_key = f'--tt-kwiver-output-{self.task_key}--' + sg.WRITE_ONLY_KEY
 
@@ -88,12 +92,15 @@ class TaskTab(LayoutSection):
         counter = sg.T(counter_str, key=self._counter_key)
         iter_str = empty_string('x.xx seconds/iter')
         avg_iteration_time = sg.T(iter_str, key=self._iteration_time_key, size=(len('x.xx seconds/iter'), 1))
+        resources = sg.T('', key=self._resources_key, size=(len('xxxx.x MB memory xxxx.x% cpu'), 1))
+        detections = sg.T('', key=self._detections_key, size=(60, 1))
         output_files = sg.Column([[]], key=self._output_files_key)
         cancel_button = sg.Button('Cancel', key=self._cancel_event_key, disabled=True)
         output_title = sg.T("Output Log", font=Fonts.title_small)
         kwiver_output = sg.Multiline( key=self._kwiver_output_key,
                                       autoscroll=False, auto_refresh=True, disabled=True, expand_x=True, expand_y=True, size=(50,10))
-        layout = [[status_icon, title, pb, time_elapsed, counter, avg_iteration_time],
+        layout = [[status_icon, title, pb, time_elapsed, counter, avg_iteration_time, resources],
+                  [detections],
                   [output_files],
                   [cancel_button],
                   [output_title],
@@ -120,6 +127,8 @@ class TaskTab(LayoutSection):
         self._update_status(window, progress.task_status)
         self._update_output_files(window, progress.output_files)
         self._update_kwiver_output(window, progress.output_log)
+        self._update_resources(window, progress.resource_usage)
+        self._update_detections(window, progress.detection_stats)
 
         self.max_count = progress.max_count
         self.progress_count = progress.progress_count
@@ -136,6 +145,16 @@ class TaskTab(LayoutSection):
         else:
             window[self._cancel_event_key](disabled=True)
 
+    def _update_resources(self, window: sg.Window, sample: Optional[ResourceSample]):
+        if sample is None:
+            return
+        window[self._resources_key](value='%s memory %.1f%% cpu' % (format_bytes(sample.rss), sample.cpu_percent))
+
+    def _update_detections(self, window: sg.Window, stats: Optional[DetectionStats]):
+        if stats is None:
+            return
+        window[self._detections_key](value=f'{stats.summary()}, at most {stats.max_detections_per_image} on an image')
+
     def _update_kwiver_output(self, window: sg.Window, new_str: str):
         if new_str is None or new_str == "":
             return
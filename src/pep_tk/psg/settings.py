@@ -28,6 +28,23 @@ class SystemSettingsNames:
     recent_jobs_list = 'recent_jobs_list'
     detection_output_location = 'detection_output_location'
     job_directory = 'job_directory'
+    max_concurrent_tasks = 'max_concurrent_tasks'
+    resource_slots = 'resource_slots'
+    metrics_port = 'metrics_port'
+    metrics_textfile = 'metrics_textfile'
+    stall_timeout = 'stall_timeout'
+    stall_retries = 'stall_retries'
+    retry_policy = 'retry_policy'
+    checkpoint_resume = 'checkpoint_resume'
+    result_cache_dir = 'result_cache_dir'
+    result_cache_max_bytes = 'result_cache_max_bytes'
+    detection_index = 'detection_index'
+    abort_rules = 'abort_rules'
+    staging_dir = 'staging_dir'
+    staging_max_bytes = 'staging_max_bytes'
+    staging_workers = 'staging_workers'
+    prefetch_window = 'prefetch_window'
+    preflight = 'preflight'
 
 
 def image_resource_path(file_path=''):
@@ -14,6 +14,7 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import datetime
 import os
 from typing import Dict, Any
 
@@ -21,7 +22,10 @@ import PySimpleGUI as sg
 
 from pep_tk.core.configuration import PipelineManifest
 from pep_tk.core.configuration.exceptions import MissingPortsException
-from pep_tk.core.job import create_job, job_exists
+from pep_tk.core.dispatch import DISPATCH_POLICIES, get_dispatch_policy
+from pep_tk.core.history import PerformanceHistory, parameter_hash
+from pep_tk.core.job import create_job, job_exists, load_job
+from pep_tk.core.job_lock import read_job_lock
 from pep_tk.core.parser import ManifestParser
 from pep_tk.psg.fonts import Fonts
 from pep_tk.psg.layouts import DatasetSelectionLayout, PipelineSelectionLayout, LayoutSection
@@ -30,6 +34,19 @@ from pep_tk.psg.utils import move_window_onto_screen
 from pep_tk.psg.windows import show_properties_window, run_job, popup_error, popup_about
 
 
+# selecting the default keeps the order of a resumed job, new jobs default to alphabetical
+DEFAULT_DISPATCH_POLICY = 'job default'
+# explicit priorities can only be set through pep_tk.core.dispatch.PriorityPolicy
+DISPATCH_POLICY_NAMES = [DEFAULT_DISPATCH_POLICY] + [n for n in DISPATCH_POLICIES.keys() if n != 'priority']
+
+
+def selected_dispatch_policy(values: Dict[Any, Any]):
+    name = values.get('-dispatch_policy-IN-', DEFAULT_DISPATCH_POLICY)
+    if not name or name == DEFAULT_DISPATCH_POLICY:
+        return None
+    return get_dispatch_policy(name)
+
+
 # ======== Handler helper functions =========
 def validate_inputs(window: sg.Window, values: Dict[Any, Any], dataset_tab, pipeline_tab) -> bool:
     user_settings = get_user_settings()
@@ -73,9 +90,37 @@ def validate_inputs(window: sg.Window, values: Dict[Any, Any], dataset_tab, pipe
                     w_loc, w_size)
         return False
 
+    # Check the previous job of a delta job
+    delta_job_dir = values.get('-delta_job-IN-')
+    if delta_job_dir and not job_exists(delta_job_dir):
+        popup_error(f'Unable to load the previous job to only process new images since.\n{delta_job_dir}',
+                    w_loc, w_size)
+        return False
+
     return True
 
 
+def show_job_estimate(window: sg.Window, dataset_tab, pipeline_tab):
+    user_settings = get_user_settings()
+    input_datasets = dataset_tab.get_selected_datasets()
+    input_pipeline = pipeline_tab.get_selected_pipeline()
+    w_loc, w_size = window.current_location(), window.size
+    if len(input_datasets) < 1 or input_pipeline is None:
+        popup_error('Select a pipeline and one or more datasets to estimate the job duration.', w_loc, w_size)
+        return
+
+    history = PerformanceHistory(user_settings.get(SystemSettingsNames.job_directory))
+    image_counts = [max(ds.thermal_image_count, ds.color_image_count) for ds in input_datasets]
+    estimate = history.predict_total_duration(input_pipeline.name, image_counts,
+                                              parameter_hash(input_pipeline.get_parameter_values()))
+    if estimate is None:
+        msg = f'No performance history found for {input_pipeline.name}, run a job with this pipeline first.'
+    else:
+        msg = f'{sum(image_counts)} images in {len(input_datasets)} datasets.\n' \
+              f'Estimated duration {str(datetime.timedelta(seconds=int(estimate)))}'
+    sg.popup_ok(msg, title='Job Estimate', location=w_loc, keep_on_top=True)
+
+
 # ======== Create Job Window launcher =========
 def launch_gui(pm: PipelineManifest, dm: ManifestParser) -> bool:
     sg.theme('SystemDefaultForReal')
@@ -99,8 +144,17 @@ def launch_gui(pm: PipelineManifest, dm: ManifestParser) -> bool:
                  relief=sg.RELIEF_RIDGE, k='-TEXT HEADING-', enable_events=True, text_color='#063970')],
         [create_frame(dataset_tab)],
         [create_frame(pipeline_tab)],
-        [sg.Text('Job Name', font=Fonts.description), sg.Input('', key='-job_name-IN-', size=(20, 1))],
-        [sg.Button('Create Job', key='-CREATE_JOB-')]]
+        [sg.Text('Job Name', font=Fonts.description), sg.Input('', key='-job_name-IN-', size=(20, 1)),
+         sg.Text('Task Order', font=Fonts.description),
+         sg.Combo(DISPATCH_POLICY_NAMES, default_value=DEFAULT_DISPATCH_POLICY, key='-dispatch_policy-IN-',
+                  readonly=True)],
+        [sg.Text('Only New Images Since Job', font=Fonts.description),
+         sg.Input('', key='-delta_job-IN-', size=(40, 1)),
+         sg.FolderBrowse(initial_folder=get_user_settings().get(SystemSettingsNames.job_directory))],
+        [sg.Checkbox('Post Filter Thresholds', key='-post_filter-IN-', default=False, font=Fonts.description,
+                     tooltip='Run the detectors at a low threshold and keep the unfiltered detections, so the job '
+                             'can be re-thresholded without running it again')],
+        [sg.Button('Create Job', key='-CREATE_JOB-'), sg.Button('Estimate Duration', key='-ESTIMATE_JOB-')]]
 
     user_settings = get_user_settings()
     location = user_settings.get(SystemSettingsNames.window_location, (None, None))
@@ -147,6 +201,12 @@ def launch_gui(pm: PipelineManifest, dm: ManifestParser) -> bool:
                     exists = job_exists(job_folder)
                     if exists:
                         RESUME_JOB_PATH = job_folder
+                        dispatch_policy = selected_dispatch_policy(values)
+                        holder = read_job_lock(job_folder)
+                        running = holder is not None and not holder.is_stale()
+                        # the order of a job that is already running is not changed, see run_job
+                        if dispatch_policy is not None and not running:
+                            load_job(job_folder, dispatch_policy=dispatch_policy)  # persists the new task order
                         break
                     else:
                         popup_error(f'Job {job_folder} is not a valid job directory.', window.current_location(),
@@ -173,7 +233,10 @@ def launch_gui(pm: PipelineManifest, dm: ManifestParser) -> bool:
                 datasets = dataset_tab.get_selected_datasets()
                 try:
                     job_dir = os.path.join(selected_job_directory, selected_job_name)
-                    CREATED_JOB_PATH = create_job(pipeline=pipeline, datasets=datasets, directory=job_dir)
+                    CREATED_JOB_PATH = create_job(pipeline=pipeline, datasets=datasets, directory=job_dir,
+                                                  dispatch_policy=selected_dispatch_policy(values),
+                                                  delta_from=values.get('-delta_job-IN-') or None,
+                                                  post_filter=bool(values.get('-post_filter-IN-')))
                 except Exception as e:
                     popup_error(
                         f'There was an error creating the job: \n {str(e)}.\n I would recommend sending this error to Yuval.',
@@ -181,6 +244,8 @@ def launch_gui(pm: PipelineManifest, dm: ManifestParser) -> bool:
                     continue
 
                 break  # END: close window
+        elif event == '-ESTIMATE_JOB-':
+            show_job_estimate(window, dataset_tab, pipeline_tab)
         else:
             # ======== Handle other user interactions =========
             dataset_tab.handle(window, event, values)
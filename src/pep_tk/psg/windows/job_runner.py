@@ -15,19 +15,30 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import os
 import threading
 import time
-from typing import List
+from typing import List, Tuple
 
 import PySimpleGUI as sg
 
-from pep_tk.core.job import load_job, TaskStatus, TaskKey
+from pep_tk.core.abort import AbortPolicy, AbortRuleException
+from pep_tk.core.job import load_job, JobState, TaskStatus, TaskKey, JobMeta
+from pep_tk.core.job_lock import JobLock, JobLockedException, running_detections, running_progress, watch_job
+from pep_tk.core.metrics import JobMetrics, MetricsExporter
+from pep_tk.core.prefetch import DEFAULT_WINDOW as DEFAULT_PREFETCH_WINDOW, Prefetcher
+from pep_tk.core.profiling import job_profiler
+from pep_tk.core.result_cache import DEFAULT_MAX_BYTES, ResultCache, result_cache_dir
+from pep_tk.core.retry import RetryPolicy
 from pep_tk.core.scheduler import Scheduler
+from pep_tk.core.slots import slot_pools_from_config
+from pep_tk.core.staging import DEFAULT_MAX_BYTES as DEFAULT_STAGING_MAX_BYTES, ImageStager
 from pep_tk.psg.events import GUIManager
 from pep_tk.psg.fonts import Fonts
 from pep_tk.psg.layouts import TaskTab, TaskRunnerTabGroup
 from pep_tk.psg.settings import get_user_settings, SystemSettingsNames, get_viame_bash_or_bat_file_path
 from pep_tk.psg.utils import set_pep_theme
+from pep_tk.psg.windows.popups import popup_error
 
 set_pep_theme(sg)
 
@@ -51,21 +62,153 @@ def make_main_window(tasks: List[TaskKey], gui_settings: sg.UserSettings):
     return window, tabs, tabs_group
 
 
+def make_metrics_exporter(manager: GUIManager, job_meta: JobMeta, gui_settings: sg.UserSettings):
+    port = gui_settings.get(SystemSettingsNames.metrics_port, None)
+    textfile_fp = gui_settings.get(SystemSettingsNames.metrics_textfile, None)
+    if port is None and not textfile_fp:
+        return None
+    if textfile_fp and os.path.isdir(textfile_fp):
+        # e.g. the node_exporter textfile collector directory
+        textfile_fp = os.path.join(textfile_fp, f'pep_tk_{job_meta.job_name}.prom')
+    return MetricsExporter(JobMetrics(manager, job_meta.job_name), textfile_fp=textfile_fp,
+                           port=int(port) if port is not None else None)
+
+
+def make_result_cache(job_meta: JobMeta, gui_settings: sg.UserSettings):
+    max_bytes = int(gui_settings.get(SystemSettingsNames.result_cache_max_bytes, DEFAULT_MAX_BYTES))
+    if max_bytes <= 0:
+        return None  # disabled
+    cache_dir = gui_settings.get(SystemSettingsNames.result_cache_dir, None) or result_cache_dir(job_meta.base_dir)
+    return ResultCache(cache_dir, max_bytes=max_bytes)
+
+
+def make_image_stager(job_meta: JobMeta, gui_settings: sg.UserSettings):
+    staging_dir = gui_settings.get(SystemSettingsNames.staging_dir, None)
+    if not staging_dir:
+        return None  # disabled
+    return ImageStager(os.path.join(staging_dir, job_meta.job_name),
+                       max_bytes=int(gui_settings.get(SystemSettingsNames.staging_max_bytes, DEFAULT_STAGING_MAX_BYTES)),
+                       max_workers=int(gui_settings.get(SystemSettingsNames.staging_workers, 4)))
+
+
+def make_prefetcher(gui_settings: sg.UserSettings):
+    window = int(gui_settings.get(SystemSettingsNames.prefetch_window, DEFAULT_PREFETCH_WINDOW))
+    if window <= 0:
+        return None  # disabled
+    return Prefetcher(window=window)
+
+
+def scheduler_policies(user_settings: sg.UserSettings) -> Tuple[RetryPolicy, AbortPolicy]:
+    """
+    :return: the retry policy and abort policy configured in the settings
+    :raises AbortRuleException, AttributeError, TypeError, ValueError: if either setting is malformed
+    """
+    return (RetryPolicy.from_dict(user_settings.get(SystemSettingsNames.retry_policy, {})),
+            AbortPolicy.from_dict(user_settings.get(SystemSettingsNames.abort_rules, {})))
+
+
+def start_scheduler(job_state: JobState, job_meta: JobMeta, manager: GUIManager, kill_event: threading.Event,
+                    lock: JobLock, user_settings: sg.UserSettings, retry_policy: RetryPolicy,
+                    abort_policy: AbortPolicy):
+    """ Run the job's scheduler in a thread, the job lock is released when the scheduler exits or fails to start """
+    profiler = job_profiler(job_meta.logs_dir)  # None unless PEP_TK_PROFILE is set or pep_gui --profile
+    try:
+        sched = Scheduler(job_state=job_state,
+                          job_meta=job_meta,
+                          manager=manager,
+                          kwiver_setup_path=get_viame_bash_or_bat_file_path(
+                              user_settings.get(SystemSettingsNames.viame_directory)), kill_event=kill_event,
+                          max_concurrent_tasks=int(user_settings.get(SystemSettingsNames.max_concurrent_tasks, 1)),
+                          slot_pools=slot_pools_from_config(user_settings.get(SystemSettingsNames.resource_slots, {})),
+                          profiler=profiler,
+                          metrics=make_metrics_exporter(manager, job_meta, user_settings),
+                          stall_timeout=user_settings.get(SystemSettingsNames.stall_timeout, None),
+                          stall_retries=int(user_settings.get(SystemSettingsNames.stall_retries, 1)),
+                          retry_policy=retry_policy,
+                          checkpoint_resume=bool(user_settings.get(SystemSettingsNames.checkpoint_resume, False)),
+                          result_cache=make_result_cache(job_meta, user_settings),
+                          detection_index=bool(user_settings.get(SystemSettingsNames.detection_index, True)),
+                          abort_policy=abort_policy,
+                          stager=make_image_stager(job_meta, user_settings),
+                          prefetcher=make_prefetcher(user_settings),
+                          preflight=bool(user_settings.get(SystemSettingsNames.preflight, True)))
+    except BaseException:
+        lock.release()
+        if profiler is not None:
+            profiler.stop()
+        raise
+
+    def run_scheduler():
+        try:
+            sched.run()
+        finally:
+            lock.release()
+
+    if profiler is not None:
+        sched_thread = threading.Thread(target=profiler.run, args=('scheduler', run_scheduler), daemon=True)
+    else:
+        sched_thread = threading.Thread(target=run_scheduler, daemon=True)
+    sched_thread.start()
+    return profiler, sched_thread
+
+
 def run_job(job_path: str):
     user_settings = get_user_settings()
-    job_state, job_meta = load_job(job_path)
+    try:
+        # malformed settings are reported before the job is locked
+        retry_policy, abort_policy = scheduler_policies(user_settings)
+    except (AbortRuleException, AttributeError, TypeError, ValueError) as e:
+        popup_error(f'Invalid retry_policy or abort_rules in the settings file, the job was not started.\n\n{e}')
+        return
+    kill_event = threading.Event()
+    # the heartbeat starts before the job is loaded and its window is made
+    job_state, manager = None, None
+
+    def lock_lost():
+        # another process took over the job, stop without saving over its changes
+        if job_state is not None:
+            job_state.stop_saving()
+        kill_event.set()
+
+    # only one process may run a job, another gui or the daemon may already be running it
+    lock = JobLock(job_path, owner='gui', progress=lambda: running_progress(manager) if manager is not None else {},
+                   on_lost=lock_lost, detections=lambda: running_detections(manager) if manager is not None else {})
+    read_only = False
+    try:
+        lock.acquire()
+    except JobLockedException as e:
+        if e.holder is None:
+            sg.popup_ok(str(e), title='Job already running', keep_on_top=True)
+            return
+        res = sg.popup_yes_no(f'{e}\n\nOpen the job read only to follow its progress?',
+                              title='Job already running', keep_on_top=True)
+        if res != 'Yes':
+            return
+        read_only = True
+    try:
+        job_state, job_meta = load_job(job_path, read_only=read_only)
+    except Exception:
+        lock.release()
+        raise
+    if lock.lost:  # lost while loading
+        job_state.stop_saving()
 
     window, tabs, tabs_group = make_main_window(job_state.tasks(), user_settings)
     tabs_by_update_key = {t.task_progress_update_key: t for t in tabs}
     manager = GUIManager(window=window, tabs=tabs)
-    kill_event = threading.Event()
-    sched = Scheduler(job_state=job_state,
-                      job_meta=job_meta,
-                      manager=manager,
-                      kwiver_setup_path=get_viame_bash_or_bat_file_path(
-                          user_settings.get(SystemSettingsNames.viame_directory)), kill_event=kill_event)
-
-    threading.Thread(target=sched.run, daemon=True).start()
+    if read_only:
+        window.set_title('PEP-TK: Job Runner (read only)')
+        profiler = None
+        sched_thread = threading.Thread(target=watch_job, args=(job_state, job_meta, manager, kill_event), daemon=True)
+        sched_thread.start()
+    else:
+        try:
+            profiler, sched_thread = start_scheduler(job_state, job_meta, manager, kill_event, lock, user_settings,
+                                                     retry_policy, abort_policy)
+        except Exception as e:
+            window.close()
+            popup_error(f'Unable to start the job.\n\n{e}')
+            return
 
     def update_total_progress(window: sg.Window, start_time: int):
         total_progress = 0
@@ -96,29 +239,42 @@ def run_job(job_path: str):
         window['--total-progress-ta--'].update(value=f'{total_progress}/{total} items({percent:.2f}%) complete.  {time_per_epoch:.2f} seconds/iter.  '
                                                      f'Elapsed time {elapsed_str}. Estimated time remaining {remaining_str}.')
 
-    start_time = time.time()
-    while True:
-        event, values = window.read()
-        if event == sg.WIN_CLOSED:
-            window.close()
-            break
-        elif event == sg.WIN_X_EVENT:
-            # If user tries to close the window by clicking X, show a popup asking to confirm the action.
-            try:
-                location = window.current_location()
-            except:
-                location = (None, None)
-            res = sg.popup_ok_cancel("Closing this window will stop any active tasks, "
-                                     "are you sure you want to close?",
-                                     title='Are you sure?', location=location)
-            if res == 'OK':
-                kill_event.set()
+    def event_loop(start_time: float):
+        while True:
+            event, values = window.read()
+            if event == sg.WIN_CLOSED:
                 window.close()
                 break
-        else:
-            if event in tabs_by_update_key:
-                tabs_by_update_key[event].handle(window, event, values)
-                update_total_progress(window, start_time)
+            elif event == sg.WIN_X_EVENT and read_only:
+                kill_event.set()  # stop watching, the job keeps running
+                window.close()
+                break
+            elif event == sg.WIN_X_EVENT:
+                # If user tries to close the window by clicking X, show a popup asking to confirm the action.
+                try:
+                    location = window.current_location()
+                except:
+                    location = (None, None)
+                res = sg.popup_ok_cancel("Closing this window will stop any active tasks, "
+                                         "are you sure you want to close?",
+                                         title='Are you sure?', location=location)
+                if res == 'OK':
+                    kill_event.set()
+                    window.close()
+                    break
+            else:
+                if event in tabs_by_update_key:
+                    tabs_by_update_key[event].handle(window, event, values)
+                    update_total_progress(window, start_time)
 
-            tabs_group.handle(window, event, values)
+                tabs_group.handle(window, event, values)
 
+    if profiler is not None:
+        try:
+            profiler.run('gui', event_loop, time.time())
+        finally:
+            # give the scheduler a chance to finish cleaning up so its profile is included
+            sched_thread.join(timeout=30)
+            profiler.stop()
+    else:
+        event_loop(time.time())
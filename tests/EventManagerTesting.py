@@ -71,7 +71,8 @@ class EventManagerTesting(SchedulerEventManager):
                                             progress_count=self.task_count[task_key],
                                             max_count=self.task_max_count[task_key],
                                             elapsed_time=self.elapsed_time(task_key),
-                                            output_log=self.pop_stdout(task_key, min_lines_to_pop=5))
+                                            output_log=self.pop_stdout(task_key, min_lines_to_pop=5),
+                                            resource_usage=self.task_resources.get(task_key))
         self.task_events[task_key].append(('_update_task_progress', evt_data))
 
     def _update_task_stdout(self, task_key: TaskKey, line: str):
@@ -0,0 +1,235 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Micro-benchmarks of the dataset manifest parsers, ImageList, compile_pipeline, JobMeta.create_meta and JobState on
+synthetic manifests, image lists and pipelines.
+
+    python tests/benchmarks/bench_core.py [--scale quick|full] [--output results.json]
+                                          [--compare baseline.json [--threshold 1.5]]
+
+Results are stored as json ({'meta': ..., 'results': {benchmark: {scale: seconds}}}) so they can be compared between
+commits, with --compare the script exits with 1 if any timing is more than --threshold times slower than the baseline.
+Larger scales of a benchmark are skipped once a scale takes longer than --budget seconds.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import time_call, benchmark_metadata, save_results, load_results, compare_results
+from util import add_src_to_pythonpath, CONF_FILEPATH
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import JobMeta, JobState, TaskStatus
+from pep_tk.core.kwiver.pipeline_compiler import compile_pipeline
+from pep_tk.core.parser import CSVDatasetsParser, INIDatasetsParser, VIAMEDataset
+from pep_tk.core.parser.parser import ImageList
+
+PIPELINE = 'ir_hotspot_detector'
+
+SCALES = {
+    'quick': {'datasets': [10, 100], 'images': [1000, 10000], 'pipe_blocks': [10, 100]},
+    'full': {'datasets': [10, 100, 1000, 10000, 100000], 'images': [1000, 10000, 100000, 1000000],
+             'pipe_blocks': [10, 100, 1000, 10000]},
+}
+
+# at most this many images files are created, image lists cycle through them
+IMAGE_POOL_SIZE = 1000
+
+
+class SyntheticData:
+    """ Creates synthetic image files, image lists, manifests and pipelines in a temporary directory """
+    def __init__(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = self._tmp.name
+        self.image_dir = os.path.join(self.root, 'images')
+        os.makedirs(self.image_dir)
+        self.image_pool = []
+        for i in range(IMAGE_POOL_SIZE):
+            fp = os.path.join(self.image_dir, f'fl01_C_{i:08d}_ir.tif')
+            open(fp, 'w').close()
+            self.image_pool.append(fp)
+
+    def image_list(self, n_images, name='images', directory=None) -> str:
+        directory = directory or self.root
+        fp = os.path.join(directory, f'{name}_ir_images.txt')
+        with open(fp, 'w') as f:
+            for i in range(n_images):
+                f.write(self.image_pool[i % IMAGE_POOL_SIZE] + '\n')
+        return fp
+
+    def datasets(self, n_datasets, images_per_dataset=10):
+        directory = os.path.join(self.root, f'datasets-{n_datasets}')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            for i in range(n_datasets):
+                self.image_list(images_per_dataset, name=f'ds{i:06d}', directory=directory)
+        return [VIAMEDataset(name=f'ds{i:06d}', thermal_image_list=os.path.join(directory, f'ds{i:06d}_ir_images.txt'),
+                             color_image_list=None, transformation_file=None) for i in range(n_datasets)]
+
+    def csv_manifest(self, datasets) -> str:
+        fp = os.path.join(self.root, f'manifest-{len(datasets)}.csv')
+        with open(fp, 'w') as f:
+            f.write('dataset_name,thermal_image_list,color_image_list,transformation_file\n')
+            for ds in datasets:
+                f.write(f'{ds.name},{ds.thermal_image_list},{ds.thermal_image_list},{self.image_pool[0]}\n')
+        return fp
+
+    def ini_manifest(self, datasets) -> str:
+        fp = os.path.join(self.root, f'manifest-{len(datasets)}.ini')
+        with open(fp, 'w') as f:
+            for ds in datasets:
+                f.write(f'[{ds.name}]\nthermal_image_list={ds.thermal_image_list}\n\n')
+        return fp
+
+    def pipeline(self, n_blocks) -> str:
+        """ a pipeline with n_blocks processes that each have an $ENV parameter and a relativepath """
+        fp = os.path.join(self.root, f'synthetic-{n_blocks}.pipe')
+        with open(fp, 'w') as f:
+            f.write('config _pipeline:_edge\n  :capacity 5\n\n')
+            for i in range(n_blocks):
+                f.write(f'process detector{i}\n  :: image_object_detector\n'
+                        f'  :detector:type darknet\n'
+                        f'  :detector:darknet:thresh $ENV{{PIPE_ARG_DET_THRESH_HS}}\n'
+                        f'  relativepath detector:darknet:net_config = ../models/model{i}.cfg\n'
+                        f'  :video_filename $ENV{{PIPE_ARG_THERMAL_INPUT}}\n\n')
+        return fp
+
+    def cleanup(self):
+        self._tmp.cleanup()
+
+
+class ScaledBenchmark:
+    def __init__(self, budget):
+        self.budget = budget
+        self.results = {}
+
+    def run(self, name, scales, fn):
+        """ fn(scale) -> seconds, larger scales are skipped once a scale exceeds the budget """
+        self.results[name] = {}
+        over_budget = False
+        for scale in scales:
+            if over_budget:
+                self.results[name][str(scale)] = 'skipped'
+                continue
+            seconds = fn(scale)
+            self.results[name][str(scale)] = seconds
+            print(f'{name:<28} {scale:>9} {seconds:10.4f}s', flush=True)
+            over_budget = seconds > self.budget
+
+
+def run_benchmarks(scale='quick', budget=30.):
+    scales = SCALES[scale]
+    data = SyntheticData()
+    pipeline = PipelineManifest(os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml'))[PIPELINE]
+    bench = ScaledBenchmark(budget)
+    try:
+        def csv_read(n):
+            fp = data.csv_manifest(data.datasets(n))
+            return time_call(lambda: CSVDatasetsParser().read(fp))
+
+        def ini_read(n):
+            fp = data.ini_manifest(data.datasets(n))
+            return time_call(lambda: INIDatasetsParser().read(fp))
+
+        def ini_read_images(n):
+            # the ini parser checks every image of every image list exists, 100 datasets sharing n images
+            directory = os.path.join(data.root, f'ini-images-{n}')
+            os.makedirs(directory, exist_ok=True)
+            datasets = [VIAMEDataset(name=f'ds{i:03d}', color_image_list=None, transformation_file=None,
+                                     thermal_image_list=data.image_list(max(n // 100, 1), f'ds{i:03d}', directory))
+                        for i in range(100)]
+            fp = data.ini_manifest(datasets)
+            return time_call(lambda: INIDatasetsParser().read(fp))
+
+        def image_list(n):
+            fp = data.image_list(n, name=f'list-{n}')
+            return time_call(lambda: len(ImageList(fp)))
+
+        def compile_pipe(n):
+            fp = data.pipeline(n)
+            pipeline.path, pipeline.directory = fp, os.path.dirname(fp)
+            env = {'PIPE_ARG_DET_THRESH_HS': 0.1, 'PIPE_ARG_THERMAL_INPUT': '/data/images.txt'}
+            return time_call(lambda: compile_pipeline(pipeline, env))
+
+        def create_meta(n):
+            datasets = data.datasets(n)
+            job_pipeline = PipelineManifest(os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml'))[PIPELINE]
+
+            def setup():
+                directory = tempfile.mkdtemp(dir=data.root)
+                os.makedirs(os.path.join(directory, 'pipelines'))
+                return JobMeta(directory)
+            return time_call(lambda meta: meta.create_meta(job_pipeline, datasets), setup=setup, repeat=2)
+
+        def job_state_mutations(n):
+            # every task goes RUNNING then SUCCESS with its outputs, like a job running to completion
+            keys = [f'ds{i:06d}' for i in range(n)]
+
+            def setup():
+                return JobState(tempfile.mkdtemp(dir=data.root), pipeline_keys=keys)
+
+            def mutate(state):
+                for k in keys:
+                    state.set_task_status(k, TaskStatus.RUNNING)
+                    state.set_task_outputs(k, [f'/outputs/{k}_ir_detections.csv', f'/outputs/{k}_ir_images.txt'])
+                    state.set_task_status(k, TaskStatus.SUCCESS)
+                    state.current_task()
+            return time_call(mutate, setup=setup, repeat=2)
+
+        bench.run('csv_parser_read', scales['datasets'], csv_read)
+        bench.run('ini_parser_read', scales['datasets'], ini_read)
+        bench.run('ini_parser_read_images', scales['images'], ini_read_images)
+        bench.run('image_list', scales['images'], image_list)
+        bench.run('compile_pipeline', scales['pipe_blocks'], compile_pipe)
+        bench.run('job_meta_create_meta', scales['datasets'], create_meta)
+        bench.run('job_state_mutations', scales['datasets'], job_state_mutations)
+    finally:
+        data.cleanup()
+    return {'meta': {**benchmark_metadata(), 'scale': scale}, 'results': bench.results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of pep_tk core entry points.')
+    parser.add_argument('--scale', choices=list(SCALES.keys()), default='quick')
+    parser.add_argument('--budget', type=float, default=30., help='skip larger scales after a scale takes longer '
+                                                                  'than this many seconds')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='baseline results json to check for regressions against')
+    parser.add_argument('--threshold', type=float, default=1.5, help='slowdown factor counted as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scale, args.budget)
+    if args.output:
+        save_results(args.output, results)
+
+    if args.compare:
+        regressions = compare_results(load_results(args.compare), results, threshold=args.threshold)
+        if regressions:
+            print('Regressions:')
+            for r in regressions:
+                print('  ' + r)
+            return 1
+        print('No regressions.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Scheduler benchmarks using the fake kwiver runner (tests/fake_kwiver.py), no VIAME install required.
+
+    python tests/benchmarks/bench_scheduler.py [--quick] [--output results.json]
+
+Measures
+  - launch latency: scheduler start to the first task starting, and task start to the kwiver process running
+  - progress latency: image written by kwiver to the progress update reaching the event manager
+  - cancel latency: cancel requested to the task ending
+  - cpu overhead: cpu time of the scheduler process (not kwiver) per task
+  - throughput: images/sec running 16 tasks with 1, 4 and 16 concurrent tasks
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import add_src_to_pythonpath, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.scheduler import Scheduler, SchedulerEventManager
+
+PIPELINE = 'ir_hotspot_detector'
+
+
+class BenchmarkEventManager(SchedulerEventManager):
+    """ Records when events reach the manager and the timing lines printed by the fake kwiver """
+    def __init__(self, cancel_after_image=None):
+        super().__init__()
+        self.cancel_after_image = cancel_after_image
+        self.progress_times = {}  # task -> [(time, count)]
+        self.kwiver_started = {}  # task -> time the fake kwiver process started
+        self.image_times = {}  # task -> {image number: time written}
+        self.first_stdout = {}
+        self.cancel_requested = {}
+        self._lock = threading.Lock()
+
+    def _initialize_task(self, task_key, count, max_count, status):
+        pass
+
+    def _start_task(self, task_key):
+        pass
+
+    def _end_task(self, task_key, status):
+        pass
+
+    def _update_task_progress(self, task_key, current_count, max_count):
+        with self._lock:
+            self.progress_times.setdefault(task_key, []).append((time.time(), current_count))
+
+    def _update_task_stdout(self, task_key, line):
+        now = time.time()
+        self.first_stdout.setdefault(task_key, now)
+        for entry in line.splitlines():
+            parts = entry.split()
+            if entry.startswith('fake-kwiver started'):
+                self.kwiver_started[task_key] = float(parts[2])
+            elif entry.startswith('fake-kwiver image'):
+                n = int(parts[2])
+                self.image_times.setdefault(task_key, {})[n] = float(parts[3])
+                if self.cancel_after_image is not None and n >= self.cancel_after_image:
+                    self.cancel_requested.setdefault(task_key, now)
+
+    def _update_task_stderr(self, task_key, line):
+        pass
+
+    def _check_cancelled(self, task_key):
+        return task_key in self.cancel_requested
+
+    def _update_task_output_files(self, task_key, output_files):
+        pass
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {'mean': statistics.mean(values),
+            'median': statistics.median(values),
+            'p95': values[min(len(values) - 1, int(round(.95 * (len(values) - 1))))],
+            'max': values[-1],
+            'n': len(values)}
+
+
+def cpu_time():
+    t = os.times()
+    return t.user + t.system
+
+
+class BenchmarkJob:
+    """ A job of synthetic datasets run by the scheduler with the fake kwiver on the PATH """
+    def __init__(self, image_counts, **fake_kwiver_options):
+        self._tmp = tempfile.TemporaryDirectory()
+        pipeline = PipelineManifest(os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml'))[PIPELINE]
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), image_counts)
+        job_dir = create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline, datasets)
+        self.job_state, self.job_meta = load_job(job_dir)
+        self.fake_kwiver_options = fake_kwiver_options
+
+    def run(self, manager, **scheduler_kwargs):
+        """ :return: (wall time, scheduler cpu time, time the scheduler was started) """
+        with fake_kwiver_on_path(os.path.join(self._tmp.name, 'bin'), **self.fake_kwiver_options):
+            sched = Scheduler(self.job_state, self.job_meta, manager, kwiver_setup_path=None, **scheduler_kwargs)
+            cpu_start = cpu_time()
+            start = time.time()
+            sched.run()
+            return time.time() - start, cpu_time() - cpu_start, start
+
+    def cleanup(self):
+        self._tmp.cleanup()
+
+
+def bench_launch_latency(n_tasks):
+    job = BenchmarkJob({f'task{i:02d}': 5 for i in range(n_tasks)})
+    manager = BenchmarkEventManager()
+    try:
+        _, _, sched_start = job.run(manager)
+    finally:
+        job.cleanup()
+    first_start = min(manager.task_start_time.values())
+    tasks = list(manager.task_start_time.keys())
+    return {'scheduler_start_to_first_task': first_start - sched_start,
+            'task_start_to_kwiver_running': summarize([manager.kwiver_started[k] - manager.task_start_time[k]
+                                                       for k in tasks if k in manager.kwiver_started]),
+            'task_start_to_first_output': summarize([manager.first_stdout[k] - manager.task_start_time[k]
+                                                     for k in tasks if k in manager.first_stdout])}
+
+
+def bench_progress_latency(n_images, image_delay, poll_freq):
+    job = BenchmarkJob({'task': n_images}, image_delay=image_delay)
+    manager = BenchmarkEventManager()
+    try:
+        job.run(manager, progress_poll_freq=poll_freq)
+    finally:
+        job.cleanup()
+    latencies = []
+    updates = manager.progress_times.get('task', [])
+    for n, written in manager.image_times.get('task', {}).items():
+        seen = next((t for t, count in updates if count >= n), None)
+        if seen is not None:
+            latencies.append(max(seen - written, 0.))
+    return {'poll_freq': poll_freq, 'latency': summarize(latencies)}
+
+
+def bench_cancel_latency(n_tasks):
+    # kwiver hangs after two images, the task is cancelled once the second image is reported
+    job = BenchmarkJob({f'task{i:02d}': 10 for i in range(n_tasks)}, hang_after=2)
+    manager = BenchmarkEventManager(cancel_after_image=2)
+    try:
+        job.run(manager)
+    finally:
+        job.cleanup()
+    latencies = [manager.task_end_time[k] - t for k, t in manager.cancel_requested.items()
+                 if manager.task_status.get(k) == TaskStatus.CANCELLED]
+    return {'latency': summarize(latencies), 'cancelled': len(latencies)}
+
+
+def bench_throughput(n_tasks, n_images, image_delay, concurrency):
+    job = BenchmarkJob({f'task{i:02d}': n_images for i in range(n_tasks)}, image_delay=image_delay)
+    manager = BenchmarkEventManager()
+    try:
+        wall, cpu, _ = job.run(manager, max_concurrent_tasks=concurrency)
+    finally:
+        job.cleanup()
+    succeeded = sum(1 for s in manager.task_status.values() if s == TaskStatus.SUCCESS)
+    ideal = n_images * image_delay * n_tasks / min(concurrency, n_tasks)
+    return {'concurrency': concurrency,
+            'tasks': n_tasks,
+            'succeeded': succeeded,
+            'wall_time': wall,
+            'images_per_sec': n_tasks * n_images / wall if wall > 0 else 0.,
+            'efficiency': ideal / wall if wall > 0 else 0.,
+            'scheduler_cpu_time': cpu,
+            'scheduler_cpu_per_task': cpu / n_tasks}
+
+
+def run_benchmarks(quick=False):
+    n_tasks = 4 if quick else 16
+    n_images = 10 if quick else 40
+    results = {'launch': bench_launch_latency(n_tasks=3 if quick else 8),
+               'progress': bench_progress_latency(n_images=n_images, image_delay=.05, poll_freq=1),
+               'cancel': bench_cancel_latency(n_tasks=2 if quick else 4),
+               'throughput': [bench_throughput(n_tasks, n_images, .02, c) for c in (1, 4, 16)]}
+    results['cpu_overhead_per_task'] = results['throughput'][0]['scheduler_cpu_per_task']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scheduler with a fake kwiver runner.')
+    parser.add_argument('--quick', action='store_true', help='fewer tasks and images')
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    if os.name == 'nt':
+        print('The fake kwiver runner requires bash, benchmarks are not supported on windows.')
+        return 1
+
+    results = run_benchmarks(quick=args.quick)
+    s = json.dumps(results, indent='\t', sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(s)
+    print(s)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Timing, result storage and regression checks shared by the benchmarks """
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, check=True)
+        return out.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_metadata() -> Dict:
+    return {'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def time_call(fn: Callable, setup: Optional[Callable] = None, repeat: int = 3, max_total: float = 2.) -> float:
+    """
+    Time fn, the best of up to `repeat` runs.  Slow calls are only repeated while the total time is under max_total.
+
+    :param fn: function to time, called with the result of setup if setup is given
+    :param setup: called before every run and not timed
+    :return: seconds
+    """
+    best = None
+    total = 0.
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn(arg) if setup is not None else fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        total += elapsed
+        if total > max_total:
+            break
+    return best
+
+
+def save_results(fp: str, results: Dict):
+    with open(fp, 'w') as f:
+        json.dump(results, f, indent='\t', sort_keys=True)
+
+
+def load_results(fp: str) -> Dict:
+    with open(fp, 'r') as f:
+        return json.load(f)
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = 1.5, min_delta: float = .005) -> List[str]:
+    """
+    Compare the timings of two result files ({'results': {benchmark: {scale: seconds}}}).
+
+    :param threshold: a timing regressed if it is more than threshold times the baseline
+    :param min_delta: and it is slower by more than min_delta seconds, to ignore noise in very fast benchmarks
+    :return: descriptions of the regressions
+    """
+    regressions = []
+    for name, scales in current.get('results', {}).items():
+        base_scales = baseline.get('results', {}).get(name, {})
+        for scale, seconds in scales.items():
+            base = base_scales.get(scale)
+            if not isinstance(base, (int, float)) or not isinstance(seconds, (int, float)):
+                continue  # skipped at one of the scales
+            if seconds > base * threshold and seconds - base > min_delta:
+                regressions.append(f'{name}[{scale}]: {seconds:.4f}s vs {base:.4f}s baseline '
+                                   f'({seconds / base if base else float("inf"):.2f}x)')
+    return regressions
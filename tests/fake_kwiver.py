@@ -0,0 +1,125 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+A stand-in for `kwiver runner <pipeline.pipe>` used to test the scheduler without a VIAME install.
+
+It reads the input image list compiled into the .pipe, and for every image appends the image to the image list
+output and a detection to the detection csv named by the output port environment variables.  The resource slots
+it was assigned (PEP_TK_SLOT_* variables and the cpu affinity) are printed to stdout.
+
+Options are read from the environment:
+    FAKE_KWIVER_IMAGE_DELAY - seconds to spend on each image (default 0)
+    FAKE_KWIVER_STARTUP_DELAY - seconds to spend "loading models" before the first image (default 0)
+    FAKE_KWIVER_LOG_LINES - log lines to print per image (default 1)
+    FAKE_KWIVER_FAIL_AFTER - exit with an error after this many images
+    FAKE_KWIVER_HANG_AFTER - stop producing output after this many images and never exit
+    FAKE_KWIVER_EXIT_CODE - exit code used by FAKE_KWIVER_FAIL_AFTER (default 1)
+    FAKE_KWIVER_FAIL_MESSAGE - error printed by FAKE_KWIVER_FAIL_AFTER, e.g. a CUDA error to test failure classification
+    FAKE_KWIVER_DETECTIONS - detections written per image (default 1)
+
+Timing lines are printed with time.time() so benchmarks can measure the scheduler's latencies:
+    fake-kwiver started <time>
+    fake-kwiver image <n> <time>       (after image n has been written to the outputs)
+"""
+import os
+import re
+import sys
+import time
+
+
+def parse_pipe(pipe_fp):
+    with open(pipe_fp, 'r') as f:
+        content = f.read()
+    inputs = re.findall(r':video_filename\s+(\S+)', content)
+    image_lists = re.findall(r':frame_list_output\s+\$ENV{(\w+)}', content)
+    det_csvs = re.findall(r':file_name\s+\$ENV{(\w+)}', content)
+    return inputs, image_lists, det_csvs
+
+
+def read_image_list(fp):
+    with open(fp, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def report_slots():
+    for k in sorted(os.environ):
+        if k.startswith('PEP_TK_SLOT_'):
+            print(f'slot {k}={os.environ[k]}', flush=True)
+    if hasattr(os, 'sched_getaffinity'):
+        print('cpu affinity ' + ','.join(str(c) for c in sorted(os.sched_getaffinity(0))), flush=True)
+
+
+def _optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] != 'runner':
+        print('usage: kwiver runner <pipeline.pipe>', file=sys.stderr)
+        return 2
+    print(f'fake-kwiver started {time.time():.6f}', flush=True)
+    delay = float(os.environ.get('FAKE_KWIVER_IMAGE_DELAY', 0))
+    startup_delay = float(os.environ.get('FAKE_KWIVER_STARTUP_DELAY', 0))
+    log_lines = int(os.environ.get('FAKE_KWIVER_LOG_LINES', 1))
+    fail_after = _optional_int(os.environ.get('FAKE_KWIVER_FAIL_AFTER'))
+    hang_after = _optional_int(os.environ.get('FAKE_KWIVER_HANG_AFTER'))
+    exit_code = int(os.environ.get('FAKE_KWIVER_EXIT_CODE', 1))
+    fail_message = os.environ.get('FAKE_KWIVER_FAIL_MESSAGE', 'ERROR: failed processing {image}')
+    detections = int(os.environ.get('FAKE_KWIVER_DETECTIONS', 1))
+
+    inputs, image_list_envs, det_csv_envs = parse_pipe(argv[2])
+    if not inputs:
+        print('No input image list in pipeline', file=sys.stderr)
+        return 1
+    images = read_image_list(inputs[0])
+    report_slots()
+
+    image_lists = [open(os.environ[k], 'w') for k in image_list_envs]
+    det_csvs = [open(os.environ[k], 'w') for k in det_csv_envs]
+    for f in det_csvs:
+        f.write('# 1: Detection or Track-id,2: Video or Image Identifier,3: Unique Frame Identifier,4-7: Img-bbox(TL_x,'
+                'TL_y,BR_x,BR_y),8: Detection or Length Confidence,9: Target Length (0 or -1 if invalid),10-11+: '
+                'Repeated Species,Confidence Pairs or Attributes\n')
+    if startup_delay:
+        time.sleep(startup_delay)
+    try:
+        for i, image in enumerate(images):
+            if fail_after is not None and i >= fail_after:
+                print(fail_message.format(image=image), flush=True)
+                return exit_code
+            if hang_after is not None and i >= hang_after:
+                while True:
+                    time.sleep(60)
+            if delay:
+                time.sleep(delay)
+            for f in det_csvs:
+                for _ in range(detections):
+                    f.write(f'{i},{image},{i},10,10,20,20,0.9,-1,Hotspot,0.9\n')  # no_path_in_name false
+                f.flush()
+            for f in image_lists:
+                f.write(image + '\n')
+                f.flush()
+            print(f'fake-kwiver image {i + 1} {time.time():.6f}', flush=True)
+            for j in range(log_lines - 1):
+                print(f'Processed image {i + 1}/{len(images)}: {image} (log line {j + 2})', flush=True)
+    finally:
+        for f in image_lists + det_csvs:
+            f.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
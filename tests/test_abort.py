@@ -0,0 +1,113 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.abort import AbortPolicy, AbortRuleException, TaskObservation
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.detection_stats import DetectionStats
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.scheduler import Scheduler
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestAbortPolicy(TestCaseBase):
+    def test_rules(self):
+        config = {'rules': [{'type': 'no_progress', 'seconds': 60},
+                            {'type': 'output_pattern', 'pattern': 'transform', 'scope': 'job'},
+                            {'type': 'no_detections', 'images': 10},
+                            {'type': 'slow_throughput', 'fraction': 0.5, 'min_seconds': 30}]}
+        policy = AbortPolicy.from_dict(config)
+        self.assertEqual(config['rules'][1], {k: v for k, v in policy.to_dict()['rules'][1].items()})
+
+        self.assertIsNone(policy.check(TaskObservation(elapsed=30, images=0)))
+        self.assertEqual('no_progress', policy.check(TaskObservation(elapsed=61, images=0)).rule)
+        self.assertIsNone(policy.check_output('loading model'))
+        decision = policy.check_output('Unable to read transform file')
+        self.assertEqual(('output_pattern', 'job'), (decision.rule, decision.scope))
+
+        self.assertIsNone(policy.check(TaskObservation(elapsed=61, images=5, detections=DetectionStats(images=5))))
+        self.assertEqual('no_detections', policy.check(TaskObservation(elapsed=61, images=10,
+                                                                       detections=DetectionStats(images=10))).rule)
+
+        slow = TaskObservation(elapsed=100, images=10, images_per_sec=1., seconds_since_first_image=40,
+                               expected_images_per_sec=3.)
+        self.assertEqual('slow_throughput', policy.check(slow).rule)
+        slow.expected_images_per_sec = None  # the pipeline has never been run
+        self.assertIsNone(policy.check(slow))
+
+    def test_invalid_rules(self):
+        for rule in [{'type': 'not_a_rule'}, {'type': 'no_progress'}, {'type': 'output_pattern', 'pattern': '('},
+                     {'type': 'no_detections', 'images': 10, 'scope': 'dataset'}]:
+            with self.assertRaises(AbortRuleException):
+                AbortPolicy.from_dict({'rules': [rule]})
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerAbort(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.bin_dir = os.path.join(self._tmp.name, 'bin')
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), {'a': 20, 'b': 20})
+        self.job_state, self.job_meta = load_job(create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline,
+                                                            datasets))
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def _run(self, rules, **options):
+        manager = FakeKwiverManager()
+        with fake_kwiver_on_path(self.bin_dir, image_delay=.05, **options):
+            Scheduler(self.job_state, self.job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.1,
+                      abort_policy=AbortPolicy.from_dict({'rules': rules})).run()
+        return manager
+
+    def test_no_detections_aborts_task(self):
+        manager = self._run([{'type': 'no_detections', 'images': 3}], detections=0)
+        for task_key in ['a', 'b']:
+            self.assertEqual(TaskStatus.CANCELLED, self.job_state.get_status(task_key))
+            self.assertLess(manager.task_count[task_key], 20)
+            aborted = [e for e in self.job_state.get_task_events(task_key) if e['event'] == 'aborted']
+            self.assertEqual(1, len(aborted))
+            self.assertEqual('no_detections', aborted[0]['rule'])
+            self.assertIn('no detections after', aborted[0]['reason'])
+        self.assertListEqual([], self.job_state.get_job_events())
+
+    def test_job_scope_cancels_job(self):
+        self._run([{'type': 'output_pattern', 'pattern': r'fake-kwiver image 2\b', 'scope': 'job'}])
+        self.assertEqual(TaskStatus.CANCELLED, self.job_state.get_status('a'))
+        self.assertEqual(TaskStatus.CANCELLED, self.job_state.get_status('b'))
+        # b never ran, it was cancelled with the reason of the job abort
+        self.assertListEqual([], self.job_state.get_task_attempts('b'))
+        reason = [e for e in self.job_state.get_task_events('b') if e['event'] == 'aborted'][0]['reason']
+        self.assertTrue(reason.startswith('job aborted: output matched'))
+        events = self.job_state.get_job_events()
+        self.assertEqual(1, len(events))
+        self.assertEqual(('output_pattern', 'job', 'a'), (events[0]['rule'], events[0]['scope'], events[0]['task']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets
+
+add_src_to_pythonpath()
+
+from pep_tk.core.admission import AdmissionController, read_available_memory, MB
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.history import PerformanceHistory, build_performance_record, parameter_hash
+from pep_tk.core.job import create_job, load_job
+from pep_tk.core.resources import proc_available
+
+GB = 1024 * MB
+
+
+class TestAdmissionController(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), {'a': 2, 'b': 3})
+        job_dir = create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline, datasets)
+        self.job_state, self.job_meta = load_job(job_dir)
+
+        self.history = PerformanceHistory(self.job_meta.base_dir)
+        params = parameter_hash(pipeline.get_parameter_values())
+        self.history.add_record(build_performance_record('ir_hotspot_detector', params, 10, 0., 10.,
+                                                         peak_memory=1 * GB))
+        self.available = 4 * GB
+        self.log_fp = os.path.join(self.job_meta.logs_dir, 'admission.log')
+        self.controller = AdmissionController(history=self.history, memory_reserve=512 * MB, log_fp=self.log_fp,
+                                              available_memory_fn=lambda: self.available)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def test_predict_task_memory(self):
+        self.assertEqual(1 * GB, self.controller.predict_task_memory('a', self.job_meta))
+        # the peak observed on a previous attempt of the task is preferred
+        self.job_meta.set_task_resources('a', {'peak_rss': 2 * GB})
+        self.assertEqual(2 * GB, self.controller.predict_task_memory('a', self.job_meta))
+
+        no_history = AdmissionController(default_task_memory=3 * GB)
+        self.assertEqual(3 * GB, no_history.predict_task_memory('b', self.job_meta))
+
+    def test_admit(self):
+        # always admit when nothing else is running
+        self.available = 0
+        self.assertTrue(self.controller.admit('a', self.job_meta, {}).admitted)
+
+        # 1.25 GB available, 512 MB reserve leaves 768 MB for a 1 GB task
+        self.available = int(1.25 * GB)
+        decision = self.controller.admit('b', self.job_meta, {'a': 0})
+        self.assertFalse(decision.admitted)
+        self.assertEqual(1 * GB, decision.required_memory)
+
+        # running tasks that haven't reached their peak yet still reserve memory
+        self.available = 2 * GB
+        self.assertFalse(self.controller.admit('b', self.job_meta, {'a': 1 * GB}).admitted)
+        self.assertTrue(self.controller.admit('b', self.job_meta, {'a': 0}).admitted)
+
+    def test_decisions_logged(self):
+        self.available = 1 * GB
+        for _ in range(3):
+            self.controller.admit('b', self.job_meta, {'a': 0})
+        self.available = 4 * GB
+        self.controller.admit('b', self.job_meta, {'a': 0})
+
+        with open(self.log_fp, 'r') as f:
+            lines = f.read().splitlines()
+        # repeated deferrals of the same task are only logged once
+        self.assertEqual(2, len(lines))
+        self.assertIn('DEFER b', lines[0])
+        self.assertIn('ADMIT b', lines[1])
+
+    @unittest.skipUnless(proc_available(), 'requires /proc/meminfo')
+    def test_read_available_memory(self):
+        self.assertGreater(read_available_memory(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.checkpoint import TaskCheckpoint, stitch_detections, write_remaining_image_lists
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.history import PerformanceHistory
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.kwiver.pipeline_compiler import compile_output_filenames
+from pep_tk.core.scheduler import Scheduler
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+def write_lines(fp, lines):
+    with open(fp, 'w') as f:
+        f.writelines(line + '\n' for line in lines)
+
+
+def read_rows(fp):
+    with open(fp, 'r') as f:
+        return [line.strip().split(',') for line in f if line.strip() and not line.startswith('#')]
+
+
+class TestCheckpoint(TestCaseBase):
+    def test_stitch_detections(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            partial, new = os.path.join(tmp, 'partial.csv'), os.path.join(tmp, 'new.csv')
+            # frame 2 has a detection but never made it into the image list
+            write_lines(partial, ['# header', '0,a.tif,0,1,1,2,2,0.9,-1,seal,0.9', '3,b.tif,1,1,1,2,2,0.9,-1,seal,0.9',
+                                  '4,c.tif,2,1,1,2,2,0.9,-1,seal,0.9'])
+            write_lines(new, ['# header', '0,c.tif,0,1,1,2,2,0.8,-1,seal,0.8', '1,d.tif,1,1,1,2,2,0.8,-1,seal,0.8'])
+            stitch_detections(partial, new, images=2)
+            rows = read_rows(new)
+            with open(new, 'r') as f:
+                self.assertEqual(1, sum(1 for line in f if line.startswith('#')))
+        self.assertListEqual(['0', '3', '4', '5'], [r[0] for r in rows])
+        self.assertListEqual(['0', '1', '2', '3'], [r[2] for r in rows])
+        self.assertListEqual(['a.tif', 'b.tif', 'c.tif', 'd.tif'], [r[1] for r in rows])
+
+    def test_remaining_image_lists(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dataset = create_synthetic_datasets(tmp, {'a': 5})[0]
+            with open(dataset.thermal_image_list, 'r') as f:
+                images = [line.strip() for line in f]
+            done_fp = os.path.join(tmp, 'done.txt')
+            write_lines(done_fp, images[:2])
+            checkpoint = TaskCheckpoint(2, image_lists={'OUT': done_fp})
+
+            remaining = write_remaining_image_lists(checkpoint, dataset, os.path.join(tmp, 'resume'))
+            with open(remaining[dataset.thermal_image_list], 'r') as f:
+                self.assertListEqual(images[2:], [line.strip() for line in f])
+
+            # processed images are matched by name, not by their position in the list
+            write_lines(done_fp, images[1:3])
+            remaining = write_remaining_image_lists(checkpoint, dataset, os.path.join(tmp, 'resume'))
+            with open(remaining[dataset.thermal_image_list], 'r') as f:
+                self.assertListEqual(images[:1] + images[3:], [line.strip() for line in f])
+
+            # a processed image was removed from the dataset, the checkpoint doesn't belong to it anymore
+            write_lines(done_fp, [images[0], os.path.join(tmp, 'removed.tif')])
+            self.assertIsNone(write_remaining_image_lists(checkpoint, dataset, os.path.join(tmp, 'resume')))
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerCheckpointResume(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bin_dir = os.path.join(tmp, 'bin')
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 5})
+            job_dir = create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets)
+
+            job_state, job_meta = load_job(job_dir)
+            with fake_kwiver_on_path(bin_dir, fail_after=3):
+                Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None,
+                          progress_poll_freq=.1).run()
+            self.assertEqual(3, job_state.get_task_checkpoint('a')['images'])
+
+            job_state, job_meta = load_job(job_dir)
+            manager = FakeKwiverManager()
+            with fake_kwiver_on_path(bin_dir):
+                Scheduler(job_state, job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.1,
+                          checkpoint_resume=True).run()
+
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+            self.assertIsNone(job_state.get_task_checkpoint('a'))
+            self.assertEqual(5, manager.task_count['a'])
+            # the resumed run only processed the last 2 images
+            self.assertIn('fake-kwiver image 2 ', manager.stdout['a'])
+            self.assertNotIn('fake-kwiver image 3 ', manager.stdout['a'])
+
+            outputs = job_state.get_task_outputs('a')
+            image_list = [fp for fp in outputs if fp.endswith('.txt')][0]
+            detections = [fp for fp in outputs if fp.endswith('.csv')][0]
+            with open(datasets[0].thermal_image_list, 'r') as f:
+                expected_images = [line.strip() for line in f]
+            with open(image_list, 'r') as f:
+                self.assertListEqual(expected_images, [line.strip() for line in f])
+            rows = read_rows(detections)
+            self.assertListEqual([str(i) for i in range(5)], [r[0] for r in rows])
+            self.assertListEqual([str(i) for i in range(5)], [r[2] for r in rows])
+            self.assertListEqual(expected_images, [r[1] for r in rows])
+
+    def test_resumed_throughput(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bin_dir = os.path.join(tmp, 'bin')
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 13})
+            job_dir = create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets)
+            job_state, job_meta = load_job(job_dir)
+            with fake_kwiver_on_path(bin_dir, fail_after=3):
+                Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None,
+                          progress_poll_freq=.05).run()
+
+            job_state, job_meta = load_job(job_dir)
+            history = PerformanceHistory(os.path.join(tmp, 'jobs'))
+            with fake_kwiver_on_path(bin_dir, image_delay=.2):
+                Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None, progress_poll_freq=.05,
+                          checkpoint_resume=True, history=history).run()
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+            record = history.records()[-1]
+            self.assertEqual(10, record.image_count)  # only the images of the resumed run
+            # 5 images per second, the 3 images of the checkpoint are not counted as processed by this run
+            self.assertGreater(record.images_per_sec, 4)
+            self.assertLess(record.images_per_sec, 6)
+
+    def test_recover_pending_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 5})
+            job_state, job_meta = load_job(create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets))
+            with open(datasets[0].thermal_image_list, 'r') as f:
+                images = [line.strip() for line in f]
+
+            # outputs of a run that never finished, e.g. the machine lost power after 2 images
+            _, _, outputs = job_meta.get('a')
+            t = datetime(2021, 6, 1, 12, 0, 0)
+            for fp in compile_output_filenames(outputs.get_image_list_env_ports(), job_meta.pending_outputs_dir,
+                                               t).values():
+                write_lines(fp, images[:2])
+            for fp in compile_output_filenames(outputs.get_det_csv_env_ports(), job_meta.pending_outputs_dir,
+                                               t).values():
+                write_lines(fp, [f'{i},{os.path.basename(p)},{i},1,1,2,2,0.9,-1,seal,0.9'
+                                 for i, p in enumerate(images[:2])])
+
+            manager = FakeKwiverManager()
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin')):
+                Scheduler(job_state, job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.1,
+                          checkpoint_resume=True).run()
+
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+            self.assertIn('fake-kwiver image 3 ', manager.stdout['a'])
+            self.assertNotIn('fake-kwiver image 4 ', manager.stdout['a'])
+            self.assertListEqual([], os.listdir(job_meta.pending_outputs_dir))
+            detections = [fp for fp in job_state.get_task_outputs('a') if fp.endswith('.csv')][0]
+            self.assertListEqual([str(i) for i in range(5)], [r[2] for r in read_rows(detections)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk import cli
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.daemon import DaemonException, JobDaemon, JobQueue, QueueStatus, daemon_request
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.job_lock import read_job_lock
+
+
+def wait_for(predicate, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        if predicate():
+            return True
+        time.sleep(.1)
+    return False
+
+
+class TestJobQueue(TestCaseBase):
+    def test_persistent_queue(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue_fp = os.path.join(tmp, 'daemon', 'queue.json')
+            queue = JobQueue(queue_fp)
+            queue.submit('/jobs/first')
+            queue.submit('/jobs/second')
+            with self.assertRaises(DaemonException):
+                queue.submit('/jobs/first')
+            self.assertEqual('/jobs/first', queue.next_queued())
+            queue.update('/jobs/first', QueueStatus.RUNNING, started=1.)
+
+            # the daemon stopped while the first job was running
+            queue = JobQueue(queue_fp)
+            self.assertEqual(QueueStatus.QUEUED, queue.status('/jobs/first'))
+            self.assertEqual(1., queue.get('/jobs/first')['started'])
+            self.assertEqual('/jobs/first', queue.next_queued())
+
+
+@unittest.skipIf(os.name == 'nt', 'the job daemon requires unix sockets and the fake kwiver runner requires bash')
+class TestJobDaemon(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+        self.socket_path = os.path.join(self.tmp, 'daemon.sock')
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self.tmp, 'data'), {'a': 3, 'b': 3})
+        self.jobs = [create_job(os.path.join(self.tmp, 'jobs', name), pipeline, datasets)
+                     for name in ('first', 'second', 'third')]
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def _start_daemon(self, **kwargs) -> threading.Thread:
+        daemon = JobDaemon(socket_path=self.socket_path, poll_freq=.1, progress_poll_freq=.1, **kwargs)
+        thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+        thread.start()
+        self.assertTrue(wait_for(lambda: os.path.exists(self.socket_path)))
+        return thread
+
+    def _status(self, job):
+        return daemon_request('status', job, socket_path=self.socket_path)['job']['status']
+
+    def test_global_task_limit(self):
+        with fake_kwiver_on_path(os.path.join(self.tmp, 'bin'), image_delay=.05):
+            thread = self._start_daemon(max_jobs=2, max_tasks=1, max_concurrent_tasks=2)
+            for job in self.jobs[:2]:
+                daemon_request('submit', job, socket_path=self.socket_path)
+            with self.assertRaises(DaemonException):
+                daemon_request('submit', self.jobs[0], socket_path=self.socket_path)
+            self.assertTrue(wait_for(lambda: all(self._status(job) == 'completed' for job in self.jobs[:2])))
+            self.assertEqual(0, cli.main(['status', '--socket', self.socket_path]))
+            self.assertEqual(0, cli.main(['shutdown', '--socket', self.socket_path]))
+            thread.join(30)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+        # both jobs ran at once, but only one kwiver task ran at a time
+        runs = []
+        for job in self.jobs[:2]:
+            job_state, _ = load_job(job)
+            self.assertListEqual(['a', 'b'], job_state.tasks(status=TaskStatus.SUCCESS))
+            runs += [(e['start'], e['end']) for task_key in job_state.tasks()
+                     for e in job_state.get_task_attempts(task_key)]
+        runs.sort()
+        self.assertEqual(4, len(runs))
+        for (_, end), (start, _) in zip(runs, runs[1:]):
+            self.assertLessEqual(end, start + .5)  # the slot is released just after the attempt is recorded
+
+    def test_pause_resume_cancel(self):
+        with fake_kwiver_on_path(os.path.join(self.tmp, 'bin'), image_delay=.5):
+            thread = self._start_daemon(max_jobs=1)
+            first, second = self.jobs[:2]
+            daemon_request('submit', first, socket_path=self.socket_path)
+            daemon_request('submit', second, socket_path=self.socket_path)
+            self.assertTrue(wait_for(lambda: self._status(first) == 'running'))
+            self.assertEqual('queued', self._status(second))
+
+            # cancelling the queued job never runs it, pausing the running job stops its kwiver process
+            daemon_request('cancel', second, socket_path=self.socket_path)
+            self.assertEqual('cancelled', self._status(second))
+            progress = daemon_request('status', first, socket_path=self.socket_path)['job']['progress']
+            self.assertEqual(6, progress['max_images'])
+            # the detections of the running task, the fake kwiver detects one hotspot per image
+            detections = lambda: daemon_request('status', first, socket_path=self.socket_path)['job']['progress'][
+                'detections']
+            self.assertTrue(wait_for(lambda: any(d['detections'] > 0 for d in detections().values())))
+            self.assertTrue(all(list(d['classes']) == ['Hotspot'] for d in detections().values()))
+            self.assertEqual(0, cli.main(['status', '--socket', self.socket_path]))
+            daemon_request('pause', first, socket_path=self.socket_path)
+            self.assertTrue(wait_for(lambda: self._status(first) == 'paused'))
+            with self.assertRaises(DaemonException):
+                daemon_request('pause', first, socket_path=self.socket_path)
+            job_state, _ = load_job(second)
+            self.assertListEqual([], job_state.tasks(status=TaskStatus.SUCCESS))
+
+        with fake_kwiver_on_path(os.path.join(self.tmp, 'bin')):
+            daemon_request('resume', first, socket_path=self.socket_path)
+            self.assertTrue(wait_for(lambda: self._status(first) == 'completed'))
+            daemon_request('shutdown', socket_path=self.socket_path)
+            thread.join(30)
+        job_state, _ = load_job(first)
+        self.assertListEqual(['a', 'b'], job_state.tasks(status=TaskStatus.SUCCESS))
+
+    def test_scheduler_error(self):
+        thread = self._start_daemon(max_jobs=1, not_a_scheduler_option=1)
+        for job in self.jobs[:2]:
+            daemon_request('submit', job, socket_path=self.socket_path)
+        # the daemon keeps dispatching, every job fails and its lock is released
+        self.assertTrue(wait_for(lambda: all(self._status(job) == 'failed' for job in self.jobs[:2])))
+        entry = daemon_request('status', self.jobs[0], socket_path=self.socket_path)['job']
+        self.assertTrue(entry['message'].startswith('unable to start the job'))
+        self.assertIsNone(read_job_lock(self.jobs[0]))
+        daemon_request('shutdown', socket_path=self.socket_path)
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
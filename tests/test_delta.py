@@ -0,0 +1,104 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, JobInitException, TaskStatus
+from pep_tk.core.scheduler import Scheduler
+from test_checkpoint import read_rows
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestDeltaJob(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+        self.bin_dir = os.path.join(self.tmp, 'bin')
+        self.data_dir = os.path.join(self.tmp, 'data')
+        self.pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+
+        datasets = create_synthetic_datasets(self.data_dir, {'a': 3, 'b': 4})
+        self.first_job = create_job(os.path.join(self.tmp, 'jobs', 'first'), self.pipeline, datasets)
+        self._run(self.first_job)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def _run(self, job_dir):
+        job_state, job_meta = load_job(job_dir)
+        manager = FakeKwiverManager()
+        with fake_kwiver_on_path(self.bin_dir):
+            Scheduler(job_state, job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.1).run()
+        return job_state, manager
+
+    def test_only_new_images_processed(self):
+        # dataset a grew from 3 to 5 images, b is unchanged
+        datasets = create_synthetic_datasets(self.data_dir, {'a': 5, 'b': 4})
+        job_dir = create_job(os.path.join(self.tmp, 'jobs', 'delta'), self.pipeline, datasets,
+                             delta_from=self.first_job)
+        job_state, manager = self._run(job_dir)
+
+        self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+        self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('b'))
+        # only the 2 new images were processed
+        self.assertIn('fake-kwiver image 2 ', manager.stdout['a'])
+        self.assertNotIn('fake-kwiver image 3 ', manager.stdout['a'])
+        self.assertNotIn('b', manager.stdout)  # nothing new, kwiver never ran
+
+        with open(datasets[0].thermal_image_list, 'r') as f:
+            expected_images = [line.strip() for line in f]
+        outputs = job_state.get_task_outputs('a')
+        with open([fp for fp in outputs if fp.endswith('.txt')][0], 'r') as f:
+            self.assertListEqual(expected_images, [line.strip() for line in f])
+        rows = read_rows([fp for fp in outputs if fp.endswith('.csv')][0])
+        self.assertListEqual([str(i) for i in range(5)], [r[2] for r in rows])
+        self.assertListEqual(expected_images, [r[1] for r in rows])
+        self.assertEqual(2, len(job_state.get_task_outputs('b')))
+
+    def test_previous_job_not_modified(self):
+        first_state, _ = load_job(self.first_job)
+        first_state.set_task_status('b', TaskStatus.RUNNING)  # e.g. being re-run by another process
+        with open(first_state.state_fp, 'rb') as f:
+            state = f.read()
+        datasets = create_synthetic_datasets(self.data_dir, {'a': 5, 'b': 4})
+        job_dir = create_job(os.path.join(self.tmp, 'jobs', 'delta'), self.pipeline, datasets,
+                             delta_from=self.first_job)
+        with open(first_state.state_fp, 'rb') as f:
+            self.assertEqual(state, f.read())
+        job_state, _ = load_job(job_dir)
+        self.assertEqual(TaskStatus.INITIALIZED, job_state.get_status('b'))  # b has no previous outputs to take
+
+    def test_different_parameters(self):
+        datasets = create_synthetic_datasets(self.data_dir, {'a': 5, 'b': 4})
+        self.assertTrue(self.pipeline.parameters_group.options[0].set_value(0.5))
+        with self.assertRaises(JobInitException):
+            create_job(os.path.join(self.tmp, 'jobs', 'delta'), self.pipeline, datasets, delta_from=self.first_job)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'jobs', 'delta')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk import cli
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.detection_index import build_task_index, image_detection_counts, load_index_manifest, \
+    query_detections, summarize_detections, update_job_index
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.scheduler import Scheduler
+from test_checkpoint import write_lines
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestDetectionIndex(TestCaseBase):
+    def test_build_task_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            det_fp, list_fp = os.path.join(tmp, 'det.csv'), os.path.join(tmp, 'images.txt')
+            write_lines(list_fp, ['/data/a.tif', '/data/b.tif', '/data/c.tif', '/data/d.tif'])
+            # out of frame order, b.tif and d.tif have no detections
+            write_lines(det_fp, ['# header', '2,c.tif,2,1,2,3,4,0.7,-1,Polar Bear,0.7,Ringed Seal,0.1',
+                                 '0,a.tif,0,1,1,2,2,0.5,-1,Ringed Seal,0.5', '1,c.tif,2,1,1,2,2,0.3,-1,Ringed Seal,0.3'])
+            index_fp = os.path.join(tmp, 'index', 'det.npz')
+            self.assertDictEqual({'detections': 3, 'images': 4}, build_task_index(det_fp, list_fp, index_fp))
+
+            with np.load(index_fp) as t:
+                self.assertListEqual(['a.tif', 'b.tif', 'c.tif', 'd.tif'], t['images'].tolist())
+                self.assertListEqual([0, 1, 1, 3, 3], t['image_offsets'].tolist())
+                self.assertListEqual([0, 2, 2], t['frame'].tolist())
+                self.assertListEqual(['Ringed Seal', 'Polar Bear', 'Ringed Seal'],
+                                     t['classes'][t['class_code']].tolist())
+                self.assertListEqual([1, 2, 3, 4], t['bbox'][1].tolist())
+                self.assertAlmostEqual(0.7, float(t['class_score'][1]), places=5)
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerDetectionIndex(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_query_jobs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 3, 'b': 2})
+            jobs_dir = os.path.join(tmp, 'jobs')
+            for name in ['first', 'second']:
+                job_state, job_meta = load_job(create_job(os.path.join(jobs_dir, name), pipeline, datasets))
+                with fake_kwiver_on_path(os.path.join(tmp, 'bin')):
+                    Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None,
+                              progress_poll_freq=.1, detection_index=(name == 'first')).run()
+                self.assertListEqual(['a', 'b'], job_state.tasks(status=TaskStatus.SUCCESS))
+
+            # the scheduler indexed the first job as its tasks finished, the second is indexed when first queried
+            first = os.path.join(jobs_dir, 'first')
+            self.assertSetEqual({'a', 'b'}, set(load_index_manifest(first)['tasks']))
+            self.assertListEqual([], update_job_index(first))
+            self.assertDictEqual({}, load_index_manifest(os.path.join(jobs_dir, 'second'))['tasks'])
+
+            # a job base directory queries every job in it
+            detections = query_detections([jobs_dir])
+            self.assertEqual(10, len(detections))
+            self.assertSetEqual({'first', 'second'}, set(detections['job']))
+            self.assertEqual(0, len(query_detections([jobs_dir], min_confidence=0.95)))
+            self.assertEqual(0, len(query_detections([jobs_dir], classes=['Polar Bear'])))
+
+            image = detections[detections['dataset'] == 'b']['image'].iloc[0]
+            on_image = query_detections([first], images=[image])
+            self.assertEqual(1, len(on_image))
+            self.assertEqual(image, on_image['image'].iloc[0])
+
+            summary = summarize_detections(query_detections([jobs_dir], datasets=['a']), by=['job', 'class'])
+            self.assertListEqual([3, 3], summary['detections'].tolist())
+            self.assertListEqual(['Hotspot', 'Hotspot'], summary['class'].tolist())
+
+            counts = image_detection_counts([first])
+            self.assertEqual(5, len(counts))
+            self.assertTrue((counts['detections'] == 1).all())
+
+            csv_fp = os.path.join(tmp, 'counts.csv')
+            self.assertEqual(0, cli.main(['query', jobs_dir, '--min-confidence', '0.5', '--group-by', 'dataset',
+                                          '--csv', csv_fp]))
+            self.assertListEqual([6, 4], pd.read_csv(csv_fp)['detections'].tolist())
+
+            # querying a job another process is running leaves its state unchanged
+            second_state, _ = load_job(os.path.join(jobs_dir, 'second'))
+            second_state.set_task_status('b', TaskStatus.RUNNING)
+            with open(second_state.state_fp, 'rb') as f:
+                state = f.read()
+            self.assertEqual(0, cli.main(['query', jobs_dir, '--csv', csv_fp]))
+            with open(second_state.state_fp, 'rb') as f:
+                self.assertEqual(state, f.read())
+            second_state.reload()
+            self.assertEqual(TaskStatus.RUNNING, second_state.get_status('b'))
+
+
+if __name__ == "__main__":
+    unittest.main()
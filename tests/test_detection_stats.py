@@ -0,0 +1,89 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.detection_stats import DetectionStats, DetectionTailReader
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.scheduler import Scheduler
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+def append(fp, text):
+    with open(fp, 'a') as f:
+        f.write(text)
+
+
+class TestDetectionTailReader(TestCaseBase):
+    def test_poll(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'det.csv')
+            reader = DetectionTailReader(fp)
+            self.assertEqual(0, reader.poll(images=0).detections)  # not written yet
+
+            append(fp, '# header\n0,a.tif,0,1,1,2,2,0.95,-1,Hotspot,0.95\n1,a.tif,0,1,1,2,2,0.15,-1,Hot')
+            stats = reader.poll(images=1)
+            # the partially written row is not read yet
+            self.assertEqual(1, stats.detections)
+            self.assertEqual(1., stats.detections_per_image)
+
+            append(fp, 'spot,0.15\n2,c.tif,2,1,1,2,2,0.5,-1,Seal,0.5,Hotspot,0.1\n')
+            stats = reader.poll(images=3)
+            self.assertEqual(3, stats.detections)
+            self.assertDictEqual({'Hotspot': 2, 'Seal': 1}, dict(stats.classes))
+            self.assertListEqual([0, 1, 0, 0, 0, 1, 0, 0, 0, 1], stats.confidence_histogram)
+            self.assertEqual(2, stats.max_detections_per_image)
+            self.assertEqual('3 detections (1.0/image) Hotspot: 2, Seal: 1', stats.summary())
+            # the summary fields are what a headless status shows
+            self.assertEqual(stats.summary(), DetectionStats.from_dict(stats.summary_dict()).summary())
+
+            # a re-started task replaces the file
+            with open(fp, 'w') as f:
+                f.write('0,a.tif,0,1,1,2,2,0.95,-1,Hotspot,0.95')
+            self.assertEqual(0, reader.poll().detections)
+            self.assertEqual(1, reader.poll(final=True).detections)
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerDetectionStats(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_running_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 4})
+            job_state, job_meta = load_job(create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets))
+            manager = FakeKwiverManager()
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin')):
+                Scheduler(job_state, job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.1).run()
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+
+            stats = manager.task_detections['a']
+            self.assertEqual(4, stats.detections)
+            self.assertEqual(4, stats.images)
+            self.assertDictEqual({'Hotspot': 4}, dict(stats.classes))
+            self.assertEqual(4, stats.confidence_histogram[9])  # the fake kwiver detections have a confidence of 0.9
+            self.assertIn('Detections: 4 detections (1.0/image) Hotspot: 4', manager.stdout['a'])
+
+
+if __name__ == "__main__":
+    unittest.main()
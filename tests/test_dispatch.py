@@ -0,0 +1,116 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.dispatch import get_dispatch_policy, PriorityPolicy, storage_location
+from pep_tk.core.history import PerformanceHistory, build_performance_record, parameter_hash
+from pep_tk.core.job import create_job, load_job, TaskStatus, JobInitException
+
+
+class TestDispatchPolicies(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+    image_counts = {'a-small': 2, 'b-large': 10, 'c-medium': 5}
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        self.datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), self.image_counts)
+        self.job_dir = os.path.join(self._tmp.name, 'jobs', 'job')
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def _run_order(self, job_state):
+        # the order tasks are handed out when each task completes in turn
+        order = []
+        while not job_state.is_job_complete():
+            task_key = job_state.current_task()
+            order.append(task_key)
+            job_state.set_task_status(task_key, TaskStatus.SUCCESS)
+        return order
+
+    def test_default_alphabetical(self):
+        create_job(self.job_dir, self.pipeline, self.datasets)
+        job_state, _ = load_job(self.job_dir)
+        self.assertDictEqual({'name': 'alphabetical'}, job_state.dispatch_policy())
+        self.assertListEqual(['a-small', 'b-large', 'c-medium'], self._run_order(job_state))
+
+    def test_longest_and_shortest_first(self):
+        create_job(self.job_dir, self.pipeline, self.datasets, dispatch_policy=get_dispatch_policy('longest_first'))
+        job_state, _ = load_job(self.job_dir)
+        self.assertListEqual(['b-large', 'c-medium', 'a-small'], job_state.dispatch_order())
+
+        job_state, _ = load_job(self.job_dir, dispatch_policy=get_dispatch_policy('shortest_first'))
+        self.assertListEqual(['a-small', 'c-medium', 'b-large'], self._run_order(job_state))
+
+    def test_order_persisted_on_resume(self):
+        policy = PriorityPolicy({'c-medium': 10, 'a-small': 5})
+        create_job(self.job_dir, self.pipeline, self.datasets, dispatch_policy=policy)
+
+        job_state, _ = load_job(self.job_dir)
+        self.assertEqual('c-medium', job_state.current_task())
+        job_state.set_task_status('c-medium', TaskStatus.SUCCESS)
+        del job_state
+
+        job_state, _ = load_job(self.job_dir)
+        self.assertEqual('priority', job_state.dispatch_policy()['name'])
+        self.assertListEqual(['a-small', 'b-large'], self._run_order(job_state))
+        # tasks keeps the original sorted listing
+        self.assertListEqual(['a-small', 'b-large', 'c-medium'], job_state.tasks())
+
+    def test_expected_duration(self):
+        history = PerformanceHistory(os.path.dirname(self.job_dir))
+        params = parameter_hash(self.pipeline.get_parameter_values())
+        history.add_record(build_performance_record('ir_hotspot_detector', params, 10, 0., 10., 0.))
+        create_job(self.job_dir, self.pipeline, self.datasets,
+                   dispatch_policy=get_dispatch_policy('expected_duration'))
+        job_state, _ = load_job(self.job_dir)
+        self.assertListEqual(['b-large', 'c-medium', 'a-small'], job_state.dispatch_order())
+
+    def test_storage_location(self):
+        other = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), {'0-other': 1},
+                                          image_dir=os.path.join(os.sep, 'nas2', 'flight'))
+        datasets = self.datasets + other
+        self.assertEqual(os.sep + os.path.join('nas2', 'flight'), storage_location(other[0].thermal_image_list))
+
+        create_job(self.job_dir, self.pipeline, datasets,
+                   dispatch_policy=get_dispatch_policy('storage_location', depth=1))
+        job_state, _ = load_job(self.job_dir)
+        order = job_state.dispatch_order()
+        # datasets on the same storage are adjacent
+        self.assertEqual(4, len(order))
+        self.assertIn(order.index('0-other'), [0, 3])
+
+    def test_invalid_order(self):
+        create_job(self.job_dir, self.pipeline, self.datasets)
+        job_state, _ = load_job(self.job_dir)
+        with self.assertRaises(JobInitException):
+            job_state.set_dispatch_order(['a-small'])
+        with self.assertRaises(ValueError):
+            get_dispatch_policy('foobar')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase
+
+add_src_to_pythonpath()
+
+from pep_tk.core.history import PerformanceHistory, build_performance_record, parameter_hash, history_json_fp
+
+
+class TestPerformanceHistory(TestCaseBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.base_dir = self._tmp.name
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def test_parameter_hash(self):
+        self.assertEqual(parameter_hash({'a': 0.1, 'b': 2}), parameter_hash({'b': 2, 'a': 0.1}))
+        self.assertNotEqual(parameter_hash({'a': 0.1}), parameter_hash({'a': 0.2}))
+
+    def test_build_record(self):
+        rec = build_performance_record('pipe', 'abc', image_count=100, start_time=10., end_time=70.,
+                                       first_progress_time=25., first_progress_count=10)
+        self.assertAlmostEqual(60., rec.duration)
+        self.assertAlmostEqual(2., rec.images_per_sec)
+        self.assertAlmostEqual(10., rec.startup_time)
+
+        # progress was only seen once the task completed
+        rec = build_performance_record('pipe', 'abc', image_count=100, start_time=10., end_time=60.,
+                                       first_progress_time=60., first_progress_count=100)
+        self.assertAlmostEqual(0., rec.startup_time)
+        self.assertAlmostEqual(2., rec.images_per_sec)
+
+    def test_predict_duration(self):
+        history = PerformanceHistory(self.base_dir)
+        self.assertIsNone(history.predict_duration('pipe', 100))
+
+        history.add_record(build_performance_record('pipe', 'abc', 100, 0., 60., 10.))  # 2 img/sec
+        history.add_record(build_performance_record('pipe', 'def', 100, 0., 30., 5.))  # 4 img/sec
+        self.assertIsFile(history_json_fp(self.base_dir))
+
+        # same parameters are preferred over other runs of the pipeline
+        self.assertAlmostEqual(10. + 50., history.predict_duration('pipe', 100, 'abc'))
+        self.assertAlmostEqual(5. + 25., history.predict_duration('pipe', 100, 'def'))
+        # unknown parameters fall back to every run of the pipeline
+        self.assertAlmostEqual(7.5 + 100 / 3., history.predict_duration('pipe', 100, 'xyz'))
+        self.assertIsNone(history.predict_duration('other_pipe', 100))
+        self.assertIsNone(history.predict_total_duration('pipe', []))
+        self.assertAlmostEqual(120., history.predict_total_duration('pipe', [100, 100], 'abc'))
+
+    def test_history_shared_between_instances(self):
+        a = PerformanceHistory(self.base_dir)
+        b = PerformanceHistory(self.base_dir)
+        a.add_record(build_performance_record('pipe', 'abc', 100, 0., 60., 10.))
+        b.add_record(build_performance_record('pipe', 'abc', 100, 0., 60., 10., peak_memory=1024))
+        self.assertEqual(2, len(PerformanceHistory(self.base_dir).records('pipe')))
+        self.assertEqual(1024, a.predict_peak_memory('pipe'))
+
+    def test_max_records(self):
+        history = PerformanceHistory(self.base_dir, max_records=3)
+        for i in range(5):
+            history.add_record(build_performance_record('pipe', 'abc', i + 1, 0., 10.))
+        counts = [r.image_count for r in history.records()]
+        self.assertListEqual([3, 4, 5], counts)
+
+
+if __name__ == "__main__":
+    unittest.main()
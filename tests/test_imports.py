@@ -43,6 +43,28 @@ class TestImports(TestCaseBase):
 
         import pep_tk.core.job
         import pep_tk.core.scheduler
+        import pep_tk.core.history
+        import pep_tk.core.dispatch
+        import pep_tk.core.resources
+        import pep_tk.core.admission
+        import pep_tk.core.slots
+        import pep_tk.core.tracing
+        import pep_tk.core.profiling
+        import pep_tk.core.metrics
+        import pep_tk.core.retry
+        import pep_tk.core.checkpoint
+        import pep_tk.core.delta
+        import pep_tk.core.pipeline_deps
+        import pep_tk.core.result_cache
+        import pep_tk.core.post_filter
+        import pep_tk.core.detection_index
+        import pep_tk.core.detection_stats
+        import pep_tk.core.abort
+        import pep_tk.core.staging
+        import pep_tk.core.prefetch
+        import pep_tk.core.daemon
+        import pep_tk.core.leases
+        import pep_tk.core.job_lock
 
     def test_import_psg(self):
         import pep_tk.psg
@@ -0,0 +1,221 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets
+
+add_src_to_pythonpath()
+
+from pep_tk import cli
+from pep_tk.core import job_lock
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.job_lock import JobLock, JobLockedException, break_job_lock, job_lock_fp, read_job_lock, watch_job
+from pep_tk.core.leases import LeaseManager
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestJobLock(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), {'a': 3, 'b': 3})
+        self.job_dir = create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline, datasets)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def _write_lock(self, **fields):
+        now = time.time()
+        holder = {'pid': os.getpid(), 'host': 'elsewhere', 'owner': 'gui', 'acquired': now, 'heartbeat': now,
+                  'progress': {}, **fields}
+        with open(job_lock_fp(self.job_dir), 'w') as f:
+            json.dump(holder, f)
+
+    def test_exclusive(self):
+        with JobLock(self.job_dir, owner='gui'):
+            holder = read_job_lock(self.job_dir)
+            self.assertEqual(os.getpid(), holder.pid)
+            self.assertEqual('gui', holder.owner)
+            self.assertFalse(holder.is_stale())
+            with self.assertRaises(JobLockedException) as cm:
+                JobLock(self.job_dir, owner='daemon').acquire()
+            self.assertEqual(holder.acquired, cm.exception.holder.acquired)
+            self.assertIn(f'pid {os.getpid()}', str(cm.exception))
+        self.assertIsNone(read_job_lock(self.job_dir))
+
+    def test_stale_heartbeat(self):
+        self._write_lock(heartbeat=time.time() - 120)
+        self.assertTrue(read_job_lock(self.job_dir).is_stale())
+        lock = JobLock(self.job_dir, owner='run').acquire()
+        try:
+            self.assertEqual('run', read_job_lock(self.job_dir).owner)
+        finally:
+            lock.release()
+
+    def test_stale_dead_process(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        self._write_lock(pid=process.pid, host=socket.gethostname())
+        self.assertTrue(read_job_lock(self.job_dir).is_stale())
+        self._write_lock()  # a live process on another host, only its heartbeat tells if it is stale
+        self.assertFalse(read_job_lock(self.job_dir).is_stale())
+        with self.assertRaises(JobLockedException):
+            JobLock(self.job_dir).acquire()
+
+        holder = read_job_lock(self.job_dir)
+        self._write_lock(acquired=holder.acquired + 1)  # taken by another process since it was read
+        self.assertFalse(break_job_lock(self.job_dir, holder))
+        self.assertTrue(break_job_lock(self.job_dir))
+        self.assertIsNone(read_job_lock(self.job_dir))
+
+    def test_heartbeat_progress(self):
+        progress = {'a': 1}
+        lock = JobLock(self.job_dir, progress=lambda: progress, heartbeat_interval=.1).acquire()
+        try:
+            progress = {'a': 2}
+            time.sleep(.5)
+            holder = read_job_lock(self.job_dir)
+            self.assertEqual({'a': 2}, holder.progress)
+            self.assertLess(holder.heartbeat_age(), .5)
+        finally:
+            lock.release()
+
+    def test_lock_lost(self):
+        job_state, _ = load_job(self.job_dir)
+        kill_event = threading.Event()
+
+        def lock_lost():
+            job_state.stop_saving()
+            kill_event.set()
+
+        lock = JobLock(self.job_dir, heartbeat_interval=.05, on_lost=lock_lost).acquire()
+        try:
+            # e.g. the heartbeat was delayed past the stale timeout and another process took the job
+            self.assertTrue(break_job_lock(self.job_dir))
+            other = JobLock(self.job_dir, owner='daemon').acquire()
+            self.assertTrue(kill_event.wait(5))
+            self.assertTrue(lock.lost)
+            time.sleep(.2)
+            self.assertEqual('daemon', read_job_lock(self.job_dir).owner)  # its heartbeat stopped
+            mtime = os.stat(job_state.state_fp).st_mtime_ns
+            job_state.set_task_status('a', TaskStatus.ERROR)
+            self.assertEqual(mtime, os.stat(job_state.state_fp).st_mtime_ns)
+        finally:
+            lock.release()
+        self.assertEqual('daemon', read_job_lock(self.job_dir).owner)  # releasing a lost lock keeps the new holder's
+        other.release()
+
+    def test_renew_while_taken(self):
+        lock = JobLock(self.job_dir, heartbeat_interval=60).acquire()
+        read = job_lock.read_job_lock
+        taking = []
+
+        def take_over():
+            self.assertTrue(break_job_lock(self.job_dir))
+            self._write_lock(owner='daemon')
+
+        def read_then_take(root_dir):
+            # another process takes the job just after the heartbeat read the lock
+            current = read(root_dir)
+            if not taking:
+                taking.append(threading.Thread(target=take_over, daemon=True))
+                taking[0].start()
+                taking[0].join(timeout=.5)
+            return current
+
+        try:
+            with mock.patch.object(job_lock, 'read_job_lock', read_then_take):
+                lock.renew()
+            taking[0].join(timeout=10)
+            self.assertEqual('daemon', read_job_lock(self.job_dir).owner)  # the heartbeat did not overwrite it
+            lock.renew()
+            self.assertTrue(lock.lost)
+        finally:
+            lock.release()
+        self.assertEqual('daemon', read_job_lock(self.job_dir).owner)
+
+    def test_nodes_running_the_job(self):
+        leases = LeaseManager(self.job_dir, node='node-1')
+        leases.acquire('a')
+        with self.assertRaises(JobLockedException) as cm:
+            JobLock(self.job_dir).acquire()
+        self.assertIsNone(cm.exception.holder)
+        self.assertIn('node-1', str(cm.exception))
+
+    def test_read_only_load(self):
+        job_state, _ = load_job(self.job_dir)
+        job_state.set_task_status('a', TaskStatus.ERROR)
+        mtime = os.stat(job_state.state_fp).st_mtime_ns
+        read_only, _ = load_job(self.job_dir, read_only=True)
+        self.assertEqual(TaskStatus.ERROR, read_only.get_status('a'))  # not reset for running it again
+        self.assertEqual(mtime, os.stat(job_state.state_fp).st_mtime_ns)
+
+    def test_cli_refuses_locked_job(self):
+        with JobLock(self.job_dir, owner='gui'):
+            self.assertEqual(1, cli.main(['run', self.job_dir]))
+            self.assertEqual(1, cli.main(['lock', self.job_dir, '--break']))
+            self.assertIsNotNone(read_job_lock(self.job_dir))
+        self._write_lock(heartbeat=time.time() - 120)
+        self.assertEqual(0, cli.main(['lock', self.job_dir, '--break']))
+        self.assertIsNone(read_job_lock(self.job_dir))
+
+    def test_watch_job(self):
+        job_state, job_meta = load_job(self.job_dir)
+        watched_state, _ = load_job(self.job_dir, read_only=True)
+        manager = FakeKwiverManager()
+        progress, detections = {}, {}
+        lock = JobLock(self.job_dir, progress=lambda: progress, heartbeat_interval=.05,
+                       detections=lambda: detections).acquire()
+        stop = threading.Event()
+        thread = threading.Thread(target=watch_job, args=(watched_state, job_meta, manager, stop, .05), daemon=True)
+        thread.start()
+        try:
+            job_state.set_task_status('a', TaskStatus.RUNNING)
+            progress = {'a': 2}
+            detections = {'a': {'detections': 3, 'images': 2, 'classes': {'Hotspot': 3}}}
+            self.assertTrue(wait_until(lambda: manager.task_count.get('a') == 2))
+            self.assertEqual(TaskStatus.RUNNING, manager.task_status['a'])
+            self.assertTrue(wait_until(lambda: 'a' in manager.task_detections))
+            self.assertEqual('3 detections (1.5/image) Hotspot: 3', manager.task_detections['a'].summary())
+            job_state.set_task_status('a', TaskStatus.SUCCESS)
+            self.assertTrue(wait_until(lambda: manager.task_status['a'] == TaskStatus.SUCCESS))
+        finally:
+            lock.release()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())  # the job stopped running
+        self.assertEqual(TaskStatus.INITIALIZED, manager.task_status['b'])
+
+
+def wait_until(predicate, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        if predicate():
+            return True
+        time.sleep(.05)
+    return False
@@ -0,0 +1,180 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, TEST_DIR, create_synthetic_datasets, \
+    fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk import cli
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.leases import LeaseManager, SharedStateLock
+from pep_tk.core.scheduler import Scheduler
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestLeaseManager(TestCaseBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.job_dir = self._tmp.name
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def test_acquire_release(self):
+        first = LeaseManager(self.job_dir, node='first')
+        second = LeaseManager(self.job_dir, node='second')
+        self.assertTrue(first.acquire('a'))
+        self.assertFalse(second.acquire('a'))
+        self.assertTrue(second.acquire('b'))
+        self.assertEqual(['a'], list(second.held_by_others()))
+        self.assertEqual('first', second.read('a')['node'])
+
+        first.release('a')
+        self.assertIsNone(second.read('a'))
+        self.assertTrue(second.acquire('a'))
+        # releasing a lease that is no longer held does not delete the new holder's lease
+        first.release('a')
+        self.assertEqual('second', first.read('a')['node'])
+
+    def test_expired_lease_reclaimed(self):
+        crashed = LeaseManager(self.job_dir, node='crashed', lease_timeout=.5)
+        other = LeaseManager(self.job_dir, node='other', lease_timeout=.5)
+        self.assertTrue(crashed.acquire('a'))
+        self.assertFalse(other.acquire('a'))
+        time.sleep(.7)  # no heartbeat
+        self.assertEqual({}, other.held_by_others())
+        self.assertTrue(other.acquire('a'))
+        self.assertEqual('other', other.read('a')['node'])
+
+        # the node that lost the lease finds out on its next heartbeat
+        self.assertFalse(crashed.lost('a'))
+        crashed.renew()
+        self.assertTrue(crashed.lost('a'))
+        self.assertEqual('other', other.read('a')['node'])
+
+    def test_heartbeat_keeps_lease(self):
+        holder = LeaseManager(self.job_dir, node='holder', lease_timeout=.5, heartbeat_interval=.1)
+        other = LeaseManager(self.job_dir, node='other', lease_timeout=.5)
+        holder.start()
+        try:
+            self.assertTrue(holder.acquire('a'))
+            time.sleep(1)
+            self.assertFalse(other.acquire('a'))
+            self.assertFalse(holder.lost('a'))
+        finally:
+            holder.stop()
+        self.assertIsNone(other.read('a'))  # released when stopped
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestDistributedScheduler(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.bin_dir = os.path.join(self._tmp.name, 'bin')
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'),
+                                             {'a': 4, 'b': 4, 'c': 4, 'd': 4})
+        self.job_dir = create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline, datasets)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def test_crashed_node_reclaimed(self):
+        # a node crashed while running a, its lease was not renewed since
+        crashed = LeaseManager(self.job_dir, node='crashed', lease_timeout=1)
+        crashed.acquire('a')
+        lease = {**crashed.read('a'), 'heartbeat': time.time() - 5}
+        with open(crashed._lease_fp('a'), 'w') as f:
+            json.dump(lease, f)
+        job_state, job_meta = load_job(self.job_dir)
+        job_state.set_task_status('a', TaskStatus.RUNNING)
+
+        leases = LeaseManager(self.job_dir, node='survivor', lease_timeout=1)
+        with fake_kwiver_on_path(self.bin_dir):
+            Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None, progress_poll_freq=.2,
+                      leases=leases).run()
+        for task_key in job_state.tasks():
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status(task_key))
+            self.assertEqual('survivor', job_state.get_task_attempts(task_key)[-1]['node'])
+        self.assertEqual({}, leases.leases())
+
+    def test_joining_node_keeps_state(self):
+        # another node failed a and crashed while running c
+        crashed = LeaseManager(self.job_dir, node='crashed')
+        crashed.acquire('c')
+        lease = {**crashed.read('c'), 'heartbeat': time.time() - 120}
+        with open(crashed._lease_fp('c'), 'w') as f:
+            json.dump(lease, f)
+        job_state, _ = load_job(self.job_dir)
+        job_state.set_task_status('a', TaskStatus.ERROR)
+        job_state.set_task_status('c', TaskStatus.RUNNING)
+
+        with fake_kwiver_on_path(self.bin_dir):
+            self.assertEqual(1, cli.main(['run', self.job_dir, '--distributed', '--lease-timeout', '10']))
+        job_state.reload()
+        self.assertEqual(TaskStatus.ERROR, job_state.get_status('a'))
+        self.assertListEqual([], job_state.get_task_attempts('a'))
+        for task_key in ['b', 'c', 'd']:
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status(task_key))
+
+    def test_shared_state_lock_reloads(self):
+        job_state, job_meta = load_job(self.job_dir)
+        other_state, _ = load_job(self.job_dir)
+        lock = SharedStateLock(self.job_dir, reload=(job_state, job_meta))
+        other_state.set_task_status('b', TaskStatus.SUCCESS)
+        with lock:
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('b'))
+            with lock:  # re-entrant
+                job_state.set_task_status('c', TaskStatus.ERROR)
+            self.assertTrue(os.path.isfile(lock.lock_fp))
+        self.assertFalse(os.path.isfile(lock.lock_fp))
+        other_state.reload()
+        self.assertEqual(TaskStatus.SUCCESS, other_state.get_status('b'))
+        self.assertEqual(TaskStatus.ERROR, other_state.get_status('c'))
+
+    def test_two_nodes(self):
+        command = [sys.executable, '-m', 'pep_tk.cli', 'run', self.job_dir, '--distributed', '--lease-timeout', '10']
+        with fake_kwiver_on_path(self.bin_dir, image_delay=.5):
+            env = {**os.environ, 'PYTHONPATH': os.path.join(os.path.dirname(TEST_DIR), 'src')}
+            nodes = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                     for _ in range(2)]
+            outputs = [node.communicate(timeout=300)[0].decode() for node in nodes]
+        for node, output in zip(nodes, outputs):
+            self.assertEqual(0, node.returncode, output)
+
+        job_state, _ = load_job(self.job_dir)
+        nodes_used = set()
+        for task_key in job_state.tasks():
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status(task_key))
+            attempts = job_state.get_task_attempts(task_key)
+            self.assertEqual(1, len(attempts), f'{task_key} ran more than once')
+            nodes_used.add(attempts[0]['node'])
+        self.assertEqual(2, len(nodes_used))
@@ -0,0 +1,122 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from util import add_src_to_pythonpath, TestCaseBase
+
+add_src_to_pythonpath()
+
+from pep_tk.core.detection_stats import DetectionStats
+from pep_tk.core.job import TaskStatus
+from pep_tk.core.metrics import JobMetrics, MetricsExporter, format_sample
+from pep_tk.core.resources import ResourceSample
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+def make_manager():
+    manager = FakeKwiverManager()
+    manager.initialize_task('done', 10, 10, TaskStatus.SUCCESS)  # completed before the job was resumed
+    manager.initialize_task('running', 0, 100, TaskStatus.INITIALIZED)
+    manager.initialize_task('queued', 0, 50, TaskStatus.INITIALIZED)
+    manager.start_task('running')
+    manager.update_task_progress('running', 30)
+    manager.task_start_time['running'] = 100.
+    manager.task_first_progress_time['running'] = 110.
+    manager.task_first_progress_count['running'] = 10
+    manager.task_last_progress_time['running'] = 115.
+    manager.task_resources['running'] = ResourceSample(115., 1., 2048, 0, 0, 1)
+    stats = DetectionStats(images=30)
+    for row in ['0,a.tif,0,1,1,2,2,0.95,-1,Hotspot,0.95', '1,a.tif,0,1,1,2,2,0.35,-1,Hotspot,0.35',
+                '2,b.tif,1,1,1,2,2,0.5,-1,Seal,0.5']:
+        stats.add_row(row.split(','))
+    manager.update_task_detections('running', stats)
+    return manager
+
+
+def parse(text):
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in text.splitlines() if line and not line.startswith('#')}
+
+
+class TestJobMetrics(TestCaseBase):
+    def test_render(self):
+        text = JobMetrics(make_manager(), 'job "1"', clock=lambda: 120.).render()
+        metrics = parse(text)
+        job = 'job="job \\"1\\""'
+
+        self.assertIn('# TYPE pep_tk_images_processed_total counter', text)
+        self.assertEqual(1, metrics[f'pep_tk_tasks{{{job},status="success"}}'])
+        self.assertEqual(1, metrics[f'pep_tk_tasks{{{job},status="running"}}'])
+        self.assertEqual(0, metrics[f'pep_tk_tasks{{{job},status="error"}}'])
+        self.assertEqual(1, metrics[f'pep_tk_queue_depth{{{job}}}'])
+        self.assertEqual(30, metrics[f'pep_tk_images_processed_total{{{job}}}'])
+        self.assertEqual(2., metrics[f'pep_tk_task_images_per_second{{{job},task="running"}}'])
+        self.assertEqual(5., metrics[f'pep_tk_task_seconds_since_progress{{{job},task="running"}}'])
+        self.assertEqual(2048, metrics[f'pep_tk_task_rss_bytes{{{job},task="running"}}'])
+        self.assertEqual(50, metrics[f'pep_tk_task_images_expected{{{job},task="queued"}}'])
+        self.assertEqual(3, metrics[f'pep_tk_task_detections{{{job},task="running"}}'])
+        self.assertEqual(0.1, metrics[f'pep_tk_task_detections_per_image{{{job},task="running"}}'])
+        self.assertEqual(2, metrics[f'pep_tk_task_max_detections_per_image{{{job},task="running"}}'])
+        self.assertEqual(2, metrics[f'pep_tk_task_class_detections{{{job},task="running",class="Hotspot"}}'])
+        self.assertEqual(1, metrics[f'pep_tk_task_detections_confidence_le{{{job},task="running",le="0.4"}}'])
+        self.assertEqual(3, metrics[f'pep_tk_task_detections_confidence_le{{{job},task="running",le="1"}}'])
+        self.assertNotIn(f'pep_tk_task_seconds_since_progress{{{job},task="queued"}}', metrics)
+
+    def test_images_processed_only_increases(self):
+        manager = make_manager()
+        metrics = JobMetrics(manager, 'job')
+        total = lambda: parse(metrics.render())['pep_tk_images_processed_total{job="job"}']
+        self.assertEqual(30, total())
+        manager.start_task('running')  # re-started, e.g. after a stall, its progress starts over
+        manager.update_task_progress('running', 5)
+        self.assertEqual(35, total())
+        # resumed from a checkpoint of 40 images, only the images processed after it are counted
+        manager.start_task('queued', skipped_images=40)
+        manager.update_task_progress('queued', 42)
+        self.assertEqual(37, total())
+        manager.update_task_progress('running', 3)  # never decreases
+        self.assertEqual(37, total())
+
+    def test_format_sample(self):
+        self.assertEqual('a 1', format_sample('a', {}, 1.))
+        self.assertEqual('a{x="y\\nz"} 0.5', format_sample('a', {'x': 'y\nz'}, .5))
+
+
+class TestMetricsExporter(TestCaseBase):
+    def test_http_and_textfile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'pep_tk.prom')
+            exporter = MetricsExporter(JobMetrics(make_manager(), 'job'), textfile_fp=fp, port=0, interval=60)
+            exporter.start()
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{exporter.port}/metrics', timeout=10) as r:
+                    self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+                    served = r.read().decode('utf-8')
+            finally:
+                exporter.stop()
+            with open(fp, 'r') as f:
+                written = f.read()
+            self.assertListEqual([fp], [os.path.join(tmp, f) for f in os.listdir(tmp)])  # no temp files left
+
+        self.assertIn('pep_tk_queue_depth{job="job"} 1', served)
+        self.assertIn('pep_tk_queue_depth{job="job"} 1', written)
+
+
+if __name__ == '__main__':
+    unittest.main()
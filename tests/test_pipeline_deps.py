@@ -0,0 +1,134 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk import cli
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.pipeline_deps import INCLUDE, RELATIVEPATH, FILE, build_dependency_graph, parse_pipe_references, \
+    preflight_pipeline
+from pep_tk.core.scheduler import Scheduler
+from test_checkpoint import write_lines
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestPipelineDependencies(TestCaseBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+        # pipes/main.pipe includes pipes/common.pipe, which includes main.pipe again and a pipe on the include path
+        self.pipe_dir = os.path.join(self.tmp, 'pipes')
+        self.models_dir = os.path.join(self.tmp, 'models')
+        self.include_dir = os.path.join(self.tmp, 'include')
+        for d in (self.pipe_dir, self.models_dir, self.include_dir):
+            os.makedirs(d)
+        self.cfg_fp = os.path.join(self.models_dir, 'detector.cfg')
+        self.weights_fp = os.path.join(self.models_dir, 'detector.weights')
+        self.list_fp = os.path.join(self.tmp, 'images.txt')
+        write_lines(self.cfg_fp, ['[net]'])
+        write_lines(self.weights_fp, ['weights'])
+        write_lines(self.list_fp, ['/data/a.tif'])
+        self.main_fp = os.path.join(self.pipe_dir, 'main.pipe')
+        write_lines(self.main_fp, ['include common.pipe', 'process input', f'  :video_filename {self.list_fp}',
+                                   '  :file_name $ENV{OUTPUT}', 'process detector',
+                                   '  block detector', '    relativepath net_config  = ../models/detector.cfg',
+                                   '    relativepath weight_file = ../models/detector.weights  # the weights',
+                                   '  endblock'])
+        write_lines(os.path.join(self.pipe_dir, 'common.pipe'), ['include main.pipe', 'include shared.pipe',
+                                                                 '# include commented.pipe'])
+        write_lines(os.path.join(self.include_dir, 'shared.pipe'), ['config _scheduler', '  type = pythread_per_process'])
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def test_parse_pipe_references(self):
+        content = 'include a.pipe\n  relativepath model = ../m.zip\n  :deployed = /models/x.zip\n' \
+                  '  :video_filename /data/list.txt\n  :threshold 0.5\n  # :video_filename /commented.txt\n'
+        self.assertListEqual([(INCLUDE, 'include', 'a.pipe'), (RELATIVEPATH, 'model', '../m.zip'),
+                              (FILE, 'deployed', '/models/x.zip'), (FILE, 'video_filename', '/data/list.txt')],
+                             list(parse_pipe_references(content)))
+
+    def test_dependency_graph(self):
+        graph = build_dependency_graph(self.main_fp, include_paths=[self.include_dir])
+        common_fp = os.path.join(self.pipe_dir, 'common.pipe')
+        shared_fp = os.path.join(self.include_dir, 'shared.pipe')
+        self.assertListEqual(sorted([self.main_fp, common_fp, shared_fp, self.cfg_fp, self.weights_fp, self.list_fp]),
+                             graph.files())
+        self.assertListEqual([self.cfg_fp, self.weights_fp], graph.files(kinds=[RELATIVEPATH]))
+        self.assertListEqual([common_fp, self.list_fp, self.cfg_fp, self.weights_fp], graph.edges()[self.main_fp])
+        self.assertListEqual([self.main_fp, shared_fp], graph.edges()[common_fp])
+        self.assertListEqual([], graph.missing())
+        self.assertTrue(all(d.digest for d in graph.dependencies))
+
+        fingerprint = graph.fingerprint()
+        self.assertEqual(fingerprint, build_dependency_graph(self.main_fp, include_paths=[self.include_dir])
+                         .fingerprint())
+        write_lines(self.weights_fp, ['retrained weights'])
+        self.assertNotEqual(fingerprint, build_dependency_graph(self.main_fp, include_paths=[self.include_dir])
+                            .fingerprint())
+
+    def test_preflight(self):
+        self.assertListEqual([], preflight_pipeline(self.main_fp, include_paths=[self.include_dir]))
+        os.remove(self.weights_fp)
+        problems = preflight_pipeline(self.main_fp)  # shared.pipe is not found without the include path
+        self.assertEqual(2, len(problems))
+        self.assertEqual(f'relativepath weight_file of main.pipe: {self.weights_fp} does not exist', problems[0])
+        self.assertIn(os.path.join(self.pipe_dir, 'shared.pipe'), problems[1])
+
+        # the pipe is parsed again once it is modified
+        write_lines(self.main_fp, ['process detector', '  relativepath weight_file = ../models/detector.cfg'])
+        os.utime(self.main_fp, ns=(0, 0))
+        self.assertListEqual([], preflight_pipeline(self.main_fp))
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerPreflight(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_missing_model(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 2, 'b': 2})
+            job_dir = create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets)
+            job_state, job_meta = load_job(job_dir)
+            pipe_fp = os.path.join(tmp, 'detector.pipe')
+            write_lines(pipe_fp, ['process detector', '  relativepath weight_file = models/missing.weights'])
+            job_meta._pipe_store.data['path'] = pipe_fp
+            self.assertEqual(1, cli.main(['deps', job_dir]))
+
+            manager = FakeKwiverManager()
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin')):
+                Scheduler(job_state, job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.1,
+                          preflight=True).run()
+            # no task was run
+            self.assertListEqual(['a', 'b'], job_state.tasks(status=TaskStatus.ERROR))
+            self.assertIn('missing.weights does not exist', manager.stdout['a'])
+            self.assertNotIn('a', manager.task_start_time)
+            events = job_state.get_job_events()
+            self.assertEqual('preflight_failed', events[0]['event'])
+            self.assertEqual(1, len(events[0]['problems']))
+
+
+if __name__ == "__main__":
+    unittest.main()
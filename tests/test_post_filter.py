@@ -0,0 +1,118 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, raw_outputs_dir, TaskStatus
+from pep_tk.core.post_filter import PostFilter, PostFilterException, filter_detections, post_filters, \
+    rethreshold_job
+from pep_tk.core.scheduler import Scheduler
+from test_checkpoint import read_rows, write_lines
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestPostFilter(TestCaseBase):
+    def test_filter_detections(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            raw, out = os.path.join(tmp, 'raw.csv'), os.path.join(tmp, 'out.csv')
+            write_lines(raw, ['# header', '0,a.tif,0,1,1,2,2,0.05,-1,Ringed Seal,0.05',
+                              '1,a.tif,0,1,1,2,2,0.5,-1,Ringed Seal,0.5', '2,b.tif,1,1,1,2,2,0.3,-1,Polar Bear,0.3',
+                              '3,b.tif,1,1,1,2,2,0.7,-1,Polar Bear,0.7,Ringed Seal,0.1'])
+            filters = [PostFilter('seal', 0.1, 0.01, classes=['Ringed Seal']),
+                       PostFilter('pb', 0.5, 0.01, classes=['Polar Bear'])]
+            self.assertEqual(2, filter_detections(raw, out, filters))
+            self.assertListEqual(['1', '3'], [r[0] for r in read_rows(out)])
+            with open(out, 'r') as f:
+                self.assertTrue(f.readline().startswith('# header'))
+
+            # filter in place, a filter without classes applies to every detection
+            self.assertEqual(1, filter_detections(out, out, [PostFilter('all', 0.6, 0.01)]))
+            self.assertListEqual(['3'], [r[0] for r in read_rows(out)])
+
+    def test_post_filters(self):
+        pipeline = PipelineManifest(manifest_file=os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml'))[
+            'ir_hotspot_detector']
+        opt = pipeline.parameters_group['detection_threshold_hotspot']
+        self.assertEqual(0.01, opt.run_value())
+        filters = post_filters(pipeline.parameters_group.to_dict(), {'detection_threshold_hotspot': 0.3})
+        self.assertEqual(0.3, filters[0].threshold)
+        self.assertListEqual(['Hotspot'], filters[0].classes)
+        with self.assertRaises(PostFilterException):
+            post_filters(pipeline.parameters_group.to_dict(), {'not_a_parameter': 0.3})
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerPostFilter(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_rethreshold(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            pipeline.parameters_group['detection_threshold_hotspot'].set_value(0.5)
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 3})
+            job_dir = create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets, post_filter=True)
+            job_state, job_meta = load_job(job_dir)
+
+            # the pipeline runs at the permissive value
+            with open(os.path.join(job_dir, job_meta.get('a')[0]), 'r') as f:
+                self.assertIn('ir_yolo_tiny_1L64x80.cfg@0.01', f.read())
+
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin')):
+                Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None,
+                          progress_poll_freq=.1).run()
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+            detections = [fp for fp in job_state.get_task_outputs('a') if fp.endswith('.csv')][0]
+            raw_fp = os.path.join(raw_outputs_dir(job_dir), os.path.basename(detections))
+            # the fake kwiver detections have a confidence of 0.9
+            self.assertEqual(3, len(read_rows(detections)))
+            self.assertEqual(3, len(read_rows(raw_fp)))
+
+            written = rethreshold_job(job_dir, {'detection_threshold_hotspot': 0.95})
+            self.assertEqual(0, len(read_rows(written['a'][0])))
+            self.assertEqual('detection_threshold_hotspot-0.95', os.path.basename(os.path.dirname(written['a'][0])))
+            with self.assertRaises(PostFilterException):
+                rethreshold_job(job_dir, {'detection_threshold_hotspot': 0.001})
+
+    def test_off_by_default(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            pipeline.parameters_group['detection_threshold_hotspot'].set_value(0.5)
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 3})
+            job_dir = create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets)
+            job_state, job_meta = load_job(job_dir)
+
+            # the pipeline runs at the configured value and its outputs are not filtered
+            with open(os.path.join(job_dir, job_meta.get('a')[0]), 'r') as f:
+                self.assertIn('ir_yolo_tiny_1L64x80.cfg@0.5', f.read())
+            self.assertListEqual([], post_filters(job_meta.parameters_config()))
+
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin')):
+                Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None,
+                          progress_poll_freq=.1).run()
+            self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+            self.assertFalse(os.path.isdir(raw_outputs_dir(job_dir)))
+            with self.assertRaises(PostFilterException):
+                rethreshold_job(job_dir, {'detection_threshold_hotspot': 0.95})
+
+
+if __name__ == "__main__":
+    unittest.main()
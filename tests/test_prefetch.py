@@ -0,0 +1,113 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import threading
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.checkpoint import read_list_lines
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.prefetch import Prefetcher, pipeline_inputs, prefetch_file
+from pep_tk.core.scheduler import Scheduler
+from test_checkpoint import write_lines
+from test_scheduler_fake_kwiver import FakeKwiverManager
+from test_staging import create_images
+
+
+class RecordingPrefetcher(Prefetcher):
+    """ Records the files it prefetches """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefetched = []
+        self._record_lock = threading.Lock()
+
+    def _prefetch(self, task, fp):
+        with self._record_lock:
+            self.prefetched.append(fp)
+
+    def wait(self):
+        self._pool.shutdown(wait=True)
+
+
+class TestPrefetch(TestCaseBase):
+    def test_prefetch_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'image.tif')
+            with open(fp, 'wb') as f:
+                f.write(b'x' * 100)
+            self.assertTrue(prefetch_file(fp))
+            self.assertTrue(prefetch_file(fp, use_fadvise=False))
+            self.assertFalse(prefetch_file(os.path.join(tmp, 'missing.tif')))
+
+    def test_window_follows_position(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            list_fp = os.path.join(tmp, 'images.txt')
+            images = [os.path.join(tmp, f'{i}.tif') for i in range(10)]
+            write_lines(list_fp, images)
+            model_fp = os.path.join(tmp, 'model.weights')
+            write_lines(model_fp, ['weights'])
+            pipe_fp = os.path.join(tmp, 'a.pipe')
+            write_lines(pipe_fp, ['process input', f'  :video_filename {list_fp}', 'process detector',
+                                  f'    weight_file = {model_fp}'])
+            model_files, image_lists = pipeline_inputs(pipe_fp, [list_fp, os.path.join(tmp, 'color.txt')])
+            self.assertListEqual([model_fp], model_files)
+            self.assertListEqual([list_fp], image_lists)
+
+            prefetcher = RecordingPrefetcher(window=3, max_workers=1)
+            prefetcher.start('a', image_lists, model_files)
+            prefetcher.start('a', image_lists, model_files)  # already prefetching
+            prefetcher.update('a', 2)
+            prefetcher.update('a', 1)  # the window never moves back
+            prefetcher.update('a', 8)  # kwiver overtook the window, the images it read are skipped
+            prefetcher.stop('a')
+            prefetcher.update('a', 9)
+            prefetcher.wait()
+            self.assertListEqual([model_fp] + images[0:5] + images[8:10], prefetcher.prefetched)
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerPrefetch(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_tasks_prefetched(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 5, 'b': 5})
+            create_images(datasets)
+            job_state, job_meta = load_job(create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets))
+            prefetcher = RecordingPrefetcher(window=2)
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin'), image_delay=.1):
+                Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None, progress_poll_freq=.1,
+                          prefetcher=prefetcher).run()
+            prefetcher.wait()
+            self.assertListEqual(['a', 'b'], job_state.tasks(status=TaskStatus.SUCCESS))
+
+            # every image was prefetched once, along with the models of the pipeline
+            prefetched = prefetcher.prefetched
+            for dataset in datasets:
+                images = read_list_lines(dataset.thermal_image_list)
+                self.assertListEqual(sorted(images), sorted(fp for fp in prefetched if fp in images))
+            self.assertTrue(any(fp.endswith('ir_yolo_tiny_1L64x80.cfg') for fp in prefetched))
+            self.assertFalse(prefetcher._tasks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import pstats
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from unittest import mock
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.profiling import Profiler, job_profiler, profiling_enabled, PROFILE_ENV_VAR
+from pep_tk.core.scheduler import Scheduler
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+def busy_function(n):
+    return sum(i * i for i in range(n))
+
+
+class TestProfiler(TestCaseBase):
+    def test_profiling_enabled(self):
+        for value, expected in [('', False), ('0', False), ('false', False), ('1', True), ('yes', True)]:
+            with mock.patch.dict(os.environ, {PROFILE_ENV_VAR: value}):
+                self.assertEqual(expected, profiling_enabled(), value)
+
+    def test_job_profiler_disabled(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.dict(os.environ, {PROFILE_ENV_VAR: '0'}):
+            self.assertIsNone(job_profiler(tmp))
+            self.assertListEqual([], os.listdir(tmp))
+
+    def test_profiles_written(self):
+        was_tracing = tracemalloc.is_tracing()
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = Profiler(tmp, snapshot_interval=3600)
+            profiler.start()
+            self.assertEqual(30, profiler.run('gui', busy_function, 5))
+
+            for _ in range(2):  # one after another, overlapping profiles are tested in test_overlapping_threads
+                t = threading.Thread(target=profiler.run, args=('tasks', busy_function, 1000))
+                t.start()
+                t.join()
+            profiler.stop()
+            profiler.stop()  # only the first call writes
+
+            files = set(os.listdir(tmp))
+            self.assertSetEqual({'gui.prof', 'gui.txt', 'tasks.prof', 'tasks.txt', 'tracemalloc.txt',
+                                 'tracemalloc.snapshot'}, files)
+            stats = pstats.Stats(os.path.join(tmp, 'tasks.prof'))
+            busy = [v for k, v in stats.stats.items() if k[2] == 'busy_function']
+            self.assertEqual(2, busy[0][1])  # called once in each thread
+            tracemalloc.Snapshot.load(os.path.join(tmp, 'tracemalloc.snapshot'))
+        self.assertEqual(was_tracing, tracemalloc.is_tracing())
+
+    def test_overlapping_threads(self):
+        # python 3.12+ allows one active cProfile per process, the threads overlapping it run unprofiled
+        barrier = threading.Barrier(2, timeout=10)
+        results, errors = [], []
+
+        def task(n):
+            barrier.wait()  # both threads are inside Profiler.run
+            return busy_function(n)
+
+        def run_thread():
+            try:
+                results.append(profiler.run('tasks', task, 5))
+            except Exception as e:
+                errors.append(e)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = Profiler(tmp, snapshot_interval=3600)
+            profiler.start()
+            threads = [threading.Thread(target=run_thread) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            profiler.stop()
+            self.assertListEqual([], errors)
+            self.assertListEqual([30, 30], results)
+            self.assertIn('tasks.prof', os.listdir(tmp))
+
+    def test_profiler_already_active(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = Profiler(tmp, snapshot_interval=3600)
+            error = ValueError('Another profiling tool is already active')
+            with mock.patch('cProfile.Profile.enable', side_effect=error):
+                self.assertEqual(30, profiler.run('tasks', busy_function, 5))
+            self.assertDictEqual({}, profiler._profiles)
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestProfiledScheduler(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_concurrent_task_threads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 5, 'b': 5})
+            job_state, job_meta = load_job(create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets))
+            profiler = Profiler(os.path.join(tmp, 'profile'), snapshot_interval=3600)
+            profiler.start()
+            manager = FakeKwiverManager()
+            scheduler = Scheduler(job_state, job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.2,
+                                  max_concurrent_tasks=2, profiler=profiler)
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin'), image_delay=.2):
+                # the scheduler thread and both task threads are profiled at the same time
+                profiler.run('scheduler', scheduler.run)
+            profiler.stop()
+            for task_key in ['a', 'b']:
+                self.assertEqual(TaskStatus.SUCCESS, job_state.get_status(task_key))
+                self.assertEqual(1, len(job_state.get_task_attempts(task_key)))
+            self.assertIn('scheduler.prof', os.listdir(os.path.join(tmp, 'profile')))
+
+
+if __name__ == '__main__':
+    unittest.main()
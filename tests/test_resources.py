@@ -0,0 +1,95 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase
+
+add_src_to_pythonpath()
+
+from pep_tk.core.resources import proc_available, list_process_tree, sample_process_tree, ResourceUsageSummary, \
+    ResourceSample
+from pep_tk.core.scheduler import monitor_resources
+
+
+class ResourceRecorder:
+    def __init__(self):
+        self.samples = []
+
+    def update_task_resources(self, task_key, sample):
+        self.samples.append((task_key, sample))
+
+
+@unittest.skipUnless(proc_available(), 'resource sampling requires /proc')
+class TestResourceSampling(TestCaseBase):
+    def setUp(self) -> None:
+        super().setUp()
+        # a process tree of bash with two children
+        self.process = subprocess.Popen('sleep 5 & sleep 5; wait', shell=True, executable='/bin/bash')
+
+    def tearDown(self) -> None:
+        self.process.kill()
+        self.process.wait()
+        super().tearDown()
+
+    def test_process_tree(self):
+        for _ in range(50):
+            tree = list_process_tree(self.process.pid)
+            if len(tree) >= 3:
+                break
+            threading.Event().wait(.05)
+        self.assertEqual(self.process.pid, tree[0])
+        self.assertGreaterEqual(len(tree), 3)
+
+        first = sample_process_tree(self.process.pid)
+        second = sample_process_tree(self.process.pid, first)
+        self.assertGreater(second.rss, 0)
+        self.assertGreaterEqual(second.num_processes, 1)
+        self.assertGreaterEqual(second.cpu_percent, 0.)
+
+    def test_exited_process(self):
+        p = subprocess.Popen(['true'])
+        p.wait()
+        self.assertIsNone(sample_process_tree(p.pid))
+
+    def test_monitor_resources(self):
+        summary = ResourceUsageSummary()
+        recorder = ResourceRecorder()
+        stop = threading.Event()
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'resources.csv')
+            t = threading.Thread(target=monitor_resources,
+                                 args=(stop, 'task', recorder, self.process.pid, .1, summary, fp))
+            t.start()
+            stop.wait(.5)
+            stop.set()
+            t.join()
+
+            with open(fp, 'r') as f:
+                lines = f.read().splitlines()
+        self.assertEqual(ResourceSample.csv_header, lines[0])
+        self.assertEqual(summary.sample_count, len(lines) - 1)
+        self.assertEqual(summary.sample_count, len(recorder.samples))
+        self.assertGreater(summary.peak_rss, 0)
+        self.assertGreaterEqual(summary.peak_rss, summary.avg_rss)
+        self.assertEqual(summary.peak_rss, summary.to_dict()['peak_rss'])
+
+
+if __name__ == "__main__":
+    unittest.main()
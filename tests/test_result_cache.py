@@ -0,0 +1,131 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import time
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.result_cache import ResultCache, referenced_files, task_cache_key
+from pep_tk.core.scheduler import Scheduler
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+def write_file(fp, content):
+    with open(fp, 'w') as f:
+        f.write(content)
+
+
+class TestResultCache(TestCaseBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def test_cache_key(self):
+        model_fp = os.path.join(self.tmp, 'model.zip')
+        write_file(model_fp, 'weights')
+        pipe_fp = os.path.join(self.tmp, 'a.pipe')
+        pipe_content = f'process detector\n  :deployed = {model_fp}\n  # comment = {model_fp}\n'
+        write_file(pipe_fp, pipe_content)
+        self.assertListEqual([model_fp], referenced_files(pipe_content))
+
+        dataset = create_synthetic_datasets(os.path.join(self.tmp, 'data'), {'a': 3})[0]
+        key = task_cache_key(pipe_fp, dataset)
+        self.assertEqual(key, task_cache_key(pipe_fp, dataset))
+
+        write_file(model_fp, 'new weights')
+        self.assertNotEqual(key, task_cache_key(pipe_fp, dataset))
+        write_file(model_fp, 'weights')
+        self.assertEqual(key, task_cache_key(pipe_fp, dataset))
+
+        with open(dataset.thermal_image_list, 'a') as f:
+            f.write('extra.tif\n')
+        self.assertNotEqual(key, task_cache_key(pipe_fp, dataset))
+
+    def test_put_fetch(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache'))
+        out_fp = os.path.join(self.tmp, 'out.csv')
+        write_file(out_fp, 'detections')
+        self.assertIsNone(cache.fetch('k', {'OUT': os.path.join(self.tmp, 'x.csv')}))
+
+        cache.put('k', {'OUT': out_fp}, meta={'task': 'a'})
+        dest = os.path.join(self.tmp, 'job', 'out-copy.csv')
+        self.assertListEqual([dest], cache.fetch('k', {'OUT': dest}))
+        with open(dest, 'r') as f:
+            self.assertEqual('detections', f.read())
+        # an output port the entry doesn't have
+        self.assertIsNone(cache.fetch('k', {'OTHER': os.path.join(self.tmp, 'y.csv')}))
+
+    def test_lru_eviction(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache'), max_bytes=25)
+        for key in ['a', 'b']:
+            fp = os.path.join(self.tmp, f'{key}.csv')
+            write_file(fp, '0123456789')
+            cache.put(key, {'OUT': fp})
+            time.sleep(.01)
+        cache.get('a')  # b is now the least recently used
+
+        fp = os.path.join(self.tmp, 'c.csv')
+        write_file(fp, '0123456789')
+        cache.put('c', {'OUT': fp})
+        self.assertSetEqual({'a', 'c'}, set(cache.entries()))
+        self.assertEqual(20, cache.size())
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerResultCache(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_identical_job_hits_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 3})
+            cache = ResultCache(os.path.join(tmp, 'cache'))
+
+            managers = []
+            for name in ['first', 'second']:
+                job_state, job_meta = load_job(create_job(os.path.join(tmp, 'jobs', name), pipeline, datasets))
+                managers.append(FakeKwiverManager())
+                with fake_kwiver_on_path(os.path.join(tmp, 'bin')):
+                    Scheduler(job_state, job_meta, managers[-1], kwiver_setup_path=None, progress_poll_freq=.1,
+                              result_cache=cache).run()
+                self.assertEqual(TaskStatus.SUCCESS, job_state.get_status('a'))
+
+            self.assertIn('fake-kwiver image', managers[0].stdout['a'])
+            self.assertNotIn('fake-kwiver image', managers[1].stdout['a'])
+            self.assertEqual(3, managers[1].task_count['a'])
+            self.assertListEqual(['cache_hit', 'attempt'], [e['event'] for e in job_state.get_task_events('a')])
+
+            outputs = job_state.get_task_outputs('a')
+            self.assertEqual(2, len(outputs))
+            for fp in outputs:
+                self.assertEqual(job_meta.completed_outputs_dir, os.path.dirname(fp))
+            with open([fp for fp in outputs if fp.endswith('.txt')][0], 'r') as f:
+                self.assertEqual(3, len(f.read().splitlines()))
+
+
+if __name__ == "__main__":
+    unittest.main()
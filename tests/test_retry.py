@@ -0,0 +1,113 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.retry import FailureClass, RetryPolicy, classify_failure
+from pep_tk.core.scheduler import Scheduler
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestFailureClassification(TestCaseBase):
+    def test_classify(self):
+        self.assertEqual(FailureClass.CUDA_ERROR,
+                         classify_failure(1, ['loading model\n', 'RuntimeError: CUDA out of memory.\n']))
+        self.assertEqual(FailureClass.OOM_KILLED, classify_failure(1, ["terminate called after throwing an "
+                                                                      "instance of 'std::bad_alloc'"]))
+        self.assertEqual(FailureClass.OOM_KILLED, classify_failure(137, ['processing image 10']))
+        self.assertEqual(FailureClass.OOM_KILLED, classify_failure(-9, []))
+        self.assertEqual(FailureClass.MISSING_FILE, classify_failure(1, ['/data/a.tif: No such file or directory']))
+        self.assertEqual(FailureClass.IO_ERROR, classify_failure(1, ['OSError: [Errno 116] Stale file handle']))
+        self.assertEqual(FailureClass.UNKNOWN, classify_failure(1, ['something went wrong']))
+
+
+class TestRetryPolicy(TestCaseBase):
+    def test_policy(self):
+        policy = RetryPolicy(max_attempts=3, backoff_base=10, backoff_factor=2, backoff_max=15)
+        self.assertTrue(policy.should_retry(FailureClass.CUDA_ERROR, 1))
+        self.assertTrue(policy.should_retry(FailureClass.CUDA_ERROR, 2))
+        self.assertFalse(policy.should_retry(FailureClass.CUDA_ERROR, 3))
+        self.assertFalse(policy.should_retry(FailureClass.MISSING_FILE, 1))
+        self.assertEqual(10, policy.backoff(1))
+        self.assertEqual(15, policy.backoff(2))
+
+    def test_from_dict(self):
+        policy = RetryPolicy.from_dict({'max_attempts': 5, 'retryable': ['unknown']})
+        self.assertEqual(5, policy.max_attempts)
+        self.assertSetEqual({FailureClass.UNKNOWN}, set(policy.retryable))
+        self.assertDictEqual(policy.to_dict(), RetryPolicy.from_dict(policy.to_dict()).to_dict())
+        self.assertSetEqual(set(RetryPolicy.DEFAULT_RETRYABLE), set(RetryPolicy.from_dict(None).retryable))
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerRetry(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.bin_dir = os.path.join(self._tmp.name, 'bin')
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), {'a': 3})
+        job_dir = create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline, datasets)
+        self.job_state, self.job_meta = load_job(job_dir)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def _run(self, fail_message):
+        policy = RetryPolicy(max_attempts=3, backoff_base=.2)
+        with fake_kwiver_on_path(self.bin_dir, fail_after=1, fail_message=fail_message):
+            Scheduler(self.job_state, self.job_meta, FakeKwiverManager(), kwiver_setup_path=None,
+                      progress_poll_freq=.1, retry_policy=policy).run()
+        return self.job_state.get_task_attempts('a')
+
+    def test_retryable_failure(self):
+        attempts = self._run('RuntimeError: CUDA error: an illegal memory access was encountered')
+        self.assertEqual(TaskStatus.ERROR, self.job_state.get_status('a'))
+        self.assertListEqual([1, 2, 3], [a['attempt'] for a in attempts])
+        self.assertTrue(all(a['failure'] == 'cuda_error' for a in attempts))
+        self.assertListEqual([.2, .4], [a['retry_in'] for a in attempts[:2]])
+        self.assertNotIn('retry_in', attempts[2])
+
+    def test_attempts_of_earlier_runs(self):
+        message = 'RuntimeError: CUDA error: an illegal memory access was encountered'
+        self.assertEqual(3, len(self._run(message)))
+        # resuming the job runs the task again, it used up its retries
+        self.job_state, self.job_meta = load_job(self.job_meta.root_dir)
+        attempts = self._run(message)
+        self.assertEqual(TaskStatus.ERROR, self.job_state.get_status('a'))
+        self.assertListEqual([1, 2, 3, 4], [a['attempt'] for a in attempts])
+        self.assertNotIn('retry_in', attempts[3])
+
+    def test_not_retryable_failure(self):
+        attempts = self._run('ERROR: /data/image.tif: No such file or directory')
+        self.assertEqual(TaskStatus.ERROR, self.job_state.get_status('a'))
+        self.assertEqual(1, len(attempts))
+        self.assertEqual('missing_file', attempts[0]['failure'])
+        self.assertEqual(1, attempts[0]['exit_code'])
+
+
+if __name__ == '__main__':
+    unittest.main()
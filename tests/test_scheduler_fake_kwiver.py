@@ -0,0 +1,129 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import time
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.scheduler import Scheduler, SchedulerEventManager
+
+
+class FakeKwiverManager(SchedulerEventManager):
+    def __init__(self, cancel_tasks=()):
+        super().__init__()
+        self.cancel_tasks = cancel_tasks
+        self.stdout = {}
+
+    def _initialize_task(self, task_key, count, max_count, status):
+        pass
+
+    def _start_task(self, task_key):
+        pass
+
+    def _end_task(self, task_key, status):
+        pass
+
+    def _update_task_progress(self, task_key, current_count, max_count):
+        pass
+
+    def _update_task_stdout(self, task_key, line):
+        self.stdout[task_key] = self.stdout.get(task_key, '') + line
+
+    def _update_task_stderr(self, task_key, line):
+        pass
+
+    def _check_cancelled(self, task_key):
+        return task_key in self.cancel_tasks and 'fake-kwiver image' in self.stdout.get(task_key, '')
+
+    def _update_task_output_files(self, task_key, output_files):
+        pass
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerFakeKwiver(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.bin_dir = os.path.join(self._tmp.name, 'bin')
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), {'a': 5, 'b': 5})
+        job_dir = create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline, datasets)
+        self.job_state, self.job_meta = load_job(job_dir)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def _run(self, manager, **scheduler_kwargs):
+        Scheduler(self.job_state, self.job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.2,
+                  **scheduler_kwargs).run()
+
+    def test_success(self):
+        manager = FakeKwiverManager()
+        with fake_kwiver_on_path(self.bin_dir):
+            self._run(manager, max_concurrent_tasks=2)
+        for task_key in ['a', 'b']:
+            self.assertEqual(TaskStatus.SUCCESS, self.job_state.get_status(task_key))
+            self.assertEqual(5, manager.task_count[task_key])
+            outputs = self.job_state.get_task_outputs(task_key)
+            self.assertEqual(2, len(outputs))
+            for fp in outputs:
+                self.assertEqual(self.job_meta.completed_outputs_dir, os.path.dirname(fp))
+
+    def test_failure(self):
+        manager = FakeKwiverManager()
+        with fake_kwiver_on_path(self.bin_dir, fail_after=2):
+            self._run(manager)
+        for task_key in ['a', 'b']:
+            self.assertEqual(TaskStatus.ERROR, self.job_state.get_status(task_key))
+            self.assertEqual(2, manager.task_count[task_key])
+        self.assertEqual(4, len(os.listdir(self.job_meta.error_outputs_dir)))
+
+    def test_cancel_hung_task(self):
+        manager = FakeKwiverManager(cancel_tasks=['a', 'b'])
+        start = time.time()
+        with fake_kwiver_on_path(self.bin_dir, hang_after=1):
+            self._run(manager, max_concurrent_tasks=1)
+        # the hung kwiver process is killed on cancel instead of waiting for it to exit
+        self.assertLess(time.time() - start, 20)
+        for task_key in ['a', 'b']:
+            self.assertEqual(TaskStatus.CANCELLED, self.job_state.get_status(task_key))
+
+    def test_stalled_task_retried(self):
+        manager = FakeKwiverManager()
+        with fake_kwiver_on_path(self.bin_dir, hang_after=1):
+            self._run(manager, max_concurrent_tasks=2, stall_timeout=1, stall_retries=1)
+        for task_key in ['a', 'b']:
+            self.assertEqual(TaskStatus.ERROR, self.job_state.get_status(task_key))
+            events = [e for e in self.job_state.get_task_events(task_key) if e['event'] == 'stalled']
+            self.assertListEqual(['retry', 'error'], [e['action'] for e in events])
+            self.assertTrue(all(e['idle_seconds'] > 1 for e in events))
+            attempts = self.job_state.get_task_attempts(task_key)
+            self.assertListEqual(['stalled', 'stalled'], [a['failure'] for a in attempts])
+        with open(os.path.join(self.job_meta.logs_dir, 'watchdog.log'), 'r') as f:
+            self.assertEqual(4, len(f.read().splitlines()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import re
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.kwiver.runner import get_kwiver_runner_command
+from pep_tk.core.scheduler import Scheduler, SchedulerEventManager
+from pep_tk.core.slots import SlotPool, acquire_slots, release_slots, cpuset_slots, slot_pools_from_config, \
+    slot_env_name
+
+
+class SlotRecordingManager(SchedulerEventManager):
+    """ Records the task stdout and the number of tasks running at once """
+    def __init__(self):
+        super().__init__()
+        self.stdout = {}
+        self.running = 0
+        self.max_running = 0
+
+    def _initialize_task(self, task_key, count, max_count, status):
+        pass
+
+    def _start_task(self, task_key):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+
+    def _end_task(self, task_key, status):
+        self.running -= 1
+
+    def _update_task_progress(self, task_key, current_count, max_count):
+        pass
+
+    def _update_task_stdout(self, task_key, line):
+        self.stdout[task_key] = self.stdout.get(task_key, '') + line
+
+    def _update_task_stderr(self, task_key, line):
+        pass
+
+    def _check_cancelled(self, task_key):
+        return False
+
+    def _update_task_output_files(self, task_key, output_files):
+        pass
+
+
+class TestSlotPools(TestCaseBase):
+    def test_acquire_release(self):
+        pool = SlotPool('devices', [0, 1], env_vars=['CUDA_VISIBLE_DEVICES'])
+        self.assertEqual('0', pool.acquire('a'))
+        self.assertEqual('0', pool.acquire('a'))  # already assigned
+        self.assertEqual('1', pool.acquire('b'))
+        self.assertIsNone(pool.acquire('c'))
+        pool.release('a')
+        self.assertEqual('0', pool.acquire('c'))
+        self.assertDictEqual({'PEP_TK_SLOT_DEVICES': '1', 'CUDA_VISIBLE_DEVICES': '1'}, pool.environment('1'))
+
+    def test_acquire_all_or_nothing(self):
+        devices = SlotPool('devices', [0, 1])
+        cpus = SlotPool('cpus', cpuset_slots(8, 8), cpuset=True)
+        pools = [devices, cpus]
+
+        a = acquire_slots(pools, 'a')
+        self.assertDictEqual({'devices': '0', 'cpus': '0-7'}, a.slots)
+        self.assertEqual('0-7', a.cpu_affinity())
+        # no free cpu set, the device must not stay reserved
+        self.assertIsNone(acquire_slots(pools, 'b'))
+        self.assertListEqual(['1'], devices.free_slots())
+
+        release_slots(pools, 'a')
+        self.assertIsNotNone(acquire_slots(pools, 'b'))
+
+    def test_from_config(self):
+        pools = slot_pools_from_config({'devices': {'slots': [0, 1], 'env': ['CUDA_VISIBLE_DEVICES']},
+                                        'cpus': {'slots': ['0-3', '4-7'], 'cpuset': True},
+                                        'license seats': ['x']})
+        self.assertListEqual(['devices', 'cpus', 'license seats'], [p.name for p in pools])
+        self.assertTrue(pools[1].cpuset)
+        self.assertEqual('PEP_TK_SLOT_LICENSE_SEATS', slot_env_name(pools[2].name))
+        self.assertListEqual(['0-3', '4-7'], cpuset_slots(9, 4))
+        with self.assertRaises(ValueError):
+            slot_pools_from_config({'devices': []})
+        with self.assertRaises(ValueError):
+            slot_pools_from_config({'devices': {'env': ['CUDA_VISIBLE_DEVICES']}})
+
+    @unittest.skipIf(os.name == 'nt', 'taskset is linux only')
+    def test_runner_command_affinity(self):
+        cmd = get_kwiver_runner_command(kwiver_setup_path='setup_viame.sh', cpu_affinity='0-3')
+        self.assertEqual('source setup_viame.sh && printenv && taskset -c 0-3 kwiver runner', ' '.join(cmd))
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerSlots(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+        datasets = create_synthetic_datasets(os.path.join(self._tmp.name, 'data'), {'a': 3, 'b': 3, 'c': 3, 'd': 3})
+        job_dir = create_job(os.path.join(self._tmp.name, 'jobs', 'job'), pipeline, datasets)
+        self.job_state, self.job_meta = load_job(job_dir)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def test_tasks_receive_slots(self):
+        pools = [SlotPool('devices', [0, 1], env_vars=['CUDA_VISIBLE_DEVICES'])]
+        manager = SlotRecordingManager()
+        with fake_kwiver_on_path(os.path.join(self._tmp.name, 'bin'), image_delay=.1):
+            Scheduler(self.job_state, self.job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.2,
+                      max_concurrent_tasks=4, slot_pools=pools).run()
+
+        self.assertListEqual(self.job_state.tasks(), self.job_state.tasks(status=TaskStatus.SUCCESS))
+        # two device slots, only two tasks at once even though four are allowed
+        self.assertLessEqual(manager.max_running, 2)
+        for task_key in self.job_state.tasks():
+            devices = re.findall(r'slot PEP_TK_SLOT_DEVICES=(\d)', manager.stdout[task_key])
+            self.assertEqual(1, len(devices))
+            self.assertIn(devices[0], ['0', '1'])
+        self.assertListEqual(['0', '1'], pools[0].free_slots())
+
+    @unittest.skipUnless(hasattr(os, 'sched_getaffinity') and 0 in os.sched_getaffinity(0), 'requires cpu 0')
+    def test_cpu_affinity(self):
+        pools = [SlotPool('cpus', ['0'], cpuset=True)]
+        manager = SlotRecordingManager()
+        with fake_kwiver_on_path(os.path.join(self._tmp.name, 'bin')):
+            Scheduler(self.job_state, self.job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.2,
+                      max_concurrent_tasks=2, slot_pools=pools).run()
+        for task_key in self.job_state.tasks():
+            self.assertIn('cpu affinity 0\n', manager.stdout[task_key])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.checkpoint import read_list_lines
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job, TaskStatus
+from pep_tk.core.scheduler import Scheduler
+from pep_tk.core.staging import ImageStager, restore_detection_images, restore_image_list, write_staged_pipeline
+from test_checkpoint import write_lines
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+def create_images(datasets, size=10):
+    for dataset in datasets:
+        for fp in read_list_lines(dataset.thermal_image_list):
+            with open(fp, 'wb') as f:
+                f.write(b'x' * size)
+
+
+class TestImageStager(TestCaseBase):
+    def test_stage_and_release(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dataset = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 5})[0]
+            create_images([dataset])
+            images = read_list_lines(dataset.thermal_image_list)
+            # only 3 of the 5 images fit the space budget
+            stager = ImageStager(os.path.join(tmp, 'scratch'), max_bytes=35, max_workers=2)
+            stager.stage('a', [dataset.thermal_image_list, None])
+            stager._tasks['a'].done.wait(10)
+            staged = stager.staged_images('a')
+            self.assertEqual(3, len(staged))
+            for image, local in staged.items():
+                self.assertIn(image, images)
+                self.assertEqual(os.path.basename(image), os.path.basename(local))
+                self.assertIsFile(local)
+
+            pipe_fp = os.path.join(tmp, 'a.pipe')
+            with open(pipe_fp, 'w') as f:
+                f.write(f'process input\n  :video_filename {dataset.thermal_image_list}\n')
+            staged_fp = write_staged_pipeline(pipe_fp, [dataset.thermal_image_list], staged,
+                                              os.path.join(tmp, 'staged'))
+            with open(staged_fp, 'r') as f:
+                self.assertNotIn(dataset.thermal_image_list, f.read())
+            staged_list = read_list_lines(os.path.join(tmp, 'staged', 'staged-a_ir_images.txt'))
+            self.assertEqual(3, len(set(staged_list) & set(staged.values())))
+            self.assertEqual(5, len(staged_list))
+
+            # kwiver writes the paths it read to its output image list
+            restore_image_list(os.path.join(tmp, 'staged', 'staged-a_ir_images.txt'), staged)
+            self.assertListEqual(images, read_list_lines(os.path.join(tmp, 'staged', 'staged-a_ir_images.txt')))
+            # and to the image column of its detection csvs
+            csv_fp = os.path.join(tmp, 'detections.csv')
+            write_lines(csv_fp, ['# 1: Detection or Track-id,2: Video or Image Identifier'] +
+                        [f'{i},{fp},{i},1,1,2,2,0.9,-1,seal,0.9' for i, fp in enumerate(staged_list)])
+            restore_detection_images(csv_fp, staged)
+            rows = read_list_lines(csv_fp)
+            self.assertEqual('# 1: Detection or Track-id,2: Video or Image Identifier', rows[0])
+            self.assertListEqual(images, [row.split(',')[1] for row in rows[1:]])
+
+            stager.release('a')
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'scratch', 'a')))
+            self.assertEqual(0, stager._used_bytes)
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerStaging(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_next_task_staged(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 5, 'b': 5})
+            create_images(datasets)
+            job_state, job_meta = load_job(create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets))
+            scratch_dir = os.path.join(tmp, 'scratch')
+            manager = FakeKwiverManager()
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin'), image_delay=.1):
+                Scheduler(job_state, job_meta, manager, kwiver_setup_path=None, progress_poll_freq=.1,
+                          stager=ImageStager(scratch_dir)).run()
+            self.assertListEqual(['a', 'b'], job_state.tasks(status=TaskStatus.SUCCESS))
+
+            # b was staged while a ran, a was the first task and read the original images
+            self.assertNotIn('staged in', manager.stdout['a'])
+            self.assertIn(f'Reading 5 images staged in {scratch_dir}', manager.stdout['b'])
+            staged_list = read_list_lines(os.path.join(job_meta.compiled_pipelines_dir, 'staged',
+                                                       'staged-b_ir_images.txt'))
+            self.assertTrue(all(fp.startswith(scratch_dir) for fp in staged_list))
+
+            # the output image list names the original images and the staged copies are deleted
+            image_list = [fp for fp in job_state.get_task_outputs('b') if fp.endswith('.txt')][0]
+            self.assertListEqual(read_list_lines(datasets[1].thermal_image_list), read_list_lines(image_list))
+            # so does the image column of the detection csv
+            detections = [fp for fp in job_state.get_task_outputs('b') if fp.endswith('.csv')][0]
+            rows = [row.split(',') for row in read_list_lines(detections) if not row.startswith('#')]
+            self.assertListEqual(read_list_lines(datasets[1].thermal_image_list), [row[1] for row in rows])
+            self.assertListEqual([], os.listdir(scratch_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
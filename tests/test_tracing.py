@@ -0,0 +1,87 @@
+#      This file is part of the PEP GUI detection pipeline batch running tool
+#      Copyright (C) 2021 Yuval Boss yuval@uw.edu
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import glob
+import json
+import os
+import tempfile
+import unittest
+
+from util import add_src_to_pythonpath, TestCaseBase, CONF_FILEPATH, create_synthetic_datasets, fake_kwiver_on_path
+
+add_src_to_pythonpath()
+
+from pep_tk.core.configuration import PipelineManifest
+from pep_tk.core.job import create_job, load_job
+from pep_tk.core.scheduler import Scheduler
+from pep_tk.core.tracing import TraceRecorder, task_track
+from test_scheduler_fake_kwiver import FakeKwiverManager
+
+
+class TestTraceRecorder(TestCaseBase):
+    def test_events(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'logs', 'trace.json')
+            tracer = TraceRecorder(fp)
+            tracer.span('env build', 'task a', 10., 10.5, foo=1)
+            tracer.span('first image', 'task a', 10., None)  # unknown end is ignored
+            tracer.instant('cancelled', 'task b', 11.)
+            with tracer.timed('output move', 'task a'):
+                pass
+            tracer.save()
+            with open(fp, 'r') as f:
+                trace = json.load(f)
+
+        events = trace['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertListEqual(['env build', 'output move'], [e['name'] for e in spans])
+        self.assertEqual(10 * 1e6, spans[0]['ts'])
+        self.assertEqual(.5 * 1e6, spans[0]['dur'])
+        self.assertDictEqual({'foo': 1}, spans[0]['args'])
+
+        track_names = {e['tid']: e['args']['name'] for e in events if e['name'] == 'thread_name'}
+        self.assertEqual('task a', track_names[spans[0]['tid']])
+        self.assertEqual(2, len(track_names))
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake kwiver runner requires bash')
+class TestSchedulerTrace(TestCaseBase):
+    pm_filepath = os.path.join(CONF_FILEPATH, 'pipeline_manifest.yaml')
+
+    def test_task_phases(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = PipelineManifest(manifest_file=self.pm_filepath)['ir_hotspot_detector']
+            datasets = create_synthetic_datasets(os.path.join(tmp, 'data'), {'a': 5, 'b': 5})
+            job_state, job_meta = load_job(create_job(os.path.join(tmp, 'jobs', 'job'), pipeline, datasets))
+            with fake_kwiver_on_path(os.path.join(tmp, 'bin'), image_delay=.1):
+                Scheduler(job_state, job_meta, FakeKwiverManager(), kwiver_setup_path=None,
+                          progress_poll_freq=.1, max_concurrent_tasks=2).run()
+
+            traces = glob.glob(os.path.join(job_meta.logs_dir, 'trace-*.json'))
+            self.assertEqual(1, len(traces))
+            with open(traces[0], 'r') as f:
+                events = json.load(f)['traceEvents']
+
+        tracks = {e['args']['name']: e['tid'] for e in events if e['name'] == 'thread_name'}
+        for task_key in ['a', 'b']:
+            tid = tracks[task_track(task_key)]
+            names = {e['name'] for e in events if e['ph'] == 'X' and e['tid'] == tid}
+            self.assertSetEqual({'task', 'env build', 'process spawn', 'first output line', 'first image',
+                                 'last image', 'process exit', 'output move', 'post filter', 'state save'}, names)
+        self.assertIn('scheduler', tracks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,6 +20,9 @@ import shutil
 import tarfile
 import unittest
 import configparser
+import contextlib
+import stat
+import sys
 import requests
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s][%(name)s] - %(message)s', level=logging.DEBUG)
@@ -32,6 +35,8 @@ global_logger.debug('TEST_DIR %s' % TEST_DIR)
 global_logger.debug('DATA_FILEPATH %s' % TESTDATA_DIR)
 global_logger.debug('CONF_FILEPATH %s' % CONF_FILEPATH)
 
+FAKE_KWIVER_FP = os.path.join(TEST_DIR, 'fake_kwiver.py')
+
 test_config = os.path.join(TEST_DIR, 'config.ini')
 config = configparser.ConfigParser()
 config.read(test_config)
@@ -98,6 +103,59 @@ def download_dummy_data():
     global_logger.debug(os.listdir(TESTDATA_DIR))
 
 
+def create_synthetic_datasets(directory, image_counts, image_dir=None):
+    """
+    Create datasets with thermal image lists that don't require the downloaded test data.  The images themselves
+    are not created.
+
+    :param directory: directory to write the image lists to
+    :param image_counts: dictionary of dataset name to the number of images in the dataset
+    :param image_dir: directory the image list entries point to, defaults to directory
+    :return: list of VIAMEDataset
+    """
+    from pep_tk.core.parser import VIAMEDataset
+    image_dir = image_dir or directory
+    os.makedirs(directory, exist_ok=True)
+    datasets = []
+    for name, count in image_counts.items():
+        list_fp = os.path.join(directory, f'{name}_ir_images.txt')
+        with open(list_fp, 'w') as f:
+            for i in range(count):
+                f.write(os.path.join(image_dir, f'{name}_{i:06d}_ir.tif') + '\n')
+        datasets.append(VIAMEDataset(name=name, thermal_image_list=list_fp, color_image_list=None,
+                                     transformation_file=None))
+    return datasets
+
+
+@contextlib.contextmanager
+def fake_kwiver_on_path(bin_dir, **options):
+    """
+    Put a fake `kwiver` executable (tests/fake_kwiver.py) first on the PATH so the scheduler can run pipelines
+    without a VIAME install.  Only supported on linux/mac since the scheduler runs kwiver through bash.
+
+    :param bin_dir: directory to create the kwiver executable in
+    :param options: fake kwiver options, e.g. image_delay=0.1 sets FAKE_KWIVER_IMAGE_DELAY=0.1
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    kwiver_fp = os.path.join(bin_dir, 'kwiver')
+    with open(kwiver_fp, 'w') as f:
+        f.write(f'#!/bin/bash\nexec "{sys.executable}" "{FAKE_KWIVER_FP}" "$@"\n')
+    os.chmod(kwiver_fp, os.stat(kwiver_fp).st_mode | stat.S_IEXEC)
+
+    env = {'PATH': bin_dir + os.pathsep + os.environ.get('PATH', '')}
+    env.update({f'FAKE_KWIVER_{k.upper()}': str(v) for k, v in options.items()})
+    previous = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        yield kwiver_fp
+    finally:
+        for k, v in previous.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
 class TestCaseBase(unittest.TestCase):
     log = None
 